@@ -0,0 +1,64 @@
+"""
+Import Time Benchmark
+
+Measures how long it takes a fresh interpreter to import the segmentation
+packages.  Every sample runs in its own process so nothing is cached in
+sys.modules, the reported time excludes interpreter start up.
+
+python benchmarks/import_time.py
+python benchmarks/import_time.py --repeat 20 segmentation_server.server
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+DEFAULT_MODULES = [
+    'segmentation_grpc',
+    'segmentation_grpc.codecs',
+    'segmentation_grpc.segmentation_pb2_grpc',
+    'segmentation_server',
+    'segmentation_server.scheduling',
+    'segmentation_server.server',
+]
+
+_TIMER = ("import time; start = time.perf_counter(); import {module}; "
+          "print(time.perf_counter() - start)")
+
+
+def time_import(module: str) -> float:
+    """
+    Import a module in a new interpreter.
+
+    Args:
+        module: Dotted name of the module to import
+
+    Returns:
+        Seconds spent importing the module
+    """
+    output = subprocess.check_output([sys.executable, '-c', _TIMER.format(module=module)], text=True)
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold import time of the segmentation packages.')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES,
+                        help='Modules to import (default: the client and server packages)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Number of fresh interpreters per module (default: 10)')
+    args = parser.parse_args()
+
+    print(f"{'module':<45} {'median ms':>10} {'min ms':>10}")
+    for module in args.modules:
+        try:
+            samples = [time_import(module) * 1000 for _ in range(args.repeat)]
+        except subprocess.CalledProcessError:
+            print(f"{module:<45} {'import failed':>21}")
+            continue
+
+        print(f"{module:<45} {statistics.median(samples):>10.1f} {min(samples):>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+"""
+Stage Benchmarks
+
+Times each stage of a SegmentImage request on its own, so a slowdown in one
+stage shows up even when end to end latency hides it among the others.  The
+model is the stub backend, the stages around it run the production code on
+synthetic images resembling electron micrographs: bright cytoplasm with dark
+membranes between cells, vesicles and noise.  The masks are cells of these
+images, so their outlines are as irregular as those of real segments.
+
+Each stage is timed per image size, results report the median and minimum
+time per call.  A run can be saved and later runs compared against it, the
+comparison lists every stage whose median slowed down by more than the
+threshold and exits with status 1 if any did.  Save the baseline on the
+machine the comparisons will run on, timings of different machines do not
+compare.
+
+python benchmarks/stages.py run --output baseline.json
+python benchmarks/stages.py run --sizes 1024 --filter polygons
+python benchmarks/stages.py compare baseline.json
+python benchmarks/stages.py compare baseline.json current.json --threshold 0.1
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+from PIL import Image
+
+from segmentation_grpc import (SegmentationResponse, LabeledImageFormat, LabeledImageType,
+                               SegmentationRequest)
+from segmentation_grpc.codecs import (encode_mask_logits, decode_mask_logits, encode_raw_labeled_image,
+                                     decode_raw_labeled_image, encode_packed_polygons, decode_packed_polygons,
+                                     encode_polygons)
+from segmentation_grpc.mask_decoding import upscale_logits
+from segmentation_server.backends import create_backend
+from segmentation_server.segmentation_service import SegmentationModel
+from segmentation_server.server import SegmentationServicer
+
+DEFAULT_SIZES = [512, 1024, 2048]
+
+# Number of cells of each synthetic image used as segments, and as annotations for create_labeled_image
+NUM_SEGMENTS = 3
+NUM_ANNOTATIONS = 24
+
+# Benchmarks are named "<stage>[<size>]"
+_NAME = re.compile(r'^(?P<stage>.+)\[(?P<size>\d+)\]$')
+
+
+def synthetic_em_image(size: int, seed: int = 0) -> NDArray[np.uint8]:
+    """
+    Create a grayscale image resembling a section of tissue in an electron micrograph.
+
+    Args:
+        size: Width and height of the image
+        seed: Seed of the random generator, equal seeds give equal images
+
+    Returns:
+        A (size, size) uint8 image
+    """
+    rng = np.random.default_rng(seed)
+
+    # Cell membranes are dark lines along the level sets of a smooth random field
+    field = cv2.GaussianBlur(rng.standard_normal((size, size)).astype(np.float32), (0, 0), size / 48)
+    field /= field.std()
+    membranes = np.abs(np.sin(field * 4)) < 0.12
+
+    # Cytoplasm has fine texture, vesicles are small dark discs
+    texture = cv2.GaussianBlur(rng.standard_normal((size, size)).astype(np.float32), (0, 0), 2)
+    image = 175 + 40 * texture
+    image[membranes] = 60
+    for x, y in rng.integers(0, size, (size * size // 4096, 2)):
+        cv2.circle(image, (int(x), int(y)), int(rng.integers(3, 7)), 95, -1)
+
+    image += rng.normal(0, 10, image.shape).astype(np.float32)
+    return np.clip(cv2.GaussianBlur(image, (0, 0), 0.8), 0, 255).astype(np.uint8)
+
+
+def cell_masks(image: NDArray[np.uint8], count: int) -> List[NDArray[np.bool_]]:
+    """Return the masks of the largest cells of a synthetic image, largest first."""
+    _, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=4)
+
+    largest = np.argsort(-stats[1:, cv2.CC_STAT_AREA])[:count] + 1
+    return [labels == label for label in largest[:num_labels - 1]]
+
+
+def mask_logits(mask: NDArray[np.bool_]) -> NDArray[np.float32]:
+    """Return smooth 256x256 low resolution logits of a mask, as a model would predict them."""
+    small = cv2.resize(mask.astype(np.float32), (256, 256), interpolation=cv2.INTER_AREA)
+    return cv2.GaussianBlur((small - 0.5) * 16, (0, 0), 1.0)
+
+
+def build_benchmarks(size: int) -> Dict[str, Callable[[], object]]:
+    """
+    Prepare the inputs of every stage for one image size.
+
+    Args:
+        size: Width and height of the synthetic image
+
+    Returns:
+        Stage names mapped to functions running the stage once
+    """
+    image = synthetic_em_image(size)
+    png = cv2.imencode('.png', image)[1].tobytes()
+    raw = image.tobytes()
+    rgb = SegmentationModel.decode_image(image)
+
+    masks = cell_masks(image, NUM_ANNOTATIONS)
+    segment_masks = np.stack(masks[:NUM_SEGMENTS])
+    logits = np.stack([mask_logits(mask) for mask in segment_masks])
+    scores = np.linspace(0.9, 0.7, len(segment_masks)).astype(np.float32)
+    annotations = [{'segmentation': mask, 'area': int(mask.sum())} for mask in masks]
+
+    # A prompt on each cell, as an annotator would click
+    coordinates = []
+    for mask in segment_masks:
+        ys, xs = np.nonzero(mask)
+        coordinates.append((int(xs[len(xs) // 2]), int(ys[len(ys) // 2])))
+    point_coords = np.array([coordinates[:1]], dtype=np.float32)
+    point_labels = np.ones((1, 1), dtype=np.int32)
+
+    backend = create_backend('stub')
+    embedding = backend.encode_image(rgb)
+    model = SegmentationModel(backend='stub')
+    model.predict_masks(png, size, size, coordinates[:1], [1], image_key='benchmark')
+
+    # The outputs of post-processing, as the server sends them
+    labeled_image, segments = model.complete_segments(segment_masks, scores, logits, size, size,
+                                                      return_low_res_logits=True)
+    polygons = [SegmentationModel.mask_to_polygons(mask) for mask in segment_masks]
+    png_request = SegmentationRequest(labeled_image_format=LabeledImageFormat.LABELED_IMAGE_PNG,
+                                      labeled_image_type=LabeledImageType.LABELED_IMAGE_UINT16)
+    raw_request = SegmentationRequest(labeled_image_format=LabeledImageFormat.LABELED_IMAGE_RAW,
+                                      labeled_image_type=LabeledImageType.LABELED_IMAGE_UINT16)
+
+    def build_response() -> SegmentationResponse:
+        labeled_png, image_type = SegmentationServicer._encode_labeled_image(labeled_image, png_request)
+        response = SegmentationResponse(labeled_image=labeled_png, width=size, height=size,
+                                        labeled_image_format=LabeledImageFormat.LABELED_IMAGE_PNG,
+                                        labeled_image_type=image_type)
+        response.segments.extend(SegmentationServicer._segment_result(segment, polygons=segment_polygons)
+                                 for segment, segment_polygons in zip(segments, polygons))
+        return response
+
+    response = build_response()
+    response_bytes = response.SerializeToString()
+    labeled_png = response.labeled_image
+    labeled_raw = encode_raw_labeled_image(labeled_image, LabeledImageType.LABELED_IMAGE_UINT16)
+    packed = [encode_packed_polygons(segment_polygons) for segment_polygons in polygons]
+
+    def decode_segments():
+        # What a client does with each segment of a response
+        for segment in response.segments:
+            np.array(Image.open(io.BytesIO(segment.mask)), dtype=np.uint8)
+            [np.array([(point.x, point.y) for point in polygon.points]) for polygon in segment.polygons]
+            decode_mask_logits(segment.low_res_logits)
+
+    return {
+        'decode_png': lambda: SegmentationModel.decode_image(png),
+        'decode_raw': lambda: SegmentationModel.decode_image(np.frombuffer(raw, dtype=np.uint8).reshape(size, size)),
+        'set_image': lambda: backend.encode_image(rgb),
+        'predict': lambda: backend.decode(embedding, point_coords, point_labels, None, None, True),
+        'predict_masks_cached': lambda: model.predict_masks(png, size, size, coordinates[:1], [1],
+                                                            image_key='benchmark'),
+        'encode_mask_png': lambda: cv2.imencode('.png', segment_masks[0].astype(np.uint8) * 255),
+        'encode_mask_logits': lambda: encode_mask_logits(logits[0]),
+        'encode_labeled_png': lambda: SegmentationServicer._encode_labeled_image(labeled_image, png_request),
+        'encode_labeled_raw': lambda: SegmentationServicer._encode_labeled_image(labeled_image, raw_request),
+        'encode_polygons': lambda: [encode_polygons(segment_polygons) for segment_polygons in polygons],
+        'encode_packed_polygons': lambda: [encode_packed_polygons(segment_polygons) for segment_polygons in polygons],
+        'mask_to_polygons': lambda: [SegmentationModel.mask_to_polygons(mask) for mask in segment_masks],
+        'logits_to_polygons': lambda: [SegmentationModel.logits_to_polygons(segment_logits, size, size)
+                                       for segment_logits in logits],
+        'create_labeled_image': lambda: SegmentationModel.create_labeled_image(annotations),
+        'complete_segments': lambda: model.complete_segments(segment_masks, scores, logits, size, size),
+        'response_build': build_response,
+        'response_serialize': response.SerializeToString,
+        'response_parse': lambda: SegmentationResponse.FromString(response_bytes),
+        'client_decode_labeled_png': lambda: cv2.imdecode(np.frombuffer(labeled_png, np.uint8), cv2.IMREAD_UNCHANGED),
+        'client_decode_labeled_raw': lambda: decode_raw_labeled_image(labeled_raw, size, size,
+                                                                      LabeledImageType.LABELED_IMAGE_UINT16),
+        'client_decode_segments': decode_segments,
+        'client_decode_packed_polygons': lambda: [decode_packed_polygons(message) for message in packed],
+        'client_upscale_logits': lambda: upscale_logits(logits[0], size, size),
+    }
+
+
+def measure(fn: Callable[[], object], repeat: int, min_sample_seconds: float = 0.02) -> Dict[str, float]:
+    """
+    Time a function.
+
+    Each sample calls the function enough times to last at least
+    min_sample_seconds, so fast stages are not dominated by timer resolution.
+
+    Args:
+        fn: The function to time
+        repeat: Number of samples
+        min_sample_seconds: Minimum duration of a sample
+
+    Returns:
+        A dictionary with the 'median_ms' and 'min_ms' per call and the 'calls' per sample
+    """
+    fn()
+
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_sample_seconds:
+            break
+        calls *= max(2, min(10, int(min_sample_seconds / max(elapsed, 1e-9)) + 1))
+
+    samples = [elapsed / calls]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        samples.append((time.perf_counter() - start) / calls)
+
+    return {'median_ms': statistics.median(samples) * 1000, 'min_ms': min(samples) * 1000, 'calls': calls}
+
+
+def machine_info() -> Dict[str, object]:
+    """Describe the machine a run was made on, comparisons warn if it differs."""
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+    }
+
+
+def run(sizes: List[int], repeat: int, pattern: Optional[str] = None, report=print) -> Dict[str, object]:
+    """
+    Run the benchmarks.
+
+    Args:
+        sizes: Image sizes to run every stage at
+        repeat: Number of samples of each benchmark
+        pattern: Optional regular expression, only benchmarks whose name it matches are run
+        report: Called with a line of text as each benchmark finishes
+
+    Returns:
+        The results, as saved by the run command
+    """
+    results = {}
+    report(f"{'benchmark':<40} {'median ms':>11} {'min ms':>11}")
+    for size in sizes:
+        for stage, fn in build_benchmarks(size).items():
+            name = f'{stage}[{size}]'
+            if pattern is not None and not re.search(pattern, name):
+                continue
+
+            results[name] = measure(fn, repeat)
+            report(f"{name:<40} {results[name]['median_ms']:>11.3f} {results[name]['min_ms']:>11.3f}")
+
+    return {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(baseline: Dict[str, object], current: Dict[str, object], threshold: float,
+            report=print) -> List[str]:
+    """
+    Compare two runs and report the change of every benchmark they share.
+
+    Args:
+        baseline: Results of the reference run
+        current: Results of the run to check
+        threshold: Relative slowdown of the median beyond which a benchmark regressed, 0.2 for 20%
+        report: Called with each line of the report
+
+    Returns:
+        The names of the benchmarks that regressed
+    """
+    if baseline.get('machine') != current.get('machine'):
+        report("Warning: the runs were made on different machines or software versions, "
+               "their timings may not compare")
+
+    regressions = []
+    report(f"{'benchmark':<40} {'baseline ms':>12} {'current ms':>12} {'change':>9}")
+    for name, result in current['results'].items():
+        reference = baseline['results'].get(name)
+        if reference is None:
+            report(f"{name:<40} {'':>12} {result['median_ms']:>12.3f} {'new':>9}")
+            continue
+
+        change = result['median_ms'] / reference['median_ms'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = '  improved'
+        report(f"{name:<40} {reference['median_ms']:>12.3f} {result['median_ms']:>12.3f} {change:>+9.1%}{flag}")
+
+    missing = sorted(set(baseline['results']) - set(current['results']))
+    if missing:
+        report(f"Not run: {', '.join(missing)}")
+
+    report(f"{len(regressions)} of {len(current['results'])} benchmarks regressed by more than {threshold:.0%}")
+    return regressions
+
+
+def _baseline_sizes(baseline: Dict[str, object]) -> List[int]:
+    """Return the image sizes of the benchmarks of a run."""
+    return sorted({int(_NAME.match(name).group('size')) for name in baseline['results'] if _NAME.match(name)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time each stage of a segmentation request.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                            help=f"Image sizes (default: {' '.join(map(str, DEFAULT_SIZES))})")
+    run_parser.add_argument('--repeat', type=int, default=7, help='Samples of each benchmark (default: 7)')
+    run_parser.add_argument('--filter', default=None, metavar='REGEX',
+                            help='Only run the benchmarks whose name matches, such as "polygons" or "\\[1024\\]"')
+    run_parser.add_argument('--output', default=None, metavar='PATH', help='Save the results to this JSON file')
+
+    compare_parser = commands.add_parser('compare', help='Report regressions against a saved baseline')
+    compare_parser.add_argument('baseline', help='Results saved by the run command')
+    compare_parser.add_argument('current', nargs='?', default=None,
+                                help='Results to check, by default the baseline\'s benchmarks are run now')
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help='Relative slowdown counted as a regression (default: 0.2)')
+    compare_parser.add_argument('--repeat', type=int, default=7, help='Samples of each benchmark (default: 7)')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run(args.sizes, args.repeat, args.filter)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"Saved {len(results['results'])} results to {args.output}")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    if args.current is not None:
+        with open(args.current) as f:
+            current = json.load(f)
+    else:
+        names = '|'.join(re.escape(name) for name in baseline['results'])
+        current = run(_baseline_sizes(baseline), args.repeat, f'^({names})$', report=lambda line: None)
+
+    return 1 if compare(baseline, current, args.threshold) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
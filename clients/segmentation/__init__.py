@@ -6,10 +6,20 @@ It includes a client example and utilities for testing the service.
 """
 
 # Import the client functions for easy access
-from SegmentationClient.client_example import segment_image, show_labeled_image, colorize_labels
+from SegmentationClient.client_example import segment_image, segment_image_progressive, segment_shared_image, prefetch_image, get_image_embedding, segment_image_groups, propagate_stack, show_labeled_image, colorize_labels
+from SegmentationClient.balancer import LoadBalancer
+from SegmentationClient.local_decoder import LocalDecoder
 
 __all__ = [
     'segment_image',
+    'segment_image_progressive',
+    'segment_shared_image',
+    'prefetch_image',
+    'get_image_embedding',
+    'segment_image_groups',
+    'propagate_stack',
     'show_labeled_image',
-    'colorize_labels'
+    'colorize_labels',
+    'LoadBalancer',
+    'LocalDecoder'
 ]
\ No newline at end of file
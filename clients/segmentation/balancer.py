@@ -0,0 +1,327 @@
+"""
+Replica Load Balancing
+
+Spreads requests across several segmentation server replicas.  Each replica's
+load is learned by polling its GetLoad RPC and from the load the server attaches
+to every SegmentImage response, so a replica busy with a large tile stops
+receiving new clicks until it catches up.
+
+In affinity mode requests for the same image go to the same replica, so they
+hit the image embedding cache there.  Images are mapped to replicas with a
+consistent hash ring, which only moves the images of a replica that drops out.
+
+Example:
+    async with LoadBalancer(['gpu1:50051', 'gpu2:50051']) as balancer:
+        response = await balancer.segment_image(request, timeout=5)
+"""
+
+import asyncio
+import bisect
+import hashlib
+import math
+import random
+from typing import Iterator, Optional, Sequence
+
+import grpc
+
+from segmentation_grpc import LoadRequest, LoadReport, SegmentationServiceStub
+from segmentation_grpc.metadata import QUEUE_DEPTH, IN_FLIGHT, AFFINITY
+
+# Latency assumed for replicas that have not completed a request yet, in seconds
+_DEFAULT_LATENCY = 0.05
+
+# Status codes after which a request is retried on another replica
+_RETRYABLE_CODES = (grpc.StatusCode.UNAVAILABLE,)
+
+
+class Replica:
+    """
+    One segmentation server and the load it last reported.
+    """
+
+    def __init__(self, address: str, channel_options: Optional[Sequence[tuple]] = None):
+        """
+        Args:
+            address: Address of the server, host:port or unix:path
+            channel_options: Optional gRPC channel options
+        """
+        self.address = address
+        self.channel = grpc.aio.insecure_channel(address, options=channel_options)
+        self.stub = SegmentationServiceStub(self.channel)
+
+        self.healthy = True
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.p50_latency = 0.0
+        self.loaded_models = []
+
+        # Requests this client sent since the replica last reported its load, which the report cannot include
+        self.sent_since_report = 0
+
+    def backlog(self) -> int:
+        """Estimated number of requests ahead of a new one on this replica."""
+        return self.queue_depth + self.in_flight + self.sent_since_report
+
+    def estimated_wait(self) -> float:
+        """Estimated seconds until a new request would complete on this replica."""
+        return (self.backlog() + 1) * (self.p50_latency or _DEFAULT_LATENCY)
+
+    def update(self, report: LoadReport):
+        """Record a load report returned by GetLoad."""
+        self.healthy = True
+        self.queue_depth = report.queue_depth
+        self.in_flight = report.in_flight
+        self.loaded_models = list(report.loaded_models)
+        if report.p50_latency_ms > 0:
+            self.p50_latency = report.p50_latency_ms / 1000
+        self.sent_since_report = 0
+
+    def update_from_trailers(self, trailing_metadata):
+        """Record the load a server attached to a response as trailing metadata."""
+        values = {key: value for key, value in trailing_metadata or ()}
+        if QUEUE_DEPTH in values and IN_FLIGHT in values:
+            self.queue_depth = int(values[QUEUE_DEPTH])
+            self.in_flight = int(values[IN_FLIGHT])
+            self.sent_since_report = 0
+
+    def __repr__(self):
+        return (f"Replica({self.address!r}, healthy={self.healthy}, queue_depth={self.queue_depth}, "
+                f"in_flight={self.in_flight}, p50_latency={self.p50_latency:.3f})")
+
+
+def _ring_hash(value: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+
+def image_affinity_key(request) -> str:
+    """
+    Return the key a SegmentationRequest or PrefetchRequest is routed by in affinity mode.
+
+    Args:
+        request: The SegmentationRequest or PrefetchRequest
+
+    Returns:
+        The request's image_key, or a hash of its image data or shared memory segment name
+    """
+    if request.image_key:
+        return request.image_key
+    if 'shared_image' in request.DESCRIPTOR.fields_by_name and request.HasField('shared_image'):
+        return f'shm:{request.shared_image.name}'
+
+    return hashlib.blake2b(request.image_data, digest_size=16).hexdigest()
+
+
+class ConsistentHashRing:
+    """
+    Maps keys onto replicas so each replica owns a stable share of the keys.
+
+    Every replica is placed on the ring at several pseudo-random points.  A key
+    belongs to the first replica found walking clockwise from the key's hash, so
+    adding or removing a replica only moves the keys it owns.
+    """
+
+    def __init__(self, replicas: Sequence[Replica], virtual_nodes: int = 64):
+        """
+        Args:
+            replicas: The replicas to place on the ring
+            virtual_nodes: Number of points per replica, more points spread the keys more evenly
+        """
+        points = sorted((_ring_hash(f'{replica.address}#{i}'.encode()), index)
+                        for index, replica in enumerate(replicas)
+                        for i in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [replicas[index] for _, index in points]
+        self._num_replicas = len(replicas)
+
+    def walk(self, key: str) -> Iterator[Replica]:
+        """Yield every replica once, in the order they are tried for key."""
+        start = bisect.bisect(self._hashes, _ring_hash(key.encode()))
+        seen = set()
+        for i in range(len(self._owners)):
+            replica = self._owners[(start + i) % len(self._owners)]
+            if id(replica) not in seen:
+                seen.add(id(replica))
+                yield replica
+                if len(seen) == self._num_replicas:
+                    return
+
+
+class LoadBalancer:
+    """
+    Picks the replica to send each request to.
+
+    Three policies are supported:
+    - 'power_of_two': compare two randomly chosen replicas and use the less loaded one.
+      This avoids every client piling onto the same replica between load reports.
+    - 'least_loaded': always use the replica with the smallest estimated wait.
+    - 'affinity': send requests for the same image to the same replica, so they hit its
+      embedding cache.  A replica is skipped while its backlog exceeds load_factor times
+      the average, so a popular image cannot overload one replica.
+
+    Replicas that fail to answer are skipped until they answer a poll again.
+    """
+
+    POLICIES = ('power_of_two', 'least_loaded', 'affinity')
+
+    def __init__(self,
+                 addresses: Sequence[str],
+                 policy: str = 'power_of_two',
+                 poll_interval: Optional[float] = 1.0,
+                 channel_options: Optional[Sequence[tuple]] = None,
+                 rng: Optional[random.Random] = None,
+                 load_factor: float = 1.25):
+        """
+        Args:
+            addresses: Addresses of the replicas, host:port or unix:path
+            policy: One of POLICIES
+            poll_interval: Seconds between GetLoad polls, None to rely only on the load attached to responses
+            channel_options: Optional gRPC channel options used for every replica
+            rng: Optional random number generator, for reproducible choices
+            load_factor: In affinity mode, how far above the average backlog a replica may be before
+                         its images spill over to the next replica on the ring
+        """
+        if len(addresses) == 0:
+            raise ValueError("LoadBalancer needs at least one replica address")
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, expected one of {', '.join(self.POLICIES)}")
+
+        self.replicas = [Replica(address, channel_options) for address in addresses]
+        self.ring = ConsistentHashRing(self.replicas)
+        self.policy = policy
+        self.load_factor = load_factor
+        self.poll_interval = poll_interval
+        self._rng = rng or random.Random()
+        self._poll_task = None
+
+    async def __aenter__(self) -> 'LoadBalancer':
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def start(self):
+        """Poll every replica once and start polling in the background."""
+        await self.poll()
+        if self.poll_interval is not None and self._poll_task is None:
+            self._poll_task = asyncio.create_task(self._poll_loop())
+
+    async def close(self):
+        """Stop polling and close the channels to the replicas."""
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+
+        await asyncio.gather(*(replica.channel.close() for replica in self.replicas))
+
+    async def poll(self):
+        """Ask every replica for its load, replicas that do not answer are marked unhealthy."""
+        timeout = self.poll_interval or 1.0
+
+        async def poll_replica(replica: Replica):
+            try:
+                replica.update(await replica.stub.GetLoad(LoadRequest(), timeout=timeout))
+            except grpc.RpcError:
+                replica.healthy = False
+
+        await asyncio.gather(*(poll_replica(replica) for replica in self.replicas))
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.poll()
+
+    def pick(self, exclude: Sequence[Replica] = (), key: Optional[str] = None) -> Replica:
+        """
+        Choose the replica for the next request.
+
+        Args:
+            exclude: Replicas that must not be chosen, for example because they just failed
+            key: The affinity key of the request, only used by the affinity policy
+
+        Returns:
+            The chosen replica
+        """
+        candidates = [replica for replica in self.replicas if replica not in exclude]
+        if len(candidates) == 0:
+            raise RuntimeError("No replica left to try")
+
+        # Prefer replicas that answered recently, but try the others rather than failing outright
+        healthy = [replica for replica in candidates if replica.healthy]
+        candidates = healthy or candidates
+
+        if self.policy == 'affinity' and key is not None:
+            # Bounded load: walk the ring past replicas whose backlog is well above the average
+            bound = math.ceil(self.load_factor * (sum(replica.backlog() for replica in candidates) + 1) / len(candidates))
+            for replica in self.ring.walk(key):
+                if replica in candidates and replica.backlog() < bound:
+                    return replica
+
+        if self.policy == 'power_of_two' and len(candidates) > 2:
+            candidates = self._rng.sample(candidates, 2)
+
+        return min(candidates, key=Replica.estimated_wait)
+
+    def owner(self, key: str) -> Replica:
+        """Return the replica that owns key on the ring, whether or not it is available."""
+        return next(self.ring.walk(key))
+
+    async def call(self, method: str, request, timeout: Optional[float] = None, metadata=None, retries: int = 1,
+                   key: Optional[str] = None):
+        """
+        Invoke a unary RPC on the replica chosen by the policy.
+
+        If the replica is unavailable the request is retried on another one.
+
+        Args:
+            method: Name of the RPC, for example 'SegmentImage'
+            request: The request message
+            timeout: Optional deadline in seconds
+            metadata: Optional invocation metadata
+            retries: Number of other replicas to try if the chosen one is unavailable
+            key: The affinity key of the request, only used by the affinity policy
+
+        Returns:
+            The response message
+        """
+        tried = []
+        while True:
+            replica = self.pick(exclude=tried, key=key)
+            replica.sent_since_report += 1
+
+            # Tell the replica the request reached it through affinity, so it can report the cache hits earned
+            call_metadata = tuple(metadata or ())
+            if self.policy == 'affinity' and key is not None and replica is self.owner(key):
+                call_metadata += ((AFFINITY, '1'),)
+
+            try:
+                call = getattr(replica.stub, method)(request, timeout=timeout, metadata=call_metadata or None)
+                response = await call
+                replica.update_from_trailers(await call.trailing_metadata())
+                return response
+            except grpc.RpcError as e:
+                if e.code() not in _RETRYABLE_CODES:
+                    raise
+
+                replica.healthy = False
+                tried.append(replica)
+                if len(tried) > retries or len(tried) == len(self.replicas):
+                    raise
+
+    async def segment_image(self, request, timeout: Optional[float] = None, metadata=None):
+        """Call SegmentImage on the replica chosen by the policy, see call()."""
+        key = image_affinity_key(request) if self.policy == 'affinity' else None
+        return await self.call('SegmentImage', request, timeout=timeout, metadata=metadata, key=key)
+
+    async def prefetch_image(self, request, timeout: Optional[float] = None, metadata=None):
+        """
+        Call PrefetchImage on the replica chosen by the policy, see call().
+
+        With the affinity policy this is the replica later requests on the same image are sent to.
+        """
+        key = image_affinity_key(request) if self.policy == 'affinity' else None
+        return await self.call('PrefetchImage', request, timeout=timeout, metadata=metadata, key=key)
@@ -7,6 +7,7 @@ It demonstrates how to create a request, call the service, and process the respo
 
 import asyncio
 import argparse
+import contextlib
 import grpc
 import numpy as np
 from PIL import Image
@@ -14,9 +15,10 @@ import io
 import matplotlib.pyplot as plt
 import os
 import sys
+import time
 import cv2
 
-from typing import Sequence, NamedTuple, Tuple
+from typing import Sequence, NamedTuple, Tuple, Optional, AsyncIterator
 
 from numpy.typing import NDArray
 
@@ -25,14 +27,40 @@ import segmentation_grpc
 from segmentation_grpc import (
     SegmentationRequest,
     SegmentationResponse,
+    SegmentationUpdate,
     Point,
     Polygon,
     SegmentResult,
     SegmentationServiceStub,
+    Box,
+    SectionImage,
+    StackPropagationRequest,
+    SectionSegmentation,
+    PropagationDirection,
+    PromptGroup,
+    LabeledImageFormat,
+    LabeledImageType,
+    ContourMode,
+    PrefetchRequest,
+    EmbeddingRequest,
+    ImageEmbedding,
+    TensorEncoding,
 )
+from segmentation_grpc.codecs import (encode_mask_logits, decode_mask_logits, decode_raw_labeled_image,
+                                     decode_packed_polygons)
+from segmentation_grpc.shared_memory import SharedImageBuffer
+from segmentation_grpc import metadata
+from segmentation_grpc.tracing import Tracer, trace_metadata
 
 np.random.seed(16)
 
+# Outstanding calls by supersede key, a newer call with the same key cancels the older one
+_outstanding_calls = {}
+
+
+class CallSuperseded(Exception):
+    """Raised when a call was cancelled because a newer call with the same supersede key started."""
+
 class Segment(NamedTuple):
     """
     A named tuple to represent a segment in the segmentation response.
@@ -41,12 +69,18 @@ class Segment(NamedTuple):
         index: The index of the segment
         score: The score of the segment
         mask: The mask of the segment as a PIL Image
-        polygons: List of polygons representing the contours of the segment
+        polygons: List of polygons representing the contours of the segment, (N, 2) arrays if they were sent packed
+        logits_handle: Server-side handle of the low resolution logits, pass as mask_input_handle to refine the segment
+        low_res_logits: The low resolution logits, if they were requested
+        prompt_group: Index of the prompt group that produced the segment
     """
     index: int
     score: float
     mask: NDArray[bool]
-    polygons: list[list[tuple[int, int]]] = []
+    polygons: list[Sequence[tuple[int, int]]] = []
+    logits_handle: str = ''
+    low_res_logits: Optional[NDArray[np.float32]] = None
+    prompt_group: int = 0
 
 
 def colorize_labels(labeled_image: NDArray) -> NDArray:
@@ -188,44 +222,374 @@ def show_labeled_image(original_image, labeled_image, segments, coordinates=None
     plt.show()
 
 
-async def segment_image(server_address: str, image_path: str, coordinates: tuple[int, int], labels: Sequence[bool], multimask_output: bool=True) -> tuple[NDArray, Sequence[Segment]]:
+def _load_grayscale_png(image_path: str) -> tuple[bytes, int, int]:
+    """
+    Load an image file and encode it as a grayscale PNG for the service.
+
+    Returns:
+        A tuple of (png_bytes, width, height)
+    """
+    image = Image.open(image_path)
+
+    # Convert to grayscale if needed
+    if image.mode != 'L':
+        image = image.convert('L')
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue(), image.width, image.height
+
+
+def _call_metadata(priority: Optional[str], client: Optional[str] = None) -> Optional[tuple[tuple[str, str], ...]]:
+    """Build the gRPC metadata for a call, or None if there is nothing to send."""
+    call_metadata = ()
+    if priority is not None:
+        call_metadata += ((metadata.PRIORITY, priority),)
+    if client is not None:
+        call_metadata += ((metadata.CLIENT, client),)
+
+    return call_metadata or None
+
+
+@contextlib.contextmanager
+def _superseding(supersede_key: Optional[str], call):
+    """
+    Make a call the outstanding call of its supersede key for the duration of a with block.
+
+    The call the key had before is cancelled, the server cancels its work as
+    well when the new request arrives.  A call cancelled this way raises
+    CallSuperseded from the with block.
+    """
+    if supersede_key is None:
+        yield
+        return
+
+    previous = _outstanding_calls.get(supersede_key)
+    _outstanding_calls[supersede_key] = call
+    if previous is not None:
+        previous.cancel()
+
+    try:
+        yield
+    except asyncio.CancelledError:
+        if _outstanding_calls.get(supersede_key) is not call:
+            raise CallSuperseded(f"Superseded by a newer call with supersede key {supersede_key!r}") from None
+        raise
+    finally:
+        if _outstanding_calls.get(supersede_key) is call:
+            del _outstanding_calls[supersede_key]
+
+
+def _decode_labeled_image(response: SegmentationResponse) -> Optional[Image.Image]:
+    """Decode the labeled image of a response into a PIL Image, or None if it was omitted."""
+    if response.labeled_image_format == LabeledImageFormat.LABELED_IMAGE_NONE or not response.labeled_image:
+        return None
+
+    if response.labeled_image_format == LabeledImageFormat.LABELED_IMAGE_RAW:
+        return Image.fromarray(decode_raw_labeled_image(response.labeled_image,
+                                                        response.width,
+                                                        response.height,
+                                                        response.labeled_image_type))
+
+    return Image.open(io.BytesIO(response.labeled_image))
+
+
+def _parse_segment(segment: SegmentResult, width: int = 0, height: int = 0) -> Segment:
+    """
+    Convert a SegmentResult message into a Segment.
+
+    Args:
+        segment: The SegmentResult message
+        width: Width of the image, a mask covering only a window is placed into a mask this size
+        height: Height of the image
+
+    Returns:
+        The Segment
+    """
+    # Extract polygons from the response
+    if segment.HasField('packed_polygons'):
+        polygons = decode_packed_polygons(segment.packed_polygons)
+    else:
+        polygons = []
+        for polygon in segment.polygons:
+            points = [(point.x, point.y) for point in polygon.points]
+            polygons.append(points)
+
+    mask = np.array(Image.open(io.BytesIO(segment.mask)), dtype=np.uint8) if segment.mask else None
+    if mask is not None and segment.HasField('mask_window') and width > 0 and height > 0:
+        # Masks decoded in a region of interest only cover the window
+        window = segment.mask_window
+        full_mask = np.zeros((height, width), dtype=np.uint8)
+        full_mask[window.y0:window.y1, window.x0:window.x1] = mask
+        mask = full_mask
+
+    return Segment(
+        segment.index,
+        segment.score,
+        mask,
+        polygons,
+        segment.logits_handle,
+        decode_mask_logits(segment.low_res_logits) if segment.HasField('low_res_logits') else None,
+        segment.prompt_group
+    )
+
+
+async def segment_image(server_address: str, image_path: str, coordinates: tuple[int, int], labels: Sequence[bool], multimask_output: bool=True,
+                        box: Optional[tuple[int, int, int, int]] = None,
+                        mask_input_handle: Optional[str] = None,
+                        mask_input: Optional[NDArray[np.float32]] = None,
+                        return_low_res_logits: bool = False,
+                        timeout: Optional[float] = None,
+                        priority: Optional[str] = None,
+                        client: Optional[str] = None,
+                        labeled_image_format: int = LabeledImageFormat.LABELED_IMAGE_PNG,
+                        labeled_image_type: int = LabeledImageType.LABELED_IMAGE_UINT16,
+                        png_compression_level: Optional[int] = None,
+                        packed_polygons: bool = False,
+                        max_polygon_vertices: int = 0,
+                        image_key: Optional[str] = None,
+                        roi: bool = False,
+                        roi_window: Optional[tuple[int, int, int, int]] = None,
+                        polygons_from_logits: bool = False,
+                        contour_mode: int = ContourMode.CONTOURS_EXTERNAL,
+                        simplify_tolerance: Optional[float] = None,
+                        supersede_key: Optional[str] = None,
+                        tracer: Optional[Tracer] = None) -> tuple[NDArray, Sequence[Segment]]:
     """
     Segment an image using the segmentation service.
 
+    A sampled call is recorded by the tracer as spans for encoding the request,
+    the RPC and decoding the response.  The server records its spans under the
+    same trace, the RPC span notes how much of its time the server took.
+
     Args:
         server_address: The address of the segmentation service (host:port)
         image_path: Path to the image file
         coordinates: List of (x, y) coordinates to use as prompts
         labels: List of labels for each coordinate (1 for foreground, 0 for background)
         multimask_output: Whether to output multiple masks per point
+        box: Optional (x0, y0, x1, y1) box prompt
+        mask_input_handle: Optional logits_handle of a previous segment to refine
+        mask_input: Optional low_res_logits of a previous segment to refine, used if the server no longer holds the handle
+        return_low_res_logits: Whether the server should include the low resolution logits of each segment
+        timeout: Optional deadline in seconds, the server drops the request once it passes
+        priority: Optional priority class, "interactive" (the default) or "bulk"
+        client: Optional name of the caller, the server shares its capacity fairly between clients
+        labeled_image_format: A LabeledImageFormat value, LABELED_IMAGE_NONE skips the labeled image
+        labeled_image_type: A LabeledImageType value
+        png_compression_level: Optional PNG compression level (0-9) for the labeled image
+        packed_polygons: Whether the server should send the polygons packed, they are decoded to (N, 2) arrays
+        max_polygon_vertices: Optional maximum number of vertices of each polygon, 0 for no limit
+        image_key: Optional identifier of the image, such as a tile ID, letting the server reuse its embedding
+        roi: Whether the server should encode only a window around the prompts, useful for very large images
+        roi_window: Optional (x0, y0, x1, y1) window to encode, implies roi.  Pass the window of the
+                    response being refined when refining through mask_input.
+        polygons_from_logits: Whether the server should trace polygons from the low resolution logits,
+                              faster on large images at about a pixel of accuracy
+        contour_mode: A ContourMode value, CONTOURS_WITH_HOLES also returns the boundaries of holes
+        simplify_tolerance: Optional polygon simplification tolerance as a fraction of each contour's
+                            perimeter, 0 keeps every contour vertex
+        supersede_key: Optional key, such as the ID of the object being annotated.  A newer call with
+                       the same key cancels this one, which then returns (None, None).
+        tracer: Optional Tracer sampling calls and recording their spans
 
     Returns:
         A tuple containing:
-        - labeled_image: The labeled image as a PIL Image
+        - labeled_image: The labeled image as a PIL Image, None if LABELED_IMAGE_NONE was requested
         - segments: List of segment information
     """
-    # Load the image
-    image = Image.open(image_path)
+    tracer = tracer if tracer is not None else Tracer()
+    with tracer.span('segment_image', tracer.start_trace()) as trace:
+        with tracer.span('encode', trace):
+            request = _segmentation_request(image_path, coordinates, labels, multimask_output, box, mask_input_handle,
+                                            mask_input, return_low_res_logits, labeled_image_format, labeled_image_type,
+                                            png_compression_level, packed_polygons, max_polygon_vertices, image_key,
+                                            roi, roi_window, polygons_from_logits, contour_mode, simplify_tolerance,
+                                            supersede_key)
+
+        # Create a gRPC channel
+        async with grpc.aio.insecure_channel(server_address) as channel:
+            # Create a stub
+            stub = SegmentationServiceStub(channel)
+
+            try:
+                # Call the service, passing the RPC's span to the server
+                rpc_span = trace.child() if trace is not None else None
+                call_metadata = trace_metadata(rpc_span, _call_metadata(priority, client))
+                start = time.monotonic()
+                call = stub.SegmentImage(request, timeout=timeout, metadata=call_metadata)
+                with _superseding(supersede_key, call):
+                    response = await call # type: SegmentationResponse
+                if rpc_span is not None:
+                    _record_rpc(tracer, trace, rpc_span, start, time.monotonic(), await call.trailing_metadata())
+
+                with tracer.span('decode', trace):
+                    # Process the response
+                    labeled_image = _decode_labeled_image(response)
+
+                    # Process segments
+                    segments = [_parse_segment(segment, response.width, response.height)
+                                for segment in response.segments]
+
+                return labeled_image, segments
+
+            except CallSuperseded:
+                return None, None
+            except grpc.RpcError as e:
+                print(f"RPC error: {e.details()}")
+                return None, None
+
+
+def _record_rpc(tracer: Tracer, trace, rpc_span, start: float, end: float, trailing_metadata):
+    """Record the span of a traced RPC, with the time the server reported spending on it and the network's share."""
+    server_seconds = next((float(value) for key, value in trailing_metadata or () if key == metadata.SERVER_SECONDS), None)
+    network_seconds = end - start - server_seconds if server_seconds is not None else None
+    tracer.record('rpc', trace, start, end, rpc_span, server_seconds=server_seconds, network_seconds=network_seconds)
+
+
+async def segment_image_progressive(server_address: str,
+                                    image_path: str,
+                                    coordinates: Sequence[tuple[int, int]],
+                                    labels: Sequence[int],
+                                    multimask_output: bool = True,
+                                    box: Optional[tuple[int, int, int, int]] = None,
+                                    mask_input_handle: Optional[str] = None,
+                                    timeout: Optional[float] = None,
+                                    priority: Optional[str] = None,
+                                    client: Optional[str] = None,
+                                    labeled_image_format: int = LabeledImageFormat.LABELED_IMAGE_PNG,
+                                    packed_polygons: bool = False,
+                                    max_polygon_vertices: int = 0,
+                                    image_key: Optional[str] = None,
+                                    roi: bool = False,
+                                    supersede_key: Optional[str] = None) -> AsyncIterator[tuple[int, Optional[Image.Image], list[Segment]]]:
+    """
+    Segment an image with SegmentImageProgressive, yielding the result as it is refined.
 
-    # Convert to grayscale if needed
-    if image.mode != 'L':
-        grayscale_image = image.convert('L')
-    else:
-        grayscale_image = image
+    The first update holds only the best segment with a coarse outline, the second
+    its full resolution polygons and the last every segment, with masks and logits
+    handles, and the labeled image.  Each update yields all segments received so far.
 
-    # Convert the image to bytes
-    buffer = io.BytesIO()
-    grayscale_image.save(buffer, format='PNG')
-    image_data = buffer.getvalue()
+    Args:
+        server_address: The address of the segmentation service (host:port)
+        image_path: Path to the image file
+        coordinates: List of (x, y) coordinates to use as prompts
+        labels: List of labels for each coordinate (1 for foreground, 0 for background)
+        multimask_output: Whether to output multiple masks per point
+        box: Optional (x0, y0, x1, y1) box prompt
+        mask_input_handle: Optional logits_handle of a previous segment to refine
+        timeout: Optional deadline in seconds for the whole stream
+        priority: Optional priority class, "interactive" (the default) or "bulk"
+        client: Optional name of the caller, the server shares its capacity fairly between clients
+        labeled_image_format: A LabeledImageFormat value, LABELED_IMAGE_NONE skips the labeled image
+        packed_polygons: Whether the server should send the polygons packed, they are decoded to (N, 2) arrays
+        max_polygon_vertices: Optional maximum number of vertices of each polygon, 0 for no limit
+        image_key: Optional identifier of the image, such as a tile ID, letting the server reuse its embedding
+        roi: Whether the server should encode only a window around the prompts
+        supersede_key: Optional key, such as the ID of the object being annotated.  A newer call with
+                       the same key cancels this one, whose updates then stop.
+
+    Yields:
+        A tuple of (stage, labeled_image, segments) where stage is a SegmentationStage value and
+        labeled_image is None until the STAGE_COMPLETE update
+    """
+    request = _segmentation_request(image_path, coordinates, labels, multimask_output, box, mask_input_handle,
+                                    labeled_image_format=labeled_image_format,
+                                    packed_polygons=packed_polygons,
+                                    max_polygon_vertices=max_polygon_vertices,
+                                    image_key=image_key,
+                                    roi=roi,
+                                    supersede_key=supersede_key)
+
+    merged = {}  # type: dict[int, SegmentResult]
+    async with grpc.aio.insecure_channel(server_address) as channel:
+        stub = SegmentationServiceStub(channel)
+
+        call = stub.SegmentImageProgressive(request, timeout=timeout, metadata=_call_metadata(priority, client))
+        try:
+            with _superseding(supersede_key, call):
+                async for update in call:  # type: SegmentationUpdate
+                    for segment in update.segments:
+                        if segment.index not in merged:
+                            merged[segment.index] = SegmentResult()
+                        _merge_segment_result(merged[segment.index], segment)
+
+                    yield (update.stage,
+                           _decode_labeled_image(update),
+                           [_parse_segment(merged[index], update.width, update.height) for index in sorted(merged)])
+        except CallSuperseded:
+            return
+
+
+def _merge_segment_result(target: SegmentResult, update: SegmentResult):
+    """Apply a progressive update to a segment, fields set in the update replace those of the target."""
+    for field, _ in update.ListFields():
+        target.ClearField(field.name)
+    target.MergeFrom(update)
+
+
+def _segmentation_request(image_path: str,
+                          coordinates: Sequence[tuple[int, int]],
+                          labels: Sequence[int],
+                          multimask_output: bool = True,
+                          box: Optional[tuple[int, int, int, int]] = None,
+                          mask_input_handle: Optional[str] = None,
+                          mask_input: Optional[NDArray[np.float32]] = None,
+                          return_low_res_logits: bool = False,
+                          labeled_image_format: int = LabeledImageFormat.LABELED_IMAGE_PNG,
+                          labeled_image_type: int = LabeledImageType.LABELED_IMAGE_UINT16,
+                          png_compression_level: Optional[int] = None,
+                          packed_polygons: bool = False,
+                          max_polygon_vertices: int = 0,
+                          image_key: Optional[str] = None,
+                          roi: bool = False,
+                          roi_window: Optional[tuple[int, int, int, int]] = None,
+                          polygons_from_logits: bool = False,
+                          contour_mode: int = ContourMode.CONTOURS_EXTERNAL,
+                          simplify_tolerance: Optional[float] = None,
+                          supersede_key: Optional[str] = None) -> SegmentationRequest:
+    """Build the SegmentationRequest for an image file, see segment_image for the arguments."""
+    # Load the image and convert it to grayscale PNG bytes
+    image_data, width, height = _load_grayscale_png(image_path)
 
     # Create the request
     request = SegmentationRequest(
         image_data=image_data,
-        width=grayscale_image.width,
-        height=grayscale_image.height,
-        multimask_output=multimask_output
+        width=width,
+        height=height,
+        multimask_output=multimask_output,
+        return_low_res_logits=return_low_res_logits,
+        labeled_image_format=labeled_image_format,
+        labeled_image_type=labeled_image_type,
+        packed_polygons=packed_polygons,
+        max_polygon_vertices=max_polygon_vertices,
+        image_key=image_key or '',
+        polygons_from_logits=polygons_from_logits,
+        contour_mode=contour_mode,
+        supersede_key=supersede_key or ''
     )
 
+    if png_compression_level is not None:
+        request.png_compression_level = png_compression_level
+
+    if simplify_tolerance is not None:
+        request.simplify_tolerance = simplify_tolerance
+
+    if box is not None:
+        x0, y0, x1, y1 = box
+        request.box.CopyFrom(Box(x0=x0, y0=y0, x1=x1, y1=y1))
+
+    if roi_window is not None:
+        x0, y0, x1, y1 = roi_window
+        request.roi.window.CopyFrom(Box(x0=x0, y0=y0, x1=x1, y1=y1))
+    elif roi:
+        request.roi.SetInParent()
+
+    if mask_input_handle:
+        request.mask_input_handle = mask_input_handle
+    elif mask_input is not None:
+        request.mask_input.CopyFrom(encode_mask_logits(mask_input))
+
     # Add coordinates and labels
     for x, y in coordinates:
         point = Point(x=x, y=y)
@@ -234,40 +598,258 @@ async def segment_image(server_address: str, image_path: str, coordinates: tuple
     for label in labels:
         request.labels.append(label)
 
-    # Create a gRPC channel
+    return request
+
+async def segment_shared_image(server_address: str,
+                               image: SharedImageBuffer,
+                               coordinates: Sequence[tuple[int, int]],
+                               labels: Sequence[int],
+                               multimask_output: bool = True,
+                               labeled_image: Optional[SharedImageBuffer] = None,
+                               timeout: Optional[float] = None,
+                               priority: Optional[str] = None,
+                               client: Optional[str] = None) -> tuple[Optional[NDArray], Sequence[Segment]]:
+    """
+    Segment an image held in shared memory, for clients on the same host as the server.
+
+    Only the name and shape of the segments are sent, the server reads the pixels
+    directly from image and writes the labeled image directly into labeled_image.
+    Connect over the server's Unix domain socket, for example "unix:/tmp/segmentation.sock",
+    to also avoid the TCP stack.
+
+    Args:
+        server_address: The address of the segmentation service, host:port or unix:path
+        image: Shared memory buffer holding the grayscale or RGB uint8 image
+        coordinates: List of (x, y) coordinates to use as prompts
+        labels: List of labels for each coordinate (1 for foreground, 0 for background)
+        multimask_output: Whether to output multiple masks per point
+        labeled_image: Optional uint8 or uint16 buffer of the same width and height that receives the labeled image
+        timeout: Optional deadline in seconds, the server drops the request once it passes
+        priority: Optional priority class, "interactive" (the default) or "bulk"
+        client: Optional name of the caller, the server shares its capacity fairly between clients
+
+    Returns:
+        A tuple containing:
+        - labeled_image: labeled_image.array once the server wrote to it, or None if no buffer was given
+        - segments: List of segment information
+    """
+    request = SegmentationRequest(
+        width=image.message.width,
+        height=image.message.height,
+        multimask_output=multimask_output,
+        shared_image=image.describe(),
+        coordinates=[Point(x=x, y=y) for x, y in coordinates],
+        labels=labels
+    )
+
+    if labeled_image is not None:
+        request.shared_labeled_image.CopyFrom(labeled_image.describe())
+    else:
+        request.labeled_image_format = LabeledImageFormat.LABELED_IMAGE_NONE
+
     async with grpc.aio.insecure_channel(server_address) as channel:
-        # Create a stub
         stub = SegmentationServiceStub(channel)
 
         try:
-            # Call the service
-            response = await stub.SegmentImage(request) # type: SegmentationResponse
-
-            # Process the response
-            labeled_image = Image.open(io.BytesIO(response.labeled_image))
-
-            # Process segments
-            segments = []
-            for segment in response.segments:
-                # Extract polygons from the response
-                polygons = []
-                for polygon in segment.polygons:
-                    points = [(point.x, point.y) for point in polygon.points]
-                    polygons.append(points)
-
-                segments.append(Segment(
-                    segment.index,
-                    segment.score,
-                    np.array(Image.open(io.BytesIO(segment.mask)), dtype=np.uint8) if segment.mask else None,
-                    polygons
-                ))
-
-            return labeled_image, segments
+            response = await stub.SegmentImage(request, timeout=timeout, metadata=_call_metadata(priority, client)) # type: SegmentationResponse
+            segments = [_parse_segment(segment, response.width, response.height) for segment in response.segments]
+
+            return labeled_image.array if labeled_image is not None else None, segments
 
         except grpc.RpcError as e:
             print(f"RPC error: {e.details()}")
             return None, None
 
+async def prefetch_image(server_address: str,
+                         image_path: str,
+                         image_key: Optional[str] = None,
+                         timeout: Optional[float] = 1.0) -> Optional[int]:
+    """
+    Ask the server to encode an image before the first click on it.
+
+    Call this as soon as it is known which image the user is about to work on.
+    The server returns immediately and may drop the prefetch when it is busy.
+
+    Args:
+        server_address: The address of the segmentation service (host:port)
+        image_path: Path to the image file
+        image_key: Optional identifier of the image, later requests must pass the same key
+        timeout: Optional deadline in seconds for the call, not for the encoding
+
+    Returns:
+        The PrefetchStatus returned by the server, or None if the call failed
+    """
+    image_data, width, height = _load_grayscale_png(image_path)
+    request = PrefetchRequest(image_data=image_data, width=width, height=height, image_key=image_key or '')
+
+    async with grpc.aio.insecure_channel(server_address) as channel:
+        stub = SegmentationServiceStub(channel)
+
+        try:
+            response = await stub.PrefetchImage(request, timeout=timeout)
+            return response.status
+        except grpc.RpcError as e:
+            print(f"RPC error: {e.details()}")
+            return None
+
+
+async def get_image_embedding(server_address: str,
+                              image_path: str,
+                              encoding: int = TensorEncoding.TENSOR_FLOAT16,
+                              compress: bool = False,
+                              image_key: Optional[str] = None,
+                              timeout: Optional[float] = None) -> ImageEmbedding:
+    """
+    Fetch the embedding of an image for decoding prompts locally with a LocalDecoder.
+
+    Args:
+        server_address: The address of the segmentation service (host:port)
+        image_path: Path to the image file
+        encoding: The TensorEncoding of the returned tensors.  TENSOR_INT8 halves the size
+                  of float16 at a small loss of mask accuracy.
+        compress: Whether the server should zlib compress the tensors, worthwhile on slow links
+        image_key: Optional identifier of the image, reuses the server's cached embedding
+        timeout: Optional deadline in seconds
+
+    Returns:
+        The ImageEmbedding message
+    """
+    image_data, width, height = _load_grayscale_png(image_path)
+    request = EmbeddingRequest(image_data=image_data, width=width, height=height, image_key=image_key or '',
+                               encoding=encoding, compress=compress)
+
+    async with grpc.aio.insecure_channel(server_address, options=[
+        ('grpc.max_receive_message_length', 64 * 1024 * 1024)
+    ]) as channel:
+        stub = SegmentationServiceStub(channel)
+        return await stub.GetImageEmbedding(request, timeout=timeout)
+
+
+async def segment_image_groups(server_address: str,
+                               image_path: str,
+                               prompt_groups: Sequence[dict],
+                               multimask_output: bool = False,
+                               timeout: Optional[float] = None,
+                               priority: Optional[str] = None,
+                               client: Optional[str] = None) -> tuple[NDArray, list[list[Segment]]]:
+    """
+    Segment several objects on one image with a single call.
+
+    Args:
+        server_address: The address of the segmentation service (host:port)
+        image_path: Path to the image file
+        prompt_groups: One dictionary per object with 'coordinates', 'labels' and an optional 'box'
+        multimask_output: Whether to output multiple masks per object
+        timeout: Optional deadline in seconds, the server drops the request once it passes
+        priority: Optional priority class, "interactive" (the default) or "bulk"
+        client: Optional name of the caller, the server shares its capacity fairly between clients
+
+    Returns:
+        A tuple containing:
+        - labeled_image: The labeled image as a PIL Image
+        - segments: A list with the segments of each prompt group, in the order of prompt_groups
+    """
+    image_data, width, height = _load_grayscale_png(image_path)
+
+    request = SegmentationRequest(
+        image_data=image_data,
+        width=width,
+        height=height,
+        multimask_output=multimask_output
+    )
+
+    for group in prompt_groups:
+        prompt_group = PromptGroup(labels=group.get('labels', []))
+        for x, y in group.get('coordinates', []):
+            prompt_group.coordinates.append(Point(x=x, y=y))
+
+        if group.get('box') is not None:
+            x0, y0, x1, y1 = group['box']
+            prompt_group.box.CopyFrom(Box(x0=x0, y0=y0, x1=x1, y1=y1))
+
+        request.prompt_groups.append(prompt_group)
+
+    async with grpc.aio.insecure_channel(server_address) as channel:
+        stub = SegmentationServiceStub(channel)
+
+        try:
+            response = await stub.SegmentImage(request, timeout=timeout, metadata=_call_metadata(priority, client))  # type: SegmentationResponse
+        except grpc.RpcError as e:
+            print(f"RPC error: {e.details()}")
+            return None, None
+
+        labeled_image = _decode_labeled_image(response)
+
+        grouped_segments = [[] for _ in prompt_groups]
+        for segment in response.segments:
+            grouped_segments[segment.prompt_group].append(_parse_segment(segment, response.width, response.height))
+
+        return labeled_image, grouped_segments
+
+
+async def propagate_stack(server_address: str,
+                          image_paths: Sequence[str],
+                          prompt_section_index: int,
+                          coordinates: Sequence[tuple[int, int]],
+                          labels: Sequence[int],
+                          box: Optional[tuple[int, int, int, int]] = None,
+                          section_numbers: Optional[Sequence[int]] = None,
+                          direction: int = PropagationDirection.PROPAGATE_BOTH,
+                          max_sections: int = 0,
+                          timeout: Optional[float] = None,
+                          priority: Optional[str] = None,
+                          client: Optional[str] = None) -> AsyncIterator[tuple[int, Sequence[Segment]]]:
+    """
+    Propagate an object prompted on one section through a stack of serial sections.
+
+    Args:
+        server_address: The address of the segmentation service (host:port)
+        image_paths: Paths to the section images, ordered by section number
+        prompt_section_index: Index into image_paths of the section the prompts were placed on
+        coordinates: List of (x, y) coordinates to use as prompts
+        labels: List of labels for each coordinate (1 for foreground, 0 for background)
+        box: Optional (x0, y0, x1, y1) box prompt
+        section_numbers: Optional section numbers of the images, defaults to their index
+        direction: A PropagationDirection value
+        max_sections: Maximum number of sections to propagate in each direction, 0 for no limit
+        timeout: Optional deadline in seconds for the whole propagation
+        priority: Optional priority class, "bulk" (the default for propagation) or "interactive"
+        client: Optional name of the caller, the server shares its capacity fairly between clients
+
+    Yields:
+        Tuples of (section_number, segments) in the order the server produces them
+    """
+    request = StackPropagationRequest(
+        prompt_section_index=prompt_section_index,
+        direction=direction,
+        max_sections=max_sections
+    )
+
+    for i, image_path in enumerate(image_paths):
+        image_data, width, height = _load_grayscale_png(image_path)
+        request.sections.append(SectionImage(
+            image_data=image_data,
+            width=width,
+            height=height,
+            section_number=section_numbers[i] if section_numbers is not None else i
+        ))
+
+    for x, y in coordinates:
+        request.coordinates.append(Point(x=x, y=y))
+    request.labels.extend(labels)
+
+    if box is not None:
+        x0, y0, x1, y1 = box
+        request.box.CopyFrom(Box(x0=x0, y0=y0, x1=x1, y1=y1))
+
+    async with grpc.aio.insecure_channel(server_address) as channel:
+        stub = SegmentationServiceStub(channel)
+
+        async for section in stub.PropagateStack(request, timeout=timeout, metadata=_call_metadata(priority, client)):  # type: SectionSegmentation
+            yield section.section_number, [_parse_segment(segment, section.width, section.height)
+                                           for segment in section.segments]
+
+
 def pair_of_numbers(value: str):
     try:
         x, y = map(int, value.split(','))
@@ -291,6 +873,10 @@ async def main():
                         help='Labels as l1,l2,... (e.g., 1,0). 1 indicates the point is in the foreground, 0 in the background.  Defaults to assuming all points are foreground.')
     parser.add_argument('--multimask', action='store_true',
                         help='Output multiple masks per point')
+    parser.add_argument('--client', type=str, default=None,
+                        help='Name to identify as, the server shares its capacity fairly between clients')
+    parser.add_argument('--trace', type=str, default=None, metavar='PATH',
+                        help='Trace the request and record its spans to this Chrome trace file')
     args = parser.parse_args()
 
     # Parse coordinates
@@ -313,13 +899,18 @@ async def main():
         return
 
     # Segment the image
+    tracer = Tracer(args.trace, sample_rate=1.0, service='client') if args.trace is not None else None
     labeled_image, segments = await segment_image(
         args.server,
         args.image,
         coordinates,
         labels,
-        args.multimask
+        args.multimask,
+        client=args.client,
+        tracer=tracer
     )
+    if tracer is not None:
+        tracer.close()
 
     if labeled_image is not None and segments is not None:
         # Show the results
@@ -0,0 +1,222 @@
+"""
+Local Prompt Decoding
+
+Runs the SAM2 prompt encoder and mask decoder in the client on an image
+embedding fetched once with GetImageEmbedding.  Only the heavy image encoder
+runs on the server, so every click after the first is answered without a
+round trip.
+
+The decoder is the ONNX model written by the server's exporter,
+python -m segmentation_server.backends.export_onnx, and produces the same
+masks as the server's ONNX backend.
+
+Example:
+    embedding = await get_image_embedding('localhost:50051', 'tile.png')
+    decoder = LocalDecoder('models/sam2.1_hiera_l.decoder.onnx')
+    decoder.set_embedding(embedding)
+    segments = decoder.segment([(120, 80)], [1])
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+from segmentation_grpc import ImageEmbedding, ContourMode
+from segmentation_grpc.codecs import decode_image_embedding
+from segmentation_grpc.mask_decoding import (EMBEDDING_NAMES, DEFAULT_SIMPLIFY_TOLERANCE, decoder_inputs,
+                                             decoder_outputs)
+
+from SegmentationClient.client_example import Segment
+
+# Limit on how often mask_to_polygons doubles the simplification tolerance to meet a vertex budget,
+# the same as the server's
+_MAX_SIMPLIFICATION_STEPS = 16
+
+
+def mask_to_polygons(mask: NDArray[np.bool_],
+                     max_vertices: int = 0,
+                     holes: bool = False,
+                     tolerance: float = DEFAULT_SIMPLIFY_TOLERANCE) -> List[NDArray[np.int32]]:
+    """
+    Convert a boolean mask to polygons, traced and simplified as the server traces them.
+
+    Args:
+        mask: A boolean array where True represents the masked region
+        max_vertices: Maximum number of vertices of each polygon, 0 for no limit.  Contours
+                      with too many vertices are simplified with a larger tolerance until they fit.
+        holes: Whether to include the boundaries of holes.  Outer boundaries are then oriented
+               to have positive and holes negative signed area.
+        tolerance: Simplification tolerance as a fraction of each contour's perimeter
+
+    Returns:
+        A list of arrays of shape (N, 2) holding the (x, y) vertices of each contour
+    """
+    mode = cv2.RETR_CCOMP if holes else cv2.RETR_EXTERNAL
+    contours, hierarchy = cv2.findContours(mask.astype(np.uint8) * 255, mode, cv2.CHAIN_APPROX_SIMPLE)
+
+    polygons = []
+    for i, contour in enumerate(contours):
+        perimeter = cv2.arcLength(contour, True)
+        epsilon = tolerance * perimeter
+        approx = cv2.approxPolyDP(contour, epsilon, True) if epsilon > 0 else contour
+
+        # Double the tolerance until the polygon fits the vertex budget, without collapsing it below a triangle
+        if max_vertices > 0:
+            if epsilon <= 0:
+                epsilon = DEFAULT_SIMPLIFY_TOLERANCE * perimeter / 2
+            for _ in range(_MAX_SIMPLIFICATION_STEPS):
+                if len(approx) <= max_vertices:
+                    break
+                epsilon *= 2
+                simpler = cv2.approxPolyDP(contour, epsilon, True)
+                if len(simpler) < 3:
+                    break
+                approx = simpler
+
+        polygon = approx.reshape(-1, 2)
+        if len(polygon) < 3:
+            continue
+
+        if holes:
+            # Shoelace signed area, a contour with a parent in the hierarchy is a hole
+            x, y = polygon[:, 0].astype(np.float64), polygon[:, 1].astype(np.float64)
+            area = np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))
+            if (area < 0) != (hierarchy[0, i, 3] >= 0):
+                polygon = polygon[::-1]
+
+        polygons.append(polygon)
+
+    return polygons
+
+
+class LocalDecoder:
+    """
+    Decodes prompts into masks on the client for the image of an ImageEmbedding.
+    """
+
+    def __init__(self,
+                 decoder_path: str,
+                 providers: Sequence[str] = ('CPUExecutionProvider',),
+                 model_name: Optional[str] = None):
+        """
+        Args:
+            decoder_path: Path of the exported decoder, <model_prefix>.decoder.onnx
+            providers: ONNX Runtime execution providers, in order of preference
+            model_name: Optional name of the model the decoder was exported from.  Embeddings
+                        produced by a different model are rejected.
+        """
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(decoder_path, providers=list(providers))
+        self.model_name = model_name
+
+        self._embedding = None
+        self._width = 0
+        self._height = 0
+        self._input_size = 0
+
+    def set_embedding(self, message: ImageEmbedding):
+        """
+        Use the embedding returned by GetImageEmbedding for the following predictions.
+
+        Args:
+            message: The ImageEmbedding message
+        """
+        if self.model_name is not None and message.model_name.removesuffix('_onnx') != self.model_name:
+            raise ValueError(f"The embedding was produced by {message.model_name}, "
+                             f"the decoder belongs to {self.model_name}")
+
+        arrays = decode_image_embedding(message)
+        missing = [name for name in EMBEDDING_NAMES if name not in arrays]
+        if missing:
+            raise ValueError(f"The embedding lacks {', '.join(missing)}")
+
+        self._embedding = arrays
+        self._width = message.width
+        self._height = message.height
+        self._input_size = message.input_size
+
+    def predict(self,
+                coordinates: Sequence[Tuple[int, int]],
+                labels: Sequence[int],
+                box: Optional[Tuple[int, int, int, int]] = None,
+                mask_input: Optional[NDArray[np.float32]] = None,
+                multimask_output: bool = True) -> Tuple[NDArray[np.bool_], NDArray[np.float32], NDArray[np.float32]]:
+        """
+        Decode one set of prompts.
+
+        Args:
+            coordinates: List of (x, y) coordinates to use as prompts
+            labels: List of labels for each coordinate (1 for foreground, 0 for background)
+            box: Optional (x0, y0, x1, y1) box prompt
+            mask_input: Optional 256x256 low resolution logits of a previous result, to refine it
+            multimask_output: Whether to return three candidate masks instead of one
+
+        Returns:
+            A tuple of (masks, scores, logits) with shapes (C, height, width), (C,) and (C, 256, 256)
+        """
+        if self._embedding is None:
+            raise RuntimeError("set_embedding must be called before predict")
+        if len(coordinates) == 0 and box is None:
+            raise ValueError("predict needs point or box prompts")
+
+        inputs = decoder_inputs(
+            self._embedding,
+            point_coords=np.array([coordinates], dtype=np.float32) if len(coordinates) > 0 else None,
+            point_labels=np.array([labels], dtype=np.int32) if len(coordinates) > 0 else None,
+            boxes=np.array([box], dtype=np.float32) if box is not None else None,
+            mask_input=mask_input[None, None] if mask_input is not None else None,
+            width=self._width,
+            height=self._height,
+            input_size=self._input_size)
+
+        low_res, iou = self.session.run(['masks', 'iou_predictions'], inputs)
+        masks, scores, logits = decoder_outputs(low_res, iou, multimask_output, width=self._width, height=self._height)
+        return masks[0], scores[0], logits[0]
+
+    def segment(self,
+                coordinates: Sequence[Tuple[int, int]],
+                labels: Sequence[int],
+                box: Optional[Tuple[int, int, int, int]] = None,
+                mask_input: Optional[NDArray[np.float32]] = None,
+                multimask_output: bool = True,
+                max_polygon_vertices: int = 0,
+                contour_mode: int = ContourMode.CONTOURS_EXTERNAL,
+                simplify_tolerance: Optional[float] = None) -> List[Segment]:
+        """
+        Decode one set of prompts into segments with polygons, best score first.
+
+        The segments match those segment_image returns for the same polygon options,
+        except that they carry their low resolution logits instead of a server side
+        logits handle.  Pass a segment's low_res_logits as mask_input to refine it.
+
+        Args:
+            coordinates: List of (x, y) coordinates to use as prompts
+            labels: List of labels for each coordinate (1 for foreground, 0 for background)
+            box: Optional (x0, y0, x1, y1) box prompt
+            mask_input: Optional 256x256 low resolution logits of a previous result, to refine it
+            multimask_output: Whether to return three candidate masks instead of one
+            max_polygon_vertices: Optional maximum number of vertices of each polygon, 0 for no limit
+            contour_mode: A ContourMode value, CONTOURS_WITH_HOLES also returns the boundaries of holes
+            simplify_tolerance: Optional polygon simplification tolerance as a fraction of each contour's
+                                perimeter, the server's default if omitted
+
+        Returns:
+            A list of Segments
+        """
+        masks, scores, logits = self.predict(coordinates, labels, box, mask_input, multimask_output)
+        polygon_options = dict(max_vertices=max_polygon_vertices,
+                               holes=contour_mode == ContourMode.CONTOURS_WITH_HOLES,
+                               tolerance=DEFAULT_SIMPLIFY_TOLERANCE if simplify_tolerance is None else simplify_tolerance)
+
+        segments = []
+        for i, index in enumerate(np.argsort(scores)[::-1]):
+            segments.append(Segment(index=i + 1,
+                                    score=float(scores[index]),
+                                    mask=masks[index].astype(np.uint8) * 255,
+                                    polygons=mask_to_polygons(masks[index], **polygon_options),
+                                    low_res_logits=logits[index]))
+
+        return segments
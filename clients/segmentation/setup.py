@@ -10,7 +10,6 @@ setup(
     packages=find_packages(),
     install_requires=[
         "grpcio",
-        "grpcio-tools",
         "protobuf",
         "numpy",
         "pillow",
@@ -18,6 +17,10 @@ setup(
         "opencv-python",
         "segmentation_grpc",
     ],
+    extras_require={
+        # Decoding prompts locally on embeddings from GetImageEmbedding
+        "local": ["onnxruntime"],
+    },
     python_requires=">=3.7",
     description="Client for the segmentation service",
     author="James Anderson",
@@ -0,0 +1,177 @@
+import asyncio
+import random
+
+import grpc
+import pytest
+
+from segmentation_grpc import (add_SegmentationServiceServicer_to_server, SegmentationServiceServicer,
+                               SegmentationRequest, SegmentationResponse, LoadReport)
+from segmentation_grpc.metadata import AFFINITY, QUEUE_DEPTH, IN_FLIGHT
+
+from SegmentationClient.balancer import LoadBalancer, ConsistentHashRing, Replica
+
+
+class FakeReplica(SegmentationServiceServicer):
+    """A server that reports a configurable load and records the requests it receives."""
+
+    def __init__(self, queue_depth=0, code=None):
+        self.queue_depth = queue_depth
+        self.code = code
+        self.requests = []
+
+    async def GetLoad(self, request, context):
+        return LoadReport(queue_depth=self.queue_depth)
+
+    async def SegmentImage(self, request, context):
+        self.requests.append(dict(context.invocation_metadata()))
+        if self.code is not None:
+            await context.abort(self.code, "fake failure")
+
+        context.set_trailing_metadata(((QUEUE_DEPTH, str(self.queue_depth)), (IN_FLIGHT, '0')))
+        return SegmentationResponse()
+
+
+def _run(fakes, test):
+    """Serve each fake replica in process and run test(addresses)."""
+    async def run():
+        servers, addresses = [], []
+        for fake in fakes:
+            server = grpc.aio.server()
+            add_SegmentationServiceServicer_to_server(fake, server)
+            addresses.append(f'127.0.0.1:{server.add_insecure_port("127.0.0.1:0")}')
+            await server.start()
+            servers.append(server)
+        try:
+            return await test(addresses)
+        finally:
+            await asyncio.gather(*(server.stop(None) for server in servers))
+
+    return asyncio.run(run())
+
+
+def test_rejects_bad_arguments():
+    with pytest.raises(ValueError):
+        LoadBalancer([])
+    with pytest.raises(ValueError):
+        LoadBalancer(['127.0.0.1:1'], policy='round_robin')
+
+
+def test_ring_walk_visits_each_replica_once():
+    async def run():
+        replicas = [Replica(f'replica{i}:50051') for i in range(4)]
+        ring = ConsistentHashRing(replicas)
+        walk = list(ring.walk('image-1'))
+        assert sorted(r.address for r in walk) == sorted(r.address for r in replicas)
+        assert list(ring.walk('image-1')) == walk
+
+        # Dropping a replica only moves the keys it owned
+        keys = [f'image-{i}' for i in range(200)]
+        smaller = ConsistentHashRing(replicas[:3])
+        for key in keys:
+            owner = next(ring.walk(key))
+            if owner is not replicas[3]:
+                assert next(smaller.walk(key)) is owner
+
+        await asyncio.gather(*(replica.channel.close() for replica in replicas))
+
+    asyncio.run(run())
+
+
+def test_least_loaded_picks_shortest_queue():
+    fakes = [FakeReplica(queue_depth=5), FakeReplica(queue_depth=0), FakeReplica(queue_depth=9)]
+
+    async def test(addresses):
+        async with LoadBalancer(addresses, policy='least_loaded', poll_interval=None) as balancer:
+            assert [replica.queue_depth for replica in balancer.replicas] == [5, 0, 9]
+            await balancer.segment_image(SegmentationRequest(image_key='a'))
+
+    _run(fakes, test)
+    assert [len(fake.requests) for fake in fakes] == [0, 1, 0]
+
+
+def test_power_of_two_never_picks_most_loaded():
+    fakes = [FakeReplica(queue_depth=1), FakeReplica(queue_depth=2), FakeReplica(queue_depth=50)]
+
+    async def test(addresses):
+        async with LoadBalancer(addresses, policy='power_of_two', poll_interval=None,
+                                rng=random.Random(0)) as balancer:
+            picked = {balancer.pick().address for _ in range(50)}
+            assert picked == set(addresses[:2])
+
+    _run(fakes, test)
+
+
+def test_affinity_keeps_keys_on_their_owner():
+    fakes = [FakeReplica() for _ in range(3)]
+
+    async def test(addresses):
+        async with LoadBalancer(addresses, policy='affinity', poll_interval=None) as balancer:
+            for key in ('image-1', 'image-2', 'image-3'):
+                owner = balancer.owner(key)
+                for _ in range(3):
+                    assert balancer.pick(key=key) is owner
+
+            await balancer.segment_image(SegmentationRequest(image_key='image-1'))
+            return balancer.replicas.index(balancer.owner('image-1'))
+
+    owner_index = _run(fakes, test)
+    assert [len(fake.requests) for fake in fakes] == [int(i == owner_index) for i in range(3)]
+    assert fakes[owner_index].requests[0][AFFINITY] == '1'
+
+
+def test_affinity_spills_over_from_overloaded_owner():
+    fakes = [FakeReplica() for _ in range(3)]
+
+    async def test(addresses):
+        async with LoadBalancer(addresses, policy='affinity', poll_interval=None) as balancer:
+            owner, second = list(balancer.ring.walk('image-1'))[:2]
+            owner.queue_depth = 20
+            assert balancer.pick(key='image-1') is second
+
+            # Requests reaching a replica other than the owner are not marked as affinity hits
+            await balancer.segment_image(SegmentationRequest(image_key='image-1'))
+            return balancer.replicas.index(second)
+
+    second_index = _run(fakes, test)
+    assert len(fakes[second_index].requests) == 1
+    assert AFFINITY not in fakes[second_index].requests[0]
+
+
+def test_retries_unavailable_on_another_replica():
+    fakes = [FakeReplica(code=grpc.StatusCode.UNAVAILABLE), FakeReplica(queue_depth=3)]
+
+    async def test(addresses):
+        async with LoadBalancer(addresses, policy='least_loaded', poll_interval=None) as balancer:
+            await balancer.segment_image(SegmentationRequest(image_key='a'))
+            assert not balancer.replicas[0].healthy
+            # The load attached to the successful response is recorded
+            assert balancer.replicas[1].queue_depth == 3
+
+    _run(fakes, test)
+    assert [len(fake.requests) for fake in fakes] == [1, 1]
+
+
+def test_does_not_retry_other_errors():
+    fakes = [FakeReplica(code=grpc.StatusCode.INVALID_ARGUMENT), FakeReplica(queue_depth=3)]
+
+    async def test(addresses):
+        async with LoadBalancer(addresses, policy='least_loaded', poll_interval=None) as balancer:
+            with pytest.raises(grpc.aio.AioRpcError) as error:
+                await balancer.segment_image(SegmentationRequest(image_key='a'))
+            assert error.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+
+    _run(fakes, test)
+    assert [len(fake.requests) for fake in fakes] == [1, 0]
+
+
+def test_gives_up_when_every_replica_is_unavailable():
+    fakes = [FakeReplica(code=grpc.StatusCode.UNAVAILABLE) for _ in range(2)]
+
+    async def test(addresses):
+        async with LoadBalancer(addresses, policy='least_loaded', poll_interval=None) as balancer:
+            with pytest.raises(grpc.aio.AioRpcError) as error:
+                await balancer.segment_image(SegmentationRequest(image_key='a'))
+            assert error.value.code() == grpc.StatusCode.UNAVAILABLE
+
+    _run(fakes, test)
+    assert [len(fake.requests) for fake in fakes] == [1, 1]
@@ -0,0 +1,105 @@
+import asyncio
+
+import cv2
+import numpy as np
+import pytest
+
+from segmentation_grpc import SegmentResult, Box, Polygon, Point
+
+from SegmentationClient import client_example
+from SegmentationClient.client_example import _parse_segment, _merge_segment_result, _superseding, CallSuperseded
+
+
+def _png(mask):
+    return cv2.imencode('.png', mask.astype(np.uint8) * 255)[1].tobytes()
+
+
+def test_parse_segment_places_window_mask_in_image():
+    window_mask = np.zeros((20, 30), dtype=bool)
+    window_mask[5:10, 5:10] = True
+    segment = SegmentResult(index=1, score=0.9, mask=_png(window_mask), mask_window=Box(x0=40, y0=10, x1=70, y1=30))
+
+    mask = _parse_segment(segment, 100, 50).mask
+    assert mask.shape == (50, 100)
+    np.testing.assert_array_equal(mask[10:30, 40:70] > 0, window_mask)
+    assert np.count_nonzero(mask) == np.count_nonzero(window_mask)
+
+
+def test_parse_segment_keeps_full_image_mask():
+    full_mask = np.zeros((50, 100), dtype=bool)
+    full_mask[1:4, 2:8] = True
+
+    mask = _parse_segment(SegmentResult(index=1, mask=_png(full_mask)), 100, 50).mask
+    np.testing.assert_array_equal(mask > 0, full_mask)
+
+
+def _polygon(*points):
+    return Polygon(points=[Point(x=x, y=y) for x, y in points])
+
+
+def test_merge_segment_result_replaces_updated_fields():
+    coarse = _polygon((0, 0), (8, 0), (8, 8))
+    refined = _polygon((1, 1), (7, 1), (7, 7), (1, 7))
+    segment = SegmentResult(index=1, score=0.9, polygons=[coarse])
+
+    # The full resolution polygons replace the preview's instead of being appended to them
+    _merge_segment_result(segment, SegmentResult(index=1, polygons=[refined]))
+    assert list(segment.polygons) == [refined]
+    assert segment.score == pytest.approx(0.9)
+
+    # The complete stage adds the mask without its polygons, which keeps the refined ones
+    _merge_segment_result(segment, SegmentResult(index=1, score=0.9, mask=b'png', mask_window=Box(x1=8, y1=8)))
+    assert list(segment.polygons) == [refined]
+    assert segment.mask == b'png'
+    assert segment.mask_window == Box(x1=8, y1=8)
+
+
+async def _await_call(supersede_key, call):
+    """Wait on a call, standing in for a gRPC call as a future cancelled by call.cancel()."""
+    with _superseding(supersede_key, call):
+        return await call
+
+
+def test_superseding_cancels_the_older_call_of_a_key():
+    async def run():
+        loop = asyncio.get_running_loop()
+        first_call, second_call = loop.create_future(), loop.create_future()
+
+        first = asyncio.ensure_future(_await_call('cell-7', first_call))
+        await asyncio.sleep(0)
+        assert client_example._outstanding_calls == {'cell-7': first_call}
+
+        second = asyncio.ensure_future(_await_call('cell-7', second_call))
+        await asyncio.sleep(0)
+        assert first_call.cancelled()
+        assert client_example._outstanding_calls == {'cell-7': second_call}
+        with pytest.raises(CallSuperseded):
+            await first
+
+        second_call.set_result('response')
+        assert await second == 'response'
+
+    asyncio.run(run())
+    assert client_example._outstanding_calls == {}
+
+
+def test_superseding_lets_other_cancellations_through():
+    async def run():
+        loop = asyncio.get_running_loop()
+
+        # Calls without a key are not tracked
+        call = loop.create_future()
+        call.set_result('response')
+        assert await _await_call(None, call) == 'response'
+        assert client_example._outstanding_calls == {}
+
+        # A call cancelled for another reason than a newer call is not reported as superseded
+        call = loop.create_future()
+        task = asyncio.ensure_future(_await_call('cell-7', call))
+        await asyncio.sleep(0)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert client_example._outstanding_calls == {}
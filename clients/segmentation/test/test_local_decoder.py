@@ -0,0 +1,31 @@
+import cv2
+import numpy as np
+
+from SegmentationClient.local_decoder import mask_to_polygons
+
+
+def _signed_area(polygon):
+    x, y = polygon[:, 0].astype(np.float64), polygon[:, 1].astype(np.float64)
+    return 0.5 * (np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def _ring():
+    mask = np.zeros((100, 100), dtype=np.uint8)
+    cv2.circle(mask, (50, 50), 40, 1, -1)
+    cv2.circle(mask, (50, 50), 15, 0, -1)
+    return mask.astype(bool)
+
+
+def test_holes_follow_contour_mode():
+    assert len(mask_to_polygons(_ring())) == 1
+
+    polygons = mask_to_polygons(_ring(), holes=True)
+    assert sorted(np.sign(_signed_area(polygon)) for polygon in polygons) == [-1, 1]
+
+
+def test_vertex_budget_and_tolerance():
+    assert all(len(polygon) <= 8 for polygon in mask_to_polygons(_ring(), max_vertices=8, holes=True))
+
+    (coarse,) = mask_to_polygons(_ring(), tolerance=0.05)
+    (fine,) = mask_to_polygons(_ring(), tolerance=0.001)
+    assert len(coarse) < len(fine)
@@ -2,7 +2,6 @@
 
 /opt/nvidia/nvidia_entrypoint.sh
 sudo service ssh start
-python3 -m segmentation_grpc
 python3 -m segmentation_server
 exec "$@"
 /bin/bash
\ No newline at end of file
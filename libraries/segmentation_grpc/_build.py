@@ -1,136 +1,46 @@
 # build.py
-import os
-import shutil
-import urllib.request
-import urllib.error
-import time
-import tempfile
-import hashlib
-from datetime import datetime
-
-from setuptools.command.build_py import build_py
-
-
-
-def setup_proto_file():
-    """Set up the proto file by first looking in the external directory, then downloading from GitHub if not found."""
-
-    # Get the current directory and package directory
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    package_dir = os.path.join(current_dir, 'segmentation_grpc')
-
-    # Create directories if they don't exist
-    os.makedirs(package_dir, exist_ok=True)
-
-    # Target path (absolute)
-    target = os.path.join(current_dir, 'segmentation_grpc', 'segmentation.proto')
+"""
+Build-time gRPC code generation.
 
-    # First, try to find the proto file in the external directory
-    possible_locations = [
-        os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(current_dir))), 'external', 'Segmentation', 'SAM2', 'segmentation.proto'),
-        os.path.join(os.path.dirname(os.path.dirname(current_dir)), 'external', 'Segmentation', 'SAM2', 'segmentation.proto'),
-        'external/Segmentation/SAM2/segmentation.proto',
-        '/home/user/external/Segmentation/SAM2/segmentation.proto'  # Docker container path
-    ]
+The Python code for the gRPC interface is generated from the proto file vendored
+in the package, segmentation_grpc/segmentation.proto, while the package is built.
+The build never touches the network.  To pick up a new version of the interface,
+copy the updated proto file into the package before building.
 
-    for local_source in possible_locations:
-        if os.path.exists(local_source):
-            print(f"Found proto file at {local_source}")
-            shutil.copy2(local_source, target)
-            print(f"Copied proto file from {local_source} to {target}")
-            return True
+The generator is segmentation_grpc/generate_grpc.py, which installs with the
+package as the generate-grpc command.  It is loaded from its file because the
+package itself cannot be imported before its code is generated.
+"""
 
-    # If not found in external directory, try to download from GitHub
-    # GitHub URL for the proto file (corrected URL)
-    github_url = 'https://raw.githubusercontent.com/jamesra/pyViking/master/libraries/segmentation_grpc/segmentation_grpc/segmentation.proto'
-
-    # Check if we need to download the file
-    need_download = True
-
-    # If the file exists, check if it's been modified
-    if os.path.exists(target) and os.path.isfile(target):
-        try:
-            # Download the remote file to a temporary location
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_path = temp_file.name
-
-            print(f"Downloading remote proto file to temporary location for comparison")
-            urllib.request.urlretrieve(github_url, temp_path)
-
-            # Calculate hashes for both files
-            def get_file_hash(file_path):
-                with open(file_path, 'rb') as f:
-                    return hashlib.md5(f.read()).hexdigest()
-
-            local_hash = get_file_hash(target)
-            remote_hash = get_file_hash(temp_path)
-
-            # Check if the files are different
-            if local_hash != remote_hash:
-                # Files are different, check if local file has been modified by user
-                # We'll look for comments or other indicators that it's been manually edited
-                with open(target, 'r') as f:
-                    local_content = f.read()
-
-                # Check for indicators of manual modification
-                # This is a simple heuristic - you might want to improve it
-                manual_edit_indicators = [
-                    "// Modified by user",
-                    "// Custom modification",
-                    "// This is a modified version"
-                ]
+import importlib.util
+import os
+import sys
 
-                is_manually_modified = any(indicator in local_content for indicator in manual_edit_indicators)
+_PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'segmentation_grpc')
 
-                if is_manually_modified:
-                    print(f"Local file appears to be manually modified. Keeping local copy.")
-                    need_download = False
-                else:
-                    # Get modification times for additional information
-                    local_mtime = os.path.getmtime(target)
-                    local_time = datetime.fromtimestamp(local_mtime)
 
-                    # If the local file is newer than a reasonable threshold (e.g., 1 day),
-                    # assume it's been intentionally modified
-                    one_day_ago = time.time() - (24 * 60 * 60)
-                    if local_mtime > one_day_ago:
-                        print(f"Local file is recent (modified at {local_time}). Keeping local copy.")
-                        need_download = False
-                    else:
-                        print(f"Local file differs from remote but doesn't appear to be manually modified.")
-                        print(f"Local file will be replaced with the remote version.")
-                        if os.path.islink(target) or os.path.isfile(target):
-                            os.remove(target)
-            else:
-                # Files are identical, no need to download
-                print(f"Local file is identical to remote file. No download needed.")
-                need_download = False
+def _load_generator():
+    """Load segmentation_grpc/generate_grpc.py without importing the package."""
+    spec = importlib.util.spec_from_file_location('_segmentation_grpc_generate',
+                                                  os.path.join(_PACKAGE_DIR, 'generate_grpc.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
-            # Clean up the temporary file
-            os.unlink(temp_path)
 
-        except (urllib.error.URLError, ValueError, IOError) as e:
-            print(f"Error checking remote file: {e}")
-            # Keep the local file if we can't check the remote one
-            print(f"Keeping local copy due to error checking remote file.")
-            need_download = False
+def generate_grpc_sources(output_dir: str = None) -> bool:
+    """
+    Generate segmentation_pb2.py and segmentation_pb2_grpc.py from the vendored proto file.
 
-    # Download the proto file from GitHub if needed
-    if need_download:
-        try:
-            print(f"Downloading proto file from {github_url}")
-            urllib.request.urlretrieve(github_url, target)
-            print(f"Successfully downloaded proto file to {target}")
-            return True
-        except urllib.error.URLError as e:
-            print(f"Error downloading proto file: {e}")
-            print(f"No local copy found in any of the expected locations and GitHub download failed")
-            return False
+    Args:
+        output_dir: Directory to write the generated modules to, defaults to the source package directory
 
-    # If we get here, it means we didn't need to download and kept the local file
-    return True
+    Returns:
+        True if the code was generated, False otherwise
+    """
+    return _load_generator().generate_grpc_sources(_PACKAGE_DIR, output_dir)
 
 
 if __name__ == "__main__":
-    # This allows running the script directly, not just as part of Poetry build
-    setup_proto_file()
+    # This allows running the script directly, not just as part of the build
+    sys.exit(0 if generate_grpc_sources() else 1)
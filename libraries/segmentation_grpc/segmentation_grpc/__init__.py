@@ -1,44 +1,63 @@
-from .generate_grpc import generate_grpc_code
+"""
+segmentation_grpc Package
+
+Messages and service stubs of the segmentation gRPC interface.  The Python code
+is generated from segmentation.proto when the package is built, importing the
+package never runs the protoc compiler.
+
+The service classes pull in the grpc runtime, so they are only imported when
+first accessed.  Code that only needs the messages does not pay for it.
+"""
 
 try:
-    from  . import segmentation_pb2
+    from . import segmentation_pb2
     from .segmentation_pb2 import (SegmentationRequest,
-                                  SegmentationResponse,
-                                  SegmentResult,
-                                  Point, Polygon)
-
-    from . import segmentation_pb2_grpc
-    from .segmentation_pb2_grpc import (SegmentationServiceServicer,
-                                        add_SegmentationServiceServicer_to_server,
-                                            SegmentationService,
-                                        SegmentationServiceStub)
-except ModuleNotFoundError:
-    # If the module is not found, it means the gRPC code has not been generated.
-    # Attempt to generate the gRPC code.
-    print("gRPC code not found. Attempting to generate it.")
-    try:
-        if not generate_grpc_code(True):
-            print("Failed to generate gRPC code. Please check the proto file.")
-            raise ImportError("Failed to generate gRPC code")
-    except ModuleNotFoundError as e:
-        if "grpc_tools" in str(e):
-            print("Warning: grpc_tools not found. Cannot generate gRPC code.")
-            print("Please install grpcio-tools and run 'python -m segmentation_grpc' to generate the gRPC code.")
-            raise ImportError("grpc_tools not found. Please install grpcio-tools") from e
-        else:
-            raise
-
-    # Try to import again after generating the code
-    try:
-        from . import segmentation_pb2
-        from .segmentation_pb2 import (SegmentationRequest,
-                                       SegmentationResponse,
-                                       Point, Polygon)
-
-        from . import segmentation_pb2_grpc
-        from .segmentation_pb2_grpc import (SegmentationServiceServicer,
-                                            SegmentationService)
-    except ModuleNotFoundError:
-        print("Failed to import generated gRPC code even after attempting to generate it.")
-        print("This might be because grpcio-tools is not installed or the proto file is invalid.")
+                                   SegmentationResponse,
+                                   SegmentationUpdate, SegmentationStage,
+                                   SegmentResult,
+                                   Point, Polygon,
+                                   Box, MaskLogits,
+                                   SectionImage, StackPropagationRequest,
+                                   SectionSegmentation, PropagationDirection,
+                                   PromptGroup, RegionOfInterest,
+                                   LabeledImageFormat, LabeledImageType,
+                                   SharedMemoryArray, PackedPolygons, ContourMode,
+                                   LoadRequest, LoadReport, StageLoad, ClientLoad,
+                                   PrefetchRequest, PrefetchResponse, PrefetchStatus,
+                                   EmbeddingRequest, EmbeddingTensor, ImageEmbedding, TensorEncoding)
+    _missing_generated_code = None
+except ModuleNotFoundError as e:
+    if e.name != f'{__name__}.segmentation_pb2':
         raise
+
+    # Only a source checkout that was never built lacks the generated code.  The package still
+    # imports so 'python -m segmentation_grpc' can generate it, using the messages raises instead.
+    _missing_generated_code = e
+
+# Names resolved on first access, mapped to the module that provides them
+_lazy_attributes = {
+    'segmentation_pb2_grpc': None,
+    'SegmentationServiceServicer': 'segmentation_pb2_grpc',
+    'add_SegmentationServiceServicer_to_server': 'segmentation_pb2_grpc',
+    'SegmentationService': 'segmentation_pb2_grpc',
+    'SegmentationServiceStub': 'segmentation_pb2_grpc',
+    'generate_grpc_code': 'generate_grpc',
+}
+
+
+def __getattr__(name):
+    """Import the grpc service classes and the code generator on first access."""
+    if name not in _lazy_attributes:
+        if _missing_generated_code is not None and not name.startswith('__'):
+            raise ImportError(f"Cannot import {name}, the gRPC code for {__name__} has not been generated. "
+                              f"Run 'python -m segmentation_grpc' or build the package with pip.") from _missing_generated_code
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    import importlib
+    module_name = _lazy_attributes[name] or name
+    module = importlib.import_module(f'.{module_name}', __name__)
+    value = module if _lazy_attributes[name] is None else getattr(module, name)
+
+    # Cache the value so later lookups bypass __getattr__
+    globals()[name] = value
+    return value
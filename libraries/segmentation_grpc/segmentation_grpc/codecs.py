@@ -0,0 +1,296 @@
+"""
+Wire Format Codecs
+
+Helpers shared by the segmentation client and server to convert between numpy
+arrays and the compact binary fields of the segmentation messages.
+"""
+
+import zlib
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from segmentation_grpc.segmentation_pb2 import (MaskLogits, LabeledImageType, PackedPolygons, Polygon, EmbeddingTensor,
+                                               ImageEmbedding, TensorEncoding)
+
+# Little-endian numpy dtype of each labeled image pixel type
+LABELED_IMAGE_DTYPES = {
+    LabeledImageType.LABELED_IMAGE_UINT16: np.dtype('<u2'),
+    LabeledImageType.LABELED_IMAGE_UINT8: np.dtype('u1'),
+}
+
+# Little-endian numpy dtype of each embedding tensor encoding
+TENSOR_DTYPES = {
+    TensorEncoding.TENSOR_FLOAT16: np.dtype('<f2'),
+    TensorEncoding.TENSOR_INT8: np.dtype('i1'),
+    TensorEncoding.TENSOR_FLOAT32: np.dtype('<f4'),
+}
+
+# Wire format tags of Polygon.points and Point.x, Point.y, all length delimited or varint fields
+_POINTS_TAG, _X_TAG, _Y_TAG = 0x0A, 0x08, 0x10
+
+# Bit offsets of the 7 bit groups of a varint, int32 values are sign extended to 10 groups
+_VARINT_SHIFTS = np.arange(0, 70, 7, dtype=np.uint64)
+
+# zlib level used for embedding tensors, higher levels gain little on float data
+_TENSOR_COMPRESSION_LEVEL = 1
+
+
+def encode_mask_logits(logits: NDArray) -> MaskLogits:
+    """
+    Pack a 2D array of low resolution mask logits into a MaskLogits message.
+
+    Args:
+        logits: A 2D array of shape (height, width)
+
+    Returns:
+        A MaskLogits message holding the logits as little-endian float16
+    """
+    if logits.ndim != 2:
+        raise ValueError(f"Expected 2D logits, got shape {logits.shape}")
+
+    height, width = logits.shape
+    return MaskLogits(width=width,
+                      height=height,
+                      data=np.ascontiguousarray(logits, dtype='<f2').tobytes())
+
+
+def decode_mask_logits(message: MaskLogits) -> NDArray[np.float32]:
+    """
+    Unpack a MaskLogits message into a 2D float32 array.
+
+    Args:
+        message: The MaskLogits message
+
+    Returns:
+        A float32 array of shape (height, width)
+    """
+    expected = message.width * message.height * 2
+    if len(message.data) != expected:
+        raise ValueError(f"MaskLogits data is {len(message.data)} bytes, expected {expected} "
+                         f"for {message.width}x{message.height} float16 values")
+
+    return np.frombuffer(message.data, dtype='<f2').reshape(message.height, message.width).astype(np.float32)
+
+
+def encode_raw_labeled_image(labeled_image: NDArray, image_type: int) -> bytes:
+    """
+    Encode a labeled image as raw little-endian pixels for LABELED_IMAGE_RAW.
+
+    Args:
+        labeled_image: A 2D array of segment indices
+        image_type: A LabeledImageType value
+
+    Returns:
+        The pixel values in row-major order
+    """
+    return np.ascontiguousarray(labeled_image, dtype=LABELED_IMAGE_DTYPES[image_type]).tobytes()
+
+
+def decode_raw_labeled_image(data: bytes, width: int, height: int, image_type: int) -> NDArray:
+    """
+    Decode a labeled image sent as LABELED_IMAGE_RAW.
+
+    Args:
+        data: The raw pixel bytes
+        width: Width of the labeled image
+        height: Height of the labeled image
+        image_type: A LabeledImageType value
+
+    Returns:
+        A read-only array of shape (height, width) backed by data
+    """
+    dtype = LABELED_IMAGE_DTYPES[image_type]
+    if len(data) != width * height * dtype.itemsize:
+        raise ValueError(f"Labeled image data is {len(data)} bytes, expected {width * height * dtype.itemsize} "
+                         f"for {width}x{height} {dtype} pixels")
+
+    return np.frombuffer(data, dtype=dtype).reshape(height, width)
+
+
+def encode_packed_polygons(polygons: Sequence[NDArray]) -> PackedPolygons:
+    """
+    Pack polygons into a PackedPolygons message.
+
+    All rings are concatenated and delta encoded in one pass, so consecutive
+    vertices, which are usually close together, encode as small varints.
+
+    Args:
+        polygons: Arrays of shape (N, 2) holding the (x, y) vertices of each ring
+
+    Returns:
+        A PackedPolygons message
+    """
+    if len(polygons) == 0:
+        return PackedPolygons()
+
+    vertices = np.concatenate([np.asarray(polygon, dtype=np.int32).reshape(-1, 2) for polygon in polygons])
+    deltas = np.diff(vertices, axis=0, prepend=np.zeros((1, 2), dtype=np.int32))
+    ring_offsets = np.cumsum([0] + [len(polygon) for polygon in polygons[:-1]])
+
+    # Converting to lists first is much faster than extending the repeated fields from arrays
+    return PackedPolygons(deltas=deltas.ravel().tolist(), ring_offsets=ring_offsets.tolist())
+
+
+def _varints(values: NDArray) -> Tuple[NDArray[np.uint8], NDArray[np.intp]]:
+    """Encode int32 values as protobuf varints, returning a (N, G) array of bytes and the length of each."""
+    unsigned = np.asarray(values, dtype=np.int64).view(np.uint64)
+
+    # Only as many 7 bit groups as the largest value needs, negative values are sign extended to 10
+    num_groups = 1 + int(np.searchsorted(np.uint64(1) << _VARINT_SHIFTS[1:], unsigned.max(initial=0), side='right'))
+    shifts = _VARINT_SHIFTS[:num_groups]
+
+    groups = ((unsigned[:, None] >> shifts) & np.uint64(0x7F)).astype(np.uint8)
+    lengths = 1 + (unsigned[:, None] >= (np.uint64(1) << shifts[1:])).sum(axis=1)
+
+    # Every byte but the last has its continuation bit set
+    groups[np.arange(num_groups) < (lengths - 1)[:, None]] |= 0x80
+    return groups, lengths
+
+
+def encode_polygons(polygons: Sequence[NDArray]) -> List[Polygon]:
+    """
+    Build Polygon messages for many polygons at once.
+
+    Creating a Point message per vertex costs a few microseconds of Python each,
+    which adds up for responses with many segments.  Instead the wire format of
+    all points is laid out with numpy and each Polygon is parsed from its bytes.
+
+    Args:
+        polygons: Arrays of shape (N, 2) holding the (x, y) vertices of each ring
+
+    Returns:
+        A list of Polygon messages, one per ring
+    """
+    if len(polygons) == 0:
+        return []
+
+    vertices = np.concatenate([np.asarray(polygon, dtype=np.int32).reshape(-1, 2) for polygon in polygons])
+    x_bytes, x_lengths = _varints(vertices[:, 0])
+    y_bytes, y_lengths = _varints(vertices[:, 1])
+
+    # Each point is a length delimited Point message: tag, length, x tag, x, y tag, y.  Points
+    # are at most 22 bytes, so their length always fits a single byte varint.
+    point_lengths = 2 + x_lengths + y_lengths
+    x_width, y_width = x_bytes.shape[1], y_bytes.shape[1]
+    rows = np.arange(len(vertices))[:, None]
+    fields = np.zeros((len(vertices), 4 + x_width + y_width), dtype=np.uint8)
+    fields[:, 0] = _POINTS_TAG
+    fields[:, 1] = point_lengths
+    fields[:, 2] = _X_TAG
+    fields[:, 3:3 + x_width] = x_bytes
+    fields[rows[:, 0], 3 + x_lengths] = _Y_TAG
+    fields[rows, (4 + x_lengths)[:, None] + np.arange(y_width)] = y_bytes
+
+    # Unused trailing bytes of each row are dropped
+    data = fields[np.arange(fields.shape[1]) < (point_lengths + 2)[:, None]].tobytes()
+
+    # Byte offset of each polygon's first point
+    point_offsets = np.concatenate([[0], np.cumsum(point_lengths + 2)])
+    offsets = point_offsets[np.cumsum([0] + [len(polygon) for polygon in polygons])].tolist()
+    return [Polygon.FromString(data[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def decode_packed_polygons(message: PackedPolygons) -> List[NDArray[np.int32]]:
+    """
+    Unpack a PackedPolygons message.
+
+    Args:
+        message: The PackedPolygons message
+
+    Returns:
+        A list of int32 arrays of shape (N, 2) holding the (x, y) vertices of each ring
+    """
+    if len(message.deltas) % 2 != 0:
+        raise ValueError(f"PackedPolygons has {len(message.deltas)} deltas, expected pairs of x, y")
+
+    if len(message.ring_offsets) == 0:
+        return []
+
+    vertices = np.asarray(message.deltas, dtype=np.int32).reshape(-1, 2).cumsum(axis=0, dtype=np.int32)
+    return np.split(vertices, np.asarray(message.ring_offsets[1:], dtype=np.intp))
+
+
+def encode_embedding_tensor(name: str,
+                            array: NDArray,
+                            encoding: int = TensorEncoding.TENSOR_FLOAT16,
+                            compress: bool = False) -> EmbeddingTensor:
+    """
+    Pack an embedding array into an EmbeddingTensor message.
+
+    Args:
+        name: Name of the tensor
+        array: An array of shape (batch, channels, ...)
+        encoding: A TensorEncoding value.  TENSOR_INT8 quantizes each channel
+                  symmetrically with its own scale.
+        compress: Whether to zlib compress the data
+
+    Returns:
+        An EmbeddingTensor message
+    """
+    array = np.asarray(array, dtype=np.float32)
+    message = EmbeddingTensor(name=name, shape=array.shape, encoding=encoding)
+
+    if encoding == TensorEncoding.TENSOR_INT8:
+        if array.ndim < 2:
+            raise ValueError(f"TENSOR_INT8 needs a channel axis, got shape {array.shape}")
+
+        reduce_axes = tuple(axis for axis in range(array.ndim) if axis != 1)
+        scales = np.abs(array).max(axis=reduce_axes) / 127.0
+        scales[scales == 0] = 1.0
+        channel_shape = [1, -1] + [1] * (array.ndim - 2)
+        values = np.clip(np.rint(array / scales.reshape(channel_shape)), -127, 127)
+        message.scales.extend(scales.tolist())
+    else:
+        values = array
+
+    data = np.ascontiguousarray(values, dtype=TENSOR_DTYPES[encoding]).tobytes()
+    if compress:
+        data = zlib.compress(data, _TENSOR_COMPRESSION_LEVEL)
+        message.compressed = True
+
+    message.data = data
+    return message
+
+
+def decode_embedding_tensor(message: EmbeddingTensor) -> NDArray[np.float32]:
+    """
+    Unpack an EmbeddingTensor message into a float32 array.
+
+    Args:
+        message: The EmbeddingTensor message
+
+    Returns:
+        A float32 array of the tensor's shape
+    """
+    dtype = TENSOR_DTYPES[message.encoding]
+    data = zlib.decompress(message.data) if message.compressed else message.data
+
+    shape = tuple(message.shape)
+    expected = int(np.prod(shape)) * dtype.itemsize
+    if len(data) != expected:
+        raise ValueError(f"EmbeddingTensor {message.name} holds {len(data)} bytes, expected {expected} "
+                         f"for a {shape} {dtype} array")
+
+    array = np.frombuffer(data, dtype=dtype).reshape(shape).astype(np.float32)
+    if message.encoding == TensorEncoding.TENSOR_INT8:
+        if len(message.scales) != shape[1]:
+            raise ValueError(f"EmbeddingTensor {message.name} has {len(message.scales)} scales "
+                             f"for {shape[1]} channels")
+        array *= np.asarray(message.scales, dtype=np.float32).reshape([1, -1] + [1] * (len(shape) - 2))
+
+    return array
+
+
+def decode_image_embedding(message: ImageEmbedding) -> Dict[str, NDArray[np.float32]]:
+    """
+    Unpack the tensors of an ImageEmbedding message.
+
+    Args:
+        message: The ImageEmbedding message
+
+    Returns:
+        A dictionary of float32 arrays by tensor name
+    """
+    return {tensor.name: decode_embedding_tensor(tensor) for tensor in message.tensors}
@@ -2,105 +2,106 @@
 Generate gRPC Code
 
 This script generates the Python code for the gRPC service from the proto file.
-It uses the protoc compiler to generate the code.
+It runs the protoc compiler shipped with grpcio-tools, which is only installed
+with the package's 'generate' extra: pip install segmentation_grpc[generate]
+
+The package build uses generate_grpc_sources too, see _build.py.  This module
+only imports the standard library so the build can load it from its file
+before the package is importable.
 """
 
 import os
 import sys
-import subprocess
 
-def generate_grpc_code(force: bool = False):
-    """Generate the gRPC code from the proto file.
-    :param force: If True, force generation even if the proto file hasn't been modified since the last generation.  If False, skip generation if the proto file hasn't been modified since the last generation.
-    :return: True if we believe the code was generated successfully, or already exists.  False otherwise."""
-    # Get the current directory
-    current_dir = os.path.dirname(os.path.abspath(__file__))
+# Directory of the package and the vendored proto file
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def generate_grpc_sources(package_dir: str = PACKAGE_DIR, output_dir: str = None) -> bool:
+    """
+    Generate segmentation_pb2.py and segmentation_pb2_grpc.py from the vendored proto file.
 
-    # Path to the proto file
-    proto_file = os.path.join(current_dir, 'segmentation.proto')
+    Args:
+        package_dir: Directory of the segmentation_grpc package holding segmentation.proto
+        output_dir: Directory to write the generated modules to, defaults to package_dir
+
+    Returns:
+        True if the code was generated, False otherwise
+    """
+    try:
+        # Imported here so the package works without grpcio-tools, it is only needed to generate code
+        from grpc_tools import protoc
+    except ImportError:
+        print("Error: generating the gRPC code requires grpcio-tools, install it with "
+              "pip install segmentation_grpc[generate]")
+        return False
+    import importlib.resources
+
+    output_dir = output_dir or package_dir
+    proto_file = os.path.join(package_dir, 'segmentation.proto')
 
-    # Check if the proto file exists
     if not os.path.exists(proto_file):
         print(f"Error: Proto file not found at {proto_file}")
         return False
 
-    print(f"Proto file found at {proto_file}")
-
-    # Figure out if the proto file was modified after the segmentation_pb2_grpc.py file
-    if not force:
-        pb2_grpc_file = os.path.join(current_dir, 'segmentation_pb2_grpc.py')
-        if os.path.exists(pb2_grpc_file):
-            proto_mtime = os.path.getmtime(proto_file)
-            pb2_grpc_mtime = os.path.getmtime(pb2_grpc_file)
-            if proto_mtime <= pb2_grpc_mtime:
-                print("No changes detected in the proto file. Skipping code generation.")
-                return True
-
-    # Try to import grpc_tools.protoc
-    # try:
-    #     import grpc_tools.protoc
-    # except ModuleNotFoundError:
-    #     print("Error: grpc_tools.protoc module not found.")
-    #     print("Please install grpcio-tools package: pip install grpcio-tools")
-    #     return False
-
-    # Command to generate the gRPC code
-    cmd = [
-        sys.executable, '-m', 'grpc_tools.protoc',
-        f'--proto_path={current_dir}',
-        f'--python_out={current_dir}',
-        f'--grpc_python_out={current_dir}',
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Include the well known protos shipped with grpcio-tools, as the protoc command line does
+    well_known_protos = str(importlib.resources.files('grpc_tools') / '_proto')
+
+    result = protoc.main([
+        'grpc_tools.protoc',
+        f'--proto_path={package_dir}',
+        f'--proto_path={well_known_protos}',
+        f'--python_out={output_dir}',
+        f'--grpc_python_out={output_dir}',
         os.path.basename(proto_file)
-    ]
+    ])
 
-    try:
-        # Run the command
-        subprocess.check_call(cmd)
+    if result != 0:
+        print(f"Error: protoc failed with exit code {result} for {proto_file}")
+        return False
 
-        if os.path.exists(os.path.join(current_dir, 'segmentation_pb2.py')):
-            print(f"Successfully generated gRPC code from {proto_file} in {current_dir}")
-        else:
-            print(f"Failed to generate gRPC code from {proto_file} in {current_dir}")
-            return False
+    _fix_imports(os.path.join(output_dir, 'segmentation_pb2_grpc.py'))
+    print(f"Generated gRPC code from {proto_file} in {output_dir}")
+    return True
 
-        # Fix imports in the generated files
-        _fix_imports()
 
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error generating gRPC code: {e}")
-        return False
-    except ModuleNotFoundError as e:
-        if "grpc_tools" in str(e):
-            print(f"Error: grpc_tools module not found: {e}")
-            print("Please install grpcio-tools package: pip install grpcio-tools")
-        else:
-            print(f"Module not found error: {e}")
-        return False
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-        return False
+def generate_grpc_code(force: bool = False) -> bool:
+    """
+    Generate the gRPC code in the package directory from the proto file.
+
+    Args:
+        force: Generate the code even if it is newer than the proto file
+
+    Returns:
+        True if the code was generated or is already up to date, False otherwise
+    """
+    proto_file = os.path.join(PACKAGE_DIR, 'segmentation.proto')
+    pb2_grpc_file = os.path.join(PACKAGE_DIR, 'segmentation_pb2_grpc.py')
+
+    # Code generated after the proto file was last modified is up to date
+    if not force and os.path.exists(proto_file) and os.path.exists(pb2_grpc_file):
+        if os.path.getmtime(proto_file) <= os.path.getmtime(pb2_grpc_file):
+            print("No changes detected in the proto file. Skipping code generation.")
+            return True
+
+    return generate_grpc_sources(PACKAGE_DIR)
 
-def _fix_imports():
-    """Fix imports in the generated files to use the segmentation_grpc package."""
-    current_dir = os.path.dirname(os.path.abspath(__file__))
 
-    # Fix imports in segmentation_pb2_grpc.py
-    pb2_grpc_file = os.path.join(current_dir, 'segmentation_pb2_grpc.py')
-    if os.path.exists(pb2_grpc_file):
-        with open(pb2_grpc_file, 'r') as f:
-            content = f.read()
+def _fix_imports(pb2_grpc_file: str):
+    """Make the generated service module import its messages from the segmentation_grpc package."""
+    with open(pb2_grpc_file, 'r') as f:
+        content = f.read()
 
-        # Replace 'import segmentation_pb2 as segmentation__pb2' with 'from segmentation_grpc import segmentation_pb2 as segmentation__pb2'
-        content = content.replace(
-            'import segmentation_pb2 as segmentation__pb2',
-            'from segmentation_grpc import segmentation_pb2 as segmentation__pb2'
-        )
+    content = content.replace(
+        'import segmentation_pb2 as segmentation__pb2',
+        'from segmentation_grpc import segmentation_pb2 as segmentation__pb2'
+    )
 
-        with open(pb2_grpc_file, 'w') as f:
-            f.write(content)
+    with open(pb2_grpc_file, 'w') as f:
+        f.write(content)
 
-        print(f"Fixed imports in {pb2_grpc_file}")
 
 if __name__ == '__main__':
-    generate_grpc_code(True)
+    sys.exit(0 if generate_grpc_code(True) else 1)
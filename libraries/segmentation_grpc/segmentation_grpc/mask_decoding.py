@@ -0,0 +1,182 @@
+"""
+SAM2 Mask Decoder Inputs and Outputs
+
+The numpy half of running an exported SAM2 mask decoder, shared by the server's
+ONNX Runtime backend and clients decoding prompts locally on an embedding from
+GetImageEmbedding, so both produce the same masks.
+
+Before decoding, prompts are mapped from image coordinates into the frame of
+the square encoder input.  After decoding, the masks are chosen from the four
+mask tokens and their logits are upsampled to the image size.  This mirrors
+what SAM2ImagePredictor does in torch.
+"""
+
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+# Names of the embedding arrays, the encoder's outputs and the decoder's first inputs
+EMBEDDING_NAMES = ('image_embed', 'high_res_feats_0', 'high_res_feats_1')
+
+# Side length of the low resolution logits the decoder returns for each mask
+LOW_RES_MASK_SIZE = 256
+
+# Default tolerance the polygons of decoded masks are simplified with, as a fraction of each
+# contour's perimeter, so local decoding traces the same polygons as the server
+DEFAULT_SIMPLIFY_TOLERANCE = 0.005
+
+# SAM2.1 replaces an unstable single mask with the best of the multimask outputs
+_STABILITY_DELTA = 0.05
+_STABILITY_THRESHOLD = 0.98
+
+# SAM2ImagePredictor clamps the low resolution logits it returns to this range
+_LOGITS_LIMIT = 32.0
+
+
+def decoder_inputs(embedding: Dict[str, NDArray],
+                   point_coords: Optional[NDArray],
+                   point_labels: Optional[NDArray],
+                   boxes: Optional[NDArray],
+                   mask_input: Optional[NDArray],
+                   width: int,
+                   height: int,
+                   input_size: int) -> Dict[str, NDArray]:
+    """
+    Build the inputs of an exported decoder for a batch of prompt sets on one image.
+
+    Args:
+        embedding: The image's arrays, keyed by EMBEDDING_NAMES
+        point_coords: Array of shape (B, N, 2) of (x, y) image coordinates, or None
+        point_labels: Array of shape (B, N) of point labels, 1 foreground, 0 background, -1 padding
+        boxes: Array of shape (B, 4) of (x0, y0, x1, y1) boxes, or None
+        mask_input: Array of shape (B, 1, 256, 256) of low resolution logits from a previous result, or None
+        width: Width of the image
+        height: Height of the image
+        input_size: Side length of the square encoder input
+
+    Returns:
+        The decoder inputs by name
+    """
+    if point_coords is not None:
+        num_sets = point_coords.shape[0]
+    elif boxes is not None:
+        num_sets = boxes.shape[0]
+    else:
+        raise ValueError("Decoding needs point or box prompts")
+
+    # Boxes are given to the decoder as two corner points labelled 2 and 3, ahead of the points
+    coords = np.zeros((num_sets, 0, 2), dtype=np.float32)
+    labels = np.zeros((num_sets, 0), dtype=np.float32)
+    if boxes is not None:
+        coords = np.asarray(boxes, dtype=np.float32).reshape(num_sets, 2, 2)
+        labels = np.tile(np.array([2, 3], dtype=np.float32), (num_sets, 1))
+    if point_coords is not None:
+        coords = np.concatenate([coords, np.asarray(point_coords, dtype=np.float32)], axis=1)
+        labels = np.concatenate([labels, np.asarray(point_labels, dtype=np.float32)], axis=1)
+
+    # Map the prompts into the frame of the resized encoder input
+    coords = coords * np.array([input_size / width, input_size / height], dtype=np.float32)
+
+    mask_shape = (num_sets, 1, LOW_RES_MASK_SIZE, LOW_RES_MASK_SIZE)
+    if mask_input is None:
+        has_mask_input = np.zeros((num_sets,), dtype=np.float32)
+        mask_input = np.zeros(mask_shape, dtype=np.float32)
+    else:
+        has_mask_input = np.ones((num_sets,), dtype=np.float32)
+        mask_input = np.ascontiguousarray(np.broadcast_to(mask_input, mask_shape), dtype=np.float32)
+
+    return {
+        **{name: embedding[name] for name in EMBEDDING_NAMES},
+        'point_coords': coords,
+        'point_labels': labels,
+        'mask_input': mask_input,
+        'has_mask_input': has_mask_input,
+    }
+
+
+def decoder_outputs(low_res: NDArray,
+                    iou: NDArray,
+                    multimask_output: bool,
+                    width: int,
+                    height: int) -> Tuple[NDArray[np.bool_], NDArray[np.float32], NDArray[np.float32]]:
+    """
+    Choose the masks from the outputs of an exported decoder and upsample them to the image.
+
+    Args:
+        low_res: Array of shape (B, 4, 256, 256) of the logits of every mask token
+        iou: Array of shape (B, 4) of the IoU predictions of every mask token
+        multimask_output: Whether to return the three multimask outputs instead of one mask
+        width: Width of the image
+        height: Height of the image
+
+    Returns:
+        A tuple of (masks, scores, logits) with shapes (B, C, height, width), (B, C) and (B, C, 256, 256)
+    """
+    # The decoder returns a single mask token followed by three multimask tokens
+    if multimask_output:
+        low_res, iou = low_res[:, 1:], iou[:, 1:]
+    else:
+        low_res, iou = select_single_mask(low_res, iou)
+
+    low_res = np.clip(low_res, -_LOGITS_LIMIT, _LOGITS_LIMIT).astype(np.float32)
+    masks = np.empty((*low_res.shape[:2], height, width), dtype=bool)
+    for i in range(low_res.shape[0]):
+        for j in range(low_res.shape[1]):
+            masks[i, j] = upscale_logits(low_res[i, j], width, height) > 0
+
+    return masks, iou.astype(np.float32), low_res
+
+
+def select_single_mask(low_res: NDArray, iou: NDArray) -> Tuple[NDArray, NDArray]:
+    """
+    Pick one mask per prompt set the way the SAM2.1 mask decoder does when asked for a single mask.
+
+    The single mask token is used unless its mask is unstable, that is its area
+    changes noticeably with the threshold, in which case the multimask output
+    with the best predicted IoU is used instead.
+
+    Args:
+        low_res: Array of shape (B, 4, 256, 256) of the logits of every mask token
+        iou: Array of shape (B, 4) of the IoU predictions of every mask token
+
+    Returns:
+        The chosen logits and IoU predictions, of shapes (B, 1, 256, 256) and (B, 1)
+    """
+    single = low_res[:, 0]
+    intersections = (single > _STABILITY_DELTA).sum(axis=(-1, -2))
+    unions = (single > -_STABILITY_DELTA).sum(axis=(-1, -2))
+    stability = np.where(unions > 0, intersections / np.maximum(unions, 1), 1.0)
+
+    best_multimask = np.argmax(iou[:, 1:], axis=1) + 1
+    chosen = np.where(stability >= _STABILITY_THRESHOLD, 0, best_multimask)
+
+    rows = np.arange(low_res.shape[0])
+    return low_res[rows, chosen][:, None], iou[rows, chosen][:, None]
+
+
+def upscale_logits(logits: NDArray, width: int, height: int) -> NDArray[np.float32]:
+    """
+    Bilinearly resize a 2D logits array, matching torch's interpolate with align_corners=False.
+
+    Args:
+        logits: A 2D array of shape (h, w)
+        width: Output width
+        height: Output height
+
+    Returns:
+        A float32 array of shape (height, width)
+    """
+    def sample_positions(out_size: int, in_size: int):
+        source = (np.arange(out_size, dtype=np.float32) + 0.5) * (in_size / out_size) - 0.5
+        source = np.clip(source, 0, in_size - 1)
+        lower = np.floor(source).astype(np.intp)
+        upper = np.minimum(lower + 1, in_size - 1)
+        return lower, upper, (source - lower).astype(np.float32)
+
+    logits = np.asarray(logits, dtype=np.float32)
+    y0, y1, wy = sample_positions(height, logits.shape[0])
+    x0, x1, wx = sample_positions(width, logits.shape[1])
+
+    rows = logits[y0] * (1 - wy)[:, None] + logits[y1] * wy[:, None]
+    return rows[:, x0] * (1 - wx) + rows[:, x1] * wx
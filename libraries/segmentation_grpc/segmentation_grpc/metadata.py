@@ -0,0 +1,33 @@
+"""
+gRPC Metadata Keys
+
+Names of the gRPC metadata entries understood by the segmentation service.
+"""
+
+# Priority class of a request, "interactive" or "bulk"
+PRIORITY = 'x-segmentation-priority'
+
+# Trailing metadata with the server's load when the response was sent, the
+# number of queued inference jobs and the number of requests in flight
+QUEUE_DEPTH = 'x-segmentation-queue-depth'
+IN_FLIGHT = 'x-segmentation-in-flight'
+
+# Set by clients that chose the replica by image affinity, "1" if so
+AFFINITY = 'x-segmentation-affinity'
+
+# Name of the client sending a request, such as a user or script name.  The
+# server shares its capacity fairly between clients and applies its limits per
+# client, requests without it are accounted to the host they come from.
+CLIENT = 'x-segmentation-client'
+
+# Trailing metadata of a request rejected with RESOURCE_EXHAUSTED because its
+# client is over a limit, the number of seconds to wait before retrying
+RETRY_AFTER = 'x-segmentation-retry-after'
+
+# W3C trace context of a request, "00-<trace id>-<parent span id>-<flags>".
+# Servers record spans of sampled requests under the client's trace.
+TRACEPARENT = 'traceparent'
+
+# Trailing metadata of a traced request, the seconds the server spent handling
+# it.  The rest of the call's duration was spent on the network.
+SERVER_SECONDS = 'x-segmentation-server-seconds'
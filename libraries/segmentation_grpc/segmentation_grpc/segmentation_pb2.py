@@ -24,23 +24,75 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x12segmentation.proto\x12\x0csegmentation\"\x9c\x01\n\x13SegmentationRequest\x12\x12\n\nimage_data\x18\x01 \x01(\x0c\x12\r\n\x05width\x18\x02 \x01(\x05\x12\x0e\n\x06height\x18\x03 \x01(\x05\x12(\n\x0b\x63oordinates\x18\x04 \x03(\x0b\x32\x13.segmentation.Point\x12\x0e\n\x06labels\x18\x05 \x03(\x05\x12\x18\n\x10multimask_output\x18\x06 \x01(\x08\"\x1d\n\x05Point\x12\t\n\x01x\x18\x01 \x01(\x05\x12\t\n\x01y\x18\x02 \x01(\x05\".\n\x07Polygon\x12#\n\x06points\x18\x01 \x03(\x0b\x32\x13.segmentation.Point\"{\n\x14SegmentationResponse\x12\x15\n\rlabeled_image\x18\x01 \x01(\x0c\x12\r\n\x05width\x18\x02 \x01(\x05\x12\x0e\n\x06height\x18\x03 \x01(\x05\x12-\n\x08segments\x18\x04 \x03(\x0b\x32\x1b.segmentation.SegmentResult\"d\n\rSegmentResult\x12\r\n\x05index\x18\x01 \x01(\x05\x12\r\n\x05score\x18\x02 \x01(\x02\x12\x0c\n\x04mask\x18\x03 \x01(\x0c\x12\'\n\x08polygons\x18\x04 \x03(\x0b\x32\x15.segmentation.Polygon2n\n\x13SegmentationService\x12W\n\x0cSegmentImage\x12!.segmentation.SegmentationRequest\x1a\".segmentation.SegmentationResponse\"\x00\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x12segmentation.proto\x12\x0csegmentation\"\x9a\x01\n\x10\x45mbeddingRequest\x12\x12\n\nimage_data\x18\x01 \x01(\x0c\x12\r\n\x05width\x18\x02 \x01(\x05\x12\x0e\n\x06height\x18\x03 \x01(\x05\x12\x11\n\timage_key\x18\x04 \x01(\t\x12.\n\x08\x65ncoding\x18\x05 \x01(\x0e\x32\x1c.segmentation.TensorEncoding\x12\x10\n\x08\x63ompress\x18\x06 \x01(\x08\"\x90\x01\n\x0f\x45mbeddingTensor\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\r\n\x05shape\x18\x02 \x03(\x05\x12.\n\x08\x65ncoding\x18\x03 \x01(\x0e\x32\x1c.segmentation.TensorEncoding\x12\x0c\n\x04\x64\x61ta\x18\x04 \x01(\x0c\x12\x0e\n\x06scales\x18\x05 \x03(\x02\x12\x12\n\ncompressed\x18\x06 \x01(\x08\"\x87\x01\n\x0eImageEmbedding\x12\x12\n\nmodel_name\x18\x01 \x01(\t\x12\r\n\x05width\x18\x02 \x01(\x05\x12\x0e\n\x06height\x18\x03 \x01(\x05\x12\x12\n\ninput_size\x18\x04 \x01(\x05\x12.\n\x07tensors\x18\x05 \x03(\x0b\x32\x1d.segmentation.EmbeddingTensor\"W\n\x0fPrefetchRequest\x12\x12\n\nimage_data\x18\x01 \x01(\x0c\x12\r\n\x05width\x18\x02 \x01(\x05\x12\x0e\n\x06height\x18\x03 \x01(\x05\x12\x11\n\timage_key\x18\x04 \x01(\t\"@\n\x10PrefetchResponse\x12,\n\x06status\x18\x01 \x01(\x0e\x32\x1c.segmentation.PrefetchStatus\"\r\n\x0bLoadRequest\"\x89\x03\n\nLoadReport\x12\x13\n\x0bqueue_depth\x18\x01 \x01(\x05\x12\x11\n\tin_flight\x18\x02 \x01(\x05\x12\x16\n\x0ep50_latency_ms\x18\x03 \x01(\x02\x12\x15\n\rloaded_models\x18\x04 \x03(\t\x12\x1f\n\x17interactive_queue_depth\x18\x05 \x01(\x05\x12\x18\n\x10\x62ulk_queue_depth\x18\x06 \x01(\x05\x12\x1c\n\x14\x65mbedding_cache_hits\x18\x07 \x01(\x03\x12\x1e\n\x16\x65mbedding_cache_misses\x18\x08 \x01(\x03\x12\x1b\n\x13\x61\x66\x66inity_cache_hits\x18\t \x01(\x03\x12\x1d\n\x15\x61\x66\x66inity_cache_misses\x18\n \x01(\x03\x12\'\n\x06stages\x18\x0b \x03(\x0b\x32\x17.segmentation.StageLoad\x12)\n\x07\x63lients\x18\x0c \x03(\x0b\x32\x18.segmentation.ClientLoad\x12\x1b\n\x13superseded_requests\x18\r \x01(\x03\"\x9f\x01\n\nClientLoad\x12\x0e\n\x06\x63lient\x18\x01 \x01(\t\x12\x0e\n\x06weight\x18\x02 \x01(\x02\x12\x13\n\x0bqueue_depth\x18\x03 \x01(\x05\x12\x11\n\tin_flight\x18\x04 \x01(\x05\x12\x10\n\x08\x61\x64mitted\x18\x05 \x01(\x03\x12\x10\n\x08rejected\x18\x06 \x01(\x03\x12\x0f\n\x07started\x18\x07 \x01(\x03\x12\x14\n\x0cwait_seconds\x18\x08 \x01(\x01\"\xa8\x01\n\tStageLoad\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x0f\n\x07workers\x18\x02 \x01(\x05\x12\x13\n\x0bqueue_depth\x18\x03 \x01(\x05\x12\x17\n\x0fmax_queue_depth\x18\x08 \x01(\x05\x12\x0f\n\x07running\x18\x04 \x01(\x05\x12\x11\n\tcompleted\x18\x05 \x01(\x03\x12\x14\n\x0c\x62usy_seconds\x18\x06 \x01(\x01\x12\x14\n\x0cwait_seconds\x18\x07 \x01(\x01\"\x9b\x07\n\x13SegmentationRequest\x12\x12\n\nimage_data\x18\x01 \x01(\x0c\x12\r\n\x05width\x18\x02 \x01(\x05\x12\x0e\n\x06height\x18\x03 \x01(\x05\x12(\n\x0b\x63oordinates\x18\x04 \x03(\x0b\x32\x13.segmentation.Point\x12\x0e\n\x06labels\x18\x05 \x03(\x05\x12\x18\n\x10multimask_output\x18\x06 \x01(\x08\x12\x1e\n\x03\x62ox\x18\x07 \x01(\x0b\x32\x11.segmentation.Box\x12\x19\n\x11mask_input_handle\x18\x08 \x01(\t\x12,\n\nmask_input\x18\t \x01(\x0b\x32\x18.segmentation.MaskLogits\x12\x1d\n\x15return_low_res_logits\x18\n \x01(\x08\x12\x30\n\rprompt_groups\x18\x0b \x03(\x0b\x32\x19.segmentation.PromptGroup\x12>\n\x14labeled_image_format\x18\x0c \x01(\x0e\x32 .segmentation.LabeledImageFormat\x12:\n\x12labeled_image_type\x18\r \x01(\x0e\x32\x1e.segmentation.LabeledImageType\x12\"\n\x15png_compression_level\x18\x0e \x01(\x05H\x00\x88\x01\x01\x12\x35\n\x0cshared_image\x18\x0f \x01(\x0b\x32\x1f.segmentation.SharedMemoryArray\x12=\n\x14shared_labeled_image\x18\x10 \x01(\x0b\x32\x1f.segmentation.SharedMemoryArray\x12\x17\n\x0fpacked_polygons\x18\x11 \x01(\x08\x12\x1c\n\x14max_polygon_vertices\x18\x12 \x01(\x05\x12\x11\n\timage_key\x18\x13 \x01(\t\x12+\n\x03roi\x18\x14 \x01(\x0b\x32\x1e.segmentation.RegionOfInterest\x12\x1c\n\x14polygons_from_logits\x18\x15 \x01(\x08\x12/\n\x0c\x63ontour_mode\x18\x16 \x01(\x0e\x32\x19.segmentation.ContourMode\x12\x1f\n\x12simplify_tolerance\x18\x17 \x01(\x02H\x01\x88\x01\x01\x12\x15\n\rsupersede_key\x18\x18 \x01(\tB\x18\n\x16_png_compression_levelB\x15\n\x13_simplify_tolerance\"i\n\x10RegionOfInterest\x12!\n\x06window\x18\x01 \x01(\x0b\x32\x11.segmentation.Box\x12\x14\n\x07padding\x18\x02 \x01(\x02H\x00\x88\x01\x01\x12\x10\n\x08min_size\x18\x03 \x01(\x05\x42\n\n\x08_padding\"g\n\x0bPromptGroup\x12(\n\x0b\x63oordinates\x18\x01 \x03(\x0b\x32\x13.segmentation.Point\x12\x0e\n\x06labels\x18\x02 \x03(\x05\x12\x1e\n\x03\x62ox\x18\x03 \x01(\x0b\x32\x11.segmentation.Box\"Y\n\x0cSectionImage\x12\x12\n\nimage_data\x18\x01 \x01(\x0c\x12\r\n\x05width\x18\x02 \x01(\x05\x12\x0e\n\x06height\x18\x03 \x01(\x05\x12\x16\n\x0esection_number\x18\x04 \x01(\x05\"\x8c\x02\n\x17StackPropagationRequest\x12,\n\x08sections\x18\x01 \x03(\x0b\x32\x1a.segmentation.SectionImage\x12\x1c\n\x14prompt_section_index\x18\x02 \x01(\x05\x12(\n\x0b\x63oordinates\x18\x03 \x03(\x0b\x32\x13.segmentation.Point\x12\x0e\n\x06labels\x18\x04 \x03(\x05\x12\x1e\n\x03\x62ox\x18\x05 \x01(\x0b\x32\x11.segmentation.Box\x12\x35\n\tdirection\x18\x06 \x01(\x0e\x32\".segmentation.PropagationDirection\x12\x14\n\x0cmax_sections\x18\x07 \x01(\x05\"\x92\x01\n\x13SectionSegmentation\x12\x15\n\rsection_index\x18\x01 \x01(\x05\x12\x16\n\x0esection_number\x18\x02 \x01(\x05\x12\r\n\x05width\x18\x03 \x01(\x05\x12\x0e\n\x06height\x18\x04 \x01(\x05\x12-\n\x08segments\x18\x05 \x03(\x0b\x32\x1b.segmentation.SegmentResult\"\x1d\n\x05Point\x12\t\n\x01x\x18\x01 \x01(\x05\x12\t\n\x01y\x18\x02 \x01(\x05\"5\n\x03\x42ox\x12\n\n\x02x0\x18\x01 \x01(\x05\x12\n\n\x02y0\x18\x02 \x01(\x05\x12\n\n\x02x1\x18\x03 \x01(\x05\x12\n\n\x02y1\x18\x04 \x01(\x05\"q\n\x11SharedMemoryArray\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\r\n\x05width\x18\x02 \x01(\x05\x12\x0e\n\x06height\x18\x03 \x01(\x05\x12\x10\n\x08\x63hannels\x18\x04 \x01(\x05\x12\r\n\x05\x64type\x18\x05 \x01(\t\x12\x0e\n\x06offset\x18\x06 \x01(\x03\"9\n\nMaskLogits\x12\r\n\x05width\x18\x01 \x01(\x05\x12\x0e\n\x06height\x18\x02 \x01(\x05\x12\x0c\n\x04\x64\x61ta\x18\x03 \x01(\x0c\".\n\x07Polygon\x12#\n\x06points\x18\x01 \x03(\x0b\x32\x13.segmentation.Point\"6\n\x0ePackedPolygons\x12\x0e\n\x06\x64\x65ltas\x18\x01 \x03(\x11\x12\x14\n\x0cring_offsets\x18\x02 \x03(\x05\"\x9e\x02\n\x14SegmentationResponse\x12\x15\n\rlabeled_image\x18\x01 \x01(\x0c\x12\r\n\x05width\x18\x02 \x01(\x05\x12\x0e\n\x06height\x18\x03 \x01(\x05\x12-\n\x08segments\x18\x04 \x03(\x0b\x32\x1b.segmentation.SegmentResult\x12>\n\x14labeled_image_format\x18\x05 \x01(\x0e\x32 .segmentation.LabeledImageFormat\x12:\n\x12labeled_image_type\x18\x06 \x01(\x0e\x32\x1e.segmentation.LabeledImageType\x12%\n\nroi_window\x18\x07 \x01(\x0b\x32\x11.segmentation.Box\"\xcc\x02\n\x12SegmentationUpdate\x12.\n\x05stage\x18\x01 \x01(\x0e\x32\x1f.segmentation.SegmentationStage\x12\r\n\x05width\x18\x02 \x01(\x05\x12\x0e\n\x06height\x18\x03 \x01(\x05\x12-\n\x08segments\x18\x04 \x03(\x0b\x32\x1b.segmentation.SegmentResult\x12\x15\n\rlabeled_image\x18\x05 \x01(\x0c\x12>\n\x14labeled_image_format\x18\x06 \x01(\x0e\x32 .segmentation.LabeledImageFormat\x12:\n\x12labeled_image_type\x18\x07 \x01(\x0e\x32\x1e.segmentation.LabeledImageType\x12%\n\nroi_window\x18\x08 \x01(\x0b\x32\x11.segmentation.Box\"\xa2\x02\n\rSegmentResult\x12\r\n\x05index\x18\x01 \x01(\x05\x12\r\n\x05score\x18\x02 \x01(\x02\x12\x0c\n\x04mask\x18\x03 \x01(\x0c\x12\'\n\x08polygons\x18\x04 \x03(\x0b\x32\x15.segmentation.Polygon\x12\x15\n\rlogits_handle\x18\x05 \x01(\t\x12\x30\n\x0elow_res_logits\x18\x06 \x01(\x0b\x32\x18.segmentation.MaskLogits\x12\x14\n\x0cprompt_group\x18\x07 \x01(\x05\x12\x35\n\x0fpacked_polygons\x18\x08 \x01(\x0b\x32\x1c.segmentation.PackedPolygons\x12&\n\x0bmask_window\x18\t \x01(\x0b\x32\x11.segmentation.Box*I\n\x0eTensorEncoding\x12\x12\n\x0eTENSOR_FLOAT16\x10\x00\x12\x0f\n\x0bTENSOR_INT8\x10\x01\x12\x12\n\x0eTENSOR_FLOAT32\x10\x02*w\n\x0ePrefetchStatus\x12\x16\n\x12PREFETCH_SCHEDULED\x10\x00\x12\x1b\n\x17PREFETCH_ALREADY_CACHED\x10\x01\x12\x14\n\x10PREFETCH_DROPPED\x10\x02\x12\x1a\n\x16PREFETCH_MISSING_IMAGE\x10\x03*=\n\x0b\x43ontourMode\x12\x15\n\x11\x43ONTOURS_EXTERNAL\x10\x00\x12\x17\n\x13\x43ONTOURS_WITH_HOLES\x10\x01*{\n\x12LabeledImageFormat\x12\x15\n\x11LABELED_IMAGE_PNG\x10\x00\x12\x15\n\x11LABELED_IMAGE_RAW\x10\x01\x12\x16\n\x12LABELED_IMAGE_NONE\x10\x02\x12\x1f\n\x1bLABELED_IMAGE_SHARED_MEMORY\x10\x03*E\n\x10LabeledImageType\x12\x18\n\x14LABELED_IMAGE_UINT16\x10\x00\x12\x17\n\x13LABELED_IMAGE_UINT8\x10\x01*Y\n\x14PropagationDirection\x12\x12\n\x0ePROPAGATE_BOTH\x10\x00\x12\x15\n\x11PROPAGATE_FORWARD\x10\x01\x12\x16\n\x12PROPAGATE_BACKWARD\x10\x02*N\n\x11SegmentationStage\x12\x11\n\rSTAGE_PREVIEW\x10\x00\x12\x12\n\x0eSTAGE_POLYGONS\x10\x01\x12\x12\n\x0eSTAGE_COMPLETE\x10\x02\x32\x9b\x04\n\x13SegmentationService\x12W\n\x0cSegmentImage\x12!.segmentation.SegmentationRequest\x1a\".segmentation.SegmentationResponse\"\x00\x12\x62\n\x17SegmentImageProgressive\x12!.segmentation.SegmentationRequest\x1a .segmentation.SegmentationUpdate\"\x00\x30\x01\x12^\n\x0ePropagateStack\x12%.segmentation.StackPropagationRequest\x1a!.segmentation.SectionSegmentation\"\x00\x30\x01\x12@\n\x07GetLoad\x12\x19.segmentation.LoadRequest\x1a\x18.segmentation.LoadReport\"\x00\x12P\n\rPrefetchImage\x12\x1d.segmentation.PrefetchRequest\x1a\x1e.segmentation.PrefetchResponse\"\x00\x12S\n\x11GetImageEmbedding\x12\x1e.segmentation.EmbeddingRequest\x1a\x1c.segmentation.ImageEmbedding\"\x00\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'segmentation_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
-  _globals['_SEGMENTATIONREQUEST']._serialized_start=37
-  _globals['_SEGMENTATIONREQUEST']._serialized_end=193
-  _globals['_POINT']._serialized_start=195
-  _globals['_POINT']._serialized_end=224
-  _globals['_POLYGON']._serialized_start=226
-  _globals['_POLYGON']._serialized_end=272
-  _globals['_SEGMENTATIONRESPONSE']._serialized_start=274
-  _globals['_SEGMENTATIONRESPONSE']._serialized_end=397
-  _globals['_SEGMENTRESULT']._serialized_start=399
-  _globals['_SEGMENTRESULT']._serialized_end=499
-  _globals['_SEGMENTATIONSERVICE']._serialized_start=501
-  _globals['_SEGMENTATIONSERVICE']._serialized_end=611
+  _globals['_TENSORENCODING']._serialized_start=4307
+  _globals['_TENSORENCODING']._serialized_end=4380
+  _globals['_PREFETCHSTATUS']._serialized_start=4382
+  _globals['_PREFETCHSTATUS']._serialized_end=4501
+  _globals['_CONTOURMODE']._serialized_start=4503
+  _globals['_CONTOURMODE']._serialized_end=4564
+  _globals['_LABELEDIMAGEFORMAT']._serialized_start=4566
+  _globals['_LABELEDIMAGEFORMAT']._serialized_end=4689
+  _globals['_LABELEDIMAGETYPE']._serialized_start=4691
+  _globals['_LABELEDIMAGETYPE']._serialized_end=4760
+  _globals['_PROPAGATIONDIRECTION']._serialized_start=4762
+  _globals['_PROPAGATIONDIRECTION']._serialized_end=4851
+  _globals['_SEGMENTATIONSTAGE']._serialized_start=4853
+  _globals['_SEGMENTATIONSTAGE']._serialized_end=4931
+  _globals['_EMBEDDINGREQUEST']._serialized_start=37
+  _globals['_EMBEDDINGREQUEST']._serialized_end=191
+  _globals['_EMBEDDINGTENSOR']._serialized_start=194
+  _globals['_EMBEDDINGTENSOR']._serialized_end=338
+  _globals['_IMAGEEMBEDDING']._serialized_start=341
+  _globals['_IMAGEEMBEDDING']._serialized_end=476
+  _globals['_PREFETCHREQUEST']._serialized_start=478
+  _globals['_PREFETCHREQUEST']._serialized_end=565
+  _globals['_PREFETCHRESPONSE']._serialized_start=567
+  _globals['_PREFETCHRESPONSE']._serialized_end=631
+  _globals['_LOADREQUEST']._serialized_start=633
+  _globals['_LOADREQUEST']._serialized_end=646
+  _globals['_LOADREPORT']._serialized_start=649
+  _globals['_LOADREPORT']._serialized_end=1042
+  _globals['_CLIENTLOAD']._serialized_start=1045
+  _globals['_CLIENTLOAD']._serialized_end=1204
+  _globals['_STAGELOAD']._serialized_start=1207
+  _globals['_STAGELOAD']._serialized_end=1375
+  _globals['_SEGMENTATIONREQUEST']._serialized_start=1378
+  _globals['_SEGMENTATIONREQUEST']._serialized_end=2301
+  _globals['_REGIONOFINTEREST']._serialized_start=2303
+  _globals['_REGIONOFINTEREST']._serialized_end=2408
+  _globals['_PROMPTGROUP']._serialized_start=2410
+  _globals['_PROMPTGROUP']._serialized_end=2513
+  _globals['_SECTIONIMAGE']._serialized_start=2515
+  _globals['_SECTIONIMAGE']._serialized_end=2604
+  _globals['_STACKPROPAGATIONREQUEST']._serialized_start=2607
+  _globals['_STACKPROPAGATIONREQUEST']._serialized_end=2875
+  _globals['_SECTIONSEGMENTATION']._serialized_start=2878
+  _globals['_SECTIONSEGMENTATION']._serialized_end=3024
+  _globals['_POINT']._serialized_start=3026
+  _globals['_POINT']._serialized_end=3055
+  _globals['_BOX']._serialized_start=3057
+  _globals['_BOX']._serialized_end=3110
+  _globals['_SHAREDMEMORYARRAY']._serialized_start=3112
+  _globals['_SHAREDMEMORYARRAY']._serialized_end=3225
+  _globals['_MASKLOGITS']._serialized_start=3227
+  _globals['_MASKLOGITS']._serialized_end=3284
+  _globals['_POLYGON']._serialized_start=3286
+  _globals['_POLYGON']._serialized_end=3332
+  _globals['_PACKEDPOLYGONS']._serialized_start=3334
+  _globals['_PACKEDPOLYGONS']._serialized_end=3388
+  _globals['_SEGMENTATIONRESPONSE']._serialized_start=3391
+  _globals['_SEGMENTATIONRESPONSE']._serialized_end=3677
+  _globals['_SEGMENTATIONUPDATE']._serialized_start=3680
+  _globals['_SEGMENTATIONUPDATE']._serialized_end=4012
+  _globals['_SEGMENTRESULT']._serialized_start=4015
+  _globals['_SEGMENTRESULT']._serialized_end=4305
+  _globals['_SEGMENTATIONSERVICE']._serialized_start=4934
+  _globals['_SEGMENTATIONSERVICE']._serialized_end=5473
 # @@protoc_insertion_point(module_scope)
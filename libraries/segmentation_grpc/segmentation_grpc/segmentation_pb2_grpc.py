@@ -40,6 +40,31 @@ class SegmentationServiceStub(object):
                 request_serializer=segmentation__pb2.SegmentationRequest.SerializeToString,
                 response_deserializer=segmentation__pb2.SegmentationResponse.FromString,
                 _registered_method=True)
+        self.SegmentImageProgressive = channel.unary_stream(
+                '/segmentation.SegmentationService/SegmentImageProgressive',
+                request_serializer=segmentation__pb2.SegmentationRequest.SerializeToString,
+                response_deserializer=segmentation__pb2.SegmentationUpdate.FromString,
+                _registered_method=True)
+        self.PropagateStack = channel.unary_stream(
+                '/segmentation.SegmentationService/PropagateStack',
+                request_serializer=segmentation__pb2.StackPropagationRequest.SerializeToString,
+                response_deserializer=segmentation__pb2.SectionSegmentation.FromString,
+                _registered_method=True)
+        self.GetLoad = channel.unary_unary(
+                '/segmentation.SegmentationService/GetLoad',
+                request_serializer=segmentation__pb2.LoadRequest.SerializeToString,
+                response_deserializer=segmentation__pb2.LoadReport.FromString,
+                _registered_method=True)
+        self.PrefetchImage = channel.unary_unary(
+                '/segmentation.SegmentationService/PrefetchImage',
+                request_serializer=segmentation__pb2.PrefetchRequest.SerializeToString,
+                response_deserializer=segmentation__pb2.PrefetchResponse.FromString,
+                _registered_method=True)
+        self.GetImageEmbedding = channel.unary_unary(
+                '/segmentation.SegmentationService/GetImageEmbedding',
+                request_serializer=segmentation__pb2.EmbeddingRequest.SerializeToString,
+                response_deserializer=segmentation__pb2.ImageEmbedding.FromString,
+                _registered_method=True)
 
 
 class SegmentationServiceServicer(object):
@@ -53,6 +78,49 @@ class SegmentationServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SegmentImageProgressive(self, request, context):
+        """Segment an image in stages, so a client can draw the best mask's outline
+        as soon as the decoder has run and receive the rest in the background.
+        Streams a STAGE_PREVIEW, a STAGE_POLYGONS and a STAGE_COMPLETE update.
+        Only a single prompt set is supported, prompt_groups and shared memory
+        are rejected.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def PropagateStack(self, request, context):
+        """Propagate an object prompted on one section through a stack of serial
+        sections, streaming back the segmentation of each section as it is produced
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetLoad(self, request, context):
+        """Report how busy the server is, cheap enough to poll frequently
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def PrefetchImage(self, request, context):
+        """Encode an image into the embedding cache ahead of the first request on
+        it.  Returns immediately, the encoding runs at the lowest priority and is
+        dropped when the server is busy.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetImageEmbedding(self, request, context):
+        """Encode an image and return its embedding, so the client can run the
+        lightweight prompt encoder and mask decoder locally for every click
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_SegmentationServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -61,6 +129,31 @@ def add_SegmentationServiceServicer_to_server(servicer, server):
                     request_deserializer=segmentation__pb2.SegmentationRequest.FromString,
                     response_serializer=segmentation__pb2.SegmentationResponse.SerializeToString,
             ),
+            'SegmentImageProgressive': grpc.unary_stream_rpc_method_handler(
+                    servicer.SegmentImageProgressive,
+                    request_deserializer=segmentation__pb2.SegmentationRequest.FromString,
+                    response_serializer=segmentation__pb2.SegmentationUpdate.SerializeToString,
+            ),
+            'PropagateStack': grpc.unary_stream_rpc_method_handler(
+                    servicer.PropagateStack,
+                    request_deserializer=segmentation__pb2.StackPropagationRequest.FromString,
+                    response_serializer=segmentation__pb2.SectionSegmentation.SerializeToString,
+            ),
+            'GetLoad': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetLoad,
+                    request_deserializer=segmentation__pb2.LoadRequest.FromString,
+                    response_serializer=segmentation__pb2.LoadReport.SerializeToString,
+            ),
+            'PrefetchImage': grpc.unary_unary_rpc_method_handler(
+                    servicer.PrefetchImage,
+                    request_deserializer=segmentation__pb2.PrefetchRequest.FromString,
+                    response_serializer=segmentation__pb2.PrefetchResponse.SerializeToString,
+            ),
+            'GetImageEmbedding': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetImageEmbedding,
+                    request_deserializer=segmentation__pb2.EmbeddingRequest.FromString,
+                    response_serializer=segmentation__pb2.ImageEmbedding.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'segmentation.SegmentationService', rpc_method_handlers)
@@ -99,3 +192,138 @@ class SegmentationService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def SegmentImageProgressive(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/segmentation.SegmentationService/SegmentImageProgressive',
+            segmentation__pb2.SegmentationRequest.SerializeToString,
+            segmentation__pb2.SegmentationUpdate.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def PropagateStack(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/segmentation.SegmentationService/PropagateStack',
+            segmentation__pb2.StackPropagationRequest.SerializeToString,
+            segmentation__pb2.SectionSegmentation.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def GetLoad(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/segmentation.SegmentationService/GetLoad',
+            segmentation__pb2.LoadRequest.SerializeToString,
+            segmentation__pb2.LoadReport.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def PrefetchImage(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/segmentation.SegmentationService/PrefetchImage',
+            segmentation__pb2.PrefetchRequest.SerializeToString,
+            segmentation__pb2.PrefetchResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def GetImageEmbedding(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/segmentation.SegmentationService/GetImageEmbedding',
+            segmentation__pb2.EmbeddingRequest.SerializeToString,
+            segmentation__pb2.ImageEmbedding.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
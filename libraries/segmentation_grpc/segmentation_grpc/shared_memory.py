@@ -0,0 +1,151 @@
+"""
+Shared Memory Transport
+
+Clients running on the same host as the segmentation server can pass pixels
+through a named multiprocessing.shared_memory segment instead of serialising
+them into the request.  The request then only carries a SharedMemoryArray
+describing the segment, and the server maps the pixels without copying them.
+
+The client owns every segment: it creates it, keeps it alive until the call
+returns, and unlinks it.  The server only attaches to segments for the
+duration of a request.
+"""
+
+import os
+import sys
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+from numpy.typing import DTypeLike, NDArray
+
+from segmentation_grpc.segmentation_pb2 import SharedMemoryArray
+
+# Pixel types the server accepts in a shared memory segment
+SUPPORTED_DTYPES = (np.dtype('u1'), np.dtype('<u2'))
+
+
+def array_shape(message: SharedMemoryArray) -> Tuple[int, ...]:
+    """Return the numpy shape of the array a SharedMemoryArray describes."""
+    if message.channels > 1:
+        return message.height, message.width, message.channels
+    return message.height, message.width
+
+
+@contextmanager
+def attach_shared_array(message: SharedMemoryArray) -> Iterator[NDArray]:
+    """
+    Map the array described by a SharedMemoryArray message for the duration of a with block.
+
+    The array is a view of the segment, writes to it are visible to the client.
+    Callers must not keep references to the array after the block exits.
+
+    Args:
+        message: Description of the array in a segment created by the client
+
+    Yields:
+        An array of shape (height, width) or (height, width, channels) backed by the segment
+
+    Raises:
+        FileNotFoundError: If no segment with the given name exists
+        ValueError: If the description does not fit the segment or uses an unsupported dtype
+    """
+    if not message.name:
+        raise ValueError("SharedMemoryArray has no segment name")
+
+    dtype = np.dtype(message.dtype or 'u1')
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f"Unsupported shared memory dtype {message.dtype}, expected one of "
+                         f"{', '.join(d.str for d in SUPPORTED_DTYPES)}")
+
+    shape = array_shape(message)
+    if message.width <= 0 or message.height <= 0 or message.offset < 0:
+        raise ValueError(f"Invalid shared memory array shape {shape} at offset {message.offset}")
+
+    segment = _attach_untracked(message.name)
+    try:
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if message.offset + nbytes > segment.size:
+            raise ValueError(f"Shared memory segment {message.name} is {segment.size} bytes, too small for "
+                             f"a {shape} {dtype} array at offset {message.offset}")
+
+        array = np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=message.offset)
+        try:
+            yield array
+        finally:
+            del array
+    finally:
+        try:
+            segment.close()
+        except BufferError:
+            # A view of the segment is still referenced, the mapping is released once it is collected
+            print(f"Shared memory segment {message.name} still referenced after the request, deferring close")
+
+
+def _attach_untracked(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach to an existing segment without registering it with the resource tracker.
+
+    The client owns the segment, so the server must not let the resource tracker
+    unlink it when the server exits.  Python 3.13 added track=False for this, older
+    versions register the segment on POSIX and need it unregistered again.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    segment = shared_memory.SharedMemory(name=name)
+    if os.name == 'posix':
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+class SharedImageBuffer:
+    """
+    A client owned shared memory segment holding one image or labeled image.
+
+    The buffer can be reused across calls, for example by rendering each tile
+    directly into buffer.array before calling the server.  Use it as a context
+    manager or call close() to release and unlink the segment.
+    """
+
+    def __init__(self, width: int, height: int, channels: int = 1, dtype: DTypeLike = np.uint8,
+                 name: Optional[str] = None):
+        """
+        Args:
+            width: Width of the image
+            height: Height of the image
+            channels: 1 for grayscale, 3 for RGB
+            dtype: The pixel type, uint8 for images, uint8 or uint16 for labeled images
+            name: Optional name of the segment, a unique name is chosen if omitted
+        """
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.message = SharedMemoryArray(width=width, height=height, channels=channels, dtype=self.dtype.str)
+
+        shape = array_shape(self.message)
+        self._segment = shared_memory.SharedMemory(name=name, create=True,
+                                                   size=int(np.prod(shape)) * self.dtype.itemsize)
+        self.message.name = self._segment.name
+        self.array = np.ndarray(shape, dtype=self.dtype, buffer=self._segment.buf)
+
+    @property
+    def name(self) -> str:
+        return self._segment.name
+
+    def describe(self) -> SharedMemoryArray:
+        """Return a SharedMemoryArray message describing the buffer, for use in a request."""
+        message = SharedMemoryArray()
+        message.CopyFrom(self.message)
+        return message
+
+    def close(self):
+        """Release and unlink the segment, the array must not be used afterwards."""
+        self.array = None
+        self._segment.close()
+        self._segment.unlink()
+
+    def __enter__(self) -> 'SharedImageBuffer':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
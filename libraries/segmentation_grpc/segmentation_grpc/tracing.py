@@ -0,0 +1,302 @@
+"""
+Request Tracing
+
+Records where the time of a request goes, on the client and on the server,
+as spans of one trace.  The client starts the trace and passes its context to
+the server in the W3C traceparent gRPC metadata entry, the server records its
+own spans as children of the client's.
+
+Each process writes its spans to a local file in the Chrome trace event
+format, which chrome://tracing and https://ui.perfetto.dev open directly.
+merge_traces combines the files of a client and its servers into one
+timeline, spans of one request share a trace_id argument.
+
+Tracing is off unless a Tracer is given a path and a sample rate above 0.  An
+unsampled request has no trace context and every span call returns at once, so
+tracing costs nothing measurable when it is off.
+
+Usage:
+    python -m segmentation_grpc.tracing merged.json client.json server.json
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from segmentation_grpc import metadata
+
+# gRPC metadata key carrying the trace context
+TRACEPARENT_METADATA_KEY = metadata.TRACEPARENT
+
+# Flag of the traceparent header marking the trace as sampled
+_SAMPLED_FLAG = 0x01
+
+# Seconds between flushes of a trace file, spans are buffered in between
+FLUSH_INTERVAL = 1.0
+
+
+class TraceContext(NamedTuple):
+    """The trace a span belongs to and the span's ID, as lowercase hex."""
+    trace_id: str  # 32 hex digits
+    span_id: str   # 16 hex digits
+
+    def traceparent(self) -> str:
+        """Return the context as a W3C traceparent header value, always marked as sampled."""
+        return f'00-{self.trace_id}-{self.span_id}-{_SAMPLED_FLAG:02x}'
+
+    def child(self) -> 'TraceContext':
+        """Return the context of a new span within this trace."""
+        return TraceContext(self.trace_id, _random_id(64))
+
+    @classmethod
+    def from_metadata(cls, metadata: Optional[Sequence[Tuple[str, str]]]) -> Optional['TraceContext']:
+        """
+        Read the trace context from gRPC invocation metadata.
+
+        Args:
+            metadata: The invocation metadata of a request
+
+        Returns:
+            The context of the caller's span, or None if the request carries no
+            valid traceparent or its trace is not sampled
+        """
+        for key, value in metadata or ():
+            if key != TRACEPARENT_METADATA_KEY:
+                continue
+
+            parts = value.strip().split('-')
+            if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+                return None
+            try:
+                # All zero IDs are invalid
+                if int(parts[1], 16) == 0 or int(parts[2], 16) == 0 or not int(parts[3], 16) & _SAMPLED_FLAG:
+                    return None
+            except ValueError:
+                return None
+
+            return cls(parts[1].lower(), parts[2].lower())
+
+        return None
+
+
+def _random_id(bits: int) -> str:
+    """Return a random non-zero ID of the given number of bits as hex."""
+    return f'{random.getrandbits(bits - 1) + 1:0{bits // 4}x}'
+
+
+def trace_metadata(trace: Optional[TraceContext], call_metadata=None) -> Optional[Tuple[Tuple[str, str], ...]]:
+    """
+    Add the traceparent of a span to the metadata of a call.
+
+    Args:
+        trace: The context of the span making the call, or None if the request is not traced
+        call_metadata: The other metadata of the call, or None
+
+    Returns:
+        The metadata to pass to the call, None if there is nothing to send
+    """
+    if trace is None:
+        return call_metadata
+
+    return tuple(call_metadata or ()) + ((TRACEPARENT_METADATA_KEY, trace.traceparent()),)
+
+
+class Tracer:
+    """
+    Samples requests and writes their spans to a Chrome trace event file.
+
+    Spans are written as complete events as soon as they end, to a buffer
+    flushed to the file every FLUSH_INTERVAL seconds and on close().  Their
+    times are wall clock microseconds, so the files of a client and a server on
+    hosts with synchronised clocks line up when merged.
+    """
+
+    def __init__(self, path: Optional[str] = None, sample_rate: float = 0.0, service: str = 'segmentation'):
+        """
+        Args:
+            path: File to write the spans to, it is overwritten.  None disables tracing.
+            sample_rate: Fraction of new traces to sample, between 0 and 1.  Requests that
+                         arrive with a sampled trace context are always traced if path is set.
+            service: Name of the process in the trace viewer, such as "client" or "server"
+
+        Raises:
+            ValueError: If sample_rate is outside [0, 1]
+        """
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"sample_rate must be between 0 and 1, got {sample_rate}")
+
+        self.path = path
+        self.sample_rate = sample_rate if path is not None else 0.0
+        self.service = service
+        self._lock = threading.Lock()
+        self._file = None
+        self._flushed = time.monotonic()
+        self._pid = os.getpid()
+
+        # Spans are timed with time.monotonic(), which this offset converts to wall clock time
+        self._wall_offset = time.time() - time.monotonic()
+
+        if path is not None:
+            self._file = open(path, 'w', encoding='utf-8', buffering=1 << 16)
+            self._file.write('[\n')
+            self._write({'name': 'process_name', 'ph': 'M', 'pid': self._pid, 'args': {'name': service}})
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the tracer records spans at all."""
+        return self._file is not None
+
+    def start_trace(self) -> Optional[TraceContext]:
+        """Start a new trace if it is sampled, returning its root context or None."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+
+        return TraceContext(_random_id(128), _random_id(64))
+
+    def continue_trace(self, metadata: Optional[Sequence[Tuple[str, str]]]) -> Optional[TraceContext]:
+        """
+        Return the trace context of an incoming request.
+
+        Args:
+            metadata: The invocation metadata of the request
+
+        Returns:
+            The caller's context if it sampled the request, else a new trace if this
+            tracer samples it, else None
+        """
+        if self._file is None:
+            return None
+
+        return TraceContext.from_metadata(metadata) or self.start_trace()
+
+    def record(self, name: str, parent: Optional[TraceContext], start: float, end: float,
+               span: Optional[TraceContext] = None, **args):
+        """
+        Write a span that already ended.
+
+        Args:
+            name: Name of the span
+            parent: Context of the enclosing span, the span is dropped if None
+            start: time.monotonic() at which the span started
+            end: time.monotonic() at which the span ended
+            span: Context of the span itself, if its children already used it
+            args: Further values shown with the span
+        """
+        if parent is None or self._file is None:
+            return
+
+        span = span or parent.child()
+        self._write({
+            'name': name, 'cat': self.service, 'ph': 'X',
+            'ts': round((start + self._wall_offset) * 1e6), 'dur': round((end - start) * 1e6),
+            'pid': self._pid, 'tid': threading.get_ident(),
+            'args': {'trace_id': span.trace_id, 'span_id': span.span_id, 'parent_id': parent.span_id, **args},
+        })
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[TraceContext], **args) -> Iterator[Optional[TraceContext]]:
+        """
+        Time a with block as a span.
+
+        Args:
+            name: Name of the span
+            parent: Context of the enclosing span, nothing is recorded if None
+            args: Further values shown with the span
+
+        Yields:
+            The context of the span for its children, or None if the request is not traced
+        """
+        if parent is None or self._file is None:
+            yield None
+            return
+
+        span = parent.child()
+        start = time.monotonic()
+        try:
+            yield span
+        finally:
+            self.record(name, parent, start, time.monotonic(), span, **args)
+
+    def _write(self, event: dict):
+        line = json.dumps(event, separators=(',', ':'))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + ',\n')
+                if time.monotonic() - self._flushed >= FLUSH_INTERVAL:
+                    self._flush()
+
+    def flush(self):
+        """Write the buffered spans to the file."""
+        with self._lock:
+            if self._file is not None:
+                self._flush()
+
+    def _flush(self):
+        self._file.flush()
+        self._flushed = time.monotonic()
+
+    def close(self):
+        """Complete the trace file, the tracer records nothing afterwards."""
+        with self._lock:
+            if self._file is not None:
+                # The JSON array format allows a missing ']', but close it so plain JSON parsers accept the file
+                self._file.write('{}]\n')
+                self._file.close()
+                self._file = None
+                self.sample_rate = 0.0
+
+
+def read_trace(path: str) -> List[dict]:
+    """Read the events of a trace file, including one whose writer did not close it."""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+
+    if not text.rstrip().endswith(']'):
+        # Drop the part of a span a writer that was killed may have left after its last complete one
+        end = text.rfind(',\n')
+        text = (text[:end] if end >= 0 else '[') + ']'
+    return [event for event in json.loads(text) if event]
+
+
+def merge_traces(paths: Sequence[str], output: str, trace_id: Optional[str] = None) -> int:
+    """
+    Combine trace files into one.
+
+    Args:
+        paths: The trace files to combine, such as a client's and its servers'
+        output: The file to write
+        trace_id: Optional trace to keep, the spans of other traces are dropped
+
+    Returns:
+        The number of spans written
+    """
+    events = []
+    for path in paths:
+        for event in read_trace(path):
+            if trace_id is None or event.get('ph') == 'M' or event['args'].get('trace_id') == trace_id:
+                events.append(event)
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(events, f)
+
+    return sum(1 for event in events if event.get('ph') != 'M')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the trace files of a client and its servers.')
+    parser.add_argument('output', help='The merged trace file to write')
+    parser.add_argument('traces', nargs='+', help='Trace files written by a Tracer')
+    parser.add_argument('--trace-id', default=None, help='Only keep the spans of this trace')
+    args = parser.parse_args()
+
+    spans = merge_traces(args.traces, args.output, args.trace_id)
+    print(f"Wrote {spans} spans to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
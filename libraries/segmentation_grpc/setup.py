@@ -6,25 +6,18 @@ import sys
 from setuptools import setup, find_packages
 from setuptools.command.build_py import build_py
 
-# Import the proto file setup function
+# Import the build-time code generation function
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
-from _build import setup_proto_file
+from _build import generate_grpc_sources
 
 class CustomBuildCommand(build_py):
-    """Custom build command to set up proto files and generate gRPC code before building."""
+    """Custom build command to generate the gRPC code from the vendored proto file before building."""
 
     def run(self):
-        """Run the build command with proto file setup and gRPC code generation."""
-        setup_proto_file()
+        """Run the build command with gRPC code generation."""
+        if not generate_grpc_sources():
+            raise RuntimeError("gRPC code generation failed")
 
-        try:
-            import generate_grpc
-            print("Importing generate_grpc module")
-        except ModuleNotFoundError:
-            # If the module is not found, we can still run the generate_grpc_code function
-            pass
-
-        generate_grpc.generate_grpc_code()  # Force regeneration of gRPC code
         # Call the original build_py command
         super().run()
 
@@ -45,12 +38,16 @@ setup(
     include_package_data=True,
     install_requires=[
         "grpcio",
-        "grpcio-tools",
         "protobuf",
+        "numpy",
     ],
+    extras_require={
+        # Only needed to regenerate the gRPC code outside of a package build
+        "generate": ["grpcio-tools"],
+    },
     entry_points={
         "console_scripts": [
-            "generate-grpc=segmentation_grpc.generate_grpc:generate_grpc_code",
+            "generate-grpc=segmentation_grpc.__main__:main",
         ],
     },
     cmdclass={
@@ -0,0 +1,53 @@
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import zipfile
+
+import pytest
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, PACKAGE_DIR)
+from _build import generate_grpc_sources
+
+pytest.importorskip('grpc_tools')
+
+
+def test_generate_grpc_sources(tmp_path):
+    assert generate_grpc_sources(str(tmp_path))
+
+    assert (tmp_path / 'segmentation_pb2.py').exists()
+    service_code = (tmp_path / 'segmentation_pb2_grpc.py').read_text()
+    assert 'from segmentation_grpc import segmentation_pb2 as segmentation__pb2' in service_code
+
+
+def _setup(directory: str, *args: str):
+    """Run setup.py in directory without the source tree on the path, as a build frontend would."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(entry for entry in env.get('PYTHONPATH', '').split(os.pathsep)
+                                        if entry and os.path.abspath(entry) != PACKAGE_DIR)
+    subprocess.run([sys.executable, 'setup.py', '-q', *args], cwd=directory, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def test_wheel_builds_from_sdist(tmp_path):
+    pytest.importorskip('setuptools.command.bdist_wheel')
+
+    # Build from a copy so the build does not leave egg-info and dist directories in the source tree
+    source = tmp_path / 'source'
+    shutil.copytree(PACKAGE_DIR, source,
+                    ignore=shutil.ignore_patterns('__pycache__', '*.egg-info', 'build', 'dist'))
+    _setup(str(source), 'sdist', '--dist-dir', str(tmp_path / 'sdist'))
+
+    (sdist,) = (tmp_path / 'sdist').iterdir()
+    with tarfile.open(sdist) as archive:
+        archive.extractall(tmp_path / 'unpacked', filter='data')
+    (unpacked,) = (tmp_path / 'unpacked').iterdir()
+    _setup(str(unpacked), 'bdist_wheel', '--dist-dir', str(tmp_path / 'wheel'))
+
+    (wheel,) = (tmp_path / 'wheel').iterdir()
+    names = zipfile.ZipFile(wheel).namelist()
+    assert 'segmentation_grpc/segmentation_pb2.py' in names
+    assert 'segmentation_grpc/segmentation_pb2_grpc.py' in names
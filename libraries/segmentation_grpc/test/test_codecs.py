@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from segmentation_grpc import MaskLogits, PackedPolygons, Point, Polygon, EmbeddingTensor, TensorEncoding
+from segmentation_grpc.codecs import (encode_mask_logits, decode_mask_logits, encode_packed_polygons,
+                                     decode_packed_polygons, encode_polygons, encode_embedding_tensor,
+                                     decode_embedding_tensor)
+
+
+def test_mask_logits_round_trip():
+    logits = np.random.default_rng(0).normal(scale=8.0, size=(256, 256)).astype(np.float32)
+
+    message = encode_mask_logits(logits)
+    assert (message.width, message.height) == (256, 256)
+    assert len(message.data) == 256 * 256 * 2
+
+    decoded = decode_mask_logits(MaskLogits.FromString(message.SerializeToString()))
+    assert decoded.dtype == np.float32
+    np.testing.assert_allclose(decoded, logits, rtol=1e-3, atol=1e-2)
+
+
+def test_mask_logits_size_mismatch():
+    message = MaskLogits(width=4, height=4, data=b'\x00' * 8)
+    with pytest.raises(ValueError):
+        decode_mask_logits(message)
+
+
+def test_packed_polygons_round_trip():
+    polygons = [np.array([[10, 10], [20, 10], [20, 30]]),
+                np.array([[100, 5], [90, 7], [80, 9], [70, 3]])]
+
+    message = PackedPolygons.FromString(encode_packed_polygons(polygons).SerializeToString())
+    assert list(message.ring_offsets) == [0, 3]
+
+    decoded = decode_packed_polygons(message)
+    assert len(decoded) == 2
+    for original, result in zip(polygons, decoded):
+        np.testing.assert_array_equal(result, original)
+
+
+def test_packed_polygons_empty():
+    assert decode_packed_polygons(encode_packed_polygons([])) == []
+
+
+def test_encode_polygons_matches_point_messages():
+    polygons = [np.array([[0, 0], [127, 128], [16384, 5]]),
+                np.zeros((0, 2), dtype=np.int32),
+                np.array([[-1, 3], [2 ** 31 - 1, -2 ** 31], [40, 50]])]
+
+    expected = [Polygon(points=[Point(x=x, y=y) for x, y in polygon.tolist()]) for polygon in polygons]
+    assert encode_polygons(polygons) == expected
+    assert encode_polygons([]) == []
+
+
+@pytest.mark.parametrize('encoding, tolerance', [(TensorEncoding.TENSOR_FLOAT32, 0),
+                                                 (TensorEncoding.TENSOR_FLOAT16, 1e-2),
+                                                 (TensorEncoding.TENSOR_INT8, 5e-2)])
+@pytest.mark.parametrize('compress', [False, True])
+def test_embedding_tensor_round_trip(encoding, tolerance, compress):
+    array = np.random.default_rng(0).normal(size=(1, 8, 16, 16)).astype(np.float32)
+    array[:, 3] = 0  # An empty channel must not divide by a zero scale
+
+    message = encode_embedding_tensor('image_embed', array, encoding, compress)
+    decoded = decode_embedding_tensor(EmbeddingTensor.FromString(message.SerializeToString()))
+
+    assert decoded.shape == array.shape
+    assert message.compressed == compress
+    np.testing.assert_allclose(decoded, array, atol=tolerance * 4)
+
+
+def test_embedding_tensor_size_mismatch():
+    message = EmbeddingTensor(name='image_embed', shape=[1, 2, 2, 2], data=b'\x00' * 8)
+    with pytest.raises(ValueError):
+        decode_embedding_tensor(message)
@@ -0,0 +1,35 @@
+import subprocess
+import sys
+
+
+def _modules_loaded_by(statement: str) -> set:
+    """Run statement in a fresh interpreter and return the names of the modules it loaded."""
+    output = subprocess.check_output([sys.executable, '-c',
+                                      f'import sys; {statement}; print("\\n".join(sys.modules))'],
+                                     text=True)
+    return set(output.split())
+
+
+def test_import_does_not_generate_code():
+    modules = _modules_loaded_by('import segmentation_grpc; segmentation_grpc.SegmentationRequest')
+    assert 'grpc_tools' not in modules
+    assert 'segmentation_grpc.generate_grpc' not in modules
+
+
+def test_messages_do_not_import_grpc():
+    modules = _modules_loaded_by('from segmentation_grpc import SegmentationRequest')
+    assert 'grpc' not in modules
+
+
+def test_service_classes_resolve_lazily():
+    modules = _modules_loaded_by('from segmentation_grpc import SegmentationServiceStub')
+    assert 'segmentation_grpc.segmentation_pb2_grpc' in modules
+
+
+def test_generate_without_grpc_tools_fails_clearly(tmp_path, monkeypatch, capsys):
+    from segmentation_grpc.generate_grpc import generate_grpc_sources
+
+    # grpcio-tools is only installed with the generate extra
+    monkeypatch.setitem(sys.modules, 'grpc_tools', None)
+    assert not generate_grpc_sources(output_dir=str(tmp_path))
+    assert 'pip install segmentation_grpc[generate]' in capsys.readouterr().out
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from segmentation_grpc.mask_decoding import decoder_inputs, decoder_outputs, select_single_mask, upscale_logits
+
+
+def _embedding():
+    return {'image_embed': np.zeros((1, 256, 64, 64), np.float32),
+            'high_res_feats_0': np.zeros((1, 32, 256, 256), np.float32),
+            'high_res_feats_1': np.zeros((1, 64, 128, 128), np.float32)}
+
+
+def test_decoder_inputs_put_box_corners_first():
+    inputs = decoder_inputs(_embedding(),
+                            point_coords=np.array([[[100, 50]]]), point_labels=np.array([[1]]),
+                            boxes=np.array([[0, 0, 200, 100]]), mask_input=None,
+                            width=200, height=100, input_size=1024)
+
+    np.testing.assert_allclose(inputs['point_coords'], [[[0, 0], [1024, 1024], [512, 512]]])
+    np.testing.assert_array_equal(inputs['point_labels'], [[2, 3, 1]])
+    assert inputs['mask_input'].shape == (1, 1, 256, 256)
+    assert inputs['has_mask_input'].tolist() == [0]
+
+
+def test_decoder_outputs_shapes():
+    low_res = np.full((2, 4, 256, 256), -1.0, np.float32)
+    low_res[:, :, 64:192, 64:192] = 1.0
+    iou = np.full((2, 4), 0.5, np.float32)
+
+    masks, scores, logits = decoder_outputs(low_res, iou, multimask_output=True, width=40, height=30)
+    assert masks.shape == (2, 3, 30, 40)
+    assert scores.shape == (2, 3)
+    assert logits.shape == (2, 3, 256, 256)
+    assert masks[0, 0, 15, 20] and not masks[0, 0, 0, 0]
+
+
+def test_single_mask_falls_back_to_best_multimask():
+    stable = np.where(np.arange(16)[None, :] < 8, 10.0, -10.0) * np.ones((16, 1))
+    unstable = np.full((16, 16), 0.01)
+    low_res = np.stack([np.stack([stable, stable, stable, stable]),
+                        np.stack([unstable, stable, stable, stable])]).astype(np.float32)
+    iou = np.array([[0.5, 0.6, 0.9, 0.7], [0.5, 0.6, 0.9, 0.7]], dtype=np.float32)
+
+    masks, scores = select_single_mask(low_res, iou)
+    assert masks.shape == (2, 1, 16, 16)
+    assert scores[:, 0].tolist() == pytest.approx([0.5, 0.9])
+
+
+def test_upscale_logits_matches_half_pixel_bilinear():
+    logits = np.array([[0.0, 1.0], [2.0, 3.0]], dtype=np.float32)
+    upscaled = upscale_logits(logits, 4, 4)
+
+    # Output pixel centres map to -0.25, 0.25, 0.75 and 1.25 in the input, clamped at the edges
+    np.testing.assert_allclose(upscaled[0], [0.0, 0.25, 0.75, 1.0])
+    np.testing.assert_allclose(upscaled[:, 0], [0.0, 0.5, 1.5, 2.0])
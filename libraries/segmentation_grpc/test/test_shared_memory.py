@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from segmentation_grpc.shared_memory import SharedImageBuffer, attach_shared_array
+
+# Before Python 3.13 the resource tracker may log a KeyError when these tests exit, because the
+# test process is both the client creating the segments and the server attaching to them
+
+
+def test_attach_maps_client_buffer():
+    with SharedImageBuffer(width=5, height=4, dtype=np.uint16) as buffer:
+        buffer.array[:] = np.arange(20).reshape(4, 5)
+
+        with attach_shared_array(buffer.describe()) as pixels:
+            assert pixels.dtype == np.dtype('<u2')
+            np.testing.assert_array_equal(pixels, buffer.array)
+            pixels[0, 0] = 99
+            del pixels
+
+        assert buffer.array[0, 0] == 99
+
+
+def test_attach_rejects_oversized_description():
+    with SharedImageBuffer(width=5, height=4) as buffer:
+        message = buffer.describe()
+        message.height = 400
+        with pytest.raises(ValueError):
+            with attach_shared_array(message):
+                pass
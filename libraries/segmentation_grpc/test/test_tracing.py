@@ -0,0 +1,68 @@
+import time
+
+from segmentation_grpc.tracing import (TraceContext, Tracer, merge_traces, read_trace, trace_metadata,
+                                       TRACEPARENT_METADATA_KEY)
+
+
+def test_traceparent_round_trip():
+    context = TraceContext('4bf92f3577b34da6a3ce929d0e0e4736', '00f067aa0ba902b7')
+    metadata = trace_metadata(context, (('x-segmentation-priority', 'bulk'),))
+    assert metadata[-1] == (TRACEPARENT_METADATA_KEY, '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01')
+    assert TraceContext.from_metadata(metadata) == context
+
+    child = context.child()
+    assert child.trace_id == context.trace_id and len(child.span_id) == 16 and child.span_id != context.span_id
+
+
+def test_unsampled_and_invalid_traceparents_are_ignored():
+    for value in ('00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-00',
+                  '00-00000000000000000000000000000000-00f067aa0ba902b7-01',
+                  '00-4bf92f3577b34da6a3ce929d0e0e4736-xyz067aa0ba902b7-01',
+                  'garbage'):
+        assert TraceContext.from_metadata(((TRACEPARENT_METADATA_KEY, value),)) is None
+    assert trace_metadata(None, None) is None
+
+
+def test_disabled_tracer_samples_nothing():
+    tracer = Tracer(sample_rate=0.0)
+    assert not tracer.enabled
+    assert tracer.start_trace() is None
+    assert tracer.continue_trace(((TRACEPARENT_METADATA_KEY, '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'),)) is None
+    with tracer.span('encode', None) as span:
+        assert span is None
+
+
+def test_spans_are_written_and_merged(tmp_path):
+    client = Tracer(str(tmp_path / 'client.json'), sample_rate=1.0, service='client')
+    server = Tracer(str(tmp_path / 'server.json'), service='server')
+
+    with client.span('segment_image', client.start_trace()) as root:
+        with client.span('rpc', root) as rpc:
+            trace = server.continue_trace(trace_metadata(rpc))
+            now = time.monotonic()
+            server.record('inference', trace, now - 0.01, now, stage='inference')
+
+    client.close()
+    # An unclosed file, as left by a server that was killed after a flush, is still readable
+    server.flush()
+    events = [event for event in read_trace(str(tmp_path / 'server.json')) if event['ph'] == 'X']
+    assert events[0]['name'] == 'inference' and events[0]['args']['parent_id'] == rpc.span_id
+    assert 9000 <= events[0]['dur'] <= 11000
+
+    spans = merge_traces([str(tmp_path / 'client.json'), str(tmp_path / 'server.json')], str(tmp_path / 'merged.json'),
+                         trace_id=root.trace_id)
+    assert spans == 3
+
+
+def test_partly_written_span_is_dropped(tmp_path):
+    path = tmp_path / 'server.json'
+    tracer = Tracer(str(path), sample_rate=1.0, service='server')
+    now = time.monotonic()
+    tracer.record('inference', tracer.start_trace(), now - 0.01, now)
+    tracer.flush()
+
+    # A server killed while writing its next span
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"name":"postpro')
+
+    assert [event['name'] for event in read_trace(str(path))] == ['process_name', 'inference']
@@ -3,13 +3,31 @@ SegmentationServer Package
 
 This package provides a server for the segmentation service.
 It includes the core segmentation model and the gRPC server implementation.
-"""
 
-# Import the server functions for easy access
-from segmentation_server.server import serve
-from segmentation_server.segmentation_service import SegmentationModel
+The server and model pull in torch and SAM2, so they are imported on first
+access.  Modules such as scheduling can be used without loading them.
+"""
 
 __all__ = [
     'serve',
     'SegmentationModel'
-]
\ No newline at end of file
+]
+
+# Names resolved on first access, mapped to the module that provides them
+_lazy_attributes = {
+    'serve': 'server',
+    'SegmentationModel': 'segmentation_service',
+}
+
+
+def __getattr__(name):
+    """Import the server and model modules on first access."""
+    if name not in _lazy_attributes:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    import importlib
+    value = getattr(importlib.import_module(f'.{_lazy_attributes[name]}', __name__), name)
+
+    # Cache the value so later lookups bypass __getattr__
+    globals()[name] = value
+    return value
@@ -8,11 +8,19 @@ It handles command-line arguments and starts the gRPC server.
 import asyncio
 import argparse
 
-# Import the generate_grpc_code function from the segmentation_grpc package
-from segmentation_grpc.generate_grpc import generate_grpc_code
-
 # Import the serve function from the server module
-from segmentation_server.server import serve
+from segmentation_server.server import serve, DEFAULT_MAX_QUEUE_DEPTH
+from segmentation_server.client_limits import ClientLimits, ClientPolicy
+from segmentation_grpc.tracing import Tracer
+
+
+def client_weight(value: str):
+    """Parse a NAME=WEIGHT command line argument."""
+    try:
+        name, weight = value.rsplit('=', 1)
+        return name, float(weight)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Value must be in format "name=weight", such as "alice=2"')
 
 
 async def main():
@@ -21,21 +29,96 @@ async def main():
     parser = argparse.ArgumentParser(description='Start the segmentation service.')
     parser.add_argument('--port', type=int, default=50051,
                         help='The port to listen on (default: 50051)')
+    parser.add_argument('--unix-socket', default=None,
+                        help='Also listen on a Unix domain socket at this path, for clients on the same host')
+    parser.add_argument('--no-tcp', action='store_true',
+                        help='Only listen on the Unix domain socket')
     parser.add_argument('--workers', type=int, default=10,
                         help='The number of worker threads (default: 10)')
+    parser.add_argument('--preprocess-workers', type=int, default=2,
+                        help='Threads decoding images ahead of inference (default: 2)')
+    parser.add_argument('--postprocess-workers', type=int, default=2,
+                        help='Threads encoding masks and building responses after inference (default: 2)')
+    parser.add_argument('--polygon-workers', type=int, default=4,
+                        help='Threads tracing the polygons of a response\'s segments in parallel (default: 4)')
+    parser.add_argument('--max-queue-depth', type=int, default=DEFAULT_MAX_QUEUE_DEPTH,
+                        help='Jobs each client queues per priority class for preprocessing before its requests '
+                             f'are rejected with RESOURCE_EXHAUSTED, 0 for no bound (default: {DEFAULT_MAX_QUEUE_DEPTH})')
     parser.add_argument('--generate-grpc', action='store_true',
-                        help='Generate gRPC code before starting the server')
+                        help='Regenerate the gRPC code before starting the server, it is normally generated '
+                             'when the segmentation_grpc package is built')
+    parser.add_argument('--backend', choices=['torch', 'onnx', 'stub'], default='torch',
+                        help='Inference backend running the model (default: torch)')
+    parser.add_argument('--onnx-model', default=None, metavar='PREFIX',
+                        help='Path prefix of the model exported by segmentation_server.backends.export_onnx, '
+                             'required by the onnx backend')
+    parser.add_argument('--onnx-threads', type=int, default=0,
+                        help='Threads ONNX Runtime uses within each operator, 0 to let it choose (default: 0)')
+    parser.add_argument('--capture', default=None, metavar='PATH',
+                        help='Record SegmentImage traffic to this file, replay it with segmentation_server.replay')
+    parser.add_argument('--capture-payload', action='store_true',
+                        help='Include the full requests in the capture so replayed outputs can be compared')
+    parser.add_argument('--client-weight', type=client_weight, action='append', default=[], metavar='NAME=WEIGHT',
+                        help='Fair share weight of the client sending the x-segmentation-client metadata NAME, '
+                             'may be repeated (default weight: 1)')
+    parser.add_argument('--client-concurrency', type=int, default=0,
+                        help='Requests each client may have in flight at once, 0 for no limit (default: 0)')
+    parser.add_argument('--client-rate', type=float, default=0.0,
+                        help='Requests per second each client may start, 0 for no limit (default: 0)')
+    parser.add_argument('--client-burst', type=int, default=0,
+                        help='Requests a client may start together after an idle period, 0 to round up '
+                             '--client-rate (default: 0)')
+    parser.add_argument('--trace', default=None, metavar='PATH',
+                        help='Record the spans of traced requests to this Chrome trace file, requests traced by '
+                             'their client are always recorded')
+    parser.add_argument('--trace-sample-rate', type=float, default=0.0,
+                        help='Fraction of requests without a client trace to trace as well (default: 0)')
     args = parser.parse_args()
+
+    # The gRPC code ships with the installed segmentation_grpc package, only regenerate it on request
+    if args.generate_grpc:
+        from segmentation_grpc.generate_grpc import generate_grpc_code
+
+        print("Generating gRPC code...")
+        if not generate_grpc_code(True):
+            print("Failed to generate gRPC code. Exiting.")
+            return
     
-    # Generate gRPC code if requested
-    print("Generating gRPC code...")
-    if not generate_grpc_code(args.generate_grpc):
-        print("Failed to generate gRPC code. Exiting.")
-        return
-    
+    backend_options = {}
+    if args.backend == 'onnx':
+        if args.onnx_model is None:
+            parser.error("--backend onnx requires --onnx-model")
+        backend_options = {'model_prefix': args.onnx_model, 'num_threads': args.onnx_threads}
+
+    if args.max_queue_depth < 0:
+        parser.error("--max-queue-depth cannot be negative")
+
+    # Every client gets the same limits, named clients may have a weight of their own
+    default_policy = ClientPolicy(max_concurrency=args.client_concurrency, rate=args.client_rate,
+                                  burst=args.client_burst)
+    try:
+        client_limits = ClientLimits(default_policy, {name: default_policy._replace(weight=weight)
+                                                      for name, weight in args.client_weight})
+    except ValueError as e:
+        parser.error(str(e))
+
+    tracer = None
+    if args.trace is not None:
+        try:
+            tracer = Tracer(args.trace, args.trace_sample_rate, service='segmentation_server')
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"Recording request traces to {args.trace}")
+
     # Start the server
-    print(f"Starting segmentation service on port {args.port} with {args.workers} workers...")
-    await serve(port=args.port, max_workers=args.workers)
+    port = None if args.no_tcp else args.port
+    print(f"Starting segmentation service with {args.workers} workers...")
+    await serve(port=port, max_workers=args.workers, unix_socket=args.unix_socket,
+                capture_path=args.capture, capture_payload=args.capture_payload,
+                backend=args.backend, backend_options=backend_options,
+                preprocess_workers=args.preprocess_workers, postprocess_workers=args.postprocess_workers,
+                polygon_workers=args.polygon_workers, client_limits=client_limits, tracer=tracer,
+                max_queue_depth=args.max_queue_depth)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,46 @@
+"""
+Inference Backends
+
+SegmentationModel runs SAM2 through an InferenceBackend:
+- 'torch': SAM2 in eager PyTorch, the default and the only backend supporting stack propagation
+- 'onnx': an exported SAM2 model in ONNX Runtime, fastest on CPU
+- 'stub': deterministic geometric masks without a model, for tests and load testing
+
+Backends are imported when created, so only the selected backend's dependencies must be installed.
+"""
+
+import importlib
+
+from segmentation_server.backends.base import InferenceBackend
+
+__all__ = [
+    'InferenceBackend',
+    'BACKENDS',
+    'create_backend',
+]
+
+# Backend names mapped to the module and class implementing them
+BACKENDS = {
+    'torch': ('torch_backend', 'TorchBackend'),
+    'onnx': ('onnx_backend', 'OnnxBackend'),
+    'stub': ('stub', 'StubBackend'),
+}
+
+
+def create_backend(name: str, **options) -> InferenceBackend:
+    """
+    Create an inference backend by name.
+
+    Args:
+        name: One of BACKENDS
+        **options: Arguments of the backend's constructor
+
+    Returns:
+        The backend
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name!r}, expected one of {', '.join(BACKENDS)}")
+
+    module_name, class_name = BACKENDS[name]
+    module = importlib.import_module(f'.{module_name}', __name__)
+    return getattr(module, class_name)(**options)
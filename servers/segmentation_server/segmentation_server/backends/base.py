@@ -0,0 +1,205 @@
+"""
+Inference Backend Interface
+
+A backend runs the two halves of SAM2 for SegmentationModel: the image encoder,
+which turns an image into an embedding, and the mask decoder, which turns an
+embedding and a set of prompts into masks.  Everything else, such as caching
+embeddings, composing labeled images and encoding masks, is shared by all backends.
+"""
+
+import contextlib
+from abc import ABC, abstractmethod
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+class InferenceBackend(ABC):
+    """
+    Encodes images and decodes prompts into masks.
+
+    Embeddings are opaque to the caller.  SegmentationModel keeps them in its
+    embedding cache and passes them back to decode, so they must stay valid
+    after later images are encoded.
+
+    Backends are not required to be thread-safe, SegmentationModel is only
+    called from the inference scheduler's worker thread.
+    """
+
+    # Side length of the square image the encoder takes
+    input_size = 1024
+
+    @property
+    @abstractmethod
+    def model_name(self) -> str:
+        """Name of the loaded model, reported by GetLoad."""
+
+    @abstractmethod
+    def encode_image(self, image: NDArray[np.uint8]) -> Any:
+        """
+        Run the image encoder.
+
+        Args:
+            image: An RGB image of shape (height, width, 3)
+
+        Returns:
+            The embedding of the image, passed back to decode
+        """
+
+    @abstractmethod
+    def decode(self,
+               embedding: Any,
+               point_coords: Optional[NDArray[np.float32]],
+               point_labels: Optional[NDArray[np.int32]],
+               boxes: Optional[NDArray[np.float32]],
+               mask_input: Optional[NDArray[np.float32]],
+               multimask_output: bool) -> Tuple[NDArray[np.bool_], NDArray[np.float32], NDArray[np.float32]]:
+        """
+        Run the mask decoder on a batch of prompt sets for one image.
+
+        Every prompt set of a batch has the same number of points.  Shorter sets
+        are padded with points labelled -1, which the decoder ignores.
+
+        Args:
+            embedding: The embedding returned by encode_image
+            point_coords: Array of shape (B, N, 2) of (x, y) image coordinates, or None
+            point_labels: Array of shape (B, N) of point labels, 1 foreground, 0 background, -1 padding
+            boxes: Array of shape (B, 4) of (x0, y0, x1, y1) boxes, or None
+            mask_input: Array of shape (B, 1, 256, 256) of low resolution logits from a previous result, or None
+            multimask_output: Whether to return three candidate masks per prompt set instead of one
+
+        Returns:
+            A tuple of (masks, scores, logits) with shapes (B, C, H, W), (B, C) and (B, C, 256, 256)
+            where C is 3 with multimask_output and 1 without
+        """
+
+    def export_embedding(self, embedding: Any) -> Tuple[Dict[str, NDArray[np.float32]], Tuple[int, int]]:
+        """
+        Convert an embedding into the arrays an exported SAM2 mask decoder takes, for GetImageEmbedding.
+
+        Args:
+            embedding: The embedding returned by encode_image
+
+        Returns:
+            A tuple of (arrays, (height, width)) where arrays are float32 arrays keyed by
+            segmentation_grpc.mask_decoding.EMBEDDING_NAMES and (height, width) is the size of the encoded image
+        """
+        raise NotImplementedError(f"The {type(self).__name__} cannot export image embeddings")
+
+    def generate_masks(self,
+                       image: NDArray[np.uint8],
+                       points_per_side: int = 16,
+                       points_per_batch: int = 16,
+                       pred_iou_thresh: float = 0.7,
+                       stability_score_thresh: float = 0.92,
+                       stability_score_offset: float = 1.0,
+                       box_nms_thresh: float = 0.7,
+                       min_mask_region_area: int = 25) -> List[Dict[str, Any]]:
+        """
+        Segment everything in an image without prompts, like SAM2AutomaticMaskGenerator.
+
+        The image is encoded once and a regular grid of single point prompts is
+        decoded in batches.  Candidates with a low predicted IoU or an unstable
+        mask are dropped, as are candidates whose box overlaps a better one.
+        Unlike SAM2's generator no crops are processed, so backends with access to
+        the full generator override this.
+
+        Args:
+            image: An RGB image of shape (height, width, 3)
+            points_per_side: Number of grid points along each side of the image
+            points_per_batch: Number of grid points decoded together
+            pred_iou_thresh: Smallest predicted IoU of a kept mask
+            stability_score_thresh: Smallest stability score of a kept mask
+            stability_score_offset: Logit offset the stability score is measured at
+            box_nms_thresh: Box IoU above which the lower scoring of two masks is dropped
+            min_mask_region_area: Smallest area of a kept mask in pixels
+
+        Returns:
+            A list of annotations as SAM2AutomaticMaskGenerator returns them, dictionaries holding
+            the boolean 'segmentation', its 'area', its 'bbox' as (x, y, width, height),
+            'predicted_iou', 'stability_score' and the prompt 'point_coords'
+        """
+        height, width = image.shape[:2]
+        embedding = self.encode_image(image)
+
+        # Grid points at the centres of points_per_side x points_per_side cells
+        offsets = (np.arange(points_per_side) + 0.5) / points_per_side
+        grid = np.stack(np.meshgrid(offsets * width, offsets * height), axis=-1).reshape(-1, 2).astype(np.float32)
+
+        candidates = []
+        for start in range(0, len(grid), points_per_batch):
+            points = grid[start:start + points_per_batch]
+            masks, scores, logits = self.decode(embedding, points[:, None, :], np.ones((len(points), 1), np.int32),
+                                                None, None, multimask_output=True)
+
+            for point, point_masks, point_scores, point_logits in zip(points, masks, scores, logits):
+                for mask, score, low_res_logits in zip(point_masks, point_scores, point_logits):
+                    if score < pred_iou_thresh:
+                        continue
+
+                    stability = stability_score(low_res_logits, stability_score_offset)
+                    area = int(mask.sum())
+                    if stability < stability_score_thresh or area < min_mask_region_area:
+                        continue
+
+                    rows, columns = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+                    candidates.append({
+                        'segmentation': mask,
+                        'area': area,
+                        'bbox': [int(columns[0]), int(rows[0]),
+                                 int(columns[-1] - columns[0] + 1), int(rows[-1] - rows[0] + 1)],
+                        'predicted_iou': float(score),
+                        'stability_score': stability,
+                        'point_coords': [point.tolist()],
+                    })
+
+        return _box_nms(candidates, box_nms_thresh)
+
+    def inference_context(self) -> ContextManager:
+        """A context entered around every call into the backend's models."""
+        return contextlib.nullcontext()
+
+    def build_video_predictor(self):
+        """
+        Build the SAM2 video predictor used to propagate objects through section stacks.
+
+        Raises:
+            NotImplementedError: If the backend cannot propagate through stacks
+        """
+        raise NotImplementedError(f"The {type(self).__name__} does not support stack propagation")
+
+
+def batch_size(point_coords: Optional[NDArray], boxes: Optional[NDArray]) -> int:
+    """Return the number of prompt sets in a decode batch."""
+    if point_coords is not None:
+        return point_coords.shape[0]
+    if boxes is not None:
+        return boxes.shape[0]
+    raise ValueError("decode needs point or box prompts")
+
+
+def stability_score(logits: NDArray[np.float32], offset: float) -> float:
+    """Return the IoU of a mask thresholded at +offset and -offset, SAM's measure of how stable a mask is."""
+    union = int((logits > -offset).sum())
+    return float((logits > offset).sum() / union) if union > 0 else 0.0
+
+
+def _box_nms(annotations: List[Dict[str, Any]], iou_threshold: float) -> List[Dict[str, Any]]:
+    """Keep annotations in order of decreasing predicted IoU, dropping those whose box overlaps a kept one."""
+    kept = []
+    for annotation in sorted(annotations, key=lambda a: a['predicted_iou'], reverse=True):
+        x, y, w, h = annotation['bbox']
+        overlaps = False
+        for other in kept:
+            ox, oy, ow, oh = other['bbox']
+            intersection = (max(0, min(x + w, ox + ow) - max(x, ox)) *
+                            max(0, min(y + h, oy + oh) - max(y, oy)))
+            if intersection > iou_threshold * (w * h + ow * oh - intersection):
+                overlaps = True
+                break
+
+        if not overlaps:
+            kept.append(annotation)
+
+    return kept
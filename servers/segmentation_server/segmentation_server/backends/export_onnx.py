@@ -0,0 +1,147 @@
+"""
+ONNX Export
+
+Exports the SAM2 image encoder and mask decoder to ONNX for the ONNX Runtime
+backend.  Exporting needs torch, SAM2 and the checkpoint, serving the exported
+model does not.
+
+Usage:
+    python -m segmentation_server.backends.export_onnx models/sam2.1_hiera_l
+    python -m segmentation_server --backend onnx --onnx-model models/sam2.1_hiera_l
+
+The encoder takes the normalised (1, 3, 1024, 1024) image and returns the three
+feature maps SAM2ImagePredictor.set_image stores.  The decoder takes those
+features and a batch of prompt sets already mapped into the 1024 pixel frame,
+and returns the low resolution logits and IoU predictions of all four mask
+tokens.  Choosing masks and upsampling them is left to OnnxBackend.
+"""
+
+import argparse
+import os
+
+import torch
+
+from segmentation_grpc.mask_decoding import LOW_RES_MASK_SIZE
+
+from segmentation_server.backends.onnx_backend import IMAGE_SIZE, EMBEDDING_NAMES, model_paths
+from segmentation_server.backends.torch_backend import default_model_paths
+
+# Feature map sizes of the SAM2 backbone for a 1024 pixel input, highest resolution first
+_FEATURE_SIZES = [(256, 256), (128, 128), (64, 64)]
+
+
+class ImageEncoder(torch.nn.Module):
+    """The part of SAM2ImagePredictor.set_image that runs on the image."""
+
+    def __init__(self, sam2_model):
+        super().__init__()
+        self.model = sam2_model
+
+    def forward(self, image: torch.Tensor):
+        backbone_out = self.model.forward_image(image)
+        _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
+        if self.model.directly_add_no_mem_embed:
+            vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
+
+        feats = [feat.permute(1, 2, 0).reshape(1, -1, *size) for feat, size in zip(vision_feats, _FEATURE_SIZES)]
+        return feats[2], feats[0], feats[1]
+
+
+class MaskDecoder(torch.nn.Module):
+    """The prompt encoder and mask decoder SAM2ImagePredictor.predict runs, returning every mask token."""
+
+    def __init__(self, sam2_model):
+        super().__init__()
+        self.prompt_encoder = sam2_model.sam_prompt_encoder
+        self.mask_decoder = sam2_model.sam_mask_decoder
+
+    def forward(self, image_embed, high_res_feats_0, high_res_feats_1, point_coords, point_labels,
+                mask_input, has_mask_input):
+        # Boxes arrive as corner points, so the prompts are always padded as SAM2 does without a box
+        sparse = self.prompt_encoder._embed_points(point_coords, point_labels, pad=True)
+
+        has_mask = has_mask_input.reshape(-1, 1, 1, 1)
+        no_mask = self.prompt_encoder.no_mask_embed.weight.reshape(1, -1, 1, 1)
+        dense = has_mask * self.prompt_encoder._embed_masks(mask_input) + (1 - has_mask) * no_mask
+
+        masks, iou_predictions, _, _ = self.mask_decoder.predict_masks(
+            image_embeddings=image_embed,
+            image_pe=self.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse,
+            dense_prompt_embeddings=dense,
+            repeat_image=True,
+            high_res_features=[high_res_feats_0, high_res_feats_1],
+        )
+        return masks, iou_predictions
+
+
+def export(model_prefix: str, model_cfg: str, checkpoint: str, opset: int = 17):
+    """
+    Export the encoder and decoder of a SAM2 model.
+
+    Args:
+        model_prefix: Path prefix of the output files, .encoder.onnx and .decoder.onnx are appended
+        model_cfg: Path of the SAM2 model config
+        checkpoint: Path of the SAM2 checkpoint
+        opset: ONNX opset version
+    """
+    from sam2.build_sam import build_sam2
+
+    directory = os.path.dirname(model_prefix)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    paths = model_paths(model_prefix)
+    sam2_model = build_sam2(model_cfg, checkpoint, device='cpu').eval()
+
+    with torch.no_grad():
+        encoder = ImageEncoder(sam2_model)
+        image = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+        print(f"Exporting image encoder to {paths['encoder']}")
+        torch.onnx.export(encoder, (image,), paths['encoder'],
+                          input_names=['image'],
+                          output_names=list(EMBEDDING_NAMES),
+                          opset_version=opset)
+
+        image_embed, high_res_feats_0, high_res_feats_1 = encoder(image)
+        decoder = MaskDecoder(sam2_model)
+        inputs = (image_embed, high_res_feats_0, high_res_feats_1,
+                  torch.randint(0, IMAGE_SIZE, (1, 2, 2), dtype=torch.float32),
+                  torch.ones(1, 2, dtype=torch.float32),
+                  torch.zeros(1, 1, LOW_RES_MASK_SIZE, LOW_RES_MASK_SIZE),
+                  torch.zeros(1))
+        print(f"Exporting mask decoder to {paths['decoder']}")
+        torch.onnx.export(decoder, inputs, paths['decoder'],
+                          input_names=[*EMBEDDING_NAMES, 'point_coords', 'point_labels', 'mask_input',
+                                       'has_mask_input'],
+                          output_names=['masks', 'iou_predictions'],
+                          dynamic_axes={
+                              'point_coords': {0: 'num_sets', 1: 'num_points'},
+                              'point_labels': {0: 'num_sets', 1: 'num_points'},
+                              'mask_input': {0: 'num_sets'},
+                              'has_mask_input': {0: 'num_sets'},
+                              'masks': {0: 'num_sets'},
+                              'iou_predictions': {0: 'num_sets'},
+                          },
+                          opset_version=opset)
+
+
+def main():
+    default_cfg, default_checkpoint = default_model_paths()
+
+    parser = argparse.ArgumentParser(description='Export the SAM2 encoder and decoder to ONNX.')
+    parser.add_argument('model_prefix',
+                        help='Path prefix of the output files, e.g. models/sam2.1_hiera_l')
+    parser.add_argument('--config', default=default_cfg,
+                        help='SAM2 model config (default: the SAM2.1 large config)')
+    parser.add_argument('--checkpoint', default=default_checkpoint,
+                        help='SAM2 checkpoint matching the config (default: the SAM2.1 large checkpoint)')
+    parser.add_argument('--opset', type=int, default=17,
+                        help='ONNX opset version (default: 17)')
+    args = parser.parse_args()
+
+    export(args.model_prefix, args.config, args.checkpoint, opset=args.opset)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+ONNX Runtime Backend
+
+Runs the SAM2 image encoder and mask decoder exported by
+segmentation_server.backends.export_onnx with ONNX Runtime.  On CPU this is
+considerably faster than eager PyTorch and needs neither torch nor the SAM2
+checkpoints at runtime.
+
+The pre and post processing SAM2ImagePredictor does in torch is done in numpy:
+resizing and normalising the image here, and mapping prompts into the encoder's
+input frame, choosing the output masks and upsampling the logits in
+segmentation_grpc.mask_decoding, which clients decoding locally share.  Results
+match the PyTorch backend up to interpolation and floating point differences.
+"""
+
+import os
+from typing import Any, Dict, Sequence, Tuple
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+from segmentation_grpc.mask_decoding import EMBEDDING_NAMES, decoder_inputs, decoder_outputs
+
+from segmentation_server.backends.base import InferenceBackend
+
+# Side length of the square image the SAM2 encoder takes
+IMAGE_SIZE = 1024
+
+# ImageNet normalisation applied by SAM2Transforms
+PIXEL_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+PIXEL_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def model_paths(model_prefix: str) -> Dict[str, str]:
+    """Return the paths of the encoder and decoder exported under model_prefix."""
+    return {'encoder': f'{model_prefix}.encoder.onnx', 'decoder': f'{model_prefix}.decoder.onnx'}
+
+
+def preprocess_image(image: NDArray[np.uint8]) -> NDArray[np.float32]:
+    """Resize and normalise an RGB image into the (1, 3, 1024, 1024) encoder input."""
+    height, width = image.shape[:2]
+    # Area interpolation stands in for the antialiasing torchvision applies when shrinking
+    interpolation = cv2.INTER_AREA if max(height, width) > IMAGE_SIZE else cv2.INTER_LINEAR
+    resized = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE), interpolation=interpolation)
+
+    normalized = (resized.astype(np.float32) / 255.0 - PIXEL_MEAN) / PIXEL_STD
+    return np.ascontiguousarray(normalized.transpose(2, 0, 1)[None])
+
+
+class OnnxBackend(InferenceBackend):
+    """
+    Runs an exported SAM2 encoder and decoder with ONNX Runtime.
+    """
+
+    input_size = IMAGE_SIZE
+
+    def __init__(self,
+                 model_prefix: str,
+                 providers: Sequence[str] = ('CPUExecutionProvider',),
+                 num_threads: int = 0):
+        """
+        Args:
+            model_prefix: Path prefix of the exported model, model_prefix.encoder.onnx and
+                          model_prefix.decoder.onnx must exist
+            providers: ONNX Runtime execution providers, in order of preference
+            num_threads: Threads used within each operator, 0 lets ONNX Runtime choose
+        """
+        import onnxruntime
+
+        paths = model_paths(model_prefix)
+        for path in paths.values():
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"{path} not found, export the model with "
+                                        f"python -m segmentation_server.backends.export_onnx")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+
+        self.model_prefix = model_prefix
+        self.encoder = onnxruntime.InferenceSession(paths['encoder'], options, providers=list(providers))
+        self.decoder = onnxruntime.InferenceSession(paths['decoder'], options, providers=list(providers))
+        print(f"Loaded ONNX model {model_prefix} using {', '.join(self.encoder.get_providers())}")
+
+    @property
+    def model_name(self) -> str:
+        return f'{os.path.basename(self.model_prefix)}_onnx'
+
+    def encode_image(self, image: NDArray[np.uint8]) -> Any:
+        outputs = self.encoder.run(list(EMBEDDING_NAMES), {'image': preprocess_image(image)})
+        embedding = dict(zip(EMBEDDING_NAMES, outputs))
+        embedding['orig_hw'] = image.shape[:2]
+        return embedding
+
+    def decode(self, embedding, point_coords, point_labels, boxes, mask_input, multimask_output):
+        height, width = embedding['orig_hw']
+        inputs = decoder_inputs(embedding, point_coords, point_labels, boxes, mask_input,
+                                width=width, height=height, input_size=self.input_size)
+        low_res, iou = self.decoder.run(['masks', 'iou_predictions'], inputs)
+        return decoder_outputs(low_res, iou, multimask_output, width=width, height=height)
+
+    def export_embedding(self, embedding: Any) -> Tuple[Dict[str, NDArray[np.float32]], Tuple[int, int]]:
+        return {name: embedding[name] for name in EMBEDDING_NAMES}, tuple(embedding['orig_hw'])
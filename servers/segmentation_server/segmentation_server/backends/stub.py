@@ -0,0 +1,110 @@
+"""
+Stub Backend
+
+A deterministic stand-in for SAM2 that needs no model, checkpoint or GPU.  It
+lets the server and its clients be tested end to end, and load tested with
+realistic timings through the optional encode and decode delays.
+
+Masks are discs centred on the mean of the foreground points, or the box when
+there are no foreground points, growing with each multimask output.  Scores
+depend only on the prompts, so repeated requests return identical results.
+"""
+
+import time
+from typing import Any, Dict, Tuple
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+from segmentation_grpc.mask_decoding import LOW_RES_MASK_SIZE
+
+from segmentation_server.backends.base import InferenceBackend, batch_size
+
+
+class StubBackend(InferenceBackend):
+    """
+    Produces simple geometric masks from the prompts without running a model.
+    """
+
+    def __init__(self, encode_delay: float = 0.0, decode_delay: float = 0.0):
+        """
+        Args:
+            encode_delay: Seconds each image encoding takes, to simulate the real encoder
+            decode_delay: Seconds each decode batch takes, to simulate the real decoder
+        """
+        self.encode_delay = encode_delay
+        self.decode_delay = decode_delay
+
+        # Number of images encoded, tests use it to check the embedding cache
+        self.encode_calls = 0
+
+    @property
+    def model_name(self) -> str:
+        return 'stub'
+
+    def encode_image(self, image: NDArray[np.uint8]) -> Any:
+        if self.encode_delay > 0:
+            time.sleep(self.encode_delay)
+
+        self.encode_calls += 1
+        return {'orig_hw': image.shape[:2], 'mean': float(image.mean())}
+
+    def export_embedding(self, embedding: Any) -> Tuple[Dict[str, NDArray[np.float32]], Tuple[int, int]]:
+        # Arrays of the shapes SAM2 produces for a 1024 pixel input, filled with the image's mean intensity
+        value = embedding['mean'] / 255.0
+        arrays = {
+            'image_embed': np.full((1, 256, 64, 64), value, dtype=np.float32),
+            'high_res_feats_0': np.full((1, 32, 256, 256), value, dtype=np.float32),
+            'high_res_feats_1': np.full((1, 64, 128, 128), value, dtype=np.float32),
+        }
+        return arrays, tuple(embedding['orig_hw'])
+
+    def decode(self, embedding, point_coords, point_labels, boxes, mask_input, multimask_output):
+        if self.decode_delay > 0:
+            time.sleep(self.decode_delay)
+
+        height, width = embedding['orig_hw']
+        num_sets = batch_size(point_coords, boxes)
+        num_masks = 3 if multimask_output else 1
+        base_radius = max(2.0, min(height, width) / 16)
+
+        yy, xx = np.mgrid[:height, :width]
+        masks = np.zeros((num_sets, num_masks, height, width), dtype=bool)
+        scores = np.zeros((num_sets, num_masks), dtype=np.float32)
+        for i in range(num_sets):
+            cx, cy, radius = self._prompt_disc(point_coords, point_labels, boxes, i, base_radius)
+            for j in range(num_masks):
+                masks[i, j] = (xx - cx) ** 2 + (yy - cy) ** 2 <= (radius * (j + 1)) ** 2
+                # A middle sized mask scores best, as SAM2 often prefers the part over the whole
+                scores[i, j] = 0.9 - 0.1 * abs(j - 1) if multimask_output else 0.9
+
+            if mask_input is not None:
+                previous = cv2.resize(np.asarray(mask_input[i, 0], dtype=np.float32), (width, height)) > 0
+                masks[i] |= previous
+
+        logits = np.empty((num_sets, num_masks, LOW_RES_MASK_SIZE, LOW_RES_MASK_SIZE), dtype=np.float32)
+        for i in range(num_sets):
+            for j in range(num_masks):
+                small = cv2.resize(masks[i, j].astype(np.uint8), (LOW_RES_MASK_SIZE, LOW_RES_MASK_SIZE),
+                                   interpolation=cv2.INTER_NEAREST)
+                logits[i, j] = np.where(small > 0, 8.0, -8.0)
+
+        return masks, scores, logits
+
+    @staticmethod
+    def _prompt_disc(point_coords, point_labels, boxes, index: int, base_radius: float):
+        """Return the (x, y, radius) of the smallest disc for one prompt set."""
+        if point_coords is not None:
+            foreground = point_coords[index][point_labels[index] == 1]
+            if len(foreground) > 0:
+                cx, cy = foreground.mean(axis=0)
+                return float(cx), float(cy), base_radius
+
+        if boxes is not None:
+            x0, y0, x1, y1 = boxes[index]
+            return (x0 + x1) / 2, (y0 + y1) / 2, max(base_radius, min(x1 - x0, y1 - y0) / 6)
+
+        # Only background points, place a small disc on the first of them
+        cx, cy = point_coords[index][0]
+        return float(cx), float(cy), base_radius
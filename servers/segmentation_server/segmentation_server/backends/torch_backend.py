@@ -0,0 +1,153 @@
+"""
+PyTorch Backend
+
+Runs SAM2 through its own SAM2ImagePredictor, the reference implementation
+and the only backend that can propagate objects through section stacks.
+"""
+
+import contextlib
+import os
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from numpy.typing import NDArray
+
+from segmentation_server.backends.base import InferenceBackend, batch_size
+
+
+def default_model_paths() -> Tuple[str, str]:
+    """Return the (config, checkpoint) paths of the SAM2.1 large model shipped with the sam2 package."""
+    import sam2
+
+    # The checkpoints directory sits next to the sam2 package in a source checkout
+    root_path = os.path.dirname(os.path.dirname(sam2.__file__))
+    return (f"/{root_path}/sam2/configs/sam2.1/sam2.1_hiera_l.yaml",
+            f"/{root_path}/checkpoints/sam2.1_hiera_large.pt")
+
+
+def select_device() -> torch.device:
+    """Pick the fastest available torch device and configure it for SAM2."""
+    if torch.cuda.is_available():
+        device = torch.device("cuda")
+        # Use bfloat16 for better performance on CUDA
+        torch.autocast("cuda", dtype=torch.bfloat16).__enter__()
+        # Turn on tfloat32 for Ampere GPUs
+        if torch.cuda.get_device_properties(0).major >= 8:
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+    elif torch.backends.mps.is_available():
+        device = torch.device("mps")
+        print(
+            "Support for MPS devices is preliminary. SAM2 is trained with CUDA and might "
+            "give numerically different outputs and sometimes degraded performance on MPS."
+        )
+    else:
+        device = torch.device("cpu")
+
+    print(f"Using device: {device}")
+    return device
+
+
+class TorchBackend(InferenceBackend):
+    """
+    Runs SAM2 in eager PyTorch on the fastest available device.
+    """
+
+    def __init__(self, model_cfg: Optional[str] = None, checkpoint: Optional[str] = None):
+        """
+        Args:
+            model_cfg: Path of the SAM2 model config, the SAM2.1 large config by default
+            checkpoint: Path of the SAM2 checkpoint matching model_cfg
+        """
+        # SAM2 and its configuration system are slow to import, only load them when a model is built
+        from sam2.build_sam import build_sam2
+        from sam2.sam2_image_predictor import SAM2ImagePredictor
+        from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+
+        self.device = select_device()
+
+        default_cfg, default_checkpoint = default_model_paths()
+        self.model_cfg = model_cfg or default_cfg
+        self.sam2_checkpoint = checkpoint or default_checkpoint
+
+        # Build the SAM2 model
+        self.sam2_model = build_sam2(self.model_cfg, self.sam2_checkpoint, device=self.device)
+
+        # Create the image predictor
+        self.predictor = SAM2ImagePredictor(self.sam2_model)
+        self.input_size = self.sam2_model.image_size
+
+        self.mask_generator = SAM2AutomaticMaskGenerator(
+            model=self.sam2_model,
+            points_per_side=32,
+            points_per_batch=256,
+            pred_iou_thresh=0.7,
+            stability_score_thresh=0.92,
+            stability_score_offset=0.7,
+            crop_n_layers=1,
+            box_nms_thresh=0.7,
+            crop_n_points_downscale_factor=2,
+            min_mask_region_area=25.0,
+            use_m2m=True,
+        )
+
+    @property
+    def model_name(self) -> str:
+        return os.path.splitext(os.path.basename(self.model_cfg))[0]
+
+    def inference_context(self) -> ContextManager:
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        stack.enter_context(torch.autocast("cuda", dtype=torch.bfloat16))
+        return stack
+
+    def encode_image(self, image: NDArray[np.uint8]) -> Any:
+        with self.inference_context():
+            self.predictor.set_image(image)
+
+        return self.predictor._features, list(self.predictor._orig_hw)
+
+    def decode(self, embedding, point_coords, point_labels, boxes, mask_input, multimask_output):
+        # Restore the state SAM2ImagePredictor.set_image leaves behind
+        features, orig_hw = embedding
+        self.predictor.reset_predictor()
+        self.predictor._features = features
+        self.predictor._orig_hw = orig_hw
+        self.predictor._is_batch = False
+        self.predictor._is_image_set = True
+
+        num_sets = batch_size(point_coords, boxes)
+        with self.inference_context():
+            masks, scores, logits = self.predictor.predict(
+                point_coords=point_coords,
+                point_labels=point_labels,
+                box=boxes,
+                mask_input=mask_input,
+                multimask_output=multimask_output,
+            )
+
+        # SAM2 drops the batch dimension when the batch holds a single entry
+        num_masks = scores.shape[-1]
+        return (masks.reshape(num_sets, num_masks, *masks.shape[-2:]).astype(bool, copy=False),
+                scores.reshape(num_sets, num_masks),
+                logits.reshape(num_sets, num_masks, *logits.shape[-2:]))
+
+    def export_embedding(self, embedding: Any) -> Tuple[Dict[str, NDArray[np.float32]], Tuple[int, int]]:
+        features, orig_hw = embedding
+        high_res_feats_0, high_res_feats_1 = features['high_res_feats']
+        arrays = {
+            'image_embed': features['image_embed'].float().cpu().numpy(),
+            'high_res_feats_0': high_res_feats_0.float().cpu().numpy(),
+            'high_res_feats_1': high_res_feats_1.float().cpu().numpy(),
+        }
+        return arrays, tuple(orig_hw[-1])
+
+    def generate_masks(self, image: NDArray[np.uint8], **options) -> List[Dict[str, Any]]:
+        # SAM2's own generator adds crops and mask refinement, it is configured in the constructor
+        with self.inference_context():
+            return self.mask_generator.generate(image)
+
+    def build_video_predictor(self):
+        from sam2.build_sam import build_sam2_video_predictor
+        return build_sam2_video_predictor(self.model_cfg, self.sam2_checkpoint, device=self.device)
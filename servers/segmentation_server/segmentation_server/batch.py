@@ -0,0 +1,486 @@
+"""
+Whole-Volume Batch Segmentation
+
+Pre-segments every tile of a volume with automatic mask generation, without a
+server in between.  Sections are sharded across worker processes, each loading
+its own SegmentationModel, and every tile's result is written as soon as it is
+produced.
+
+Progress is recorded in a manifest of append-only logs, one per worker process,
+with a line per finished tile.  A tile counts as done once its line is written,
+after its outputs, so a run that is interrupted, even mid-write, resumes with
+exactly the tiles that have no line yet.
+
+The volume is a directory holding one directory per section, each holding the
+section's tile images:
+
+    volume/
+        0001/
+            X001_Y001.png
+            X001_Y002.png
+        0002/
+            ...
+
+Results are written per tile by default.  With --label-volume they are written
+into a single chunked label volume instead, see segmentation_server.label_volume.
+
+Usage:
+    python -m segmentation_server.batch volume/ output/ --workers 8 --backend onnx --onnx-model models/sam2.1_hiera_l
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+from segmentation_server.backends import BACKENDS
+
+# File extensions of the tile images of a section
+TILE_EXTENSIONS = ('.png', '.tif', '.tiff', '.jpg', '.jpeg')
+
+# Name of the file recording how a job was started, checked when it is resumed
+JOB_FILE = 'job.json'
+
+
+class Tile(NamedTuple):
+    """
+    A tile of a section.
+
+    Attributes:
+        section: Name of the section's directory
+        name: File name of the tile
+        path: Path of the tile image
+    """
+    section: str
+    name: str
+    path: str
+
+    @property
+    def key(self) -> str:
+        """Identifier of the tile within its volume, as recorded in the manifest."""
+        return f'{self.section}/{self.name}'
+
+
+class WorkerStats(NamedTuple):
+    """
+    Throughput of one worker process.
+
+    Attributes:
+        worker: Process ID of the worker
+        tiles: Number of tiles segmented
+        failures: Number of tiles that could not be segmented, they are retried when the job is resumed
+        seconds: Time spent segmenting and writing tiles
+    """
+    worker: int
+    tiles: int
+    failures: int
+    seconds: float
+
+    @property
+    def tiles_per_second(self) -> float:
+        return self.tiles / self.seconds if self.seconds > 0 else 0.0
+
+
+def _section_sort_key(name: str):
+    """Sort section directories numerically when they are numbered."""
+    return (0, int(name), name) if name.isdigit() else (1, 0, name)
+
+
+def discover_sections(volume_dir: str) -> Dict[str, List[Tile]]:
+    """
+    Find the tiles of every section of a volume.
+
+    Args:
+        volume_dir: Directory holding a directory of tile images per section
+
+    Returns:
+        The tiles of each section keyed by the section's directory name, in section order
+    """
+    sections = {}
+    for section in sorted(os.listdir(volume_dir), key=_section_sort_key):
+        section_dir = os.path.join(volume_dir, section)
+        if not os.path.isdir(section_dir):
+            continue
+
+        names = sorted(name for name in os.listdir(section_dir) if name.lower().endswith(TILE_EXTENSIONS))
+        if len(names) > 0:
+            sections[section] = [Tile(section, name, os.path.join(section_dir, name)) for name in names]
+
+    return sections
+
+
+class TileWriter:
+    """
+    Writes each tile's labeled image as a 16-bit PNG and its segments as JSON.
+
+    Outputs go to <output_dir>/<section>/<tile>.png and .json, each written to a
+    temporary file and renamed into place, so readers never see a partial file.
+
+    Sinks are passed to the worker processes, so they must be picklable and open
+    any files on first use.
+    """
+
+    def __init__(self, output_dir: str):
+        """
+        Args:
+            output_dir: Directory the per-tile outputs are written to
+        """
+        self.output_dir = output_dir
+
+    def write(self, tile: Tile, labeled_image: NDArray, segments: List[Dict[str, Any]]):
+        """
+        Write the result of one tile.
+
+        Args:
+            tile: The tile
+            labeled_image: The tile's labeled image
+            segments: The tile's segments, see SegmentationModel.generate_masks
+        """
+        stem = os.path.join(self.output_dir, tile.section, os.path.splitext(tile.name)[0])
+        os.makedirs(os.path.dirname(stem), exist_ok=True)
+
+        _write_atomically(f'{stem}.png', cv2.imencode('.png', labeled_image.astype(np.uint16))[1].tobytes())
+        _write_atomically(f'{stem}.json', json.dumps({'tile': tile.key, 'segments': segments}).encode())
+
+    def describe(self) -> Dict[str, Any]:
+        """Return where the writer puts its outputs, recorded in the job file so a resumed job writes there too."""
+        return {'type': 'tiles', 'path': os.path.abspath(self.output_dir)}
+
+    def close(self):
+        """Release any resources held by the writer."""
+
+
+def _write_atomically(path: str, data: bytes):
+    temporary = f'{path}.tmp{os.getpid()}'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+class Manifest:
+    """
+    The progress of a batch job, as append-only logs of finished tiles.
+
+    Every process appends to a log of its own, <directory>/<pid>.jsonl, so no
+    locking is needed.  Each line is flushed to disk before the next tile starts,
+    and a line cut short by an interruption is ignored when the logs are read.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Args:
+            directory: Directory holding the logs
+        """
+        self.directory = directory
+        self._log = None
+
+    def completed(self) -> Dict[str, Dict[str, Any]]:
+        """Return the records of all successfully segmented tiles, keyed by Tile.key."""
+        records = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.jsonl'))):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if 'error' not in record:
+                        records[record['tile']] = record
+
+        return records
+
+    def record(self, tile: Tile, **fields):
+        """
+        Record that a tile was finished.
+
+        Args:
+            tile: The tile
+            **fields: Values stored with the record.  Records holding an 'error' mark failed tiles.
+        """
+        if self._log is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._log = open(os.path.join(self.directory, f'{os.getpid()}.jsonl'), 'ab+')
+
+            # A line cut short in an earlier run must not swallow the first record of this one
+            if self._log.tell() > 0:
+                self._log.seek(-1, os.SEEK_END)
+                if self._log.read(1) != b'\n':
+                    self._log.write(b'\n')
+
+        self._log.write(json.dumps({'tile': tile.key, **fields}).encode() + b'\n')
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+# State of a worker process, set up once by _init_worker
+_worker = None  # type: Optional[Tuple[Any, Any, Manifest, Dict[str, Any]]]
+
+
+def _init_worker(backend: str,
+                 backend_options: Dict[str, Any],
+                 sink,
+                 manifest_dir: str,
+                 generator_options: Dict[str, Any],
+                 threads: int):
+    """Load the model of a worker process."""
+    global _worker
+
+    from segmentation_server.segmentation_service import SegmentationModel
+
+    # Processes share the node's cores, each limits its own thread pools accordingly
+    if threads > 0:
+        cv2.setNumThreads(threads)
+        if backend == 'torch':
+            import torch
+            torch.set_num_threads(threads)
+
+    model = SegmentationModel(max_stored_logits=1, max_cached_embeddings=1, backend=backend,
+                              backend_options=backend_options)
+    _worker = (model, sink, Manifest(manifest_dir), generator_options)
+
+    # Pool workers have no teardown hook, they close their sink and log as their process exits
+    if multiprocessing.parent_process() is not None:
+        multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+
+
+def _close_worker():
+    """Release the model, sink and manifest log of the calling process."""
+    global _worker
+
+    if _worker is None:
+        return
+
+    # The sink is closed first, flushing the tiles the log already records as done
+    _, sink, manifest, _ = _worker
+    sink.close()
+    manifest.close()
+    _worker = None
+
+
+def _segment_section(tiles: List[Tile]) -> WorkerStats:
+    """Segment the given tiles of a section in a worker process, writing and recording each tile."""
+    model, sink, manifest, generator_options = _worker
+
+    segmented = failures = 0
+    seconds = 0.0
+    for tile in tiles:
+        start = time.perf_counter()
+        try:
+            with open(tile.path, 'rb') as f:
+                labeled_image, segments = model.generate_masks(f.read(), **generator_options)
+            sink.write(tile, labeled_image, segments)
+        except Exception as e:
+            # One unreadable tile must not stop a job over thousands, it is retried on resume
+            print(f"Failed to segment {tile.key}: {e}")
+            manifest.record(tile, error=str(e), worker=os.getpid())
+            failures += 1
+            continue
+        finally:
+            seconds += time.perf_counter() - start
+
+        manifest.record(tile, segments=len(segments), seconds=round(time.perf_counter() - start, 4),
+                        worker=os.getpid())
+        segmented += 1
+
+    return WorkerStats(os.getpid(), segmented, failures, seconds)
+
+
+def _check_job_file(output_dir: str, job: Dict[str, Any]):
+    """Record how a job was started, or check that a resumed job is started the same way."""
+    path = os.path.join(output_dir, JOB_FILE)
+
+    # Compare the settings as they read back from the file, where tuples have become lists
+    job = json.loads(json.dumps(job))
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            previous = json.load(f)
+        if previous != job:
+            raise ValueError(f"{output_dir} holds a job started with {previous}, "
+                             f"resume it with the same settings or use a new output directory")
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+    _write_atomically(path, json.dumps(job, indent=2).encode())
+
+
+def _describe_sink(sink) -> Dict[str, Any]:
+    """Return the settings of a sink recorded in the job file, its type for sinks without a describe() method."""
+    describe = getattr(sink, 'describe', None)
+    return describe() if describe is not None else {'type': type(sink).__name__}
+
+
+def run_job(volume_dir: str,
+            output_dir: str,
+            num_workers: Optional[int] = None,
+            backend: str = 'torch',
+            backend_options: Optional[Dict[str, Any]] = None,
+            generator_options: Optional[Dict[str, Any]] = None,
+            sink=None,
+            report: Callable[[str], None] = print) -> Dict[int, WorkerStats]:
+    """
+    Segment every tile of a volume that a previous run of the job has not finished.
+
+    Args:
+        volume_dir: Directory holding a directory of tile images per section
+        output_dir: Directory of the job's manifest, and of its outputs unless a sink is given
+        num_workers: Number of worker processes, all cores by default.  With 1 the tiles are
+                     segmented in the calling process.
+        backend: Name of the inference backend, see segmentation_server.backends
+        backend_options: Arguments used to create the backend in each worker
+        generator_options: Options of the backend's automatic mask generation
+        sink: Object whose write(tile, labeled_image, segments) method stores each tile's result,
+              a TileWriter writing into output_dir by default.  What its describe() method returns
+              is recorded in the job file, so a resumed job must write to the same place.
+        report: Function called with a progress line after each section
+
+    Returns:
+        The throughput of each worker process in this run, keyed by process ID
+
+    Raises:
+        ValueError: If output_dir holds a job started on another volume or with other settings
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    backend_options = dict(backend_options or {})
+    generator_options = dict(generator_options or {})
+    sink = sink if sink is not None else TileWriter(output_dir)
+
+    # The thread count added to the backend options below depends on the work left, so it is not recorded
+    _check_job_file(output_dir, {'volume': os.path.abspath(volume_dir),
+                                 'backend': backend,
+                                 'backend_options': backend_options,
+                                 'generator_options': generator_options,
+                                 'sink': _describe_sink(sink)})
+
+    manifest_dir = os.path.join(output_dir, 'manifest')
+    done = Manifest(manifest_dir).completed()
+    sections = discover_sections(volume_dir)
+    total = sum(len(tiles) for tiles in sections.values())
+    pending = [[tile for tile in tiles if tile.key not in done] for tiles in sections.values()]
+    pending = [tiles for tiles in pending if len(tiles) > 0]
+
+    # Sections are the unit of sharding, more workers than sections would sit idle
+    num_workers = min(num_workers, len(pending))
+    remaining = sum(len(tiles) for tiles in pending)
+    report(f"{total - remaining} of {total} tiles already segmented, {remaining} tiles in "
+           f"{len(pending)} sections to go on {num_workers} workers")
+
+    # Split the cores between the workers
+    threads = max(1, (os.cpu_count() or 1) // num_workers) if num_workers > 1 else 0
+    if backend == 'onnx' and threads > 0:
+        backend_options.setdefault('num_threads', threads)
+
+    stats = {}  # type: Dict[int, WorkerStats]
+    finished = total - remaining
+    start = time.monotonic()
+
+    def account(result: WorkerStats):
+        nonlocal finished
+        previous = stats.get(result.worker, WorkerStats(result.worker, 0, 0, 0.0))
+        stats[result.worker] = WorkerStats(result.worker, previous.tiles + result.tiles,
+                                           previous.failures + result.failures, previous.seconds + result.seconds)
+        finished += result.tiles
+        rate = (finished - (total - remaining)) / max(time.monotonic() - start, 1e-9)
+        report(f"{finished}/{total} tiles, {rate:.2f} tiles/s, worker {result.worker} at "
+               f"{stats[result.worker].tiles_per_second:.2f} tiles/s")
+
+    initargs = (backend, backend_options, sink, manifest_dir, generator_options, threads)
+    if num_workers == 1:
+        _init_worker(*initargs)
+        try:
+            for tiles in pending:
+                account(_segment_section(tiles))
+        finally:
+            _close_worker()
+    elif num_workers > 1:
+        # Spawned workers do not inherit CUDA or thread pool state from the parent
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(num_workers, initializer=_init_worker, initargs=initargs) as pool:
+            for result in pool.imap_unordered(_segment_section, pending, chunksize=1):
+                account(result)
+
+            # Let the workers exit on their own, leaving the pool would terminate them before they close their sinks
+            pool.close()
+            pool.join()
+
+    sink.close()
+
+    for worker in stats.values():
+        report(f"Worker {worker.worker}: {worker.tiles} tiles in {worker.seconds:.1f}s, "
+               f"{worker.tiles_per_second:.2f} tiles/s, {worker.failures} failed")
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-segment every tile of a volume with automatic mask generation')
+    parser.add_argument('volume', help='Directory holding a directory of tile images per section')
+    parser.add_argument('output', help='Directory for the results and the manifest, rerun with the same '
+                                       'directory to resume an interrupted job')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: one per core)')
+    parser.add_argument('--backend', choices=list(BACKENDS), default='torch',
+                        help='Inference backend running the model (default: torch)')
+    parser.add_argument('--onnx-model', default=None, metavar='PREFIX',
+                        help='Path prefix of the model exported by segmentation_server.backends.export_onnx, '
+                             'required by the onnx backend')
+    parser.add_argument('--label-volume', action='store_true',
+                        help='Write the results into a chunked label volume in output/labels instead of a PNG and '
+                             'JSON file per tile.  Tiles must be named by their grid position, such as X003_Y012.png.')
+    parser.add_argument('--chunk-size', type=int, default=512,
+                        help='Side length of the label volume\'s chunks in pixels (default: 512)')
+    parser.add_argument('--points-per-side', type=int, default=None,
+                        help='Grid points along each side of a tile, for backends without SAM2\'s own generator')
+    args = parser.parse_args()
+
+    backend_options = {}
+    if args.backend == 'onnx':
+        if args.onnx_model is None:
+            parser.error("--backend onnx requires --onnx-model")
+        backend_options = {'model_prefix': args.onnx_model}
+
+    generator_options = {}
+    if args.points_per_side is not None:
+        generator_options['points_per_side'] = args.points_per_side
+
+    sink = None
+    if args.label_volume:
+        sink = _label_volume_writer(args.volume, os.path.join(args.output, 'labels'), args.chunk_size)
+
+    run_job(args.volume, args.output, num_workers=args.workers, backend=args.backend,
+            backend_options=backend_options, generator_options=generator_options, sink=sink)
+
+
+def _label_volume_writer(volume_dir: str, path: str, chunk_size: int):
+    """Create, or reopen when resuming, the label volume of a job and return a sink writing into it."""
+    from segmentation_server.label_volume import LabelVolume, LabelVolumeWriter, TileGrid
+
+    sections = discover_sections(volume_dir)
+    tiles = [tile for section_tiles in sections.values() for tile in section_tiles]
+    if len(tiles) == 0:
+        raise ValueError(f"{volume_dir} holds no tiles")
+
+    # All tiles are assumed to have the size of the first
+    tile_height, tile_width = cv2.imread(tiles[0].path, cv2.IMREAD_UNCHANGED).shape[:2]
+    grid = TileGrid(list(sections), tile_width, tile_height)
+
+    if not os.path.exists(path):
+        LabelVolume.create(path, grid.volume_shape(tiles), (1, chunk_size, chunk_size)).close()
+
+    return LabelVolumeWriter(path, grid)
+
+
+if __name__ == '__main__':
+    main()
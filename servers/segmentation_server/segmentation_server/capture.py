@@ -0,0 +1,226 @@
+"""
+Traffic Capture
+
+Records the requests a server handles so they can be replayed later against
+another build, see segmentation_server.replay.  Capture is opt-in, the server
+only records when started with --capture.
+
+The capture file is append-only.  It starts with a magic line followed by one
+record per request:
+
+    uint32 little-endian header length
+    header: UTF-8 JSON object describing the request, its timing and its outputs
+    payload: the serialized request, only present if payload capture is enabled
+
+The header's 'payload_size' field gives the length of the payload, 0 if it was
+not recorded.
+"""
+
+import hashlib
+import json
+import os
+import queue
+import struct
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+MAGIC = b'SEGCAP1\n'
+_HEADER_LENGTH = struct.Struct('<I')
+
+
+def content_hash(data: bytes) -> str:
+    """Return a short hash identifying a payload, such as an image or a mask."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def describe_request(request) -> Dict[str, Any]:
+    """
+    Summarize the shape of a SegmentationRequest without its pixels.
+
+    Args:
+        request: The SegmentationRequest message
+
+    Returns:
+        A JSON serializable dictionary
+    """
+    return {
+        'width': request.width,
+        'height': request.height,
+        'image_bytes': len(request.image_data),
+        'image_hash': content_hash(request.image_data) if request.image_data else None,
+        'shared_image': request.HasField('shared_image'),
+        'num_points': len(request.coordinates),
+        'num_foreground': sum(1 for label in request.labels if label == 1),
+        'box': request.HasField('box'),
+        'num_prompt_groups': len(request.prompt_groups),
+        'prompt_group_points': [len(group.coordinates) for group in request.prompt_groups],
+        'multimask_output': request.multimask_output,
+        'mask_input': bool(request.mask_input_handle) or request.HasField('mask_input'),
+        'labeled_image_format': request.labeled_image_format,
+        'packed_polygons': request.packed_polygons,
+        'image_key': request.image_key,
+    }
+
+
+def describe_response(response) -> Dict[str, Any]:
+    """
+    Summarize the outputs of a SegmentationResponse for comparison with a replay.
+
+    Args:
+        response: The SegmentationResponse message
+
+    Returns:
+        A JSON serializable dictionary
+    """
+    return {
+        'labeled_image_hash': content_hash(response.labeled_image) if response.labeled_image else None,
+        'segments': [{
+            'index': segment.index,
+            'score': round(float(segment.score), 6),
+            'mask_hash': content_hash(segment.mask) if segment.mask else None,
+            'polygon_hash': _polygon_hash(segment),
+            'polygon_vertices': (sum(len(polygon.points) for polygon in segment.polygons) +
+                                 len(segment.packed_polygons.deltas) // 2),
+            'prompt_group': segment.prompt_group,
+        } for segment in response.segments],
+    }
+
+
+def _polygon_hash(segment) -> Optional[str]:
+    """Return a hash of the polygons of a SegmentResult in either format, None if it has none."""
+    if len(segment.polygons) == 0 and len(segment.packed_polygons.deltas) == 0:
+        return None
+
+    data = b''.join(polygon.SerializeToString() for polygon in segment.polygons)
+    return content_hash(data + segment.packed_polygons.SerializeToString())
+
+
+class TrafficCapture:
+    """
+    Appends request records to a capture file.
+
+    Records are described, serialized and written by a background thread so
+    capturing does not block the server's event loop, even when payloads are
+    recorded.  The messages must not be modified after they are recorded.
+    """
+
+    def __init__(self, path: str, include_payload: bool = False, max_queued: int = 1024):
+        """
+        Args:
+            path: The capture file, appended to if it exists
+            include_payload: Whether to record the full serialized requests, needed to compare outputs on replay
+            max_queued: Records waiting for the writer before new ones are dropped, so a slow disk
+                        cannot hold on to an unbounded number of requests and their images
+        """
+        self.path = path
+        self.include_payload = include_payload
+        self._start = time.monotonic()
+        self._queue = queue.Queue(maxsize=max_queued)
+
+        # Records dropped because the writer fell behind
+        self.dropped = 0
+
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+        self._writer = threading.Thread(target=self._write_records, name='traffic-capture', daemon=True)
+        self._writer.start()
+
+    def record(self,
+               method: str,
+               request,
+               response,
+               start: float,
+               latency: float,
+               status: str,
+               priority: Optional[str] = None):
+        """
+        Queue a record of one request for writing, or drop it if the writer is too far behind.
+
+        Args:
+            method: Name of the RPC
+            request: The request message
+            response: The response message, or None if the request failed
+            start: time.monotonic() when the request arrived
+            latency: Seconds the server spent on the request
+            status: Name of the gRPC status code the request finished with
+            priority: Name of the priority class of the request
+        """
+        # Describing and serializing the messages hashes every image and mask, the writer thread does that
+        timing = {
+            'wall_time': time.time() - (time.monotonic() - start),
+            'offset': start - self._start,
+            'latency_ms': latency * 1000,
+            'status': status,
+            'priority': priority,
+        }
+        try:
+            self._queue.put_nowait((method, request, response, timing))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write the queued records and close the file."""
+        self._queue.put(None)
+        self._writer.join()
+        self._file.close()
+        if self.dropped > 0:
+            print(f"Traffic capture dropped {self.dropped} records because writing {self.path} fell behind")
+
+    def _write_records(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            method, request, response, timing = item
+            header = {
+                'method': method,
+                **timing,
+                'request': describe_request(request),
+                'response': describe_response(response) if response is not None else None,
+            }
+
+            payload = request.SerializeToString() if self.include_payload else b''
+            header['payload_size'] = len(payload)
+            encoded = json.dumps(header, separators=(',', ':')).encode()
+            self._file.write(_HEADER_LENGTH.pack(len(encoded)) + encoded + payload)
+
+            # Keep the file complete up to the last record in case the server is killed
+            if self._queue.empty():
+                self._file.flush()
+
+
+def read_capture(path: str) -> Iterator[Tuple[Dict[str, Any], bytes]]:
+    """
+    Read the records of a capture file.
+
+    Args:
+        path: The capture file
+
+    Yields:
+        Tuples of (header, payload), payload is empty if it was not recorded
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a segmentation traffic capture")
+
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size:
+            length_bytes = f.read(_HEADER_LENGTH.size)
+            if len(length_bytes) < _HEADER_LENGTH.size:
+                break
+
+            (length,) = _HEADER_LENGTH.unpack(length_bytes)
+            header_bytes = f.read(length)
+            if len(header_bytes) < length:
+                break  # A record truncated by a server that was killed mid-write
+
+            header = json.loads(header_bytes)
+            payload = f.read(header.get('payload_size', 0))
+            if len(payload) < header.get('payload_size', 0):
+                break
+
+            yield header, payload
@@ -0,0 +1,165 @@
+"""
+Per-Client Limits
+
+A shared server serves annotators clicking through images alongside scripts
+segmenting whole volumes.  The scheduler shares the model between the clients
+with queued work by their weights, the limits here bound what one client can
+ask of the server at all: how many of its requests may be in flight at once
+and how many requests per second it may start.  A request over a limit is
+rejected straight away, with the time after which a retry would be admitted,
+instead of joining the client's backlog.
+
+Clients are identified by the x-segmentation-client gRPC metadata entry, see
+scheduling.client_from_metadata.
+"""
+
+import math
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+
+# Suggested retry delay for a client at its concurrency limit before any of its requests finished
+DEFAULT_RETRY_AFTER = 1.0
+
+# Weight of the moving average of a client's request durations given to each new request
+_DURATION_SMOOTHING = 0.2
+
+
+class ClientPolicy(NamedTuple):
+    """The fair share weight and limits of a client, 0 means no limit."""
+    weight: float = 1.0       # Share of the model relative to other clients with queued work
+    max_concurrency: int = 0  # Requests in flight at once
+    rate: float = 0.0         # Requests started per second, averaged over the burst
+    burst: int = 0            # Requests that may start together after an idle period, 0 for max(1, rate)
+
+
+class ClientStats(NamedTuple):
+    """A snapshot of one client's requests, the totals count since the server started."""
+    client: str
+    weight: float
+    in_flight: int
+    admitted: int
+    rejected: int
+
+
+class ClientLimitExceeded(Exception):
+    """Raised when a client is over its concurrency or rate limit."""
+
+    def __init__(self, message: str, retry_after: float):
+        """
+        Args:
+            message: Description of the limit that was exceeded
+            retry_after: Seconds after which a retry would probably be admitted
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _ClientState:
+    """Token bucket and counters of one client."""
+
+    def __init__(self, policy: ClientPolicy, now: float):
+        self.policy = policy
+        self.capacity = policy.burst if policy.burst > 0 else max(1, math.ceil(policy.rate))
+        self.tokens = float(self.capacity)
+        self.updated = now
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.mean_seconds = None  # Moving average of the client's request durations
+
+
+class ClientLimits:
+    """
+    Admits requests according to the concurrency and rate limits of their client.
+
+    Every request calls acquire() before any work is queued and release() once
+    it finished, successfully or not.
+    """
+
+    def __init__(self, default: ClientPolicy = ClientPolicy(), policies: Optional[Dict[str, ClientPolicy]] = None):
+        """
+        Args:
+            default: The policy of clients without one of their own
+            policies: Policies of individual clients, keyed by client name
+
+        Raises:
+            ValueError: If a policy has a weight that is not positive or a negative limit
+        """
+        self.default = default
+        self.policies = dict(policies or {})
+        for policy in [default, *self.policies.values()]:
+            if not policy.weight > 0:
+                raise ValueError(f"Client weights must be positive, got {policy.weight}")
+            if policy.max_concurrency < 0 or policy.rate < 0 or policy.burst < 0:
+                raise ValueError(f"Client limits cannot be negative, got {policy}")
+
+        self._lock = threading.Lock()
+        self._clients = {}  # client -> _ClientState
+
+    def policy(self, client: str) -> ClientPolicy:
+        """Return the policy of a client."""
+        return self.policies.get(client, self.default)
+
+    def weight(self, client: str) -> float:
+        """Return the fair share weight of a client, see scheduling.FairQueue."""
+        return self.policy(client).weight
+
+    def acquire(self, client: str):
+        """
+        Admit a request of a client.
+
+        Args:
+            client: The client sending the request
+
+        Raises:
+            ClientLimitExceeded: If the client is over one of its limits, the request must not proceed
+        """
+        with self._lock:
+            now = time.monotonic()
+            state = self._clients.get(client)
+            if state is None:
+                state = self._clients[client] = _ClientState(self.policy(client), now)
+
+            policy = state.policy
+            if policy.max_concurrency > 0 and state.in_flight >= policy.max_concurrency:
+                state.rejected += 1
+                retry_after = state.mean_seconds if state.mean_seconds is not None else DEFAULT_RETRY_AFTER
+                raise ClientLimitExceeded(
+                    f"Client {client!r} already has {state.in_flight} requests in flight, the limit is "
+                    f"{policy.max_concurrency}", retry_after)
+
+            if policy.rate > 0:
+                state.tokens = min(state.capacity, state.tokens + (now - state.updated) * policy.rate)
+                state.updated = now
+                if state.tokens < 1.0:
+                    state.rejected += 1
+                    raise ClientLimitExceeded(
+                        f"Client {client!r} exceeded its rate limit of {policy.rate:g} requests per second",
+                        (1.0 - state.tokens) / policy.rate)
+                state.tokens -= 1.0
+
+            state.in_flight += 1
+            state.admitted += 1
+
+    def release(self, client: str, seconds: float):
+        """
+        Record that an admitted request of a client finished.
+
+        Args:
+            client: The client the request was admitted for
+            seconds: How long the request took, used to suggest when to retry at the concurrency limit
+        """
+        with self._lock:
+            state = self._clients[client]
+            state.in_flight -= 1
+            if state.mean_seconds is None:
+                state.mean_seconds = seconds
+            else:
+                state.mean_seconds += _DURATION_SMOOTHING * (seconds - state.mean_seconds)
+
+    def stats(self) -> Dict[str, ClientStats]:
+        """Return the requests of every client seen so far."""
+        with self._lock:
+            return {client: ClientStats(client, state.policy.weight, state.in_flight, state.admitted, state.rejected)
+                    for client, state in self._clients.items()}
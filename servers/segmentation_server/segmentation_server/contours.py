@@ -0,0 +1,134 @@
+"""
+Contours of Low Resolution Logits
+
+SAM2 predicts every mask as 256x256 logits which are upsampled to the image
+size and thresholded at 0.  Tracing polygons on that full resolution mask costs
+time proportional to the image area, although the simplified polygon carries no
+more information than the logits it came from.
+
+Instead the logits are upsampled only a few times, to a grid fine enough that
+its pixels are smaller than the polygon simplification removes, contoured with
+OpenCV, and the contours are scaled to image coordinates.  The cost depends only
+on the logits grid, which matters most for large tiles.  compare_polygon_paths
+measures how closely the polygons match those traced from the full resolution mask.
+"""
+
+import time
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+# How many times the logits are upsampled before contouring, finer grids cost more without improving the polygons
+LOGITS_UPSAMPLING = 4
+
+
+def logits_contours(logits: NDArray,
+                    width: int,
+                    height: int,
+                    holes: bool = False,
+                    upsampling: int = LOGITS_UPSAMPLING) -> Tuple[List[NDArray[np.float32]], Optional[List[bool]]]:
+    """
+    Trace the contours of the 0 level of low resolution logits, in image coordinates.
+
+    The logits are bilinearly upsampled as the backends upsample them, but only
+    to at most upsampling times their size, and the contours are scaled from
+    pixel centres of that grid onto pixel centres of the image.
+
+    Args:
+        logits: A 2D array of low resolution logits, positive inside the mask
+        width: Width of the image, or window, the logits were decoded for
+        height: Height of the image, or window, the logits were decoded for
+        holes: Whether to trace the boundaries of holes as well as the outer boundaries
+        upsampling: Upsampling factor of the grid the contours are traced on
+
+    Returns:
+        A tuple of (contours, is_hole).  The contours are float32 arrays of shape
+        (N, 1, 2) as cv2.findContours returns them.  is_hole tells for each contour
+        whether it bounds a hole, it is None unless holes were requested.
+    """
+    rows, columns = logits.shape
+    grid_width, grid_height = min(width, columns * upsampling), min(height, rows * upsampling)
+
+    # cv2's bilinear resize samples at pixel centres, as torch's interpolate with align_corners=False
+    grid = cv2.resize(np.asarray(logits, dtype=np.float32), (grid_width, grid_height), interpolation=cv2.INTER_LINEAR)
+    inside = (grid > 0).astype(np.uint8)
+
+    if holes:
+        contours, hierarchy = cv2.findContours(inside, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+        is_hole = [parent >= 0 for parent in hierarchy[0, :, 3]] if len(contours) > 0 else []
+    else:
+        contours, _ = cv2.findContours(inside, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        is_hole = None
+
+    # Map pixel centres of the grid onto pixel centres of the image
+    scale = np.array([width / grid_width, height / grid_height], dtype=np.float32)
+    return [(contour.astype(np.float32) + 0.5) * scale - 0.5 for contour in contours], is_hole
+
+
+def signed_area(ring: NDArray) -> float:
+    """Return the signed area of a ring by the shoelace formula."""
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * float(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def polygon_iou(polygons: List[NDArray], mask: NDArray[np.bool_]) -> float:
+    """Return the intersection over union of a mask and the rasterised polygons."""
+    filled = np.zeros(mask.shape, dtype=np.uint8)
+    if len(polygons) > 0:
+        cv2.fillPoly(filled, [np.round(polygon).astype(np.int32) for polygon in polygons], 1)
+
+    filled = filled > 0
+    union = np.logical_or(filled, mask).sum()
+    return float(np.logical_and(filled, mask).sum() / union) if union > 0 else 1.0
+
+
+def compare_polygon_paths(logits: NDArray[np.float32],
+                          width: int,
+                          height: int,
+                          max_vertices: int = 0,
+                          repeats: int = 5) -> Dict[str, Dict[str, float]]:
+    """
+    Compare polygons traced from the full resolution mask with those traced from the logits.
+
+    The full resolution mask is produced as the backends produce it, by
+    upsampling the logits and thresholding at 0, and serves as ground truth.
+
+    Args:
+        logits: A 2D array of low resolution logits
+        width: Width of the image the logits belong to
+        height: Height of the image the logits belong to
+        max_vertices: Vertex budget passed to both paths
+        repeats: Number of timed repetitions, the fastest is reported
+
+    Returns:
+        A dictionary keyed by 'mask' and 'logits' holding the 'iou' of each path's
+        polygons with the mask, their 'vertices' and the 'seconds' taken.  The mask
+        path's time includes upsampling the logits.
+    """
+    from segmentation_grpc.mask_decoding import upscale_logits
+    from segmentation_server.segmentation_service import SegmentationModel
+
+    def mask_path():
+        return SegmentationModel.mask_to_polygons(upscale_logits(logits, width, height) > 0, max_vertices)
+
+    def logits_path():
+        return SegmentationModel.logits_to_polygons(logits, width, height, max_vertices)
+
+    mask = upscale_logits(logits, width, height) > 0
+    results = {}
+    for name, path in (('mask', mask_path), ('logits', logits_path)):
+        seconds = []
+        for _ in range(max(repeats, 1)):
+            start = time.perf_counter()
+            polygons = path()
+            seconds.append(time.perf_counter() - start)
+
+        results[name] = {
+            'iou': polygon_iou(polygons, mask),
+            'vertices': float(sum(len(polygon) for polygon in polygons)),
+            'seconds': min(seconds),
+        }
+
+    return results
@@ -0,0 +1,432 @@
+"""
+Chunked Label Volume
+
+An on-disk volume of uint32 labels spanning every section of a batch job, so
+downstream tools can read any region directly instead of decoding the PNG of
+every tile it touches.
+
+A volume is a directory of four files:
+    volume.json    the shape of the volume and of its chunks
+    chunks.u32     the labels, one fixed-size chunk after another in (z, y, x) chunk order
+    index.u32      a per-chunk count of the tiles written into each chunk, 0 for chunks never written
+    segments.bin   the segment table, a record per label holding its section, bounding box, area and scores
+
+Every chunk has a fixed place in chunks.u32, which is created sparse, so
+chunks that are never written take no disk space and writers need no
+allocation.  Writers in several processes share the files: a tile's pixels
+are written through a shared memory map, only the index entries of the
+chunks a tile covers are locked while it is written.  Segment records are
+appended while holding a lock on the byte after the index, so a tile's
+records land after everything written before it; the position of a record is
+its label, so labels are unique across the volume without any other
+coordination.
+
+Labels start at 1, 0 is background.  Segment record i describes label i + 1.
+A tile written again, such as when a batch job resumes, gets new labels and
+leaves the records of its earlier attempt without pixels.
+
+Example:
+    volume = LabelVolume.create('labels', shape=(100, 20000, 20000))
+    volume.write_tile(z=3, y=4096, x=8192, labeled_image=labels, segments=segments)
+    region = LabelVolume.open('labels')[3, 4000:5000, 8000:9000]
+"""
+
+import contextlib
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+# Record of the segment table
+SEGMENT_DTYPE = np.dtype([
+    ('z', '<u4'),
+    ('x0', '<i4'), ('y0', '<i4'), ('x1', '<i4'), ('y1', '<i4'),
+    ('area', '<u8'),
+    ('score', '<f4'),
+    ('stability_score', '<f4'),
+])
+
+LABEL_DTYPE = np.dtype('<u4')
+
+_HEADER_FILE = 'volume.json'
+_CHUNKS_FILE = 'chunks.u32'
+_INDEX_FILE = 'index.u32'
+_SEGMENTS_FILE = 'segments.bin'
+
+_FORMAT_VERSION = 1
+
+
+@contextlib.contextmanager
+def _locked(fd: int, offset: int, length: int):
+    """Hold an exclusive lock on a byte range of a file, excluding other processes."""
+    if os.name == 'nt':
+        import msvcrt
+
+        os.lseek(fd, offset, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK, length)
+        try:
+            yield
+        finally:
+            os.lseek(fd, offset, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, length)
+    else:
+        import fcntl
+
+        fcntl.lockf(fd, fcntl.LOCK_EX, length, offset, os.SEEK_SET)
+        try:
+            yield
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, length, offset, os.SEEK_SET)
+
+
+class LabelVolume:
+    """
+    A chunked, memory-mapped volume of uint32 labels with a table of its segments.
+
+    Open one LabelVolume per process.  Byte-range locks exclude other processes,
+    not other threads of the same process.
+    """
+
+    def __init__(self, path: str, writable: bool = False):
+        """
+        Open an existing volume, see create and open.
+
+        Args:
+            path: Directory of the volume
+            writable: Whether tiles will be written
+        """
+        with open(os.path.join(path, _HEADER_FILE), 'r') as f:
+            header = json.load(f)
+        if header.get('version') != _FORMAT_VERSION:
+            raise ValueError(f"{path} is a label volume of version {header.get('version')}, "
+                             f"expected {_FORMAT_VERSION}")
+
+        self.path = path
+        self.writable = writable
+        self.shape = tuple(header['shape'])  # type: Tuple[int, int, int]
+        self.chunk_shape = tuple(header['chunk_shape'])  # type: Tuple[int, int, int]
+        self.grid_shape = tuple(-(-size // chunk) for size, chunk in zip(self.shape, self.chunk_shape))
+
+        mode = 'r+' if writable else 'r'
+        self._chunks = np.memmap(os.path.join(path, _CHUNKS_FILE), dtype=LABEL_DTYPE, mode=mode,
+                                 shape=self.grid_shape + self.chunk_shape)
+        self._index = np.memmap(os.path.join(path, _INDEX_FILE), dtype=LABEL_DTYPE, mode=mode,
+                                shape=self.grid_shape)
+
+        self._index_fd = os.open(os.path.join(path, _INDEX_FILE), os.O_RDWR) if writable else None
+        self._segments_fd = None
+
+        # Appends to the segment table lock the byte after the index, which no chunk lock covers
+        self._append_lock_offset = int(np.prod(self.grid_shape)) * LABEL_DTYPE.itemsize
+
+    @classmethod
+    def create(cls, path: str, shape: Sequence[int], chunk_shape: Sequence[int] = (1, 512, 512)) -> 'LabelVolume':
+        """
+        Create an empty volume.
+
+        Args:
+            path: Directory of the volume, must not exist yet
+            shape: The (sections, height, width) of the volume
+            chunk_shape: The (sections, height, width) of each chunk
+
+        Returns:
+            The volume, opened for writing
+        """
+        if len(shape) != 3 or len(chunk_shape) != 3:
+            raise ValueError(f"Expected 3D shapes, got {shape} and {chunk_shape}")
+
+        os.makedirs(path)
+        grid_shape = [-(-size // chunk) for size, chunk in zip(shape, chunk_shape)]
+        num_chunks = int(np.prod(grid_shape))
+
+        # Truncating to the final size leaves the files sparse, unwritten chunks take no space
+        for name, size in ((_CHUNKS_FILE, num_chunks * int(np.prod(chunk_shape))), (_INDEX_FILE, num_chunks)):
+            with open(os.path.join(path, name), 'wb') as f:
+                f.truncate(size * LABEL_DTYPE.itemsize)
+        open(os.path.join(path, _SEGMENTS_FILE), 'wb').close()
+
+        # The header is written last, a directory without one is not a volume
+        header = {'version': _FORMAT_VERSION, 'shape': list(shape), 'chunk_shape': list(chunk_shape),
+                  'dtype': LABEL_DTYPE.str, 'segment_dtype': SEGMENT_DTYPE.descr}
+        with open(os.path.join(path, _HEADER_FILE), 'w') as f:
+            json.dump(header, f, indent=2)
+
+        return cls(path, writable=True)
+
+    @classmethod
+    def open(cls, path: str, writable: bool = False) -> 'LabelVolume':
+        """Open an existing volume, for reading unless writable is set."""
+        return cls(path, writable)
+
+    def close(self):
+        """Flush written chunks to disk and close the volume's files."""
+        if self.writable:
+            self._chunks.flush()
+            self._index.flush()
+        for fd in (self._index_fd, self._segments_fd):
+            if fd is not None:
+                os.close(fd)
+        self._index_fd = self._segments_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append_segments(self, records: NDArray) -> int:
+        """
+        Append records to the segment table, atomically with respect to other writers.
+
+        Args:
+            records: An array of SEGMENT_DTYPE records
+
+        Returns:
+            The label of the first record, the others follow consecutively
+        """
+        if not self.writable:
+            raise PermissionError(f"{self.path} was opened for reading")
+        if self._segments_fd is None:
+            self._segments_fd = os.open(os.path.join(self.path, _SEGMENTS_FILE),
+                                        os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+
+        data = np.ascontiguousarray(records, dtype=SEGMENT_DTYPE).tobytes()
+        with _locked(self._index_fd, self._append_lock_offset, 1):
+            # A record cut short by an interrupted writer is skipped, not overwritten by another record
+            end = os.lseek(self._segments_fd, 0, os.SEEK_END)
+            first_record = -(-end // SEGMENT_DTYPE.itemsize)
+            if first_record + len(records) > np.iinfo(LABEL_DTYPE).max:
+                raise OverflowError(f"The segment table of {self.path} exceeds the range of uint32 labels")
+
+            os.lseek(self._segments_fd, first_record * SEGMENT_DTYPE.itemsize, os.SEEK_SET)
+            written = os.write(self._segments_fd, data)
+            if written != len(data):
+                raise OSError(f"Appended {written} of {len(data)} bytes to the segment table of {self.path}")
+
+        return first_record + 1
+
+    def write_labels(self, z: int, y: int, x: int, labels: NDArray):
+        """
+        Write a 2D array of labels into a section, leaving pixels where labels is 0 untouched.
+
+        Args:
+            z: The section
+            y: Row of the array's top left pixel in the volume
+            x: Column of the array's top left pixel in the volume
+            labels: A 2D array of volume labels, clipped to the volume
+        """
+        if not self.writable:
+            raise PermissionError(f"{self.path} was opened for reading")
+
+        height, width = labels.shape
+        y0, x0 = max(y, 0), max(x, 0)
+        y1, x1 = min(y + height, self.shape[1]), min(x + width, self.shape[2])
+        if not 0 <= z < self.shape[0] or y0 >= y1 or x0 >= x1:
+            return
+
+        cz, cy, cx = self.chunk_shape
+        k, dz = divmod(z, cz)
+        for i in range(y0 // cy, -(-y1 // cy)):
+            for j in range(x0 // cx, -(-x1 // cx)):
+                # The part of the array falling into this chunk, in volume coordinates
+                top, bottom = max(y0, i * cy), min(y1, (i + 1) * cy)
+                left, right = max(x0, j * cx), min(x1, (j + 1) * cx)
+                source = labels[top - y:bottom - y, left - x:right - x]
+
+                chunk_number = int(np.ravel_multi_index((k, i, j), self.grid_shape))
+                with _locked(self._index_fd, chunk_number * LABEL_DTYPE.itemsize, LABEL_DTYPE.itemsize):
+                    target = self._chunks[k, i, j, dz, top - i * cy:bottom - i * cy, left - j * cx:right - j * cx]
+                    np.copyto(target, source, where=source != 0, casting='unsafe')
+                    self._index[k, i, j] += 1
+
+    def write_tile(self, z: int, y: int, x: int, labeled_image: NDArray, segments: List[Dict[str, Any]]):
+        """
+        Add a tile's segments to the table and write its labeled image with volume-wide labels.
+
+        Args:
+            z: The tile's section
+            y: Row of the tile's top left pixel in the volume
+            x: Column of the tile's top left pixel in the volume
+            labeled_image: The tile's labeled image, labelled by each segment's 'index'
+            segments: The tile's segments as SegmentationModel.generate_masks returns them
+        """
+        if len(segments) == 0:
+            return
+
+        records = np.zeros(len(segments), dtype=SEGMENT_DTYPE)
+        records['z'] = z
+        bboxes = np.array([segment['bbox'] for segment in segments], dtype=np.int64).reshape(-1, 4)
+        records['x0'], records['x1'] = bboxes[:, 0] + x, bboxes[:, 2] + x
+        records['y0'], records['y1'] = bboxes[:, 1] + y, bboxes[:, 3] + y
+        records['area'] = [segment['area'] for segment in segments]
+        records['score'] = [segment['score'] for segment in segments]
+        records['stability_score'] = [segment.get('stability_score', 0.0) for segment in segments]
+
+        first_label = self.append_segments(records)
+
+        # Map the tile's labels onto the labels of its records
+        indices = np.array([segment['index'] for segment in segments], dtype=np.int64)
+        lookup = np.zeros(max(int(indices.max()), int(labeled_image.max())) + 1, dtype=LABEL_DTYPE)
+        lookup[indices] = first_label + np.arange(len(segments), dtype=LABEL_DTYPE)
+        self.write_labels(z, y, x, lookup[labeled_image])
+
+    def chunk_writes(self) -> NDArray:
+        """Return the number of tiles written into each chunk, an array of the volume's chunk grid shape."""
+        return np.array(self._index)
+
+    def segments(self) -> NDArray:
+        """Return the segment table as an array of SEGMENT_DTYPE records, record i describes label i + 1."""
+        path = os.path.join(self.path, _SEGMENTS_FILE)
+        num_records = os.path.getsize(path) // SEGMENT_DTYPE.itemsize
+        if num_records == 0:
+            return np.zeros(0, dtype=SEGMENT_DTYPE)
+
+        return np.memmap(path, dtype=SEGMENT_DTYPE, mode='r', shape=(num_records,))
+
+    def read(self, z: Tuple[int, int], y: Tuple[int, int], x: Tuple[int, int]) -> NDArray:
+        """
+        Read a region of the volume.
+
+        Args:
+            z: The (start, stop) sections
+            y: The (start, stop) rows
+            x: The (start, stop) columns
+
+        Returns:
+            An array of shape (z stop - start, y stop - start, x stop - start), after clipping to the volume
+        """
+        (z0, z1), (y0, y1), (x0, x1) = [(max(start, 0), min(stop, size))
+                                        for (start, stop), size in zip((z, y, x), self.shape)]
+        region = np.zeros((max(z1 - z0, 0), max(y1 - y0, 0), max(x1 - x0, 0)), dtype=LABEL_DTYPE)
+        if region.size == 0:
+            return region
+
+        cz, cy, cx = self.chunk_shape
+        for k in range(z0 // cz, -(-z1 // cz)):
+            for i in range(y0 // cy, -(-y1 // cy)):
+                for j in range(x0 // cx, -(-x1 // cx)):
+                    # Chunks never written are known to be empty without touching their pages
+                    if self._index[k, i, j] == 0:
+                        continue
+
+                    front, back = max(z0, k * cz), min(z1, (k + 1) * cz)
+                    top, bottom = max(y0, i * cy), min(y1, (i + 1) * cy)
+                    left, right = max(x0, j * cx), min(x1, (j + 1) * cx)
+                    region[front - z0:back - z0, top - y0:bottom - y0, left - x0:right - x0] = self._chunks[
+                        k, i, j, front - k * cz:back - k * cz, top - i * cy:bottom - i * cy,
+                        left - j * cx:right - j * cx]
+
+        return region
+
+    def __getitem__(self, key) -> NDArray:
+        """Read a region with integers and unit step slices, volume[z, y0:y1, x0:x1] returns a 2D array."""
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        if len(key) != 3:
+            raise IndexError(f"A label volume has 3 dimensions, got {len(key)} indices")
+
+        ranges = []
+        squeeze = []
+        for axis, (item, size) in enumerate(zip(key, self.shape)):
+            if isinstance(item, slice):
+                start, stop, step = item.indices(size)
+                if step != 1:
+                    raise IndexError("Label volumes only support slices with a step of 1")
+                ranges.append((start, max(start, stop)))
+            else:
+                index = int(item) + size if int(item) < 0 else int(item)
+                if not 0 <= index < size:
+                    raise IndexError(f"Index {item} is out of bounds for axis {axis} of size {size}")
+                ranges.append((index, index + 1))
+                squeeze.append(axis)
+
+        return self.read(*ranges).squeeze(axis=tuple(squeeze))
+
+
+class TileGrid:
+    """
+    Places the tiles of a batch job in a label volume by their names.
+
+    Tiles are expected to be named by their column and row in the section's
+    tile grid, such as X003_Y012.png, and to be tile_width x tile_height pixels.
+    Sections are stacked in the order given.
+    """
+
+    def __init__(self,
+                 sections: Sequence[str],
+                 tile_width: int,
+                 tile_height: int,
+                 pattern: str = r'X(\d+)_Y(\d+)',
+                 first_index: int = 1):
+        """
+        Args:
+            sections: Section names in the order of the volume's z axis
+            tile_width: Width of each tile in pixels
+            tile_height: Height of each tile in pixels
+            pattern: Regular expression capturing a tile's column and row in its name, case insensitive
+            first_index: The number of the first column and row
+        """
+        self.z = {section: z for z, section in enumerate(sections)}
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.pattern = pattern
+        self.first_index = first_index
+
+    def __call__(self, tile) -> Tuple[int, int, int]:
+        """Return the (z, y, x) of a batch.Tile's top left pixel in the volume."""
+        match = re.search(self.pattern, tile.name, re.IGNORECASE)
+        if match is None:
+            raise ValueError(f"Cannot place tile {tile.key}, its name does not match {self.pattern}")
+
+        column, row = (int(value) - self.first_index for value in match.groups())
+        return self.z[tile.section], row * self.tile_height, column * self.tile_width
+
+    def volume_shape(self, tiles) -> Tuple[int, int, int]:
+        """Return the (sections, height, width) of a volume holding the given tiles."""
+        origins = np.array([self(tile) for tile in tiles]).reshape(-1, 3)
+        return (len(self.z),
+                int(origins[:, 1].max(initial=0)) + self.tile_height,
+                int(origins[:, 2].max(initial=0)) + self.tile_width)
+
+
+class LabelVolumeWriter:
+    """
+    A batch job sink writing every tile into a shared LabelVolume.
+
+    The volume is opened on the first write, in the process doing the writing,
+    so the writer can be handed to the batch job's worker processes.
+    """
+
+    def __init__(self, path: str, place_tile):
+        """
+        Args:
+            path: Directory of an existing label volume
+            place_tile: Function returning the (z, y, x) of a batch.Tile in the volume, such as a TileGrid
+        """
+        self.path = path
+        self.place_tile = place_tile
+        self._volume = None  # type: Optional[LabelVolume]
+
+    def __getstate__(self):
+        return {'path': self.path, 'place_tile': self.place_tile, '_volume': None}
+
+    def write(self, tile, labeled_image: NDArray, segments: List[Dict[str, Any]]):
+        """Write the result of one tile, see batch.TileWriter.write."""
+        if self._volume is None:
+            self._volume = LabelVolume.open(self.path, writable=True)
+
+        z, y, x = self.place_tile(tile)
+        self._volume.write_tile(z, y, x, labeled_image, segments)
+
+    def describe(self) -> Dict[str, Any]:
+        """Return the volume written to, see batch.TileWriter.describe."""
+        return {'type': 'label_volume', 'path': os.path.abspath(self.path)}
+
+    def close(self):
+        if self._volume is not None:
+            self._volume.close()
+            self._volume = None
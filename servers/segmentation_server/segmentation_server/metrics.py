@@ -0,0 +1,78 @@
+"""
+Server Metrics
+
+Lightweight counters describing how busy the server is.  They are cheap to
+update on every request and cheap to read, so clients can poll them through
+the GetLoad RPC to balance work across replicas.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator
+
+import numpy as np
+
+
+class LoadTracker:
+    """
+    Counts the requests in flight and keeps a window of recent request latencies.
+    """
+
+    def __init__(self, latency_window: int = 256):
+        """
+        Args:
+            latency_window: The number of most recent request latencies kept for percentiles
+        """
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._latencies = deque(maxlen=latency_window)
+
+    @property
+    def in_flight(self) -> int:
+        """Number of requests currently being handled."""
+        with self._lock:
+            return self._in_flight
+
+    @contextmanager
+    def track(self, record_latency: bool = True) -> Iterator[None]:
+        """
+        Count a request as in flight for the duration of a with block.
+
+        Args:
+            record_latency: Whether to add the duration of the block to the latency window.
+                            Long running streams should not, they would skew the percentiles.
+                            Blocks that raise are never recorded, a request rejected at once
+                            would make the server look faster than it is.
+        """
+        start = time.monotonic()
+        with self._lock:
+            self._in_flight += 1
+
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                if record_latency and succeeded:
+                    self._latencies.append(time.monotonic() - start)
+
+    def latency_percentile(self, percentile: float) -> float:
+        """
+        Return a percentile of the recent request latencies in seconds.
+
+        Args:
+            percentile: The percentile, between 0 and 100
+
+        Returns:
+            The latency in seconds, or 0 if no request completed yet
+        """
+        with self._lock:
+            if len(self._latencies) == 0:
+                return 0.0
+            latencies = np.fromiter(self._latencies, dtype=np.float64, count=len(self._latencies))
+
+        return float(np.percentile(latencies, percentile))
@@ -0,0 +1,295 @@
+"""
+Traffic Replay
+
+Re-issues the SegmentImage requests recorded by a server started with --capture
+against another server, preserving their original arrival times or compressing
+them by a speed factor, then compares the replayed latencies and outputs with
+the captured ones.
+
+Requests are sent open-loop: each one is issued at its recorded offset whether
+or not earlier ones have completed, so a slower server sees queues build up the
+way they would in production.
+
+Records captured without their payload are replayed with a synthetic noise
+image of the same size and the same number of prompts.  They exercise the server
+with realistic shapes and timing but their outputs are not compared.
+
+Usage:
+    python -m segmentation_server.replay capture.seg localhost:50051 --speed 2
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+import cv2
+import grpc
+import numpy as np
+
+from segmentation_grpc import Box, Point, PromptGroup, SegmentationRequest, SegmentationServiceStub
+from segmentation_grpc.metadata import PRIORITY
+
+from segmentation_server.capture import describe_response, read_capture
+
+
+def synthesize_request(header: Dict[str, Any], rng: np.random.Generator) -> SegmentationRequest:
+    """
+    Build a request with the shape of a captured one, for records captured without their payload.
+
+    Args:
+        header: The capture record header
+        rng: Random number generator for the image and prompt positions
+
+    Returns:
+        A SegmentationRequest with a noise image and random prompts
+    """
+    info = header['request']
+    width, height = info['width'], info['height']
+
+    image = rng.integers(0, 256, size=(height, width), dtype=np.uint8)
+    request = SegmentationRequest(image_data=cv2.imencode('.png', image)[1].tobytes(),
+                                  width=width,
+                                  height=height,
+                                  multimask_output=info['multimask_output'],
+                                  labeled_image_format=info['labeled_image_format'],
+                                  packed_polygons=info['packed_polygons'],
+                                  image_key=info['image_key'])
+
+    def random_points(count):
+        return [Point(x=int(x), y=int(y))
+                for x, y in zip(rng.integers(0, width, count), rng.integers(0, height, count))]
+
+    def random_box():
+        x0, x1 = sorted(rng.integers(0, width, 2))
+        y0, y1 = sorted(rng.integers(0, height, 2))
+        return Box(x0=int(x0), y0=int(y0), x1=int(x1), y1=int(y1))
+
+    if info['num_prompt_groups'] > 0:
+        for count in info['prompt_group_points']:
+            request.prompt_groups.append(PromptGroup(coordinates=random_points(count), labels=[1] * count))
+    else:
+        request.coordinates.extend(random_points(info['num_points']))
+        request.labels.extend([1] * info['num_foreground'] + [0] * (info['num_points'] - info['num_foreground']))
+        if info['box']:
+            request.box.CopyFrom(random_box())
+
+    return request
+
+
+def load_requests(path: str, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    Read the SegmentImage records of a capture and prepare the requests to replay.
+
+    Args:
+        path: The capture file
+        seed: Seed for the synthetic requests of records without a payload
+
+    Returns:
+        A list of dictionaries with the record header, the request and whether its outputs can be compared
+    """
+    rng = np.random.default_rng(seed)
+    records = []
+    for header, payload in read_capture(path):
+        if header['method'] != 'SegmentImage':
+            continue
+
+        if payload:
+            request = SegmentationRequest.FromString(payload)
+            comparable = not request.HasField('shared_image') and not request.mask_input_handle
+        else:
+            request = synthesize_request(header, rng)
+            comparable = False
+
+        if request.HasField('shared_image'):
+            # The client's shared memory segment is long gone, send the pixels inline instead
+            request.ClearField('shared_image')
+            request.image_data = synthesize_request(header, rng).image_data
+        if request.mask_input_handle:
+            # Handles refer to logits stored by the captured server
+            request.mask_input_handle = ''
+        if request.HasField('shared_labeled_image'):
+            request.ClearField('shared_labeled_image')
+
+        records.append({'header': header, 'request': request, 'comparable': comparable})
+
+    return records
+
+
+async def replay(records: List[Dict[str, Any]], address: str, speed: float = 1.0,
+                 timeout: Optional[float] = 60) -> List[Dict[str, Any]]:
+    """
+    Send the requests to a server at their captured offsets divided by speed.
+
+    Args:
+        records: The requests returned by load_requests
+        address: Address of the server, host:port or unix:path
+        speed: How much faster than captured to issue the requests, 1 for real time
+        timeout: Deadline of each request in seconds
+
+    Returns:
+        A result dictionary per record with the captured and replayed latency, status and outputs
+    """
+    if speed <= 0:
+        raise ValueError(f"speed must be positive, got {speed}")
+    if len(records) == 0:
+        return []
+
+    first_offset = min(record['header']['offset'] for record in records)
+
+    async with grpc.aio.insecure_channel(address, options=[
+        ('grpc.max_send_message_length', 64 * 1024 * 1024),
+        ('grpc.max_receive_message_length', 64 * 1024 * 1024)
+    ]) as channel:
+        stub = SegmentationServiceStub(channel)
+        start = time.monotonic()
+
+        async def send(record):
+            header = record['header']
+            await asyncio.sleep(max(0.0, start + (header['offset'] - first_offset) / speed - time.monotonic()))
+
+            metadata = ((PRIORITY, header['priority']),) if header.get('priority') else None
+            sent = time.monotonic()
+            try:
+                response = await stub.SegmentImage(record['request'], timeout=timeout, metadata=metadata)
+                status = grpc.StatusCode.OK.name
+            except grpc.RpcError as e:
+                response = None
+                status = e.code().name
+
+            return {
+                'offset': header['offset'],
+                'captured_latency_ms': header['latency_ms'],
+                'replayed_latency_ms': (time.monotonic() - sent) * 1000,
+                'captured_status': header['status'],
+                'replayed_status': status,
+                'comparable': record['comparable'],
+                'captured': header['response'],
+                'replayed': describe_response(response) if response is not None else None,
+            }
+
+        return await asyncio.gather(*(send(record) for record in records))
+
+
+def compare_outputs(captured: Dict[str, Any], replayed: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compare the summarized outputs of a captured and a replayed response.
+
+    Masks, polygons and labeled images are compared by content hash.  An output
+    neither response carries is not compared, so its entry is None.
+
+    Args:
+        captured: describe_response() of the captured response
+        replayed: describe_response() of the replayed response
+
+    Returns:
+        A dictionary with whether the segment counts, masks, polygons and labeled images
+        match and the largest score difference
+    """
+    captured_segments, replayed_segments = captured['segments'], replayed['segments']
+    same_count = len(captured_segments) == len(replayed_segments)
+    paired = list(zip(captured_segments, replayed_segments))
+
+    def segments_match(key: str) -> Optional[bool]:
+        hashes = [(a.get(key), b.get(key)) for a, b in paired]
+        if all(a is None and b is None for a, b in hashes):
+            return None
+        return same_count and all(a == b for a, b in hashes)
+
+    labeled_images = (captured['labeled_image_hash'], replayed['labeled_image_hash'])
+    return {
+        'same_segment_count': same_count,
+        'masks_match': segments_match('mask_hash'),
+        'polygons_match': segments_match('polygon_hash'),
+        'labeled_images_match': None if labeled_images == (None, None) else labeled_images[0] == labeled_images[1],
+        'max_score_delta': max((abs(a['score'] - b['score']) for a, b in paired), default=0.0),
+    }
+
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Aggregate replay results into latency percentiles and output agreement.
+
+    Args:
+        results: The results returned by replay
+
+    Returns:
+        A JSON serializable summary
+    """
+    def percentiles(values):
+        if len(values) == 0:
+            return None
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        return {'p50': float(p50), 'p90': float(p90), 'p99': float(p99)}
+
+    ok = [r for r in results if r['captured_status'] == 'OK' and r['replayed_status'] == 'OK']
+    comparisons = [compare_outputs(r['captured'], r['replayed']) for r in ok if r['comparable']]
+
+    def match_rate(key):
+        compared = [c[key] for c in comparisons if c[key] is not None]
+        return sum(compared) / len(compared) if compared else None
+
+    return {
+        'requests': len(results),
+        'replayed_errors': sum(1 for r in results if r['replayed_status'] != 'OK'),
+        'status_mismatches': sum(1 for r in results if r['captured_status'] != r['replayed_status']),
+        'captured_latency_ms': percentiles([r['captured_latency_ms'] for r in ok]),
+        'replayed_latency_ms': percentiles([r['replayed_latency_ms'] for r in ok]),
+        'compared': len(comparisons),
+        'mask_match_rate': match_rate('masks_match'),
+        'polygon_match_rate': match_rate('polygons_match'),
+        'labeled_image_match_rate': match_rate('labeled_images_match'),
+        'max_score_delta': max((c['max_score_delta'] for c in comparisons), default=None),
+    }
+
+
+def print_summary(summary: Dict[str, Any]):
+    print(f"Replayed {summary['requests']} requests, {summary['replayed_errors']} failed, "
+          f"{summary['status_mismatches']} finished with a different status than captured")
+
+    for label, key in (('Captured', 'captured_latency_ms'), ('Replayed', 'replayed_latency_ms')):
+        latency = summary[key]
+        if latency is not None:
+            print(f"{label} latency: p50 {latency['p50']:.1f} ms, p90 {latency['p90']:.1f} ms, "
+                  f"p99 {latency['p99']:.1f} ms")
+
+    if summary['compared'] > 0:
+        outputs = [f"{summary[key] * 100:.1f}% identical {name}"
+                   for key, name in (('mask_match_rate', 'masks'), ('polygon_match_rate', 'polygons'),
+                                     ('labeled_image_match_rate', 'labeled images'))
+                   if summary[key] is not None]
+        outputs.append(f"largest score difference {summary['max_score_delta']:.4f}")
+        print(f"Outputs compared for {summary['compared']} requests: {', '.join(outputs)}")
+    else:
+        print("No outputs compared, capture with --capture-payload to compare outputs")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Replay captured segmentation traffic against a server.')
+    parser.add_argument('capture', help='Capture file written by a server started with --capture')
+    parser.add_argument('address', help='Address of the server to replay against, host:port or unix:path')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='How much faster than captured to issue the requests (default: 1, real time)')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='Deadline of each request in seconds (default: 60)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the synthetic images of records captured without payloads')
+    parser.add_argument('--output', default=None,
+                        help='Write the per-request results to this file as JSON lines')
+    args = parser.parse_args()
+
+    records = load_requests(args.capture, seed=args.seed)
+    print(f"Replaying {len(records)} requests from {args.capture} against {args.address} at {args.speed}x")
+    results = await replay(records, args.address, speed=args.speed, timeout=args.timeout)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    print_summary(summarize(results))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,561 @@
+"""
+Inference Scheduling
+
+This module decides the order in which inference work runs on the model.
+Requests carry a priority class taken from their gRPC metadata and a deadline
+taken from their gRPC context.  Work is queued by priority, queued work whose
+deadline passed or whose client went away is dropped without running, and the
+model code checks the request between expensive stages so abandoned work stops
+early.
+
+Within a priority class each client has a queue of its own and the queues
+are served by weighted deficit round robin, so a client submitting a batch of
+bulk work delays another client's next job by at most one job per unit of
+its weight instead of by the whole batch.
+
+A stage may bound the jobs each client queues in each priority class.  A
+request that finds its client's queue full is rejected with the time after
+which a retry would probably find room, rather than holding the memory of its
+decoded image while it waits.  The server bounds only the first stage, so
+requests are turned away on admission and never after part of their work ran.
+
+Jobs of traced requests are recorded as two spans, the time they spent
+queued and the time they ran, named after the stage.
+
+The same scheduler runs each stage of a request on its own pool of threads:
+decoding images, running the model and post-processing its output.  While one
+request's masks are being encoded the next request's image is already decoded
+and the model is busy with a third, so throughput approaches that of the model
+alone.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent import futures
+from enum import IntEnum
+from typing import Callable, Dict, NamedTuple, Optional, Sequence, Tuple, TypeVar
+
+from segmentation_grpc import metadata
+from segmentation_grpc.tracing import TraceContext, Tracer
+
+T = TypeVar('T')
+
+# Suggested retry delay for a request rejected by a full queue before any job of the stage finished
+DEFAULT_QUEUE_RETRY_AFTER = 1.0
+
+# gRPC metadata key clients use to select the priority class of a request
+PRIORITY_METADATA_KEY = metadata.PRIORITY
+
+# gRPC metadata key clients use to identify themselves for fair sharing
+CLIENT_METADATA_KEY = metadata.CLIENT
+
+
+class Priority(IntEnum):
+    """Priority classes, lower values are served first."""
+    INTERACTIVE = 0
+    BULK = 1
+    PREFETCH = 2  # Speculative work such as warming the embedding cache
+
+    @classmethod
+    def from_metadata(cls, metadata: Optional[Sequence[Tuple[str, str]]], default: 'Priority',
+                      highest: Optional['Priority'] = None) -> 'Priority':
+        """
+        Read the priority class from gRPC invocation metadata.
+
+        Args:
+            metadata: The invocation metadata of the request
+            default: The priority to use if the metadata does not name a known class
+            highest: Optional highest class the request may claim, a higher class is lowered to it
+
+        Returns:
+            The priority class of the request
+        """
+        priority = default
+        for key, value in metadata or ():
+            if key == PRIORITY_METADATA_KEY:
+                priority = cls.__members__.get(value.strip().upper(), default)
+                break
+
+        return max(priority, highest) if highest is not None else priority
+
+
+def client_from_metadata(metadata: Optional[Sequence[Tuple[str, str]]], peer: str = '') -> str:
+    """
+    Identify the client a request is accounted to for fair sharing.
+
+    Args:
+        metadata: The invocation metadata of the request
+        peer: The gRPC peer address of the request, such as "ipv4:10.0.0.5:53412"
+
+    Returns:
+        The client named in the metadata, or else the peer address without its port
+        so all connections from one host share a queue
+    """
+    for key, value in metadata or ():
+        if key == CLIENT_METADATA_KEY and value.strip():
+            return value.strip()
+
+    if peer.startswith(('ipv4:', 'ipv6:')):
+        return peer.rsplit(':', 1)[0]
+
+    return peer
+
+
+class RequestCancelled(Exception):
+    """Raised at a stage boundary when the client cancelled the request."""
+
+
+class DeadlineExceeded(RequestCancelled):
+    """Raised at a stage boundary when the request's deadline has passed."""
+
+
+class RequestSuperseded(RequestCancelled):
+    """Raised at a stage boundary when a newer request with the same supersede key arrived."""
+
+
+class QueueFull(Exception):
+    """Raised when a client's queue for a priority class of a stage is at its bound."""
+
+    def __init__(self, message: str, retry_after: float):
+        """
+        Args:
+            message: Description of the queue that is full
+            retry_after: Seconds after which a retry would probably find room in the queue
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RequestControl:
+    """
+    Deadline and cancellation state of one request.
+
+    The control is shared between the event loop, which cancels it when the
+    client goes away, and the inference thread, which calls check() before
+    each expensive stage.
+    """
+
+    def __init__(self, deadline: Optional[float] = None, client: str = '', trace: Optional[TraceContext] = None):
+        """
+        Args:
+            deadline: Absolute time.monotonic() deadline, or None for no deadline
+            client: The client the request's work is queued for, see client_from_metadata
+            trace: Context of the span the request's jobs are recorded under, or None if it is not traced
+        """
+        self.deadline = deadline
+        self.client = client
+        self.trace = trace
+        self.superseded = False
+        self._cancelled = threading.Event()
+
+    @classmethod
+    def from_context(cls, context, trace: Optional[TraceContext] = None) -> 'RequestControl':
+        """Create a control using the deadline and client of a gRPC servicer context."""
+        time_remaining = context.time_remaining()
+        deadline = time.monotonic() + time_remaining if time_remaining is not None else None
+        return cls(deadline, client_from_metadata(context.invocation_metadata(), context.peer()), trace)
+
+    def cancel(self):
+        """Mark the request as cancelled, work stops at the next stage boundary."""
+        self._cancelled.set()
+
+    def supersede(self):
+        """Cancel the request because a newer one replaces it."""
+        self.superseded = True
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def time_remaining(self) -> Optional[float]:
+        """Seconds until the deadline, or None if the request has no deadline."""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def check(self, stage: str):
+        """
+        Raise if the request should not proceed to the given stage.
+
+        Args:
+            stage: Name of the stage about to start, used in the error message
+
+        Raises:
+            RequestCancelled: If the request was cancelled
+            RequestSuperseded: If a newer request replaced this one
+            DeadlineExceeded: If the request's deadline has passed
+        """
+        if self.cancelled:
+            if self.superseded:
+                raise RequestSuperseded(f"Request superseded by a newer request before {stage}")
+            raise RequestCancelled(f"Request cancelled before {stage}")
+        if self.expired:
+            raise DeadlineExceeded(f"Deadline exceeded before {stage}")
+
+
+class SupersedeKeys:
+    """
+    Tracks the latest request of each supersede key.
+
+    Registering a request supersedes the request registered under the same
+    key before it, which stops at its next stage boundary.  Queued jobs of the
+    superseded request are dropped when they reach the front of the queue.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}  # key -> RequestControl
+        self.superseded = 0  # Requests superseded since the server started
+
+    def register(self, key, control: RequestControl):
+        """
+        Make a request the latest of its key.
+
+        Args:
+            key: The supersede key, requests with a falsy key are not tracked
+            control: The control of the request
+        """
+        if not key:
+            return
+
+        with self._lock:
+            previous = self._latest.get(key)
+            self._latest[key] = control
+            if previous is not None and not previous.cancelled:
+                self.superseded += 1
+
+        if previous is not None:
+            previous.supersede()
+
+    def release(self, key, control: RequestControl):
+        """Forget a finished request, unless a newer request of its key replaced it already."""
+        if not key:
+            return
+
+        with self._lock:
+            if self._latest.get(key) is control:
+                del self._latest[key]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._latest)
+
+
+class StageStats(NamedTuple):
+    """A snapshot of the work done by one scheduler, the times are totals since it started."""
+    name: str
+    workers: int
+    queue_depth: int
+    max_queue_depth: int  # Bound of each client's queue in each priority class, 0 if unbounded
+    running: int
+    completed: int
+    busy_seconds: float
+    wait_seconds: float
+
+
+class ClientQueueStats(NamedTuple):
+    """A snapshot of one client's jobs in a scheduler, the totals count since it started."""
+    client: str
+    queue_depth: int
+    started: int        # Jobs taken off the queue, including dropped ones
+    wait_seconds: float  # Total time the started jobs spent queued
+
+
+class FairQueue:
+    """
+    Queues of several clients served by weighted deficit round robin.
+
+    Every job costs one unit.  Each time a client's turn comes its deficit
+    grows by its weight and it is served while the deficit covers a job, so
+    over time clients with queued work receive jobs in proportion to their
+    weights.  A client whose queue empties leaves the rotation and forfeits its
+    deficit, idle clients cannot save up a burst.
+
+    The queue is not thread safe, the scheduler holds its lock around every call.
+    """
+
+    def __init__(self, weight: Callable[[str], float] = lambda client: 1.0):
+        """
+        Args:
+            weight: Returns the weight of a client, which must be positive
+        """
+        self._weight = weight
+        self._queues = {}  # client -> deque of jobs
+        self._deficits = {}
+        self._rotation = deque()  # clients with queued jobs, the one whose turn it is first
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self):
+        for queue in self._queues.values():
+            yield from queue
+
+    def depth(self, client: str) -> int:
+        """Number of jobs the client has queued."""
+        queue = self._queues.get(client)
+        return len(queue) if queue is not None else 0
+
+    def push(self, client: str, job):
+        """Queue a job behind the client's other jobs."""
+        queue = self._queues.get(client)
+        if queue is None:
+            queue = self._queues[client] = deque()
+            # A client's quantum is added when its turn comes, or now if it is the only client
+            self._deficits[client] = self._weight(client) if len(self._rotation) == 0 else 0.0
+            self._rotation.append(client)
+
+        queue.append(job)
+        self._length += 1
+
+    def pop(self):
+        """
+        Remove and return the next job.
+
+        Raises:
+            IndexError: If no job is queued
+        """
+        if self._length == 0:
+            raise IndexError("pop from an empty FairQueue")
+
+        # The client whose turn it is used up its quantum, the next one gets its own
+        while self._deficits[self._rotation[0]] < 1.0:
+            self._rotation.rotate(-1)
+            self._deficits[self._rotation[0]] += self._weight(self._rotation[0])
+
+        client = self._rotation[0]
+        self._deficits[client] -= 1.0
+        queue = self._queues[client]
+        job = queue.popleft()
+        self._length -= 1
+        if len(queue) == 0:
+            del self._queues[client]
+            del self._deficits[client]
+            self._rotation.popleft()
+            if len(self._rotation) > 0:
+                self._deficits[self._rotation[0]] += self._weight(self._rotation[0])
+
+        return job
+
+    def clear(self):
+        self._queues.clear()
+        self._deficits.clear()
+        self._rotation.clear()
+        self._length = 0
+
+
+class InferenceScheduler:
+    """
+    Runs inference work on dedicated threads in priority order.
+
+    The model is not safe to call concurrently, so by default a single worker
+    thread executes all jobs.  Jobs of a higher priority class always run before
+    queued jobs of a lower class.  Within a class each client's jobs run
+    first-in-first-out and the clients share the workers by their weights, see
+    FairQueue.
+
+    Stages that do not touch the model, such as decoding images, use their own
+    scheduler with several workers.
+    """
+
+    def __init__(self, num_workers: int = 1, name: str = 'inference',
+                 client_weight: Callable[[str], float] = lambda client: 1.0,
+                 tracer: Optional[Tracer] = None, max_queue_depth: int = 0):
+        """
+        Args:
+            num_workers: Number of worker threads
+            name: Name of the stage the scheduler runs, used for its threads and stats
+            client_weight: Returns the fair share weight of a client, see FairQueue
+            tracer: Records the queue wait and run time of the jobs of traced requests
+            max_queue_depth: Jobs submit() queues for each client in each priority class before
+                             rejecting more of the client's jobs with QueueFull, 0 for no bound.
+                             Bounding each client rather than the whole class keeps one busy
+                             client from filling the queue and locking the others out.
+
+        Raises:
+            ValueError: If max_queue_depth is negative
+        """
+        if max_queue_depth < 0:
+            raise ValueError(f"max_queue_depth cannot be negative, got {max_queue_depth}")
+
+        self.name = name
+        self.num_workers = num_workers
+        self.max_queue_depth = max_queue_depth
+        self.tracer = tracer
+        # Jobs of each priority class are (control, fn, future, queued_at) tuples
+        self._queues = {priority: FairQueue(client_weight) for priority in Priority}
+        self._condition = threading.Condition()
+        self._shutdown = False
+
+        # Totals reported by stats() and client_stats()
+        self._running = 0
+        self._completed = 0
+        self._busy_seconds = 0.0
+        self._wait_seconds = 0.0
+        self._client_totals = {}  # client -> [started, wait_seconds]
+
+        self._workers = [threading.Thread(target=self._run, name=f'{name}-{i}', daemon=True)
+                         for i in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs waiting to run."""
+        with self._condition:
+            return self._queue_depth()
+
+    def _queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> StageStats:
+        """Return the scheduler's queue depth and the totals of the work it did."""
+        with self._condition:
+            return StageStats(self.name, self.num_workers, self._queue_depth(), self.max_queue_depth,
+                              self._running, self._completed, self._busy_seconds, self._wait_seconds)
+
+    def queue_depth_by_priority(self) -> dict:
+        """Number of jobs waiting to run in each priority class."""
+        with self._condition:
+            return {priority: len(queue) for priority, queue in self._queues.items()}
+
+    def client_stats(self) -> Dict[str, ClientQueueStats]:
+        """Return the queue depth and queueing totals of every client seen so far."""
+        with self._condition:
+            return {client: ClientQueueStats(client, sum(queue.depth(client) for queue in self._queues.values()),
+                                             started, wait_seconds)
+                    for client, (started, wait_seconds) in self._client_totals.items()}
+
+    def schedule(self, fn: Callable[[], T], control: RequestControl, priority: Priority = Priority.INTERACTIVE,
+                 bounded: bool = False) -> futures.Future:
+        """
+        Queue fn to run on an inference thread without waiting for it.
+
+        Args:
+            fn: The work to run, it should call control.check() between stages
+            control: The deadline and cancellation state of the request
+            priority: The priority class of the request
+            bounded: Whether to reject the job if the client's queue in the priority class is full.
+                     Work the server queues for itself, such as releasing a request's state, is
+                     never rejected.
+
+        Returns:
+            A concurrent.futures.Future that receives the result of fn
+
+        Raises:
+            QueueFull: If bounded and the client's queue in the priority class is full
+        """
+        future = futures.Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("InferenceScheduler has been shut down")
+            queue = self._queues[priority]
+            client_depth = queue.depth(control.client)
+            if bounded and 0 < self.max_queue_depth <= client_depth:
+                raise QueueFull(f"The {self.name} queue of {priority.name.lower()} requests from "
+                                f"{control.client or 'anonymous clients'} is full with {client_depth} jobs",
+                                self._retry_after(len(queue)))
+            queue.push(control.client, (control, fn, future, time.monotonic()))
+            self._client_totals.setdefault(control.client, [0, 0.0])
+            self._condition.notify()
+
+        return future
+
+    def _retry_after(self, queue_depth: int) -> float:
+        """Estimate the seconds until the workers work through queue_depth jobs, called with the lock held."""
+        if self._completed == 0:
+            return DEFAULT_QUEUE_RETRY_AFTER
+        return queue_depth * (self._busy_seconds / self._completed) / self.num_workers
+
+    async def submit(self, fn: Callable[[], T], control: RequestControl, priority: Priority = Priority.INTERACTIVE) -> T:
+        """
+        Queue fn to run on an inference thread and wait for its result.
+
+        If the awaiting task is cancelled, for example because the client
+        disconnected, the control is cancelled so the job is dropped if still
+        queued or stops at its next stage boundary if already running.
+
+        Args:
+            fn: The work to run, it should call control.check() between stages
+            control: The deadline and cancellation state of the request
+            priority: The priority class of the request
+
+        Returns:
+            The return value of fn
+
+        Raises:
+            QueueFull: If the client's queue in the priority class is full, fn is not queued
+            RequestCancelled: If the request was cancelled before or while running
+            DeadlineExceeded: If the deadline passed before or while running
+        """
+        future = self.schedule(fn, control, priority, bounded=True)
+
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            control.cancel()
+            raise
+
+    def shutdown(self):
+        """Stop the worker threads once the jobs already running finish, queued jobs are cancelled."""
+        with self._condition:
+            self._shutdown = True
+            for queue in self._queues.values():
+                for _, _, future, _ in queue:
+                    future.set_exception(RequestCancelled("Server shutting down"))
+                queue.clear()
+            self._condition.notify_all()
+
+    def _run(self):
+        """Worker loop, executes queued jobs in priority order."""
+        while True:
+            with self._condition:
+                while self._queue_depth() == 0 and not self._shutdown:
+                    self._condition.wait()
+                if self._shutdown:
+                    return
+                queue = next(queue for queue in self._queues.values() if len(queue) > 0)
+                control, fn, future, queued_at = queue.pop()
+                start = time.monotonic()
+                self._wait_seconds += start - queued_at
+                self._running += 1
+
+                totals = self._client_totals[control.client]
+                totals[0] += 1
+                totals[1] += start - queued_at
+
+            result, error = None, None
+            cancelled = not future.set_running_or_notify_cancel()
+            if not cancelled:
+                try:
+                    # Drop work nobody is waiting for any more without running it
+                    control.check(self.name)
+                    result = fn()
+                except BaseException as e:
+                    error = e
+
+            # Account for the job before resolving it, so its caller sees up to date stats
+            end = time.monotonic()
+            with self._condition:
+                self._running -= 1
+                self._completed += 1
+                self._busy_seconds += end - start
+
+            if not cancelled:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+            if control.trace is not None and self.tracer is not None:
+                self.tracer.record(f'{self.name} queue', control.trace, queued_at, start)
+                args = {'error': type(error).__name__} if error is not None else {}
+                self.tracer.record(self.name, control.trace, start, end, **args)
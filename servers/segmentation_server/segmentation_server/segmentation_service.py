@@ -2,24 +2,214 @@
 Segmentation Service Implementation
 
 This module implements the core logic for segmenting images using SAM2.
-It adapts the SAM2 model to work with the gRPC service interface.
+It adapts the SAM2 model to work with the gRPC service interface.  The model
+itself runs in an inference backend, see segmentation_server.backends.
 """
 
 import os
 import numpy as np
-import torch
 from PIL import Image
 import io
 import cv2
 import asyncio
-from typing import List, Tuple, Dict, Any, Optional
+import hashlib
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from typing import List, NamedTuple, Sequence, Tuple, Dict, Any, Optional, Iterator, Union
 from numpy.typing import NDArray
 
-# Import SAM2 modules
-import sam2
-from sam2.build_sam import build_sam2
-from sam2.sam2_image_predictor import SAM2ImagePredictor
-from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+from segmentation_grpc.mask_decoding import LOW_RES_MASK_SIZE, DEFAULT_SIMPLIFY_TOLERANCE
+from segmentation_server.scheduling import RequestControl
+from segmentation_server.backends import InferenceBackend, create_backend
+from segmentation_server.contours import logits_contours, signed_area
+
+
+# Limit on how often mask_to_polygons doubles the simplification tolerance to meet a vertex budget
+_MAX_SIMPLIFICATION_STEPS = 16
+
+# Defaults for automatically chosen region of interest windows, see SegmentationModel.choose_roi_window
+DEFAULT_ROI_PADDING = 1.0
+DEFAULT_ROI_MIN_SIZE = 512
+
+# An automatic window covering more than this fraction of the image is not worth cropping
+_MAX_ROI_AREA_FRACTION = 0.5
+
+# A window as (x0, y0, x1, y1) in image coordinates, x1 and y1 exclusive
+Window = Tuple[int, int, int, int]
+
+
+class UnknownHandleError(KeyError):
+    """Raised when a request refers to a logits handle the server no longer holds."""
+
+
+class InvalidPromptError(ValueError):
+    """Raised when the prompts of a request cannot be used for segmentation."""
+
+
+class UnknownImageError(KeyError):
+    """Raised when a request refers to an image by key alone and the server no longer holds its embedding."""
+
+
+class PreparedImage(NamedTuple):
+    """
+    An image made ready for the inference thread by SegmentationModel.prepare_image.
+
+    Attributes:
+        key: The embedding cache key of the image, or of its window
+        pixels: The decoded RGB pixels, or window of them, None if the embedding was cached when prepared
+        source: The image data the image was prepared from, decoded on the inference thread if the
+                cached embedding was evicted in the meantime
+        window: The window the key refers to, if any
+    """
+    key: str
+    pixels: Optional[NDArray[np.uint8]]
+    source: Any
+    window: Optional[Window] = None
+
+
+class PreparedStack(NamedTuple):
+    """
+    A stack of sections made ready for propagation by SegmentationModel.prepare_stack.
+
+    Attributes:
+        frame_dir: Directory holding each section as a JPEG frame, the form SAM2's video predictor loads
+        num_sections: Number of sections in the stack
+    """
+    frame_dir: str
+    num_sections: int
+
+    def cleanup(self):
+        """Delete the frames, the stack cannot be propagated afterwards."""
+        shutil.rmtree(self.frame_dir, ignore_errors=True)
+
+
+class PolygonOptions(NamedTuple):
+    """
+    How SegmentationModel.segment_polygons traces and simplifies the polygons of a segment.
+
+    Attributes:
+        max_vertices: Maximum number of vertices of each polygon, 0 for no limit
+        from_logits: Whether to trace the segment's low resolution logits instead of its mask
+        holes: Whether to include the boundaries of holes
+        tolerance: Simplification tolerance as a fraction of each contour's perimeter
+    """
+    max_vertices: int = 0
+    from_logits: bool = False
+    holes: bool = False
+    tolerance: float = DEFAULT_SIMPLIFY_TOLERANCE
+
+
+class LogitsStore:
+    """
+    A bounded, thread-safe store of low resolution mask logits.
+
+    Logits are kept under an opaque handle so a client can pass a previous
+    result back as the mask input of a later request without sending the
+    logits over the wire.  The least recently used entries are evicted once
+    the store holds max_entries logits.
+
+    Logits decoded in a region of interest window are stored with the window,
+    since they only line up with the image when decoded in the same window.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[NDArray[np.float16], Optional[Window]]]
+        self._lock = threading.Lock()
+
+    def put(self, logits: NDArray, window: Optional[Window] = None) -> str:
+        """Store a 2D logits array, and the window it was decoded in, and return its handle."""
+        handle = uuid.uuid4().hex
+        with self._lock:
+            self._entries[handle] = (logits.astype(np.float16), window)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return handle
+
+    def _lookup(self, handle: str):
+        with self._lock:
+            try:
+                entry = self._entries[handle]
+            except KeyError:
+                raise UnknownHandleError(handle) from None
+            self._entries.move_to_end(handle)
+
+        return entry
+
+    def get(self, handle: str) -> NDArray[np.float32]:
+        """Return the logits stored under handle, or raise UnknownHandleError."""
+        logits, _ = self._lookup(handle)
+        return logits.astype(np.float32)
+
+    def get_window(self, handle: str) -> Optional[Window]:
+        """Return the window the logits stored under handle were decoded in, None for the whole image."""
+        _, window = self._lookup(handle)
+        return window
+
+
+class EmbeddingCache:
+    """
+    A bounded, thread-safe cache of image encoder outputs.
+
+    Repeated requests on the same image, such as successive clicks on a tile,
+    skip decoding and encoding the image.  The least recently used embeddings
+    are evicted once the cache holds max_entries images.
+
+    Hits and misses are counted separately for requests a client routed to this
+    replica by image affinity, to show how much of the hit rate the routing earns.
+    """
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # type: OrderedDict[str, Any]
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+
+    def get(self, key: str, affinity_routed: bool = False) -> Optional[Any]:
+        """
+        Return the embedding stored under key, or None.
+
+        Args:
+            key: The image key
+            affinity_routed: Whether the client routed the request here by image affinity
+        """
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+
+            hit = embedding is not None
+            self.hits += hit
+            self.misses += not hit
+            if affinity_routed:
+                self.affinity_hits += hit
+                self.affinity_misses += not hit
+
+        return embedding
+
+    def __contains__(self, key: str) -> bool:
+        """Whether an embedding is stored under key, without counting a lookup."""
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key: str, embedding: Any):
+        """Store the embedding of the image identified by key."""
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
 
 
 class SegmentationModel:
@@ -30,62 +220,98 @@ class SegmentationModel:
     methods for segmenting images based on input coordinates.
     """
     
-    def __init__(self):
-        """Initialize the SAM2 model."""
-        # Select the device for computation
-        if torch.cuda.is_available():
-            self.device = torch.device("cuda")
-            # Use bfloat16 for better performance on CUDA
-            torch.autocast("cuda", dtype=torch.bfloat16).__enter__()
-            # Turn on tfloat32 for Ampere GPUs
-            if torch.cuda.get_device_properties(0).major >= 8:
-                torch.backends.cuda.matmul.allow_tf32 = True
-                torch.backends.cudnn.allow_tf32 = True
-        elif torch.backends.mps.is_available():
-            self.device = torch.device("mps")
-            print(
-                "Support for MPS devices is preliminary. SAM2 is trained with CUDA and might "
-                "give numerically different outputs and sometimes degraded performance on MPS."
-            )
-        else:
-            self.device = torch.device("cpu")
-            
-        print(f"Using device: {self.device}")
-        
-        # Set up paths for the SAM2 model
-        root_path = os.path.dirname(sam2.__file__)
-        root_path = os.path.dirname(root_path)
-        
-        sam2_checkpoint = f"/{root_path}/checkpoints/sam2.1_hiera_large.pt"
-        model_cfg = f"/{root_path}/sam2/configs/sam2.1/sam2.1_hiera_l.yaml"
-        
-        # Build the SAM2 model
-        self.sam2_model = build_sam2(model_cfg, sam2_checkpoint, device=self.device)
-        
-        # Create the image predictor
-        self.predictor = SAM2ImagePredictor(self.sam2_model)
-
-        self.mask_generator = SAM2AutomaticMaskGenerator(
-            model=self.sam2_model,
-            points_per_side=32,
-            points_per_batch=256,
-            pred_iou_thresh=0.7,
-            stability_score_thresh=0.92,
-            stability_score_offset=0.7,
-            crop_n_layers=1,
-            box_nms_thresh=0.7,
-            crop_n_points_downscale_factor=2,
-            min_mask_region_area=25.0,
-            use_m2m=True,
-        )
+    def __init__(self,
+                 max_stored_logits: int = 1024,
+                 max_cached_embeddings: int = 8,
+                 backend: Union[str, InferenceBackend] = 'torch',
+                 backend_options: Optional[Dict[str, Any]] = None):
+        """Initialize the SAM2 model.
+
+        Args:
+            max_stored_logits: The number of low resolution logits kept for mask_input_handle lookups
+            max_cached_embeddings: The number of image embeddings kept for repeated requests on the same image
+            backend: The inference backend, or the name of one to create, see segmentation_server.backends
+            backend_options: Arguments used to create the backend when it is given by name
+        """
+        if isinstance(backend, str):
+            backend = create_backend(backend, **(backend_options or {}))
+        self.backend = backend
+
+        self.logits_store = LogitsStore(max_stored_logits)
+        self.embedding_cache = EmbeddingCache(max_cached_embeddings)
+
+        # The video predictor holds its own copy of the weights, so it is only built when first needed
+        self._video_predictor = None
+        self._video_predictor_lock = threading.Lock()
+
+    @property
+    def video_predictor(self):
+        """The SAM2 video predictor used to propagate objects through section stacks, built on first use."""
+        with self._video_predictor_lock:
+            if self._video_predictor is None:
+                self._video_predictor = self.backend.build_video_predictor()
+
+        return self._video_predictor
+
+    @property
+    def loaded_models(self) -> List[str]:
+        """Names of the models currently loaded, the video predictor is only listed once built."""
+        name = self.backend.model_name
+        models = [name]
+        if self._video_predictor is not None:
+            models.append(f'{name}_video')
+        return models
+
+    @staticmethod
+    def decode_image(image_data) -> NDArray[np.uint8]:
+        """
+        Decode encoded image bytes into an RGB numpy array as expected by SAM2.
+
+        Args:
+            image_data: The encoded image data, typically a grayscale PNG, or an already decoded
+                        uint8 array of shape (height, width) or (height, width, 3), for example a
+                        view of a shared memory segment
+
+        Returns:
+            An array of shape (height, width, 3).  Arrays are returned without copying them, a
+            grayscale array as a read-only view repeating its single channel.
+        """
+        if isinstance(image_data, np.ndarray):
+            if image_data.dtype != np.uint8:
+                raise InvalidPromptError(f"Expected a uint8 image, got {image_data.dtype}")
+            if image_data.ndim == 3 and image_data.shape[2] == 3:
+                return image_data
+            if image_data.ndim == 3 and image_data.shape[2] == 1:
+                image_data = image_data[:, :, 0]
+            if image_data.ndim != 2:
+                raise InvalidPromptError(f"Expected a grayscale or RGB image, got shape {image_data.shape}")
+
+            # Convert grayscale to RGB (SAM2 expects RGB) by repeating the channel with a zero stride
+            return np.broadcast_to(image_data[:, :, None], image_data.shape + (3,))
+
+        image = Image.open(io.BytesIO(image_data))
+
+        # Convert grayscale to RGB if needed (SAM2 expects RGB)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        return np.array(image)
 
     @staticmethod
-    def mask_to_polygons(mask: NDArray[np.bool_]) -> List[np.ndarray]:
+    def mask_to_polygons(mask: NDArray[np.bool_],
+                         max_vertices: int = 0,
+                         holes: bool = False,
+                         tolerance: float = DEFAULT_SIMPLIFY_TOLERANCE) -> List[np.ndarray]:
         """
         Convert a boolean mask to a list of polygons representing the contours.
 
         Args:
             mask: A boolean numpy array where True represents the masked region
+            max_vertices: Maximum number of vertices of each polygon, 0 for no limit.  Contours
+                          with too many vertices are simplified with a larger tolerance until they fit.
+            holes: Whether to include the boundaries of holes.  Outer boundaries are then oriented
+                   to have positive and holes negative signed area.
+            tolerance: Simplification tolerance as a fraction of each contour's perimeter
 
         Returns:
             A list of polygons, where each polygon is a numpy array of shape (N, 2)
@@ -94,124 +320,1082 @@ class SegmentationModel:
         # Make sure mask is boolean and convert to uint8 for OpenCV
         mask_uint8 = mask.astype(np.uint8) * 255
 
-        # Find contours in the mask
-        contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Find contours in the mask, a two level hierarchy separates outer boundaries from holes
+        if not holes:
+            contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            return SegmentationModel._simplify_contours(contours, max_vertices, tolerance)
+
+        contours, hierarchy = cv2.findContours(mask_uint8, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+        is_hole = [parent >= 0 for parent in hierarchy[0, :, 3]] if len(contours) > 0 else []
+        return SegmentationModel._simplify_contours(contours, max_vertices, tolerance, is_hole)
+
+    @staticmethod
+    def _simplify_contours(contours,
+                           max_vertices: int = 0,
+                           tolerance: float = DEFAULT_SIMPLIFY_TOLERANCE,
+                           is_hole: Optional[List[bool]] = None) -> List[np.ndarray]:
+        """
+        Simplify contours into polygons of at least three vertices, see mask_to_polygons.
 
+        If is_hole is given, each polygon is oriented by whether its contour is a hole.
+        """
         # Convert contours to simplified polygons
         polygons = []
-        for contour in contours:
+        for i, contour in enumerate(contours):
             # Simplify the contour to reduce the number of points
-            epsilon = 0.005 * cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, epsilon, True)
+            perimeter = cv2.arcLength(contour, True)
+            epsilon = tolerance * perimeter
+            approx = cv2.approxPolyDP(contour, epsilon, True) if epsilon > 0 else contour
+
+            # Double the tolerance until the polygon fits the vertex budget, without collapsing it below a triangle
+            if max_vertices > 0:
+                if epsilon <= 0:
+                    epsilon = DEFAULT_SIMPLIFY_TOLERANCE * perimeter / 2
+                for _ in range(_MAX_SIMPLIFICATION_STEPS):
+                    if len(approx) <= max_vertices:
+                        break
+                    epsilon *= 2
+                    simpler = cv2.approxPolyDP(contour, epsilon, True)
+                    if len(simpler) < 3:
+                        break
+                    approx = simpler
 
             # Reshape from (N, 1, 2) to (N, 2)
             polygon = approx.reshape(-1, 2)
 
             # Only include polygons with a minimum number of points
-            if len(polygon) >= 3:
-                polygons.append(polygon)
+            if len(polygon) < 3:
+                continue
+
+            if is_hole is not None and (signed_area(polygon.astype(np.float64)) < 0) != is_hole[i]:
+                polygon = polygon[::-1]
+
+            polygons.append(polygon)
 
         return polygons
 
+    @staticmethod
+    def logits_to_polygons(logits: NDArray[np.float32],
+                           width: int,
+                           height: int,
+                           max_vertices: int = 0,
+                           holes: bool = False,
+                           tolerance: float = DEFAULT_SIMPLIFY_TOLERANCE) -> List[np.ndarray]:
+        """
+        Convert low resolution logits to polygons without upsampling them to a full resolution mask.
+
+        The logits cover the whole encoded image, stretched to a square.  Their 0
+        level is traced on a grid a few times finer than the logits and scaled to
+        the image, see contours.logits_contours, so the cost does not grow with the
+        image size.
+
+        Args:
+            logits: A 2D array of low resolution logits, positive inside the mask
+            width: Width of the image, or window, the logits were decoded for
+            height: Height of the image, or window, the logits were decoded for
+            max_vertices: Maximum number of vertices of each polygon, 0 for no limit
+            holes: Whether to include the boundaries of holes, oriented as by mask_to_polygons
+            tolerance: Simplification tolerance as a fraction of each contour's perimeter
+
+        Returns:
+            A list of polygons of shape (N, 2) in the image's coordinates, like mask_to_polygons
+        """
+        contours, is_hole = logits_contours(logits, width, height, holes)
+        return [np.round(polygon).astype(np.int32)
+                for polygon in SegmentationModel._simplify_contours(contours, max_vertices, tolerance, is_hole)]
+
+    @staticmethod
+    def segment_polygons(segment: Dict[str, Any], options: PolygonOptions) -> List[np.ndarray]:
+        """
+        Trace the polygons of a segment dictionary produced by segment_image, in image coordinates.
+
+        The cheapest representation the segment carries is traced: its logits if
+        options.from_logits is set, else its mask array, else its PNG encoded mask.
+        OpenCV releases the GIL, so several segments can be traced on parallel threads.
+
+        Args:
+            segment: A segment dictionary
+            options: How to trace and simplify the polygons
+
+        Returns:
+            A list of polygons of shape (N, 2)
+        """
+        settings = dict(max_vertices=options.max_vertices, holes=options.holes, tolerance=options.tolerance)
+
+        if options.from_logits and 'mask_logits' in segment:
+            # Cheaper than tracing the full resolution mask and independent of the image size
+            x0, y0, width, height = segment['logits_frame']
+            polygons = SegmentationModel.logits_to_polygons(segment['mask_logits'], width, height, **settings)
+        elif 'mask_array' in segment:
+            # Masks decoded in a region of interest are traced at the window's size and shifted into the image
+            x0, y0 = segment['mask_offset']
+            polygons = SegmentationModel.mask_to_polygons(segment['mask_array'], **settings)
+        else:
+            x0, y0 = segment.get('mask_window', (0, 0))[:2]
+            mask = cv2.imdecode(np.frombuffer(segment['mask'], np.uint8), cv2.IMREAD_GRAYSCALE) > 0
+            polygons = SegmentationModel.mask_to_polygons(mask, **settings)
+
+        if x0 == 0 and y0 == 0:
+            return polygons
+
+        return [polygon + np.array([x0, y0], dtype=polygon.dtype) for polygon in polygons]
+
+    @staticmethod
+    def compose_labeled_image(masks: Sequence[NDArray[np.bool_]],
+                              labels: NDArray,
+                              priorities: NDArray,
+                              dtype=np.uint16) -> Optional[NDArray]:
+        """
+        Compose a labeled image from possibly overlapping masks.
+
+        Where masks overlap, the pixel takes the label of the mask with the highest
+        priority.  The masks are painted into a single label array from the lowest
+        priority to the highest, so memory does not grow with the number of masks.
+
+        Args:
+            masks: N boolean masks of shape (H, W), such as an (N, H, W) array
+            labels: Array of shape (N,) with the label of each mask, 0 is reserved for background
+            priorities: Array of shape (N,), for example the score of each mask
+            dtype: The dtype of the labeled image
+
+        Returns:
+            An array of shape (H, W) where each pixel is the label of the winning mask or 0,
+            or None if there are no masks
+        """
+        if len(masks) == 0:
+            return None
+
+        # Of masks with equal priority the first one wins, so it is painted last
+        order = np.argsort(-np.asarray(priorities), kind='stable')[::-1]
+        labels = np.asarray(labels)
+
+        labeled_image = np.zeros(np.shape(masks[0]), dtype=dtype)
+        for i in order:
+            labeled_image[np.asarray(masks[i], dtype=bool)] = labels[i]
+        return labeled_image
+
     @staticmethod
     def create_labeled_image(anns, borders=True) -> NDArray[np.uint16]:
-        """Given a set of masks, creates a labeled image."""
+        """Given a set of masks from the automatic mask generator, creates a labeled image.
+
+        Smaller masks are drawn on top of larger ones.  Labels start at 1 in order of decreasing area.
+        """
 
         if len(anns) == 0:
             return
 
         #Start with the largest mask, and work towards the smallest
         sorted_anns = sorted(anns, key=(lambda x: x['area']), reverse=True)
-        #ax = plt.gca()
-        #ax.set_autoscale_on(False)
 
-        img = np.zeros((sorted_anns[0]['segmentation'].shape[0], sorted_anns[0]['segmentation'].shape[1]), dtype=np.uint16)
-        for i, ann in enumerate(sorted_anns):
-            m = ann['segmentation']
-            img[m] = i
+        masks = [ann['segmentation'] for ann in sorted_anns]
+        labels = np.arange(1, len(sorted_anns) + 1)
+        areas = np.array([ann['area'] for ann in sorted_anns])
+
+        return SegmentationModel.compose_labeled_image(masks, labels, -areas)
+
+    @staticmethod
+    def choose_roi_window(width: int,
+                          height: int,
+                          points: List[Tuple[int, int]],
+                          boxes: List[Tuple[int, int, int, int]],
+                          padding: float = DEFAULT_ROI_PADDING,
+                          min_size: int = DEFAULT_ROI_MIN_SIZE) -> Optional[Window]:
+        """
+        Choose a square window around the prompts to encode instead of the whole image.
+
+        The window's side is the larger side of the prompts' bounding box plus the
+        padding on each side, and at least min_size.  It is centred on the prompts
+        and shifted to lie inside the image.
+
+        Args:
+            width: Width of the image
+            height: Height of the image
+            points: All (x, y) point prompts, foreground and background
+            boxes: All (x0, y0, x1, y1) box prompts
+            padding: Margin on each side of the bounding box as a fraction of its larger side
+            min_size: Smallest side length of the window
+
+        Returns:
+            The window, or None if it would cover so much of the image that encoding the whole image is better
+        """
+        corners = list(points) + [corner for box in boxes for corner in ((box[0], box[1]), (box[2], box[3]))]
+        if len(corners) == 0:
+            return None
+
+        corners = np.asarray(corners, dtype=np.float64)
+        lower, upper = corners.min(axis=0), corners.max(axis=0)
+        span = float((upper - lower).max())
+        side = int(np.ceil(max(span * (1 + 2 * padding), min_size)))
+
+        window_width, window_height = min(side, width), min(side, height)
+        if window_width * window_height > _MAX_ROI_AREA_FRACTION * width * height:
+            return None
+
+        centre = (lower + upper) / 2
+        x0 = int(np.clip(round(centre[0] - window_width / 2), 0, width - window_width))
+        y0 = int(np.clip(round(centre[1] - window_height / 2), 0, height - window_height))
+        return x0, y0, x0 + window_width, y0 + window_height
+
+    def resolve_roi_window(self,
+                           width: int,
+                           height: int,
+                           points: List[Tuple[int, int]],
+                           boxes: List[Tuple[int, int, int, int]],
+                           window: Optional[Window] = None,
+                           auto: bool = False,
+                           padding: float = DEFAULT_ROI_PADDING,
+                           min_size: int = DEFAULT_ROI_MIN_SIZE,
+                           mask_input_handle: Optional[str] = None) -> Optional[Window]:
+        """
+        Decide which window of the image a request is encoded in.
+
+        An explicit window wins, then the window of the logits being refined,
+        then an automatically chosen window if auto is set.
+
+        Args:
+            width: Width of the image
+            height: Height of the image
+            points: All (x, y) point prompts of the request
+            boxes: All (x0, y0, x1, y1) box prompts of the request
+            window: Optional window requested by the client
+            auto: Whether to choose a window around the prompts if none is given
+            padding: See choose_roi_window
+            min_size: See choose_roi_window
+            mask_input_handle: Optional handle of the logits the request refines
+
+        Returns:
+            The window, or None to encode the whole image
+
+        Raises:
+            InvalidPromptError: If the requested window does not overlap the image
+            UnknownHandleError: If mask_input_handle is not held by the logits store
+        """
+        if window is not None:
+            x0, y0 = max(window[0], 0), max(window[1], 0)
+            x1, y1 = min(window[2], width), min(window[3], height)
+            if x1 <= x0 or y1 <= y0:
+                raise InvalidPromptError(f"Region of interest {window} does not overlap the {width}x{height} image")
+            return x0, y0, x1, y1
+
+        if mask_input_handle:
+            stored = self.logits_store.get_window(mask_input_handle)
+            if stored is not None:
+                return stored
+
+        if auto:
+            return self.choose_roi_window(width, height, points, boxes, padding, min_size)
+
+        return None
+
+    @staticmethod
+    def image_cache_key(image_data, image_key: Optional[str] = None) -> str:
+        """
+        Return the key identifying an image in the embedding cache.
+
+        Args:
+            image_data: The encoded image data or a decoded image array
+            image_key: Optional key supplied by the client, such as a tile ID, which must change whenever
+                       the pixels do.  The image content is hashed if it is not given.
+
+        Returns:
+            The cache key
+        """
+        if image_key:
+            return f'key:{image_key}'
+
+        digest = hashlib.blake2b(digest_size=16)
+        if isinstance(image_data, np.ndarray):
+            digest.update(repr((image_data.shape, image_data.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(image_data).data)
+        else:
+            digest.update(image_data)
+
+        return f'sha:{digest.hexdigest()}'
+
+    @staticmethod
+    def _require_image_data(image_data, image_key: Optional[str]):
+        """Raise UnknownImageError if a request whose embedding is not cached carries no image to encode."""
+        if isinstance(image_data, (bytes, bytearray)) and len(image_data) == 0:
+            raise UnknownImageError(image_key or '')
+
+    def _window_key(self, image_data, image_key: Optional[str], window: Optional[Window]) -> str:
+        """Return the embedding cache key of an image, or of a window of it."""
+        key = self.image_cache_key(image_data, image_key)
+        if window is not None:
+            key += '@{},{},{},{}'.format(*window)
+        return key
+
+    def _decode_window(self, image_data, window: Optional[Window]) -> NDArray[np.uint8]:
+        """Decode an image, cropped to a window if one is given."""
+        image_np = self.decode_image(image_data)
+        if window is not None:
+            x0, y0, x1, y1 = window
+            image_np = np.ascontiguousarray(image_np[y0:y1, x0:x1])
+        return image_np
+
+    def prepare_image(self,
+                      image_data,
+                      image_key: Optional[str] = None,
+                      window: Optional[Window] = None,
+                      control: Optional[RequestControl] = None) -> PreparedImage:
+        """
+        Hash and decode an image ahead of inference, on a thread other than the inference thread.
+
+        The image is only decoded if its embedding is not cached.  Any method
+        taking image_data accepts the returned PreparedImage in its place.
+
+        Args:
+            image_data: The encoded image data or a decoded image array
+            image_key: Optional client supplied key of the image, see image_cache_key
+            window: Optional (x0, y0, x1, y1) window of the image that will be encoded
+            control: Optional deadline and cancellation state, checked before decoding
+
+        Returns:
+            The prepared image
+
+        Raises:
+            UnknownImageError: If image_data is empty and the embedding of image_key is not cached
+        """
+        if isinstance(image_data, PreparedImage):
+            return image_data
+
+        control = control or RequestControl()
+        key = self._window_key(image_data, image_key, window)
+        if key in self.embedding_cache:
+            return PreparedImage(key, None, image_data, window)
+        self._require_image_data(image_data, image_key)
+
+        control.check('image decode')
+        return PreparedImage(key, self._decode_window(image_data, window), image_data, window)
+
+    def _embed_image(self,
+                     image_data,
+                     image_key: Optional[str],
+                     affinity_routed: bool,
+                     control: RequestControl,
+                     window: Optional[Window] = None) -> Any:
+        """
+        Return the embedding of an image, reusing a cached embedding if there is one.
+
+        Args:
+            image_data: The encoded image data, a decoded image array or a PreparedImage
+            image_key: Optional client supplied key of the image, see image_cache_key
+            affinity_routed: Whether the client routed the request here by image affinity
+            control: Deadline and cancellation state, checked before decoding and encoding
+            window: Optional (x0, y0, x1, y1) window of the image to encode instead of the whole image
+
+        Returns:
+            The backend's embedding of the image
+        """
+        prepared = image_data if isinstance(image_data, PreparedImage) else None
+        if prepared is not None and prepared.window != window:
+            raise ValueError(f"The image was prepared for window {prepared.window}, not {window}")
+
+        key = prepared.key if prepared is not None else self._window_key(image_data, image_key, window)
+        embedding = self.embedding_cache.get(key, affinity_routed)
+        if embedding is not None:
+            return embedding
+
+        if prepared is not None and prepared.pixels is not None:
+            image_np = prepared.pixels
+        else:
+            # The embedding may have been evicted since the image was prepared
+            source = prepared.source if prepared is not None else image_data
+            self._require_image_data(source, image_key)
+            control.check('image decode')
+            image_np = self._decode_window(source, window)
+
+        control.check('image encode')
+        embedding = self.backend.encode_image(image_np)
+        self.embedding_cache.put(key, embedding)
+        return embedding
+
+    def prefetch_image(self,
+                       image_data: bytes,
+                       image_key: Optional[str] = None,
+                       control: Optional[RequestControl] = None) -> bool:
+        """
+        Encode an image into the embedding cache so later requests on it skip the image encoder.
+
+        Args:
+            image_data: The grayscale image data as bytes
+            image_key: Optional client supplied key of the image, see image_cache_key
+            control: Optional deadline and cancellation state, checked before decoding and encoding
+
+        Returns:
+            True if the image was encoded, False if its embedding was already cached
+        """
+        control = control or RequestControl()
+
+        prepared = self.prepare_image(image_data, image_key, control=control)
+        if prepared.pixels is None:
+            return False
+
+        control.check('image encode')
+        self.embedding_cache.put(prepared.key, self.backend.encode_image(prepared.pixels))
+        return True
+
+    def get_image_embedding(self,
+                            image_data,
+                            image_key: Optional[str] = None,
+                            affinity_routed: bool = False,
+                            control: Optional[RequestControl] = None) -> Tuple[Dict[str, NDArray[np.float32]], Tuple[int, int]]:
+        """
+        Return the arrays an exported SAM2 mask decoder needs to decode prompts on an image.
+
+        Args:
+            image_data: The grayscale image data as bytes, or a decoded uint8 array
+            image_key: Optional client supplied key of the image for the embedding cache, the content is hashed if omitted
+            affinity_routed: Whether the client routed the request here by image affinity, for the cache statistics
+            control: Optional deadline and cancellation state, checked before decoding and encoding
+
+        Returns:
+            A tuple of (arrays, (height, width)) where arrays are float32 arrays keyed by
+            segmentation_grpc.mask_decoding.EMBEDDING_NAMES and (height, width) is the size of the image
+
+        Raises:
+            NotImplementedError: If the backend cannot export its embeddings
+            UnknownImageError: If image_data is empty and the embedding of image_key is no longer cached
+        """
+        control = control or RequestControl()
+        embedding = self._embed_image(image_data, image_key, affinity_routed, control)
+        return self.backend.export_embedding(embedding)
+
+    def generate_masks(self, image_data, **options) -> Tuple[NDArray[np.uint16], List[Dict[str, Any]]]:
+        """
+        Segment everything in an image without prompts, for batch jobs pre-segmenting whole volumes.
+
+        Generated masks bypass the embedding cache, every image is expected to be seen once.
+
+        Args:
+            image_data: The grayscale image data as bytes, or a decoded uint8 array
+            **options: Options of the backend's InferenceBackend.generate_masks
+
+        Returns:
+            A tuple of (labeled_image, segments).  Labels start at 1 in order of decreasing
+            area, smaller masks are drawn on top of larger ones.  Each segment is a dictionary
+            holding its 'index' in the labeled image, 'score', 'stability_score', 'area' and
+            'bbox' as an (x0, y0, x1, y1) window.
+
+        Raises:
+            NotImplementedError: If the backend cannot generate masks
+        """
+        image = self.decode_image(image_data)
+        annotations = sorted(self.backend.generate_masks(image, **options), key=lambda a: a['area'], reverse=True)
+
+        if len(annotations) == 0:
+            return np.zeros(image.shape[:2], dtype=np.uint16), []
+
+        segments = []
+        for i, annotation in enumerate(annotations):
+            x, y, w, h = (int(round(value)) for value in annotation['bbox'])
+            segments.append({
+                'index': i + 1,
+                'score': float(annotation['predicted_iou']),
+                'stability_score': float(annotation['stability_score']),
+                'area': int(annotation['area']),
+                'bbox': (x, y, x + w, y + h),
+            })
+
+        return self.create_labeled_image(annotations), segments
 
-        return img
-    
     def segment_image(self,
                            image_data: bytes, 
                            width: int, 
                            height: int, 
                            coordinates: List[Tuple[int, int]], 
                            labels: List[int], 
-                           multimask_output: bool = True) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+                           multimask_output: bool = True,
+                           box: Optional[Tuple[int, int, int, int]] = None,
+                           mask_input_handle: Optional[str] = None,
+                           mask_input: Optional[NDArray[np.float32]] = None,
+                           return_low_res_logits: bool = False,
+                           return_labeled_image: bool = True,
+                           image_key: Optional[str] = None,
+                           affinity_routed: bool = False,
+                           control: Optional[RequestControl] = None,
+                           roi_window: Optional[Window] = None) -> Tuple[Optional[np.ndarray], List[Dict[str, Any]]]:
         """
         Segment an image based on input coordinates.
+
+        With a roi_window only that window of the image is encoded and decoded.
+        Prompts are given, and masks and polygons returned, in full image coordinates.
         
         Args:
-            image_data: The grayscale image data as bytes
+            image_data: The grayscale image data as bytes, or a decoded uint8 array
             width: The width of the image
             height: The height of the image
             coordinates: List of (x, y) coordinates to use as prompts
             labels: List of labels for each coordinate (1 for foreground, 0 for background)
             multimask_output: Whether to output multiple masks per point
+            box: Optional (x0, y0, x1, y1) box prompt
+            mask_input_handle: Optional handle of logits returned by a previous call, used to refine that result
+            mask_input: Optional low resolution logits used to refine a previous result, ignored if mask_input_handle is set
+            return_low_res_logits: Whether to include the low resolution logits in each segment
+            return_labeled_image: Whether to compose the labeled image, if False None is returned in its place
+            image_key: Optional client supplied key of the image for the embedding cache, the content is hashed if omitted
+            affinity_routed: Whether the client routed the request here by image affinity, for the cache statistics
+            control: Optional deadline and cancellation state, checked before each stage
+            roi_window: Optional (x0, y0, x1, y1) window to segment in, see resolve_roi_window
             
         Returns:
             A tuple containing:
-            - labeled_image: A 2D numpy array where each pixel value corresponds to a segment index
+            - labeled_image: A 2D uint16 array where each pixel value is the index of the highest scoring segment covering it
             - segments: A list of dictionaries containing information about each segment
+
+        Raises:
+            UnknownHandleError: If mask_input_handle is not held by the logits store
+            RequestCancelled: If the request was cancelled or its deadline passed between stages
         """
-        # Convert image bytes to numpy array
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Convert grayscale to RGB if needed (SAM2 expects RGB)
-        if image.mode == 'L':
-           image = image.convert('RGB')
-        
-        # Convert to numpy array
-        image_np = np.array(image)
+        control = control or RequestControl()
 
-        # Convert coordinates to numpy array
-        point_coords = np.array(coordinates)
-        point_labels = np.array(labels)
+        masks, scores, logits = self.predict_masks(
+            image_data, width, height, coordinates, labels,
+            multimask_output=multimask_output,
+            box=box,
+            mask_input_handle=mask_input_handle,
+            mask_input=mask_input,
+            image_key=image_key,
+            affinity_routed=affinity_routed,
+            control=control,
+            roi_window=roi_window)
 
-        # Set the image for the
-        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16):
-            self.predictor.set_image(image_np)
+        return self.complete_segments(masks, scores, logits, width, height,
+                                      return_low_res_logits=return_low_res_logits,
+                                      return_labeled_image=return_labeled_image,
+                                      control=control,
+                                      roi_window=roi_window)
 
-            masks, scores, logits = self.predictor.predict(
-                    point_coords=point_coords,
-                    point_labels=point_labels,
-                    multimask_output=multimask_output,
-                )
+    def predict_masks(self,
+                      image_data: bytes,
+                      width: int,
+                      height: int,
+                      coordinates: List[Tuple[int, int]],
+                      labels: List[int],
+                      multimask_output: bool = True,
+                      box: Optional[Tuple[int, int, int, int]] = None,
+                      mask_input_handle: Optional[str] = None,
+                      mask_input: Optional[NDArray[np.float32]] = None,
+                      image_key: Optional[str] = None,
+                      affinity_routed: bool = False,
+                      control: Optional[RequestControl] = None,
+                      roi_window: Optional[Window] = None) -> Tuple[NDArray[np.bool_], NDArray[np.float32], NDArray[np.float32]]:
+        """
+        Run the encoder and decoder for one prompt set, the first half of segment_image.
+
+        The masks are not yet encoded or stored, which lets callers show a
+        preview of the result before complete_segments does the rest.  See
+        segment_image for the arguments.
+
+        Returns:
+            A tuple of (masks, scores, logits) with shapes (C, H, W), (C,) and (C, 256, 256),
+            ordered by decreasing score.  With a roi_window the masks cover only the window.
+
+        Raises:
+            UnknownHandleError: If mask_input_handle is not held by the logits store
+            InvalidPromptError: If mask_input is not 256x256
+            RequestCancelled: If the request was cancelled or its deadline passed between stages
+        """
+        control = control or RequestControl()
 
-            #full_masks = self.mask_generator.generate(image_np)
+        # Resolve the mask input before doing any expensive work
+        if mask_input_handle:
+            mask_input = self.logits_store.get(mask_input_handle)
+        if mask_input is not None and mask_input.shape != (LOW_RES_MASK_SIZE, LOW_RES_MASK_SIZE):
+            raise InvalidPromptError(f"mask_input must be {LOW_RES_MASK_SIZE}x{LOW_RES_MASK_SIZE} logits, "
+                                     f"got shape {mask_input.shape}")
 
-        #labeled_image = self.create_labeled_image(full_masks)
-        labeled_image = np.zeros((height, width), dtype=np.uint16)
+        # Convert prompts to a batch of one prompt set, backends expect None for absent prompts
+        point_coords = np.array([coordinates], dtype=np.float32) if len(coordinates) > 0 else None
+        point_labels = np.array([labels], dtype=np.int32) if len(coordinates) > 0 else None
+        box_np = np.array([box], dtype=np.float32) if box is not None else None
+        mask_input_np = mask_input[None, None, :, :] if mask_input is not None else None
+        point_coords, box_np = self._window_prompts(point_coords, box_np, roi_window)
 
+        # The embedding of a recently seen image is reused
+        embedding = self._embed_image(image_data, image_key, affinity_routed, control, roi_window)
+
+        control.check('mask decode')
+        masks, scores, logits = self.backend.decode(
+                embedding,
+                point_coords=point_coords,
+                point_labels=point_labels,
+                boxes=box_np,
+                mask_input=mask_input_np,
+                multimask_output=multimask_output,
+            )
+
+        order = np.argsort(scores[0])[::-1]
+        return masks[0][order], scores[0][order], logits[0][order]
+
+    def complete_segments(self,
+                          masks: NDArray[np.bool_],
+                          scores: NDArray[np.float32],
+                          logits: NDArray[np.float32],
+                          width: int,
+                          height: int,
+                          return_low_res_logits: bool = False,
+                          return_labeled_image: bool = True,
+                          control: Optional[RequestControl] = None,
+                          roi_window: Optional[Window] = None) -> Tuple[Optional[np.ndarray], List[Dict[str, Any]]]:
+        """
+        Compose the labeled image and encode the segments of predict_masks' result, the second half of segment_image.
+
+        Args:
+            masks: Masks returned by predict_masks
+            scores: Scores returned by predict_masks
+            logits: Logits returned by predict_masks
+            width: The width of the image
+            height: The height of the image
+            return_low_res_logits: Whether to include the low resolution logits in each segment
+            return_labeled_image: Whether to compose the labeled image, if False None is returned in its place
+            control: Optional deadline and cancellation state, checked before each stage
+            roi_window: The window passed to predict_masks, if any
+
+        Returns:
+            A tuple of (labeled_image, segments) as returned by segment_image
+        """
+        control = control or RequestControl()
+
+        labeled_image = None
+        if return_labeled_image:
+            # Segment indices are assigned in order of decreasing score
+            control.check('labeled image')
+            ranks = np.empty(len(scores), dtype=np.int64)
+            ranks[np.argsort(scores)[::-1]] = np.arange(1, len(scores) + 1)
+            labeled_image = self.compose_labeled_image(masks, ranks, -ranks)
+            labeled_image = self._paste_window(labeled_image, roi_window, width, height)
+
+        control.check('mask encode')
+        segments = self._build_segments(masks, scores, logits, return_low_res_logits=return_low_res_logits,
+                                        window=roi_window, image_size=(width, height))
+
+        return labeled_image, segments
+
+    def _build_segments(self,
+                        masks: NDArray,
+                        scores: NDArray,
+                        logits: NDArray,
+                        first_index: int = 1,
+                        return_low_res_logits: bool = False,
+                        window: Optional[Window] = None,
+                        image_size: Optional[Tuple[int, int]] = None) -> List[Dict[str, Any]]:
+        """
+        Convert the masks predicted for one prompt set into segment dictionaries, best score first.
+
+        Masks predicted in a window are encoded at the window's size, the window is
+        kept in 'mask_window'.  The mask as predicted is kept in 'mask_array' and
+        its position in 'mask_offset', so polygons can be traced without decoding
+        the PNG encoded mask again.  The
+        logits are kept in 'mask_logits' with the (x, y, width, height) of the
+        area they cover in 'logits_frame', for SegmentationModel.logits_to_polygons.
+
+        Args:
+            masks: Array of shape (C, H, W) of predicted masks
+            scores: Array of shape (C,) of predicted IoU scores
+            logits: Array of shape (C, 256, 256) of low resolution logits
+            first_index: The segment index assigned to the highest scoring mask
+            return_low_res_logits: Whether to include the low resolution logits in each segment
+            window: Optional (x0, y0, x1, y1) window the masks were predicted in
+            image_size: The (width, height) of the full image, required with a window
+
+        Returns:
+            A list of dictionaries containing information about each segment
+        """
         # Sort masks by score
         sorted_ind = np.argsort(scores)[::-1]
         masks = masks[sorted_ind].astype(bool)
         scores = scores[sorted_ind]
         logits = logits[sorted_ind]
-        
-        # Create a labeled image where each pixel value corresponds to a segment index
-        #labeled_image = np.zeros((height, width), dtype=np.uint16)
-        
+
         # List to store segment information
         segments = []
-        
+
         # Assign each mask a unique index in the labeled image
-        for i, (mask, score) in enumerate(zip(masks, scores)):
-            # Add 1 to index to avoid 0 (background)
-            index = i + 1
-            
-            # Update the labeled image
-            #labeled_image[mask] = index
-            
-            # Convert mask to bytes for the response
+        for i, (mask, score, low_res_logits) in enumerate(zip(masks, scores, logits)):
+            # Convert mask to bytes for the response, only the window is encoded so the PNG does not grow with the image
+            if window is not None:
+                mask = mask[:window[3] - window[1], :window[2] - window[0]]
             mask_bytes = cv2.imencode('.png', mask.astype(np.uint8) * 255)[1].tobytes()
-            
+
             # Add segment information
-            segments.append({
-                'index': index,
+            segment = {
+                'index': first_index + i,
                 'score': float(score),
-                'mask': mask_bytes
-            })
-        
-        return labeled_image, segments
\ No newline at end of file
+                'mask': mask_bytes,
+                'logits_handle': self.logits_store.put(low_res_logits, window)
+            }
+
+            segment['mask_array'] = mask
+            segment['mask_offset'] = (window[0], window[1]) if window is not None else (0, 0)
+            if window is not None:
+                segment['mask_window'] = window
+
+            # Polygons may be traced from the logits, which cover the mask's full extent
+            segment['mask_logits'] = low_res_logits
+            segment['logits_frame'] = (*(window[:2] if window is not None else (0, 0)), mask.shape[1], mask.shape[0])
+
+            if return_low_res_logits:
+                segment['low_res_logits'] = low_res_logits
+
+            segments.append(segment)
+
+        return segments
+
+    @staticmethod
+    def _window_prompts(point_coords: Optional[NDArray[np.float32]],
+                        boxes: Optional[NDArray[np.float32]],
+                        window: Optional[Window]) -> Tuple[Optional[NDArray[np.float32]], Optional[NDArray[np.float32]]]:
+        """Translate batched point and box prompts from image coordinates into a window's coordinates."""
+        if window is None:
+            return point_coords, boxes
+
+        x0, y0 = window[0], window[1]
+        if point_coords is not None:
+            point_coords = point_coords - np.array([x0, y0], dtype=np.float32)
+        if boxes is not None:
+            boxes = boxes - np.array([x0, y0, x0, y0], dtype=np.float32)
+
+        return point_coords, boxes
+
+    @staticmethod
+    def _paste_window(array: NDArray, window: Optional[Window], width: int, height: int) -> NDArray:
+        """Place an array computed for a window into a zero filled array the size of the full image."""
+        if window is None:
+            return array
+
+        x0, y0, x1, y1 = window
+        full = np.zeros((height, width), dtype=array.dtype)
+        full[y0:y1, x0:x1] = array[:y1 - y0, :x1 - x0]
+        return full
+
+    def segment_prompt_groups(self,
+                              image_data: bytes,
+                              width: int,
+                              height: int,
+                              prompt_groups: List[Dict[str, Any]],
+                              multimask_output: bool = True,
+                              return_low_res_logits: bool = False,
+                              return_labeled_image: bool = True,
+                              image_key: Optional[str] = None,
+                              affinity_routed: bool = False,
+                              control: Optional[RequestControl] = None,
+                              roi_window: Optional[Window] = None) -> Tuple[Optional[np.ndarray], List[Dict[str, Any]]]:
+        """
+        Segment several independent objects on one image.
+
+        The image is encoded once and the prompt groups are run through the mask
+        decoder as batched tensors.  Groups with fewer points are padded with points
+        labelled -1, which SAM2's prompt encoder ignores.  Groups with and without a
+        box prompt are decoded as separate batches because SAM2 takes a box for
+        every entry of a batch or for none of them.
+
+        With a roi_window only that window of the image is encoded, which must
+        then hold the prompts of every group.
+
+        Args:
+            image_data: The grayscale image data as bytes, or a decoded uint8 array
+            width: The width of the image
+            height: The height of the image
+            prompt_groups: List of dictionaries with 'coordinates', 'labels' and an optional 'box'
+            multimask_output: Whether to output multiple masks per prompt group
+            return_low_res_logits: Whether to include the low resolution logits in each segment
+            return_labeled_image: Whether to compose the labeled image, if False None is returned in its place
+            image_key: Optional client supplied key of the image for the embedding cache, the content is hashed if omitted
+            affinity_routed: Whether the client routed the request here by image affinity, for the cache statistics
+            control: Optional deadline and cancellation state, checked before each stage
+            roi_window: Optional (x0, y0, x1, y1) window to segment in, see resolve_roi_window
+
+        Returns:
+            A tuple containing:
+            - labeled_image: A 2D uint16 array where each pixel value is the index of the highest scoring segment covering it
+            - segments: A list of dictionaries containing information about each segment, ordered
+              by prompt group.  Each dictionary has a 'prompt_group' entry.
+
+        Raises:
+            InvalidPromptError: If a prompt group has no prompts or mismatched coordinates and labels
+            RequestCancelled: If the request was cancelled or its deadline passed between stages
+        """
+        control = control or RequestControl()
+
+        group_results = self.predict_prompt_groups(
+            image_data, width, height, prompt_groups,
+            multimask_output=multimask_output,
+            image_key=image_key,
+            affinity_routed=affinity_routed,
+            control=control,
+            roi_window=roi_window)
+
+        return self.complete_prompt_groups(group_results, width, height,
+                                           return_low_res_logits=return_low_res_logits,
+                                           return_labeled_image=return_labeled_image,
+                                           control=control,
+                                           roi_window=roi_window)
+
+    def predict_prompt_groups(self,
+                              image_data: bytes,
+                              width: int,
+                              height: int,
+                              prompt_groups: List[Dict[str, Any]],
+                              multimask_output: bool = True,
+                              image_key: Optional[str] = None,
+                              affinity_routed: bool = False,
+                              control: Optional[RequestControl] = None,
+                              roi_window: Optional[Window] = None) -> List[Tuple[NDArray, NDArray, NDArray]]:
+        """
+        Run the encoder and decoder for several prompt groups, the first half of segment_prompt_groups.
+
+        See segment_prompt_groups for the arguments.
+
+        Returns:
+            A (masks, scores, logits) tuple per prompt group, as predict_masks returns for one prompt set
+            but not sorted by score
+
+        Raises:
+            InvalidPromptError: If a prompt group has no prompts or mismatched coordinates and labels
+            RequestCancelled: If the request was cancelled or its deadline passed between stages
+        """
+        control = control or RequestControl()
+
+        for group_index, group in enumerate(prompt_groups):
+            if len(group['coordinates']) == 0 and group.get('box') is None:
+                raise InvalidPromptError(f"Prompt group {group_index} has neither points nor a box")
+            if len(group['coordinates']) != len(group['labels']):
+                raise InvalidPromptError(f"Prompt group {group_index} has {len(group['coordinates'])} coordinates "
+                                 f"but {len(group['labels'])} labels")
+
+        # Batch the groups by whether they carry a box prompt
+        batches = [
+            [i for i, group in enumerate(prompt_groups) if group.get('box') is not None],
+            [i for i, group in enumerate(prompt_groups) if group.get('box') is None],
+        ]
+
+        group_results = {}
+        embedding = self._embed_image(image_data, image_key, affinity_routed, control, roi_window)
+
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+
+            control.check('mask decode')
+
+            num_points = max(len(prompt_groups[i]['coordinates']) for i in batch)
+            point_coords = None
+            point_labels = None
+            if num_points > 0:
+                point_coords = np.zeros((len(batch), num_points, 2), dtype=np.float32)
+                point_labels = np.full((len(batch), num_points), -1, dtype=np.int32)
+                for row, i in enumerate(batch):
+                    n = len(prompt_groups[i]['coordinates'])
+                    if n > 0:
+                        point_coords[row, :n] = prompt_groups[i]['coordinates']
+                        point_labels[row, :n] = prompt_groups[i]['labels']
+
+            box_np = None
+            if prompt_groups[batch[0]].get('box') is not None:
+                box_np = np.array([prompt_groups[i]['box'] for i in batch], dtype=np.float32)
+
+            point_coords, box_np = self._window_prompts(point_coords, box_np, roi_window)
+            masks, scores, logits = self.backend.decode(
+                embedding,
+                point_coords=point_coords,
+                point_labels=point_labels,
+                boxes=box_np,
+                mask_input=None,
+                multimask_output=multimask_output,
+            )
+
+            for row, i in enumerate(batch):
+                group_results[i] = (masks[row], scores[row], logits[row])
+
+        return [group_results[i] for i in range(len(prompt_groups))]
+
+    def complete_prompt_groups(self,
+                               group_results: List[Tuple[NDArray, NDArray, NDArray]],
+                               width: int,
+                               height: int,
+                               return_low_res_logits: bool = False,
+                               return_labeled_image: bool = True,
+                               control: Optional[RequestControl] = None,
+                               roi_window: Optional[Window] = None) -> Tuple[Optional[np.ndarray], List[Dict[str, Any]]]:
+        """
+        Compose the labeled image and encode the segments of predict_prompt_groups' result.
+
+        Args:
+            group_results: The results returned by predict_prompt_groups
+            width: The width of the image
+            height: The height of the image
+            return_low_res_logits: Whether to include the low resolution logits in each segment
+            return_labeled_image: Whether to compose the labeled image, if False None is returned in its place
+            control: Optional deadline and cancellation state, checked before each stage
+            roi_window: The window passed to predict_prompt_groups, if any
+
+        Returns:
+            A tuple of (labeled_image, segments) as returned by segment_prompt_groups
+        """
+        control = control or RequestControl()
+
+        labeled_image = None
+        if return_labeled_image:
+            # Segment indices are assigned group by group, in order of decreasing score within a group
+            control.check('labeled image')
+            orders = [np.argsort(scores)[::-1] for _, scores, _ in group_results]
+            all_masks = [group_results[i][0][j] for i, order in enumerate(orders) for j in order]
+            all_scores = np.concatenate([group_results[i][1][order] for i, order in enumerate(orders)])
+            labeled_image = self.compose_labeled_image(all_masks, np.arange(1, len(all_scores) + 1), all_scores)
+            labeled_image = self._paste_window(labeled_image, roi_window, width, height)
+
+        control.check('mask encode')
+        segments = []
+        for group_index, (masks, scores, logits) in enumerate(group_results):
+            group_segments = self._build_segments(masks, scores, logits,
+                                                  first_index=len(segments) + 1,
+                                                  return_low_res_logits=return_low_res_logits,
+                                                  window=roi_window,
+                                                  image_size=(width, height))
+            for segment in group_segments:
+                segment['prompt_group'] = group_index
+            segments.extend(group_segments)
+
+        return labeled_image, segments
+
+    def prepare_stack(self,
+                      sections: List[bytes],
+                      frame_dir: Optional[str] = None,
+                      control: Optional[RequestControl] = None) -> PreparedStack:
+        """
+        Decode the sections of a stack and write them as video frames, on a thread other than the inference thread.
+
+        Args:
+            sections: The encoded image of each section, ordered by section number
+            frame_dir: Empty directory to write the frames to, by default a new temporary directory
+            control: Optional deadline and cancellation state, checked before each section
+
+        Returns:
+            The prepared stack, the caller deletes its frames with cleanup() once propagation finished
+        """
+        control = control or RequestControl()
+        frame_dir = frame_dir if frame_dir is not None else tempfile.mkdtemp(prefix='sections_')
+        try:
+            for i, image_data in enumerate(sections):
+                control.check('image decode')
+                Image.fromarray(self.decode_image(image_data)).save(os.path.join(frame_dir, f'{i:05d}.jpg'), quality=95)
+        except BaseException:
+            shutil.rmtree(frame_dir, ignore_errors=True)
+            raise
+
+        return PreparedStack(frame_dir, len(sections))
+
+    def propagate_stack(self,
+                        sections: Union[List[bytes], PreparedStack],
+                        prompt_section_index: int,
+                        coordinates: List[Tuple[int, int]],
+                        labels: List[int],
+                        box: Optional[Tuple[int, int, int, int]] = None,
+                        forward: bool = True,
+                        backward: bool = True,
+                        max_sections: int = 0,
+                        control: Optional[RequestControl] = None) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+        """
+        Propagate an object prompted on one section through a stack of serial sections.
+
+        The sections are treated as the frames of a video so SAM2's memory attention
+        carries the object from one section to the next.  Results are yielded as soon
+        as each section is processed, starting with the prompted section.  The backend's
+        inference context is only held while a step runs, so each step of the
+        iterator can be scheduled as a separate unit of inference work.
+
+        Args:
+            sections: The encoded image of each section, ordered by section number, or the
+                      stack returned by prepare_stack.  A prepared stack is left to the caller
+                      to clean up.
+            prompt_section_index: Index into sections of the section the prompts refer to
+            coordinates: List of (x, y) coordinates to use as prompts
+            labels: List of labels for each coordinate (1 for foreground, 0 for background)
+            box: Optional (x0, y0, x1, y1) box prompt
+            forward: Whether to propagate towards higher section indices
+            backward: Whether to propagate towards lower section indices
+            max_sections: Maximum number of sections to propagate in each direction, 0 for no limit
+            control: Optional deadline and cancellation state, checked before each section
+
+        Yields:
+            Tuples of (section_index, segments) where segments is a list of dictionaries
+            containing information about the object on that section
+
+        Raises:
+            NotImplementedError: If the backend cannot propagate through stacks
+            RequestCancelled: If the request was cancelled or its deadline passed between sections
+        """
+        num_sections = sections.num_sections if isinstance(sections, PreparedStack) else len(sections)
+        if not 0 <= prompt_section_index < num_sections:
+            raise InvalidPromptError(f"prompt_section_index {prompt_section_index} is outside the {num_sections} sections")
+
+        control = control or RequestControl()
+        predictor = self.video_predictor
+        max_frames = max_sections if max_sections > 0 else None
+
+        # SAM2 loads video frames from a directory of JPEG files
+        prepared = sections if isinstance(sections, PreparedStack) else self.prepare_stack(sections, control=control)
+        try:
+            control.check('image encode')
+            with self.backend.inference_context():
+                state = predictor.init_state(video_path=prepared.frame_dir, offload_video_to_cpu=True)
+
+            try:
+                control.check('mask decode')
+                with self.backend.inference_context():
+                    _, _, prompt_logits = predictor.add_new_points_or_box(
+                        inference_state=state,
+                        frame_idx=prompt_section_index,
+                        obj_id=1,
+                        points=np.array(coordinates, dtype=np.float32) if len(coordinates) > 0 else None,
+                        labels=np.array(labels, dtype=np.int32) if len(coordinates) > 0 else None,
+                        box=np.array(box, dtype=np.float32) if box is not None else None,
+                    )
+                yield prompt_section_index, self._object_segments(prompt_logits)
+
+                directions = ([False] if forward else []) + ([True] if backward else [])
+                for reverse in directions:
+                    frames = predictor.propagate_in_video(
+                        state,
+                        start_frame_idx=prompt_section_index,
+                        max_frame_num_to_track=max_frames,
+                        reverse=reverse)
+
+                    while True:
+                        control.check('section propagation')
+                        with self.backend.inference_context():
+                            frame = next(frames, None)
+
+                        if frame is None:
+                            break
+
+                        # The prompted section was already returned
+                        frame_idx, _, frame_logits = frame
+                        if frame_idx == prompt_section_index:
+                            continue
+
+                        yield frame_idx, self._object_segments(frame_logits)
+            finally:
+                predictor.reset_state(state)
+        finally:
+            if prepared is not sections:
+                prepared.cleanup()
+
+    @staticmethod
+    def _object_segments(object_logits) -> List[Dict[str, Any]]:
+        """Convert the mask logits of the tracked object on one frame into segment dictionaries."""
+        logits = object_logits[0, 0].float().cpu().numpy()
+        mask = logits > 0.0
+        if not mask.any():
+            return []
+
+        # The video predictor reports no IoU estimate, use the mean foreground probability instead
+        score = float(np.mean(1.0 / (1.0 + np.exp(-logits[mask]))))
+        mask_bytes = cv2.imencode('.png', mask.astype(np.uint8) * 255)[1].tobytes()
+
+        return [{
+            'index': 1,
+            'score': score,
+            'mask': mask_bytes
+        }]
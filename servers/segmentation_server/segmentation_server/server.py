@@ -7,26 +7,65 @@ to the SegmentationModel implementation.
 """
 
 import asyncio
+import contextlib
+import os
+import shutil
+import stat
+import tempfile
+import time
 import grpc
 import numpy as np
 import cv2
 import io
 from concurrent import futures
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 # Import the generated gRPC code from the segmentation_grpc package
 from segmentation_grpc import (
     SegmentationRequest,
     SegmentationResponse,
-    Point,
-    Polygon,
+    SegmentationUpdate,
+    SegmentationStage,
     SegmentResult,
     SegmentationServiceServicer,
-    add_SegmentationServiceServicer_to_server
+    add_SegmentationServiceServicer_to_server,
+    SectionSegmentation,
+    PropagationDirection,
+    LoadReport,
+    StageLoad,
+    ClientLoad,
+    PrefetchResponse,
+    PrefetchStatus,
+    ImageEmbedding,
+    Box,
+    ContourMode
 )
+from segmentation_grpc import metadata
+from segmentation_grpc import LabeledImageFormat, LabeledImageType
+from segmentation_grpc.codecs import (encode_mask_logits, decode_mask_logits, encode_raw_labeled_image,
+                                     encode_packed_polygons, encode_polygons, encode_embedding_tensor)
+from segmentation_grpc.shared_memory import attach_shared_array
+from segmentation_grpc.tracing import Tracer
 
 # Import the segmentation model
-from segmentation_server.segmentation_service import SegmentationModel
+from segmentation_server.segmentation_service import (SegmentationModel, UnknownHandleError, UnknownImageError,
+                                                      InvalidPromptError, PolygonOptions, DEFAULT_ROI_PADDING,
+                                                      DEFAULT_ROI_MIN_SIZE, DEFAULT_SIMPLIFY_TOLERANCE)
+from segmentation_server.scheduling import (InferenceScheduler, RequestControl, Priority, SupersedeKeys, QueueFull,
+                                            RequestCancelled, DeadlineExceeded, StageStats, client_from_metadata)
+from segmentation_server.client_limits import ClientLimits, ClientLimitExceeded
+from segmentation_server.metrics import LoadTracker
+from segmentation_server.capture import TrafficCapture
+
+# Jobs each client queues per priority class for preprocessing before its requests are
+# rejected with RESOURCE_EXHAUSTED
+DEFAULT_MAX_QUEUE_DEPTH = 32
+
+# A prefetch is dropped if more jobs than this are queued when it arrives
+PREFETCH_MAX_QUEUE_DEPTH = 2
+
+# A queued prefetch that has not started within this many seconds is dropped, the client has likely moved on
+PREFETCH_TIMEOUT = 5.0
 
 
 class SegmentationServicer(SegmentationServiceServicer):
@@ -37,18 +76,387 @@ class SegmentationServicer(SegmentationServiceServicer):
     the gRPC message format and the format expected by the SegmentationModel.
     """
 
-    def __init__(self):
-        """Initialize the servicer with a SegmentationModel."""
-        self.model = SegmentationModel()
+    def __init__(self,
+                 capture: Optional[TrafficCapture] = None,
+                 backend: str = 'torch',
+                 backend_options: Optional[dict] = None,
+                 preprocess_workers: int = 2,
+                 postprocess_workers: int = 2,
+                 polygon_workers: int = 4,
+                 client_limits: Optional[ClientLimits] = None,
+                 tracer: Optional[Tracer] = None,
+                 max_queue_depth: int = DEFAULT_MAX_QUEUE_DEPTH):
+        """
+        Initialize the servicer with a SegmentationModel.
+
+        Args:
+            capture: Optional TrafficCapture recording every SegmentImage request for later replay
+            backend: Name of the inference backend running the model, see segmentation_server.backends
+            backend_options: Arguments used to create the backend
+            preprocess_workers: Threads hashing and decoding images ahead of inference
+            postprocess_workers: Threads encoding masks and building responses
+            polygon_workers: Threads tracing the polygons of a response's segments in parallel
+            client_limits: Fair share weights and limits of the clients, by default every client
+                           has the same weight and no limits
+            tracer: Records the spans of traced requests, by default tracing is off
+            max_queue_depth: Jobs each client queues per priority class for preprocessing before
+                             its requests are rejected with RESOURCE_EXHAUSTED, 0 for no bound.
+                             Requests are only rejected on admission, the later stages never
+                             drop work a request was admitted with.
+        """
+        self.model = SegmentationModel(backend=backend, backend_options=backend_options)
+        self.capture = capture
+        self.clients = client_limits if client_limits is not None else ClientLimits()
+        self.tracer = tracer if tracer is not None else Tracer()
+
+        # All model calls go through the scheduler, which serializes them in priority order
+        # and shares the model between the clients with queued work by their weights
+        self.scheduler = InferenceScheduler(client_weight=self.clients.weight, tracer=self.tracer)
+
+        # The CPU work before and after inference runs on pools of its own so it overlaps inference.
+        # Every request starts with preprocessing, so only its queue is bounded.
+        self.preprocess = InferenceScheduler(num_workers=preprocess_workers, name='preprocess',
+                                             client_weight=self.clients.weight, tracer=self.tracer,
+                                             max_queue_depth=max_queue_depth)
+        self.postprocess = InferenceScheduler(num_workers=postprocess_workers, name='postprocess',
+                                              client_weight=self.clients.weight, tracer=self.tracer)
+
+        # Post-processing jobs fan the segments of a response out to a separate pool, waiting
+        # on their own pool could deadlock once every post-processing worker is waiting
+        self.polygon_pool = futures.ThreadPoolExecutor(max_workers=polygon_workers, thread_name_prefix='polygons')
+
+        # Requests in flight and recent latencies, reported by GetLoad
+        self.load = LoadTracker()
+
+        # The latest request of each client's supersede keys, a newer request cancels the older one
+        self.supersede_keys = SupersedeKeys()
+
+    @staticmethod
+    def _segment_result(segment, packed_polygons: bool = False, polygons=None) -> SegmentResult:
+        """
+        Convert a segment dictionary produced by the SegmentationModel into a SegmentResult message.
+
+        Args:
+            segment: A dictionary containing information about the segment
+            packed_polygons: Whether to return the polygons in packed_polygons instead of polygons
+            polygons: The segment's polygons, traced by SegmentationModel.segment_polygons, None to omit them
+
+        Returns:
+            A SegmentResult message
+        """
+        # Create the segment result
+        segment_result = SegmentResult(
+            index=segment['index'],
+            score=segment['score'],
+            mask=segment['mask'],
+            logits_handle=segment.get('logits_handle', ''),
+            prompt_group=segment.get('prompt_group', 0)
+        )
+
+        if 'mask_window' in segment:
+            x0, y0, x1, y1 = segment['mask_window']
+            segment_result.mask_window.CopyFrom(Box(x0=x0, y0=y0, x1=x1, y1=y1))
+
+        if 'low_res_logits' in segment:
+            segment_result.low_res_logits.CopyFrom(encode_mask_logits(segment['low_res_logits']))
+
+        # Add polygons to the segment result
+        if polygons is not None:
+            SegmentationServicer._set_polygons(segment_result, polygons, packed_polygons)
+
+        return segment_result
+
+    def _segment_results(self,
+                         segments,
+                         options: PolygonOptions = PolygonOptions(),
+                         packed_polygons: bool = False,
+                         control: Optional[RequestControl] = None,
+                         include_polygons=lambda segment: True) -> List[SegmentResult]:
+        """
+        Convert segment dictionaries into SegmentResult messages, tracing their polygons in parallel.
+
+        Args:
+            segments: Segment dictionaries produced by the SegmentationModel
+            options: How to trace and simplify the polygons
+            packed_polygons: Whether to return the polygons in packed_polygons instead of polygons
+            control: Optional deadline and cancellation of the request, checked before each segment is traced
+            include_polygons: Function returning whether to trace the polygons of a segment
+
+        Returns:
+            A SegmentResult message per segment, in the order of segments
+        """
+        def trace(segment):
+            if not include_polygons(segment):
+                return None
+            if control is not None:
+                control.check('polygon extraction')
+            return self.model.segment_polygons(segment, options)
+
+        # A single segment is traced on the calling thread, the hand-off would cost more than it saves
+        if len(segments) > 1:
+            polygons = list(self.polygon_pool.map(trace, segments))
+        else:
+            polygons = [trace(segment) for segment in segments]
+
+        return [self._segment_result(segment, packed_polygons, segment_polygons)
+                for segment, segment_polygons in zip(segments, polygons)]
+
+    @staticmethod
+    def _set_polygons(segment_result: SegmentResult, polygons, packed_polygons: bool):
+        """Store polygons of (N, 2) vertex arrays in a SegmentResult, packed or as Polygon messages."""
+        if packed_polygons:
+            segment_result.packed_polygons.CopyFrom(encode_packed_polygons(polygons))
+        else:
+            segment_result.polygons.extend(encode_polygons(polygons))
+
+    @staticmethod
+    def _polygon_options(request) -> PolygonOptions:
+        """
+        Read how to trace polygons from a SegmentationRequest.
+
+        Raises:
+            InvalidPromptError: If the simplification tolerance is negative
+        """
+        tolerance = request.simplify_tolerance if request.HasField('simplify_tolerance') else DEFAULT_SIMPLIFY_TOLERANCE
+        if not tolerance >= 0:
+            raise InvalidPromptError(f"simplify_tolerance must not be negative, got {tolerance}")
+
+        return PolygonOptions(max_vertices=request.max_polygon_vertices,
+                              from_logits=request.polygons_from_logits,
+                              holes=request.contour_mode == ContourMode.CONTOURS_WITH_HOLES,
+                              tolerance=tolerance)
+
+    def _roi_window(self, request, width: int, height: int, coordinates, box, prompt_groups, mask_input_handle):
+        """
+        Resolve the window a SegmentationRequest is encoded in, None for the whole image.
+
+        A refinement reuses the window of the logits it refines.
+
+        Raises:
+            InvalidPromptError: If the requested window does not overlap the image
+            UnknownHandleError: If mask_input_handle is not held by the logits store
+        """
+        if not request.HasField('roi') and not mask_input_handle:
+            return None
+
+        roi = request.roi
+        all_groups = prompt_groups or [{'coordinates': coordinates, 'box': box}]
+        return self.model.resolve_roi_window(
+            width=width,
+            height=height,
+            points=[point for group in all_groups for point in group['coordinates']],
+            boxes=[group['box'] for group in all_groups if group['box'] is not None],
+            window=(roi.window.x0, roi.window.y0, roi.window.x1, roi.window.y1) if roi.HasField('window') else None,
+            auto=request.HasField('roi'),
+            padding=roi.padding if roi.HasField('padding') else DEFAULT_ROI_PADDING,
+            min_size=roi.min_size or DEFAULT_ROI_MIN_SIZE,
+            mask_input_handle=mask_input_handle)
+
+    @staticmethod
+    def _encode_labeled_image(labeled_image, request) -> Tuple[bytes, int]:
+        """
+        Encode the labeled image using the format, pixel type and compression requested.
+
+        Args:
+            labeled_image: A 2D uint16 array of segment indices, or None if it was not composed
+            request: The SegmentationRequest message
+
+        Returns:
+            A tuple of (encoded_bytes, labeled_image_type) where the type may be widened to
+            LABELED_IMAGE_UINT16 if the requested 8-bit type cannot hold every segment index
+        """
+        image_type = request.labeled_image_type
+        if labeled_image is None or request.labeled_image_format == LabeledImageFormat.LABELED_IMAGE_NONE:
+            return b'', image_type
+
+        if image_type == LabeledImageType.LABELED_IMAGE_UINT8 and labeled_image.max(initial=0) > 255:
+            image_type = LabeledImageType.LABELED_IMAGE_UINT16
+
+        if request.labeled_image_format == LabeledImageFormat.LABELED_IMAGE_RAW:
+            return encode_raw_labeled_image(labeled_image, image_type), image_type
+
+        pixels = labeled_image.astype(np.uint8) if image_type == LabeledImageType.LABELED_IMAGE_UINT8 else labeled_image
+        params = []
+        if request.HasField('png_compression_level'):
+            params = [cv2.IMWRITE_PNG_COMPRESSION, min(max(request.png_compression_level, 0), 9)]
+
+        return cv2.imencode('.png', pixels, params)[1].tobytes(), image_type
+
+    @staticmethod
+    def _write_shared_labeled_image(labeled_image, message) -> int:
+        """
+        Write the labeled image into a shared memory segment provided by the client.
+
+        Args:
+            labeled_image: A 2D uint16 array of segment indices, or None if no segments were found
+            message: The SharedMemoryArray describing the client's segment
+
+        Returns:
+            The LabeledImageType matching the dtype of the segment
+
+        Raises:
+            FileNotFoundError: If the segment does not exist
+            ValueError: If the segment does not match the labeled image
+        """
+        with attach_shared_array(message) as pixels:
+            if pixels.shape != (message.height, message.width) or pixels.dtype.itemsize not in (1, 2):
+                raise ValueError(f"shared_labeled_image must be a single channel uint8 or uint16 array")
+
+            if labeled_image is None:
+                pixels[...] = 0
+            elif labeled_image.shape != pixels.shape:
+                raise ValueError(f"shared_labeled_image is {pixels.shape[1]}x{pixels.shape[0]}, "
+                                 f"the labeled image is {labeled_image.shape[1]}x{labeled_image.shape[0]}")
+            elif labeled_image.max(initial=0) > np.iinfo(pixels.dtype).max:
+                raise ValueError(f"The labeled image has {labeled_image.max()} segments, "
+                                 f"too many for a {pixels.dtype} shared_labeled_image")
+            else:
+                pixels[...] = labeled_image
+
+            is_uint8 = pixels.dtype.itemsize == 1
+            del pixels
+
+        return LabeledImageType.LABELED_IMAGE_UINT8 if is_uint8 else LabeledImageType.LABELED_IMAGE_UINT16
+
+    def _build_response(self, labeled_image, segments, request, width: int, height: int, roi_window,
+                        polygon_options: PolygonOptions, control: RequestControl) -> SegmentationResponse:
+        """
+        Encode the labeled image and segments of a request into a SegmentationResponse, on the post-processing pool.
+
+        Raises:
+            InvalidPromptError: If the labeled image cannot be written to the client's shared memory
+        """
+        # Convert the labeled image to bytes in the format the client asked for
+        labeled_image_format = request.labeled_image_format
+        if request.HasField('shared_labeled_image'):
+            try:
+                labeled_image_type = self._write_shared_labeled_image(labeled_image, request.shared_labeled_image)
+            except (FileNotFoundError, ValueError) as e:
+                raise InvalidPromptError(f"Cannot write shared_labeled_image: {e}") from e
+            labeled_image_bytes = b''
+            labeled_image_format = LabeledImageFormat.LABELED_IMAGE_SHARED_MEMORY
+        else:
+            labeled_image_bytes, labeled_image_type = self._encode_labeled_image(labeled_image, request)
+
+        # Create the response
+        response = SegmentationResponse(
+            labeled_image=labeled_image_bytes,
+            width=width,
+            height=height,
+            labeled_image_format=labeled_image_format,
+            labeled_image_type=labeled_image_type
+        )
+        if roi_window is not None:
+            response.roi_window.CopyFrom(Box(x0=roi_window[0], y0=roi_window[1], x1=roi_window[2], y1=roi_window[3]))
+
+        # Add segment results to the response
+        control.check('polygon extraction')
+        response.segments.extend(self._segment_results(segments, polygon_options, request.packed_polygons, control))
+
+        return response
+
+    @contextlib.asynccontextmanager
+    async def _admit(self, context):
+        """
+        Count a request against its client's limits for the duration of an async with block.
+
+        A client over its concurrency or rate limit is rejected with
+        RESOURCE_EXHAUSTED before any work is queued, the seconds after which a
+        retry would probably be admitted are attached as trailing metadata.
+
+        Args:
+            context: The gRPC context of the request
+        """
+        client = client_from_metadata(context.invocation_metadata(), context.peer())
+        try:
+            self.clients.acquire(client)
+        except ClientLimitExceeded as e:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e),
+                                trailing_metadata=((metadata.RETRY_AFTER, f'{e.retry_after:.3f}'),))
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.clients.release(client, time.monotonic() - start)
+
+    @staticmethod
+    async def _reject_queue_full(context, error: QueueFull):
+        """Abort a request a stage had no room for, telling the client when to retry."""
+        await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(error),
+                            trailing_metadata=((metadata.RETRY_AFTER, f'{error.retry_after:.3f}'),))
 
     async def SegmentImage(self, request, context):
         """
         Implement the SegmentImage RPC method.
 
+        The server's load is attached to the response as trailing metadata so
+        clients balancing across replicas learn it without polling.
+
+        Requests over their client's limits are rejected with RESOURCE_EXHAUSTED,
+        see _admit.
+
+        When the client traces the request the server records its time in each
+        stage under the client's span, and reports the time it spent on the
+        request so the client can tell the network's share.
+
         Args:
             request: The SegmentationRequest message
             context: The gRPC context
 
+        Returns:
+            A SegmentationResponse message
+        """
+        start = time.monotonic()
+        response = None
+        trace = self.tracer.continue_trace(context.invocation_metadata())
+        span = trace.child() if trace is not None else None
+        async with self._admit(context):
+            with self.load.track():
+                try:
+                    response = await self._segment_image(request, context, span)
+                    return response
+                finally:
+                    end = time.monotonic()
+                    trailing_metadata = [
+                        (metadata.QUEUE_DEPTH, str(self.scheduler.queue_depth)),
+                        (metadata.IN_FLIGHT, str(self.load.in_flight - 1)),
+                    ]
+                    if span is not None:
+                        trailing_metadata.append((metadata.SERVER_SECONDS, f'{end - start:.6f}'))
+
+                        # gRPC serialises the response after the handler returns, its size shows what that costs
+                        args = {'response_bytes': response.ByteSize()} if response is not None else {}
+                        self.tracer.record('SegmentImage', trace, start, end, span, **args)
+                    context.set_trailing_metadata(tuple(trailing_metadata))
+                    if self.capture is not None:
+                        self._capture_request(request, response, context, start)
+
+    def _capture_request(self, request, response, context, start: float):
+        """Record a completed or failed SegmentImage request in the traffic capture."""
+        if response is not None:
+            status = grpc.StatusCode.OK
+        else:
+            status = context.code() or grpc.StatusCode.UNKNOWN
+
+        priority = Priority.from_metadata(context.invocation_metadata(), Priority.INTERACTIVE)
+        self.capture.record('SegmentImage', request, response, start, time.monotonic() - start,
+                            status.name, priority.name.lower())
+
+    @staticmethod
+    def _supersede_key(request, control: RequestControl):
+        """Return the key a request supersedes others of the same client by, or None if it has none."""
+        return (control.client, request.supersede_key) if request.supersede_key else None
+
+    async def _segment_image(self, request, context, trace=None):
+        """
+        Segment an image for the SegmentImage RPC method.
+
+        Args:
+            request: The SegmentationRequest message
+            context: The gRPC context
+            trace: Context of the span the request's stages are recorded under, or None if it is not traced
+
         Returns:
             A SegmentationResponse message
         """
@@ -66,75 +474,643 @@ class SegmentationServicer(SegmentationServiceServicer):
         # Extract multimask_output flag
         multimask_output = request.multimask_output
 
+        # Extract the optional box prompt
+        box = None
+        if request.HasField('box'):
+            box = (request.box.x0, request.box.y0, request.box.x1, request.box.y1)
+
+        # Extract the optional mask input from a previous response
+        mask_input_handle = request.mask_input_handle or None
+        mask_input = None
+        if request.HasField('mask_input') and mask_input_handle is None:
+            try:
+                mask_input = decode_mask_logits(request.mask_input)
+            except ValueError as e:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        # Co-located clients may pass the pixels in shared memory, which is mapped without copying
+        shared_memory = contextlib.ExitStack()
+        if request.HasField('shared_image'):
+            try:
+                image_data = shared_memory.enter_context(attach_shared_array(request.shared_image))
+            except (FileNotFoundError, ValueError) as e:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Cannot map shared_image: {e}")
+            height, width = image_data.shape[:2]
+
+        return_labeled_image = (request.HasField('shared_labeled_image') or
+                                request.labeled_image_format != LabeledImageFormat.LABELED_IMAGE_NONE)
+
+        # Deadline, cancellation and priority of this request
+        control = RequestControl.from_context(context, trace)
+        priority = Priority.from_metadata(context.invocation_metadata(), Priority.INTERACTIVE)
+        affinity_routed = any(key == metadata.AFFINITY and value == '1'
+                              for key, value in context.invocation_metadata() or ())
+
+        # Cancel the client's older request on the same object, only the newest result will be shown
+        supersede_key = self._supersede_key(request, control)
+        self.supersede_keys.register(supersede_key, control)
+
         try:
-            # Run the prediction in a separate thread to avoid blocking the event loop
-            loop = asyncio.get_event_loop()
-
-            labeled_image, segments = await loop.run_in_executor(None, lambda: self.model.segment_image(
-                    image_data=image_data,
-                    width=width,
-                    height=height,
-                    coordinates=coordinates,
-                    labels=labels,
-                    multimask_output=multimask_output
-                )
-           )
-
-            # Convert the labeled image to bytes
-            labeled_image_bytes = cv2.imencode('.png', labeled_image)[1].tobytes()
-
-            # Create the response
-            response = SegmentationResponse(
-                labeled_image=labeled_image_bytes,
-                width=width,
-                height=height
-            )
-
-            # Add segment results to the response
-            for i, segment in enumerate(segments):
-                # Create the segment result
-                segment_result = SegmentResult(
-                    index=segment['index'],
-                    score=segment['score'],
-                    mask=segment['mask']
-                )
+            prompt_groups = [{
+                'coordinates': [(point.x, point.y) for point in group.coordinates],
+                'labels': list(group.labels),
+                'box': (group.box.x0, group.box.y0, group.box.x1, group.box.y1) if group.HasField('box') else None
+            } for group in request.prompt_groups]
 
-                # Extract polygons from the mask
-                if 'mask' in segment:
-                    # Decode the mask from bytes to numpy array
-                    mask_np = cv2.imdecode(np.frombuffer(segment['mask'], np.uint8), cv2.IMREAD_GRAYSCALE)
-                    mask_bool = mask_np > 0
+            # Choose the window to encode, a refinement reuses the window of the logits it refines
+            roi_window = self._roi_window(request, width, height, coordinates, box, prompt_groups, mask_input_handle)
+            polygon_options = self._polygon_options(request)
 
-                    # Extract polygons from the mask
-                    polygons = self.model.mask_to_polygons(mask_bool)
+            # Each stage runs on its own pool, so the model works on one request while
+            # the next request's image is decoded and the previous one's masks are encoded
+            prepared = await self.preprocess.submit(lambda: self.model.prepare_image(
+                image_data, request.image_key or None, roi_window, control), control, priority)
 
-                    # Add polygons to the segment result
-                    for polygon in polygons:
-                        poly = Polygon()
-                        for point in polygon:
-                            poly.points.append(Point(x=int(point[0]), y=int(point[1])))
-                        segment_result.polygons.append(poly)
+            if len(prompt_groups) > 0:
+                # Segment each prompt group as an independent object on the same image encoding
+                group_results = await self.scheduler.submit(lambda: self.model.predict_prompt_groups(
+                        image_data=prepared,
+                        width=width,
+                        height=height,
+                        prompt_groups=prompt_groups,
+                        multimask_output=multimask_output,
+                        affinity_routed=affinity_routed,
+                        control=control,
+                        roi_window=roi_window
+                    ), control, priority
+                )
+                complete = lambda: self.model.complete_prompt_groups(
+                    group_results, width, height,
+                    return_low_res_logits=request.return_low_res_logits,
+                    return_labeled_image=return_labeled_image,
+                    control=control,
+                    roi_window=roi_window)
+            else:
+                masks, scores, logits = await self.scheduler.submit(lambda: self.model.predict_masks(
+                        image_data=prepared,
+                        width=width,
+                        height=height,
+                        coordinates=coordinates,
+                        labels=labels,
+                        multimask_output=multimask_output,
+                        box=box,
+                        mask_input_handle=mask_input_handle,
+                        mask_input=mask_input,
+                        affinity_routed=affinity_routed,
+                        control=control,
+                        roi_window=roi_window
+                    ), control, priority
+                )
+                complete = lambda: self.model.complete_segments(
+                    masks, scores, logits, width, height,
+                    return_low_res_logits=request.return_low_res_logits,
+                    return_labeled_image=return_labeled_image,
+                    control=control,
+                    roi_window=roi_window)
 
-                response.segments.append(segment_result)
+            response = await self.postprocess.submit(
+                lambda: self._build_response(*complete(), request, width, height, roi_window, polygon_options, control),
+                control, priority)
 
             return response
 
+        except grpc.aio.AbortError:
+            raise
+        except DeadlineExceeded as e:
+            await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, str(e))
+        except RequestCancelled as e:
+            await context.abort(grpc.StatusCode.CANCELLED, str(e))
+        except QueueFull as e:
+            await self._reject_queue_full(context, e)
+        except UnknownHandleError as e:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"Unknown mask_input_handle {e}, resend the logits in mask_input")
+        except UnknownImageError:
+            await context.abort(grpc.StatusCode.NOT_FOUND,
+                                f"The server no longer holds image {request.image_key!r}, send the image data")
+        except InvalidPromptError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
         except Exception as e:
             # Log the error and return an error status
             import traceback
             stack_trace = traceback.format_exc()
             print(f"Error processing request: {e}\n{stack_trace}")
             await context.abort(grpc.StatusCode.INTERNAL, f"Error processing request: {e}")
+        finally:
+            self.supersede_keys.release(supersede_key, control)
 
+            # Drop the view of the shared image so its segment can be unmapped
+            image_data = None
+            shared_memory.close()
 
-async def serve(port=50051, max_workers=10):
+    async def SegmentImageProgressive(self, request, context):
+        """
+        Implement the SegmentImageProgressive RPC method.
+
+        The prompts are decoded once.  The best mask's outline is traced from its
+        256x256 logits by the inference job itself and sent straight away, which
+        takes a fraction of the time needed to upscale, contour and encode every
+        candidate.  Its full resolution polygons follow, then everything else
+        SegmentImage returns.
+
+        Args:
+            request: The SegmentationRequest message
+            context: The gRPC context
+
+        Yields:
+            A SegmentationUpdate message per stage
+        """
+        if len(request.prompt_groups) > 0:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "SegmentImageProgressive does not support prompt_groups")
+        if request.HasField('shared_image') or request.HasField('shared_labeled_image'):
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "SegmentImageProgressive does not support shared memory")
+
+        width = request.width
+        height = request.height
+        coordinates = [(point.x, point.y) for point in request.coordinates]
+        labels = list(request.labels)
+
+        box = None
+        if request.HasField('box'):
+            box = (request.box.x0, request.box.y0, request.box.x1, request.box.y1)
+
+        mask_input_handle = request.mask_input_handle or None
+        mask_input = None
+        if request.HasField('mask_input') and mask_input_handle is None:
+            try:
+                mask_input = decode_mask_logits(request.mask_input)
+            except ValueError as e:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        control = RequestControl.from_context(context, self.tracer.continue_trace(context.invocation_metadata()))
+        priority = Priority.from_metadata(context.invocation_metadata(), Priority.INTERACTIVE)
+        affinity_routed = any(key == metadata.AFFINITY and value == '1'
+                              for key, value in context.invocation_metadata() or ())
+
+        async with self._admit(context):
+            with self.load.track():
+                supersede_key = self._supersede_key(request, control)
+                self.supersede_keys.register(supersede_key, control)
+                try:
+                    roi_window = self._roi_window(request, width, height, coordinates, box, [], mask_input_handle)
+                    polygon_options = self._polygon_options(request)
+                    prepared = await self.preprocess.submit(lambda: self.model.prepare_image(
+                        request.image_data, request.image_key or None, roi_window, control), control, priority)
+                    def predict_and_outline():
+                        masks, scores, logits = self.model.predict_masks(
+                            image_data=prepared,
+                            width=width,
+                            height=height,
+                            coordinates=coordinates,
+                            labels=labels,
+                            multimask_output=request.multimask_output,
+                            box=box,
+                            mask_input_handle=mask_input_handle,
+                            mask_input=mask_input,
+                            affinity_routed=affinity_routed,
+                            control=control,
+                            roi_window=roi_window)
+
+                        # The preview outline costs about a millisecond at any image size.  Tracing it
+                        # here keeps it from queueing behind other requests' polygons on the postprocess pool.
+                        mask_height, mask_width = masks.shape[-2:]
+                        coarse = self.model.logits_to_polygons(logits[0], mask_width, mask_height,
+                                                               polygon_options.max_vertices, polygon_options.holes,
+                                                               polygon_options.tolerance)
+                        return masks, scores, logits, coarse
+
+                    masks, scores, logits, coarse = await self.scheduler.submit(predict_and_outline, control, priority)
+
+                    def update(stage):
+                        message = SegmentationUpdate(stage=stage, width=width, height=height)
+                        if roi_window is not None:
+                            message.roi_window.CopyFrom(Box(x0=roi_window[0], y0=roi_window[1],
+                                                            x1=roi_window[2], y1=roi_window[3]))
+                        return message
+
+                    # Polygons are traced in the window and shifted into the image
+                    x0, y0 = roi_window[:2] if roi_window is not None else (0, 0)
+
+                    # Stage 1: the outline of the best mask from its low resolution logits
+                    preview = update(SegmentationStage.STAGE_PREVIEW)
+                    best = preview.segments.add(index=1, score=float(scores[0]))
+                    self._set_polygons(best, [polygon + (x0, y0) for polygon in coarse], request.packed_polygons)
+                    yield preview
+
+                    # Stage 2: the best mask's polygons at full resolution
+                    control.check('polygon extraction')
+                    refined = update(SegmentationStage.STAGE_POLYGONS)
+                    polygons = await self.postprocess.submit(
+                        lambda: self.model.mask_to_polygons(masks[0], polygon_options.max_vertices,
+                                                            polygon_options.holes, polygon_options.tolerance),
+                        control, priority)
+                    self._set_polygons(refined.segments.add(index=1),
+                                       [polygon + (x0, y0) for polygon in polygons], request.packed_polygons)
+                    yield refined
+
+                    # Stage 3: masks, logits handles, the remaining candidates and the labeled image
+                    return_labeled_image = request.labeled_image_format != LabeledImageFormat.LABELED_IMAGE_NONE
+
+                    def complete_and_encode():
+                        labeled_image, segments = self.model.complete_segments(
+                            masks, scores, logits, width, height,
+                            return_low_res_logits=request.return_low_res_logits,
+                            return_labeled_image=return_labeled_image,
+                            control=control,
+                            roi_window=roi_window)
+                        return self._encode_labeled_image(labeled_image, request), segments
+
+                    (labeled_image, labeled_image_type), segments = await self.postprocess.submit(
+                        complete_and_encode, control, priority)
+
+                    complete = update(SegmentationStage.STAGE_COMPLETE)
+                    complete.labeled_image, complete.labeled_image_type = labeled_image, labeled_image_type
+                    complete.labeled_image_format = request.labeled_image_format
+                    complete.segments.extend(await self.postprocess.submit(lambda: self._segment_results(
+                        segments, polygon_options, request.packed_polygons, control,
+                        include_polygons=lambda segment: segment['index'] != 1), control, priority))
+                    yield complete
+
+                except grpc.aio.AbortError:
+                    raise
+                except DeadlineExceeded as e:
+                    await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, str(e))
+                except RequestCancelled as e:
+                    await context.abort(grpc.StatusCode.CANCELLED, str(e))
+                except QueueFull as e:
+                    await self._reject_queue_full(context, e)
+                except UnknownHandleError as e:
+                    await context.abort(grpc.StatusCode.NOT_FOUND, f"Unknown mask_input_handle {e}, resend the logits in mask_input")
+                except UnknownImageError:
+                    await context.abort(grpc.StatusCode.NOT_FOUND,
+                                        f"The server no longer holds image {request.image_key!r}, send the image data")
+                except InvalidPromptError as e:
+                    await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+                except Exception as e:
+                    import traceback
+                    stack_trace = traceback.format_exc()
+                    print(f"Error processing progressive request: {e}\n{stack_trace}")
+                    await context.abort(grpc.StatusCode.INTERNAL, f"Error processing request: {e}")
+                finally:
+                    self.supersede_keys.release(supersede_key, control)
+
+    async def GetLoad(self, request, context):
+        """
+        Implement the GetLoad RPC method.
+
+        Args:
+            request: The LoadRequest message
+            context: The gRPC context
+
+        Returns:
+            A LoadReport message
+        """
+        queue_depths = self.scheduler.queue_depth_by_priority()
+        cache = self.model.embedding_cache
+        return LoadReport(
+            queue_depth=sum(queue_depths.values()),
+            in_flight=self.load.in_flight,
+            p50_latency_ms=self.load.latency_percentile(50) * 1000,
+            loaded_models=self.model.loaded_models,
+            interactive_queue_depth=queue_depths[Priority.INTERACTIVE],
+            bulk_queue_depth=queue_depths[Priority.BULK],
+            embedding_cache_hits=cache.hits,
+            embedding_cache_misses=cache.misses,
+            affinity_cache_hits=cache.affinity_hits,
+            affinity_cache_misses=cache.affinity_misses,
+            stages=[StageLoad(**stats._asdict()) for stats in self.stage_stats()],
+            clients=self.client_loads(),
+            superseded_requests=self.supersede_keys.superseded
+        )
+
+    def stage_stats(self) -> List[StageStats]:
+        """Return the stats of each stage of request processing, in the order requests pass them."""
+        return [self.preprocess.stats(), self.scheduler.stats(), self.postprocess.stats()]
+
+    def client_loads(self) -> List[ClientLoad]:
+        """Return the requests and inference queue of each client seen so far, ordered by name."""
+        requests = self.clients.stats()
+        queues = self.scheduler.client_stats()
+
+        loads = []
+        for client in sorted(set(requests) | set(queues)):
+            load = ClientLoad(client=client, weight=self.clients.weight(client))
+            if client in requests:
+                load.in_flight = requests[client].in_flight
+                load.admitted = requests[client].admitted
+                load.rejected = requests[client].rejected
+            if client in queues:
+                load.queue_depth = queues[client].queue_depth
+                load.started = queues[client].started
+                load.wait_seconds = queues[client].wait_seconds
+            loads.append(load)
+
+        return loads
+
+    async def PrefetchImage(self, request, context):
+        """
+        Implement the PrefetchImage RPC method.
+
+        The image is decoded on the preprocessing pool, then its encoding is queued
+        at the lowest priority, and the call returns without waiting for either.
+        Prefetches are speculative, so they are dropped rather than queued when the
+        server is busy, and dropped from the queue if they do not start within
+        PREFETCH_TIMEOUT seconds.
+
+        Args:
+            request: The PrefetchRequest message
+            context: The gRPC context
+
+        Returns:
+            A PrefetchResponse message
+        """
+        image_key = request.image_key or None
+        if self.model.image_cache_key(request.image_data, image_key) in self.model.embedding_cache:
+            return PrefetchResponse(status=PrefetchStatus.PREFETCH_ALREADY_CACHED)
+
+        if not request.image_data:
+            return PrefetchResponse(status=PrefetchStatus.PREFETCH_MISSING_IMAGE)
+
+        queue_depths = self.scheduler.queue_depth_by_priority()
+        queued_prefetches = queue_depths[Priority.PREFETCH] + self.preprocess.queue_depth_by_priority()[Priority.PREFETCH]
+        if (queue_depths[Priority.INTERACTIVE] > 0 or queue_depths[Priority.BULK] > 0 or
+                queued_prefetches >= PREFETCH_MAX_QUEUE_DEPTH):
+            return PrefetchResponse(status=PrefetchStatus.PREFETCH_DROPPED)
+
+        control = RequestControl(deadline=time.monotonic() + PREFETCH_TIMEOUT,
+                                 client=client_from_metadata(context.invocation_metadata(), context.peer()))
+        def encode(prepared_future):
+            if prepared_future.exception() is not None:
+                _report_prefetch_failure(prepared_future)
+                return
+            prepared = prepared_future.result()
+            try:
+                future = self.scheduler.schedule(lambda: self.model.prefetch_image(prepared, image_key, control),
+                                                 control, Priority.PREFETCH)
+            except RuntimeError:
+                return  # The server is shutting down
+            future.add_done_callback(_report_prefetch_failure)
+
+        prepared_future = self.preprocess.schedule(
+            lambda: self.model.prepare_image(request.image_data, image_key, control=control),
+            control, Priority.PREFETCH)
+        prepared_future.add_done_callback(encode)
+
+        return PrefetchResponse(status=PrefetchStatus.PREFETCH_SCHEDULED)
+
+    async def GetImageEmbedding(self, request, context):
+        """
+        Implement the GetImageEmbedding RPC method.
+
+        The embedding comes from the embedding cache when the image was seen
+        recently, so a client switching to local decoding does not pay for a
+        second encoding.
+
+        Args:
+            request: The EmbeddingRequest message
+            context: The gRPC context
+
+        Returns:
+            An ImageEmbedding message
+        """
+        image_key = request.image_key or None
+        if not request.image_data and self.model.image_cache_key(b'', image_key) not in self.model.embedding_cache:
+            await context.abort(grpc.StatusCode.NOT_FOUND,
+                                f"The server does not hold image {request.image_key!r}, send the image data")
+
+        control = RequestControl.from_context(context, self.tracer.continue_trace(context.invocation_metadata()))
+        priority = Priority.from_metadata(context.invocation_metadata(), Priority.INTERACTIVE)
+        affinity_routed = any(key == metadata.AFFINITY and value == '1'
+                              for key, value in context.invocation_metadata() or ())
+
+        async with self._admit(context):
+            with self.load.track():
+                try:
+                    prepared = await self.preprocess.submit(lambda: self.model.prepare_image(
+                        request.image_data, image_key, control=control), control, priority)
+                    arrays, (height, width) = await self.scheduler.submit(lambda: self.model.get_image_embedding(
+                        prepared, image_key, affinity_routed, control), control, priority)
+
+                    def encode_response():
+                        response = ImageEmbedding(model_name=self.model.backend.model_name,
+                                                  width=width,
+                                                  height=height,
+                                                  input_size=self.model.backend.input_size)
+                        for name, array in arrays.items():
+                            response.tensors.append(encode_embedding_tensor(name, array, request.encoding, request.compress))
+                        return response
+
+                    # Quantising and compressing the tensors is CPU work that need not hold up the model
+                    return await self.postprocess.submit(encode_response, control, priority)
+
+                except grpc.aio.AbortError:
+                    raise
+                except DeadlineExceeded as e:
+                    await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, str(e))
+                except RequestCancelled as e:
+                    await context.abort(grpc.StatusCode.CANCELLED, str(e))
+                except QueueFull as e:
+                    await self._reject_queue_full(context, e)
+                except UnknownImageError:
+                    await context.abort(grpc.StatusCode.NOT_FOUND,
+                                        f"The server no longer holds image {request.image_key!r}, send the image data")
+                except NotImplementedError as e:
+                    await context.abort(grpc.StatusCode.UNIMPLEMENTED, str(e))
+                except Exception as e:
+                    print(f"Error encoding image embedding: {e}")
+                    await context.abort(grpc.StatusCode.INTERNAL, f"Error encoding image embedding: {e}")
+
+    async def PropagateStack(self, request, context):
+        """
+        Implement the PropagateStack RPC method.
+
+        Args:
+            request: The StackPropagationRequest message
+            context: The gRPC context
+
+        Yields:
+            A SectionSegmentation message per processed section
+        """
+        # Streams are counted as in flight but their duration would skew the latency percentiles
+        async with self._admit(context):
+            with self.load.track(record_latency=False):
+                stream = self._propagate_stack(request, context)
+                try:
+                    async for response in stream:
+                        yield response
+                finally:
+                    # Release the propagation promptly if the client stops reading
+                    await stream.aclose()
+
+    async def _propagate_stack(self, request, context):
+        """
+        Propagate an object through a stack of sections for the PropagateStack RPC method.
+
+        The sections are decoded on the preprocessing pool, then the propagation
+        runs on the inference thread one section at a time and each section's
+        result is streamed back to the client as soon as the model produces it.
+
+        Args:
+            request: The StackPropagationRequest message
+            context: The gRPC context
+
+        Yields:
+            A SectionSegmentation message per processed section
+        """
+        sections = list(request.sections)
+        if len(sections) == 0:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "No sections provided")
+
+        if not 0 <= request.prompt_section_index < len(sections):
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                f"prompt_section_index {request.prompt_section_index} is outside the {len(sections)} sections")
+
+        coordinates = [(point.x, point.y) for point in request.coordinates]
+        labels = list(request.labels)
+
+        box = None
+        if request.HasField('box'):
+            box = (request.box.x0, request.box.y0, request.box.x1, request.box.y1)
+
+        if len(coordinates) == 0 and box is None:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Propagation requires point or box prompts")
+
+        control = RequestControl.from_context(context, self.tracer.continue_trace(context.invocation_metadata()))
+        # A propagation holds the model for a whole stack, it may not claim the interactive class
+        priority = Priority.from_metadata(context.invocation_metadata(), Priority.BULK, highest=Priority.BULK)
+
+        # The frames are written on the preprocessing pool, the directory is owned here so it is
+        # deleted even if the request is cancelled while they are being written
+        frame_dir = tempfile.mkdtemp(prefix='sections_')
+        propagation = None
+        finished = object()
+
+        try:
+            # A backend that cannot propagate fails here, before any section is decoded
+            await self.scheduler.submit(lambda: self.model.video_predictor, control, priority)
+
+            # Decoding a long stack on the inference thread would hold up interactive requests
+            prepared = await self.preprocess.submit(lambda: self.model.prepare_stack(
+                [section.image_data for section in sections], frame_dir, control), control, priority)
+
+            propagation = self.model.propagate_stack(
+                sections=prepared,
+                prompt_section_index=request.prompt_section_index,
+                coordinates=coordinates,
+                labels=labels,
+                box=box,
+                forward=request.direction != PropagationDirection.PROPAGATE_BACKWARD,
+                backward=request.direction != PropagationDirection.PROPAGATE_FORWARD,
+                max_sections=request.max_sections,
+                control=control)
+
+            while True:
+                # Schedule one section at a time so interactive requests can run between sections
+                result = await self.scheduler.submit(lambda: next(propagation, finished), control, priority)
+                if result is finished:
+                    break
+
+                section_index, segments = result
+                section = sections[section_index]
+                response = SectionSegmentation(
+                    section_index=section_index,
+                    section_number=section.section_number,
+                    width=section.width,
+                    height=section.height
+                )
+
+                # Tracing the section's polygons overlaps propagation into the next section
+                response.segments.extend(await self.postprocess.submit(
+                    lambda: self._segment_results(segments, control=control), control, priority))
+
+                yield response
+
+        except DeadlineExceeded as e:
+            await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, str(e))
+        except RequestCancelled as e:
+            await context.abort(grpc.StatusCode.CANCELLED, str(e))
+        except QueueFull as e:
+            await self._reject_queue_full(context, e)
+        except InvalidPromptError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        except NotImplementedError as e:
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED, str(e))
+        except grpc.aio.AbortError:
+            raise
+        except Exception as e:
+            print(f"Error propagating stack: {e}")
+            await context.abort(grpc.StatusCode.INTERNAL, f"Error propagating stack: {e}")
+        finally:
+            # Release the propagation state on the inference thread, the generator may be mid-step there
+            control.cancel()
+
+            def release():
+                if propagation is not None:
+                    try:
+                        propagation.close()
+                    except ValueError:
+                        pass  # A step is still running on a worker of a scheduler that shut down
+                shutil.rmtree(frame_dir, ignore_errors=True)
+
+            try:
+                self.scheduler.schedule(release, RequestControl(), Priority.INTERACTIVE)
+            except RuntimeError:
+                # The server is stopping and its scheduler runs no more jobs
+                release()
+
+def _report_prefetch_failure(future):
+    """Log prefetches that failed, nobody waits for their result.  Dropped prefetches are expected."""
+    error = future.exception()
+    if error is not None and not isinstance(error, RequestCancelled):
+        print(f"Error prefetching image: {error}")
+
+
+def remove_stale_socket(path: str):
+    """
+    Remove a Unix domain socket left behind by a previous run, which would make the bind fail.
+
+    Args:
+        path: Path the server is going to listen on
+
+    Raises:
+        ValueError: If something other than a socket exists at the path
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+
+    if not stat.S_ISSOCK(mode):
+        raise ValueError(f"Refusing to listen on {path}, it exists and is not a socket")
+    os.remove(path)
+
+
+async def serve(port=50051, max_workers=10, unix_socket=None, capture_path=None, capture_payload=False,
+                backend='torch', backend_options=None, preprocess_workers=2, postprocess_workers=2, polygon_workers=4,
+                client_limits=None, tracer=None, max_queue_depth=DEFAULT_MAX_QUEUE_DEPTH):
     """
     Start the gRPC server.
 
     Args:
-        port: The port to listen on
+        port: The TCP port to listen on, or None to only listen on the Unix domain socket
         max_workers: The maximum number of worker threads
+        unix_socket: Optional path of a Unix domain socket to listen on, for clients on the same host
+        capture_path: Optional file to record SegmentImage traffic to, see segmentation_server.replay
+        capture_payload: Whether the capture includes the full requests, needed to compare outputs on replay
+        backend: Name of the inference backend running the model, see segmentation_server.backends
+        backend_options: Arguments used to create the backend
+        preprocess_workers: Threads decoding images ahead of inference
+        postprocess_workers: Threads encoding masks and building responses after inference
+        polygon_workers: Threads tracing the polygons of a response's segments in parallel
+        client_limits: Optional ClientLimits with the fair share weights and limits of the clients
+        tracer: Optional Tracer recording the spans of traced requests, it is closed when the server stops
+        max_queue_depth: Jobs each client queues per priority class for preprocessing before its requests
+                         are rejected, 0 for no bound
     """
+    if port is None and unix_socket is None:
+        raise ValueError("serve() needs a port or a unix_socket to listen on")
+    if unix_socket is not None:
+        remove_stale_socket(unix_socket)
+
     # Create a server with the specified number of workers
     server = grpc.aio.server(
         futures.ThreadPoolExecutor(max_workers=max_workers),
@@ -144,21 +1120,42 @@ async def serve(port=50051, max_workers=10):
         ]
     )
 
+    capture = None
+    if capture_path is not None:
+        capture = TrafficCapture(capture_path, include_payload=capture_payload)
+        print(f"Capturing SegmentImage traffic to {capture_path}"
+              f"{' with payloads' if capture_payload else ''}")
+
     # Add the servicer to the server
     add_SegmentationServiceServicer_to_server(
-        SegmentationServicer(), server
+        SegmentationServicer(capture=capture, backend=backend, backend_options=backend_options,
+                             preprocess_workers=preprocess_workers, postprocess_workers=postprocess_workers,
+                             polygon_workers=polygon_workers, client_limits=client_limits, tracer=tracer,
+                             max_queue_depth=max_queue_depth), server
     )
 
-    # Add a port for the server to listen on
-    server_address = f'[::]:{port}'
-    server.add_insecure_port(server_address)
+    # Add the addresses for the server to listen on
+    server_addresses = []
+    if port is not None:
+        server_addresses.append(f'[::]:{port}')
+    if unix_socket is not None:
+        server_addresses.append(f'unix:{unix_socket}')
+
+    for server_address in server_addresses:
+        server.add_insecure_port(server_address)
 
     # Start the server
     await server.start()
-    print(f"Server started, listening on {server_address}")
+    print(f"Server started, listening on {', '.join(server_addresses)}")
 
     # Keep the server running until it is terminated
-    await server.wait_for_termination()
+    try:
+        await server.wait_for_termination()
+    finally:
+        if capture is not None:
+            capture.close()
+        if tracer is not None:
+            tracer.close()
 
 
 if __name__ == '__main__':
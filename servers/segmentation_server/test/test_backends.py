@@ -0,0 +1,114 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from segmentation_server.backends import create_backend
+from segmentation_server.backends.onnx_backend import preprocess_image
+from segmentation_server.segmentation_service import SegmentationModel, InvalidPromptError
+
+
+def _image(width=96, height=64):
+    return cv2.imencode('.png', np.full((height, width), 128, dtype=np.uint8))[1].tobytes()
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        create_backend('tensorrt')
+
+
+def test_stub_segment_image_reuses_embedding():
+    model = SegmentationModel(backend='stub')
+    labeled_image, segments = model.segment_image(_image(), 96, 64, [(40, 30)], [1])
+
+    assert labeled_image.shape == (64, 96)
+    assert [segment['index'] for segment in segments] == [1, 2, 3]
+    assert segments[0]['score'] == pytest.approx(0.9)
+    assert labeled_image[30, 40] != 0
+
+    # A repeated request skips the encoder and returns identical results
+    _, repeated = model.segment_image(_image(), 96, 64, [(40, 30)], [1])
+    assert [segment['mask'] for segment in repeated] == [segment['mask'] for segment in segments]
+
+    _, refined = model.segment_image(_image(), 96, 64, [(40, 30)], [1], multimask_output=False,
+                                     mask_input_handle=segments[0]['logits_handle'])
+    assert len(refined) == 1
+    assert model.backend.encode_calls == 1
+    assert model.loaded_models == ['stub']
+
+
+def test_stub_prompt_groups():
+    model = SegmentationModel(backend='stub')
+    groups = [{'coordinates': [(10, 10)], 'labels': [1]},
+              {'coordinates': [], 'labels': [], 'box': (50, 20, 90, 60)},
+              {'coordinates': [(70, 10), (20, 50)], 'labels': [1, 0]}]
+    _, segments = model.segment_prompt_groups(_image(), 96, 64, groups, multimask_output=False)
+
+    assert [segment['prompt_group'] for segment in segments] == [0, 1, 2]
+    assert model.backend.encode_calls == 1
+
+
+def test_stub_exports_embedding():
+    model = SegmentationModel(backend='stub')
+    arrays, size = model.get_image_embedding(_image(), image_key='tile')
+
+    assert size == (64, 96)
+    assert arrays['image_embed'].shape == (1, 256, 64, 64)
+    assert arrays['high_res_feats_0'].shape == (1, 32, 256, 256)
+
+    # The embedding is cached, a later request on the key alone needs no image data
+    model.get_image_embedding(b'', image_key='tile')
+    assert model.backend.encode_calls == 1
+
+
+def test_stub_cannot_propagate():
+    model = SegmentationModel(backend='stub')
+    with pytest.raises(NotImplementedError):
+        next(model.propagate_stack([_image()], 0, [(10, 10)], [1]))
+
+
+def test_prepare_stack_writes_frames():
+    model = SegmentationModel(backend='stub')
+    stack = model.prepare_stack([_image(), _image(), _image()])
+
+    assert stack.num_sections == 3
+    assert sorted(os.listdir(stack.frame_dir)) == ['00000.jpg', '00001.jpg', '00002.jpg']
+    stack.cleanup()
+    assert not os.path.exists(stack.frame_dir)
+
+
+def test_onnx_preprocess_image():
+    image = np.zeros((300, 200, 3), dtype=np.uint8)
+    tensor = preprocess_image(image)
+
+    assert tensor.shape == (1, 3, 1024, 1024)
+    assert tensor.dtype == np.float32
+    assert tensor[0, 0, 0, 0] == pytest.approx(-0.485 / 0.229)
+
+
+def test_predict_and_complete_match_segment_image():
+    model = SegmentationModel(backend='stub')
+    labeled_image, segments = model.segment_image(_image(), 96, 64, [(40, 30)], [1])
+
+    masks, scores, logits = model.predict_masks(_image(), 96, 64, [(40, 30)], [1])
+    assert list(scores) == sorted(scores, reverse=True)
+
+    staged_image, staged = model.complete_segments(masks, scores, logits, 96, 64)
+    np.testing.assert_array_equal(staged_image, labeled_image)
+    assert [segment['mask'] for segment in staged] == [segment['mask'] for segment in segments]
+
+
+def test_mask_input_of_wrong_shape_is_rejected():
+    model = SegmentationModel(backend='stub')
+    with pytest.raises(InvalidPromptError):
+        model.predict_masks(_image(), 96, 64, [(40, 30)], [1], mask_input=np.zeros((128, 128), dtype=np.float32))
+
+
+def test_decode_grayscale_array_without_copy():
+    pixels = np.random.randint(0, 256, (64, 96), dtype=np.uint8)
+    image = SegmentationModel.decode_image(pixels)
+
+    assert image.shape == (64, 96, 3)
+    assert np.shares_memory(image, pixels)
+    np.testing.assert_array_equal(preprocess_image(image), preprocess_image(np.dstack([pixels] * 3)))
@@ -0,0 +1,111 @@
+import json
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from segmentation_server import batch
+from segmentation_server.batch import Manifest, TileWriter, discover_sections, run_job
+from segmentation_server.segmentation_service import SegmentationModel
+
+
+def _volume(root, sections=2, tiles=2, size=128):
+    for section in range(1, sections + 1):
+        section_dir = root / f'{section:04d}'
+        section_dir.mkdir(parents=True)
+        for tile in range(tiles):
+            cv2.imwrite(str(section_dir / f'tile{tile}.png'), np.full((size, size), 60 * tile, dtype=np.uint8))
+
+    return str(root)
+
+
+def test_generate_masks_labels_by_decreasing_area():
+    image = cv2.imencode('.png', np.zeros((128, 128), dtype=np.uint8))[1].tobytes()
+    labeled_image, segments = SegmentationModel(backend='stub').generate_masks(image, points_per_side=2)
+
+    assert labeled_image.shape == (128, 128)
+    assert [segment['index'] for segment in segments] == list(range(1, len(segments) + 1))
+    assert segments[0]['area'] >= segments[-1]['area']
+    x0, y0, x1, y1 = segments[-1]['bbox']
+    assert (labeled_image[y0:y1, x0:x1] == len(segments)).any()
+
+
+def test_run_job_writes_outputs_and_resumes(tmp_path):
+    volume = _volume(tmp_path / 'volume')
+    output = str(tmp_path / 'output')
+    options = {'points_per_side': 2}
+
+    stats = run_job(volume, output, num_workers=1, backend='stub', generator_options=options, report=lambda line: None)
+    assert sum(worker.tiles for worker in stats.values()) == 4
+
+    with open(os.path.join(output, '0002', 'tile1.json')) as f:
+        assert json.load(f)['tile'] == '0002/tile1.png'
+    assert cv2.imread(os.path.join(output, '0001', 'tile0.png'), cv2.IMREAD_UNCHANGED).dtype == np.uint16
+
+    # Lose the record of one tile, as if the run was interrupted after writing its outputs
+    manifest_dir = os.path.join(output, 'manifest')
+    log = os.path.join(manifest_dir, os.listdir(manifest_dir)[0])
+    with open(log) as f:
+        lines = f.readlines()
+    with open(log, 'w') as f:
+        f.writelines(lines[:-1] + ['{"tile": "0002/ti'])
+
+    stats = run_job(volume, output, num_workers=1, backend='stub', generator_options=options, report=lambda line: None)
+    assert sum(worker.tiles for worker in stats.values()) == 1
+    assert len(Manifest(manifest_dir).completed()) == 4
+
+    with pytest.raises(ValueError):
+        run_job(volume, output, num_workers=1, backend='stub', report=lambda line: None)
+
+
+def test_run_job_shards_sections_across_processes(tmp_path):
+    volume = _volume(tmp_path / 'volume', sections=3, tiles=1, size=64)
+    output = str(tmp_path / 'output')
+
+    stats = run_job(volume, output, num_workers=2, backend='stub', generator_options={'points_per_side': 2},
+                    report=lambda line: None)
+
+    assert sum(worker.tiles for worker in stats.values()) == 3
+    assert set(Manifest(os.path.join(output, 'manifest')).completed()) == {
+        f'{section}/tile0.png' for section in discover_sections(volume)}
+
+
+def test_run_job_refuses_to_resume_with_other_backend_options_or_sink(tmp_path):
+    volume = _volume(tmp_path / 'volume', sections=1, tiles=1, size=64)
+    output = str(tmp_path / 'output')
+    options = {'points_per_side': 2}
+
+    run_job(volume, output, num_workers=1, backend='stub', backend_options={'encode_delay': 0.0}, generator_options=options,
+            report=lambda line: None)
+
+    with pytest.raises(ValueError):
+        run_job(volume, output, num_workers=1, backend='stub', backend_options={'encode_delay': 0.001},
+                generator_options=options, report=lambda line: None)
+    with pytest.raises(ValueError):
+        run_job(volume, output, num_workers=1, backend='stub', backend_options={'encode_delay': 0.0},
+                generator_options=options, sink=TileWriter(str(tmp_path / 'elsewhere')), report=lambda line: None)
+
+    stats = run_job(volume, output, num_workers=1, backend='stub', backend_options={'encode_delay': 0.0},
+                    generator_options=options, sink=TileWriter(output), report=lambda line: None)
+    assert sum(worker.tiles for worker in stats.values()) == 0
+
+
+def test_close_worker_closes_sink_before_manifest(tmp_path):
+    closed = []
+
+    class Sink:
+        def write(self, tile, labeled_image, segments):
+            pass
+
+        def close(self):
+            closed.append('sink')
+
+    batch._init_worker('stub', {}, Sink(), str(tmp_path / 'manifest'), {}, 0)
+    manifest = batch._worker[2]
+    manifest_close = manifest.close
+    manifest.close = lambda: (closed.append('manifest'), manifest_close())
+
+    batch._close_worker()
+    assert closed == ['sink', 'manifest']
+    assert batch._worker is None
@@ -0,0 +1,119 @@
+import threading
+
+import pytest
+
+from segmentation_grpc import Point, Polygon, SegmentationRequest, SegmentationResponse, SegmentResult
+
+from segmentation_server import capture as capture_module
+from segmentation_server.capture import TrafficCapture, read_capture, describe_response
+from segmentation_server.replay import load_requests, compare_outputs
+
+
+def _request():
+    return SegmentationRequest(image_data=b'\x89PNG not really', width=64, height=32,
+                               coordinates=[Point(x=3, y=4), Point(x=10, y=12)], labels=[1, 0])
+
+
+def _response(score=0.9):
+    return SegmentationResponse(segments=[SegmentResult(index=1, score=score, mask=b'mask')])
+
+
+def _polygon_response(x=5):
+    polygon = Polygon(points=[Point(x=1, y=1), Point(x=x, y=1), Point(x=x, y=5)])
+    return SegmentationResponse(segments=[SegmentResult(index=1, score=0.9, polygons=[polygon])])
+
+
+def test_capture_round_trip(tmp_path):
+    path = str(tmp_path / 'traffic.seg')
+
+    capture = TrafficCapture(path, include_payload=True)
+    capture.record('SegmentImage', _request(), _response(), 0.0, 0.012, 'OK', 'interactive')
+    capture.record('SegmentImage', _request(), None, 0.0, 0.001, 'INVALID_ARGUMENT')
+    capture.close()
+
+    # Appending to an existing capture must not write a second header
+    capture = TrafficCapture(path)
+    capture.record('SegmentImage', _request(), _response(), 0.0, 0.010, 'OK')
+    capture.close()
+
+    records = list(read_capture(path))
+    assert [header['status'] for header, _ in records] == ['OK', 'INVALID_ARGUMENT', 'OK']
+    assert SegmentationRequest.FromString(records[0][1]) == _request()
+    assert records[0][0]['request']['num_points'] == 2
+    assert records[0][0]['response']['segments'][0]['score'] == pytest.approx(0.9)
+    assert records[1][0]['response'] is None
+    assert records[2][1] == b''
+
+
+def test_capture_describes_requests_on_writer_thread(tmp_path, monkeypatch):
+    threads = []
+
+    def describe_request(request):
+        threads.append(threading.current_thread().name)
+        return {}
+
+    monkeypatch.setattr(capture_module, 'describe_request', describe_request)
+    capture = TrafficCapture(str(tmp_path / 'traffic.seg'), include_payload=True)
+    capture.record('SegmentImage', _request(), _response(), 0.0, 0.012, 'OK')
+    capture.close()
+
+    assert threads == ['traffic-capture']
+
+
+def test_capture_drops_records_when_writer_falls_behind(tmp_path, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def describe_request(request):
+        started.set()
+        release.wait()
+        return {}
+
+    monkeypatch.setattr(capture_module, 'describe_request', describe_request)
+    path = str(tmp_path / 'traffic.seg')
+    capture = TrafficCapture(path, max_queued=2)
+
+    # The writer holds the first record, two more fit in the queue
+    capture.record('SegmentImage', _request(), _response(), 0.0, 0.012, 'OK')
+    started.wait()
+    for _ in range(4):
+        capture.record('SegmentImage', _request(), _response(), 0.0, 0.012, 'OK')
+
+    assert capture.dropped == 2
+    release.set()
+    capture.close()
+    assert len(list(read_capture(path))) == 3
+
+
+def test_replay_synthesizes_requests_without_payload(tmp_path):
+    path = str(tmp_path / 'traffic.seg')
+    capture = TrafficCapture(path)
+    capture.record('SegmentImage', _request(), _response(), 0.0, 0.012, 'OK')
+    capture.close()
+
+    (record,) = load_requests(path)
+    assert not record['comparable']
+    assert (record['request'].width, record['request'].height) == (64, 32)
+    assert list(record['request'].labels) == [1, 0]
+    assert all(0 <= p.x < 64 and 0 <= p.y < 32 for p in record['request'].coordinates)
+
+
+def test_compare_outputs():
+    same = compare_outputs(describe_response(_response()), describe_response(_response()))
+    assert same['masks_match'] and same['max_score_delta'] == 0
+
+    assert same['polygons_match'] is None and same['labeled_images_match'] is None
+
+    shifted = compare_outputs(describe_response(_response()), describe_response(_response(0.8)))
+    assert shifted['masks_match'] and shifted['max_score_delta'] == pytest.approx(0.1)
+
+
+def test_compare_outputs_compares_polygons():
+    same = compare_outputs(describe_response(_polygon_response()), describe_response(_polygon_response()))
+    assert same['polygons_match'] and same['masks_match'] is None
+
+    moved = compare_outputs(describe_response(_polygon_response()), describe_response(_polygon_response(x=6)))
+    assert moved['polygons_match'] is False
+
+    # A replay that loses its polygons does not match
+    lost = compare_outputs(describe_response(_polygon_response()), describe_response(_response()))
+    assert lost['polygons_match'] is False and lost['masks_match'] is False
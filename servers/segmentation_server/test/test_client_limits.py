@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+from segmentation_server.client_limits import ClientLimits, ClientPolicy, ClientLimitExceeded, DEFAULT_RETRY_AFTER
+
+
+def test_concurrency_limit():
+    limits = ClientLimits(ClientPolicy(max_concurrency=2))
+    limits.acquire('alice')
+    limits.acquire('alice')
+    limits.acquire('bob')
+
+    with pytest.raises(ClientLimitExceeded) as error:
+        limits.acquire('alice')
+    assert error.value.retry_after == DEFAULT_RETRY_AFTER
+
+    # Once a request finished its duration suggests when to retry
+    limits.release('alice', 0.25)
+    limits.acquire('alice')
+    with pytest.raises(ClientLimitExceeded) as error:
+        limits.acquire('alice')
+    assert error.value.retry_after == pytest.approx(0.25)
+
+    stats = limits.stats()
+    assert (stats['alice'].in_flight, stats['alice'].admitted, stats['alice'].rejected) == (2, 3, 2)
+    assert (stats['bob'].in_flight, stats['bob'].rejected) == (1, 0)
+
+
+def test_rate_limit_refills():
+    limits = ClientLimits(policies={'script': ClientPolicy(weight=0.5, rate=20.0, burst=2)})
+    for _ in range(2):
+        limits.acquire('script')
+        limits.release('script', 0.01)
+
+    with pytest.raises(ClientLimitExceeded) as error:
+        limits.acquire('script')
+    assert 0 < error.value.retry_after <= 0.05
+
+    time.sleep(error.value.retry_after + 0.01)
+    limits.acquire('script')
+
+    # Clients without a policy of their own are not limited
+    for _ in range(100):
+        limits.acquire('annotator')
+    assert limits.weight('script') == 0.5 and limits.weight('annotator') == 1.0
+
+
+def test_invalid_policies_are_rejected():
+    with pytest.raises(ValueError):
+        ClientLimits(ClientPolicy(weight=0))
+    with pytest.raises(ValueError):
+        ClientLimits(policies={'alice': ClientPolicy(rate=-1)})
@@ -0,0 +1,54 @@
+import cv2
+import numpy as np
+
+from segmentation_server.contours import logits_contours, signed_area, compare_polygon_paths
+
+
+def _blobs(size=256):
+    y, x = np.mgrid[:size, :size]
+    disc = (40 - np.hypot(x - 100, y - 120)) / 4
+    small = (25 - np.hypot(x - 200, y - 60)) / 3
+    return np.maximum(disc, small).astype(np.float32)
+
+
+def test_contours_are_in_image_coordinates():
+    logits = np.full((16, 16), -1.0)
+    logits[4:12, 8:12] = 1.0
+
+    (contour,), is_hole = logits_contours(logits, 160, 320)
+    assert is_hole is None
+    x, y = contour[:, 0, 0], contour[:, 0, 1]
+
+    # The inside spans columns 8 to 11 and rows 4 to 11 of the logits, 10 and 20 image pixels each
+    assert 75 <= x.min() <= 85 and 115 <= x.max() <= 125
+    assert 75 <= y.min() <= 85 and 235 <= y.max() <= 245
+
+
+def test_holes_are_only_traced_on_request():
+    values = np.ones((6, 6))
+    values[2:4, 2:4] = -1
+
+    contours, _ = logits_contours(values, 60, 60)
+    assert len(contours) == 1
+
+    contours, is_hole = logits_contours(values, 60, 60, holes=True)
+    assert sorted(is_hole) == [False, True]
+    areas = [signed_area(contour.reshape(-1, 2)) for contour in contours]
+    assert abs(areas[is_hole.index(True)]) < abs(areas[is_hole.index(False)])
+
+
+def test_grid_is_never_finer_than_the_image():
+    logits = _blobs()
+    contours, _ = logits_contours(logits, 256, 256)
+    mask_contours, _ = cv2.findContours((logits > 0).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    assert len(contours) == len(mask_contours)
+    assert sorted(len(c) for c in contours) == sorted(len(c) for c in mask_contours)
+
+
+def test_logits_polygons_match_mask_polygons():
+    results = compare_polygon_paths(_blobs(), 3000, 2000, repeats=1)
+
+    # Tracing the logits is at least as accurate as tracing the upsampled mask
+    assert results['logits']['iou'] > 0.97
+    assert results['logits']['iou'] >= results['mask']['iou'] - 0.005
@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+import pytest
+
+from segmentation_server.segmentation_service import EmbeddingCache, SegmentationModel, UnknownImageError
+
+
+def test_cache_evicts_least_recently_used():
+    cache = EmbeddingCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_cache_counts_affinity_lookups_separately():
+    cache = EmbeddingCache()
+    cache.put('a', 1)
+    cache.get('a', affinity_routed=True)
+    cache.get('b', affinity_routed=True)
+    cache.get('a')
+
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert (cache.affinity_hits, cache.affinity_misses) == (1, 1)
+
+
+def test_image_cache_key():
+    image = np.arange(12, dtype=np.uint8).reshape(3, 4)
+
+    assert SegmentationModel.image_cache_key(image) == SegmentationModel.image_cache_key(image.copy())
+    assert SegmentationModel.image_cache_key(image) != SegmentationModel.image_cache_key(image.reshape(4, 3))
+    assert SegmentationModel.image_cache_key(b'png', image_key='tile-7') == 'key:tile-7'
+
+
+def test_prepared_image_skips_decoding_on_inference_thread():
+    model = SegmentationModel(backend='stub')
+    image = cv2.imencode('.png', np.full((64, 96), 128, dtype=np.uint8))[1].tobytes()
+
+    prepared = model.prepare_image(image, window=(10, 5, 60, 45))
+    assert prepared.pixels.shape == (40, 50, 3)
+    model.segment_image(prepared, 96, 64, [(30, 20)], [1], roi_window=(10, 5, 60, 45))
+    assert model.backend.encode_calls == 1
+
+    # Once the embedding is cached the image is only hashed
+    again = model.prepare_image(image, window=(10, 5, 60, 45))
+    assert again.pixels is None and again.key == prepared.key
+    model.segment_image(again, 96, 64, [(30, 20)], [1], roi_window=(10, 5, 60, 45))
+    assert model.backend.encode_calls == 1
+
+    # An embedding evicted after preparing is encoded from the source image
+    model.embedding_cache = EmbeddingCache()
+    model.segment_image(again, 96, 64, [(30, 20)], [1], roi_window=(10, 5, 60, 45))
+    assert model.backend.encode_calls == 2
+
+
+def test_key_only_image_must_be_cached():
+    model = SegmentationModel(backend='stub')
+    image = cv2.imencode('.png', np.full((64, 96), 128, dtype=np.uint8))[1].tobytes()
+    with pytest.raises(UnknownImageError):
+        model.prepare_image(b'', image_key='tile-7')
+
+    model.prefetch_image(image, image_key='tile-7')
+    prepared = model.prepare_image(b'', image_key='tile-7')
+    assert prepared.pixels is None
+
+    # The embedding is evicted before the inference thread gets to the request
+    model.embedding_cache = EmbeddingCache()
+    with pytest.raises(UnknownImageError):
+        model.get_image_embedding(prepared, image_key='tile-7')
@@ -0,0 +1,112 @@
+import multiprocessing
+
+import numpy as np
+
+from segmentation_server.batch import Tile, run_job
+from segmentation_server.label_volume import LabelVolume, LabelVolumeWriter, TileGrid
+
+
+def _tile(value, size=48):
+    """A labeled image holding a square of label 1 inside a larger square of label 2."""
+    labeled_image = np.zeros((size, size), dtype=np.uint16)
+    labeled_image[4:40, 4:40] = 2
+    labeled_image[10:20, 10:20] = 1
+    segments = [{'index': 1, 'bbox': (10, 10, 20, 20), 'area': 100, 'score': value, 'stability_score': 1.0},
+                {'index': 2, 'bbox': (4, 4, 40, 40), 'area': 1196, 'score': value, 'stability_score': 1.0}]
+    return labeled_image, segments
+
+
+def _write_tiles(path, z, origins):
+    with LabelVolume.open(path, writable=True) as volume:
+        for y, x in origins:
+            volume.write_tile(z, y, x, *_tile(0.5))
+
+
+def test_write_tiles_across_chunks(tmp_path):
+    path = str(tmp_path / 'labels')
+    volume = LabelVolume.create(path, shape=(2, 100, 100), chunk_shape=(1, 32, 32))
+    volume.write_tile(1, 20, 30, *_tile(0.9))
+    volume.write_tile(1, 50, 50, *_tile(0.8))
+    volume.close()
+
+    volume = LabelVolume.open(path)
+    segments = volume.segments()
+    assert len(segments) == 4
+    assert (segments[0]['x0'], segments[0]['y0'], segments[0]['x1'], segments[0]['y1']) == (40, 30, 50, 40)
+    np.testing.assert_allclose(segments['score'], [0.9, 0.9, 0.8, 0.8])
+
+    # The second tile overwrites the first where its labels are not 0
+    region = volume[1, 20:68, 30:78]
+    assert region.shape == (48, 48)
+    assert region[15, 15] == 1 and region[5, 5] == 2
+    assert volume[1, 65, 65] == 3 and volume[1, 59, 59] == 4
+    assert not volume[0].any()
+
+    # Only the chunks the tiles touched are recorded as written
+    writes = volume.chunk_writes()
+    assert writes[0].sum() == 0
+    assert writes[1, 0, 0] == 1 and writes[1, 1, 1] == 2 and writes[1, 3, 0] == 0
+
+
+def test_concurrent_writers_get_unique_labels(tmp_path):
+    path = str(tmp_path / 'labels')
+    LabelVolume.create(path, shape=(1, 400, 400), chunk_shape=(1, 64, 64)).close()
+
+    # Tiles of both writers share chunks, but not pixels
+    context = multiprocessing.get_context('spawn')
+    writers = [context.Process(target=_write_tiles, args=(path, 0, [(y, x) for y in range(0, 400, 50)
+                                                                     for x in range(offset, 400, 100)]))
+               for offset in (0, 50)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+        assert writer.exitcode == 0
+
+    volume = LabelVolume.open(path)
+    labels = volume[0]
+    assert len(volume.segments()) == 2 * 64
+    assert len(np.unique(labels[labels > 0])) == 2 * 64
+
+
+def test_append_skips_record_cut_short(tmp_path):
+    path = str(tmp_path / 'labels')
+    with LabelVolume.create(path, shape=(1, 64, 64)) as volume:
+        volume.write_tile(0, 0, 0, *_tile(0.5))
+
+    # An interrupted writer left half a record behind
+    with open(tmp_path / 'labels' / 'segments.bin', 'ab') as f:
+        f.write(b'\0' * 5)
+
+    with LabelVolume.open(path, writable=True) as volume:
+        volume.write_tile(0, 0, 0, *_tile(0.7))
+
+    volume = LabelVolume.open(path)
+    segments = volume.segments()
+    assert len(segments) == 5
+    np.testing.assert_allclose(segments['score'][3:], [0.7, 0.7])
+    assert set(np.unique(volume[0])) == {0, 4, 5}
+
+
+def test_batch_job_writes_label_volume(tmp_path):
+    import cv2
+
+    section_dir = tmp_path / 'volume' / '0001'
+    section_dir.mkdir(parents=True)
+    for name in ('X001_Y001.png', 'X002_Y001.png'):
+        cv2.imwrite(str(section_dir / name), np.full((64, 64), 100, dtype=np.uint8))
+
+    path = str(tmp_path / 'labels')
+    grid = TileGrid(['0001'], 64, 64)
+    tiles = [Tile('0001', name, '') for name in ('X001_Y001.png', 'X002_Y001.png')]
+    assert grid.volume_shape(tiles) == (1, 64, 128)
+    LabelVolume.create(path, grid.volume_shape(tiles), (1, 32, 32)).close()
+
+    run_job(str(tmp_path / 'volume'), str(tmp_path / 'output'), num_workers=1, backend='stub',
+            generator_options={'points_per_side': 2}, sink=LabelVolumeWriter(path, grid), report=lambda line: None)
+
+    volume = LabelVolume.open(path)
+    segments = volume.segments()
+    assert len(segments) > 0
+    assert segments['x0'].max() >= 64
+    assert set(np.unique(volume[0])) - {0} <= set(range(1, len(segments) + 1))
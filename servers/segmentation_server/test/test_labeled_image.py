@@ -0,0 +1,63 @@
+import numpy as np
+
+from segmentation_server.segmentation_service import SegmentationModel
+
+
+def _reference_labeled_image(masks, labels, priorities):
+    """Paint masks one at a time, lowest priority first, so the highest priority ends on top."""
+    image = np.zeros(masks.shape[1:], dtype=np.uint16)
+    for i in np.argsort(priorities):
+        image[masks[i]] = labels[i]
+    return image
+
+
+def test_highest_priority_mask_wins():
+    masks = np.zeros((3, 8, 8), dtype=bool)
+    masks[0, 0:6, 0:6] = True
+    masks[1, 2:8, 2:8] = True
+    masks[2, 5:8, 5:8] = True
+
+    labeled = SegmentationModel.compose_labeled_image(masks, np.array([1, 2, 3]), np.array([0.9, 0.5, 0.7]))
+
+    assert labeled.dtype == np.uint16
+    assert labeled[0, 0] == 1
+    assert labeled[3, 3] == 1  # masks 0 and 1 overlap, mask 0 has the highest score
+    assert labeled[5, 5] == 1  # all three overlap
+    assert labeled[6, 6] == 3  # masks 1 and 2 overlap, mask 2 scores higher
+    assert labeled[2, 7] == 2
+    assert labeled[0, 7] == 0
+
+
+def test_matches_sequential_painting():
+    rng = np.random.default_rng(1)
+    masks = rng.random((20, 32, 48)) > 0.7
+    labels = np.arange(1, 21)
+    priorities = rng.random(20)
+
+    labeled = SegmentationModel.compose_labeled_image(masks, labels, priorities)
+    np.testing.assert_array_equal(labeled, _reference_labeled_image(masks, labels, priorities))
+
+
+def test_compose_accepts_mask_sequences():
+    rng = np.random.default_rng(2)
+    masks = rng.random((5, 16, 24)) > 0.5
+    labels, priorities = np.arange(1, 6), np.array([0.3, 0.9, 0.3, 0.1, 0.5])
+
+    labeled = SegmentationModel.compose_labeled_image(list(masks.astype(np.float32)), labels, priorities)
+    np.testing.assert_array_equal(labeled, SegmentationModel.compose_labeled_image(masks, labels, priorities))
+    assert SegmentationModel.compose_labeled_image([], np.array([]), np.array([])) is None
+
+
+def test_create_labeled_image_draws_small_masks_on_top():
+    large = np.zeros((6, 6), dtype=bool)
+    large[:, :] = True
+    small = np.zeros((6, 6), dtype=bool)
+    small[2:4, 2:4] = True
+
+    labeled = SegmentationModel.create_labeled_image([
+        {'segmentation': small, 'area': int(small.sum())},
+        {'segmentation': large, 'area': int(large.sum())},
+    ])
+
+    assert labeled[0, 0] == 1
+    assert labeled[2, 2] == 2
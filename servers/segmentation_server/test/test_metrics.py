@@ -0,0 +1,65 @@
+import pytest
+
+from segmentation_server import metrics
+from segmentation_server.metrics import LoadTracker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(metrics.time, 'monotonic', clock)
+    return clock
+
+
+def test_in_flight_counts_open_requests():
+    load = LoadTracker()
+    with load.track():
+        with load.track(record_latency=False):
+            assert load.in_flight == 2
+        assert load.in_flight == 1
+    assert load.in_flight == 0
+
+
+def test_latency_percentile(clock):
+    load = LoadTracker()
+    assert load.latency_percentile(50) == 0.0
+
+    for duration in (0.1, 0.3, 0.2):
+        with load.track():
+            clock.now += duration
+    assert load.latency_percentile(50) == pytest.approx(0.2)
+    assert load.latency_percentile(100) == pytest.approx(0.3)
+
+
+def test_latency_window_keeps_recent_requests(clock):
+    load = LoadTracker(latency_window=2)
+    for duration in (5.0, 0.1, 0.1):
+        with load.track():
+            clock.now += duration
+    assert load.latency_percentile(100) == pytest.approx(0.1)
+
+
+def test_stream_does_not_record_latency():
+    load = LoadTracker()
+    with load.track(record_latency=False):
+        pass
+    assert load.latency_percentile(50) == 0.0
+
+
+def test_failed_request_does_not_record_latency(clock):
+    load = LoadTracker()
+    with pytest.raises(RuntimeError):
+        with load.track():
+            clock.now += 0.001
+            raise RuntimeError("rejected")
+
+    assert load.in_flight == 0
+    assert load.latency_percentile(50) == 0.0
@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+
+from segmentation_server.contours import signed_area
+from segmentation_server.segmentation_service import SegmentationModel, PolygonOptions
+
+
+def _disc(size=400, radius=150):
+    y, x = np.mgrid[:size, :size]
+    return (x - size / 2) ** 2 + (y - size / 2) ** 2 <= radius ** 2
+
+
+def test_vertex_budget_limits_polygon_size():
+    unlimited = SegmentationModel.mask_to_polygons(_disc())
+    limited = SegmentationModel.mask_to_polygons(_disc(), max_vertices=8)
+
+    assert len(unlimited[0]) > 8
+    assert 3 <= len(limited[0]) <= 8
+
+
+def test_budget_below_triangle_still_returns_polygon():
+    polygons = SegmentationModel.mask_to_polygons(_disc(), max_vertices=1)
+    assert len(polygons) == 1
+    assert len(polygons[0]) >= 3
+
+
+def test_logits_outline_matches_full_resolution_polygon():
+    mask = cv2.resize(_disc(size=1024, radius=300).astype(np.uint8), (1200, 900), interpolation=cv2.INTER_NEAREST) > 0
+    logits = np.where(cv2.resize(mask.astype(np.uint8), (256, 256), interpolation=cv2.INTER_AREA) > 0, 8.0, -8.0)
+
+    coarse = SegmentationModel.logits_to_polygons(logits, 1200, 900)
+    full = SegmentationModel.mask_to_polygons(mask)
+
+    assert len(coarse) == 1
+    assert coarse[0].dtype == np.int32
+    np.testing.assert_allclose(coarse[0].min(axis=0), full[0].min(axis=0), atol=6)
+    np.testing.assert_allclose(coarse[0].max(axis=0), full[0].max(axis=0), atol=6)
+
+
+def test_holes_are_returned_with_opposite_orientation():
+    ring = _disc() & ~_disc(radius=60)
+
+    assert len(SegmentationModel.mask_to_polygons(ring)) == 1
+
+    for polygons in (SegmentationModel.mask_to_polygons(ring, holes=True),
+                     SegmentationModel.logits_to_polygons(np.where(ring, 8.0, -8.0), 400, 400, holes=True)):
+        areas = sorted(signed_area(polygon.astype(float)) for polygon in polygons)
+        assert len(areas) == 2
+        assert areas[0] < 0 < areas[1]
+        assert abs(areas[0]) < areas[1]
+
+
+def test_simplify_tolerance():
+    coarse = SegmentationModel.mask_to_polygons(_disc(), tolerance=0.05)
+    exact = SegmentationModel.mask_to_polygons(_disc(), tolerance=0)
+
+    assert len(coarse[0]) < len(SegmentationModel.mask_to_polygons(_disc())[0]) < len(exact[0])
+
+
+def test_segment_polygons_shifts_window_masks():
+    mask = _disc(size=100, radius=30)
+    segment = {'mask_array': mask, 'mask_offset': (500, 200)}
+
+    polygons = SegmentationModel.segment_polygons(segment, PolygonOptions())
+
+    np.testing.assert_array_equal(polygons[0], SegmentationModel.mask_to_polygons(mask)[0] + (500, 200))
@@ -0,0 +1,78 @@
+import cv2
+import numpy as np
+import pytest
+
+from segmentation_server.segmentation_service import SegmentationModel, InvalidPromptError, PolygonOptions
+
+
+def _image(width, height):
+    return cv2.imencode('.png', np.full((height, width), 128, dtype=np.uint8))[1].tobytes()
+
+
+def test_choose_roi_window_is_square_and_inside_image():
+    window = SegmentationModel.choose_roi_window(4000, 3000, [(100, 2950)], [], padding=1.0, min_size=256)
+    x0, y0, x1, y1 = window
+
+    assert (x1 - x0, y1 - y0) == (256, 256)
+    assert x0 == 0 and y1 == 3000
+    assert x0 <= 100 < x1 and y0 <= 2950 < y1
+
+
+def test_choose_roi_window_grows_with_prompts():
+    window = SegmentationModel.choose_roi_window(4000, 4000, [(1000, 1000)], [(900, 950, 1300, 1100)],
+                                                 padding=0.5, min_size=64)
+
+    # The larger side of the bounding box, 400, plus half of it on either side
+    assert window[2] - window[0] == 800
+    assert window[0] <= 900 and window[2] >= 1300
+
+
+def test_choose_roi_window_skips_small_images():
+    assert SegmentationModel.choose_roi_window(600, 600, [(300, 300)], [], min_size=512) is None
+    assert SegmentationModel.choose_roi_window(4000, 4000, [], []) is None
+
+
+def test_resolve_roi_window_precedence():
+    model = SegmentationModel(backend='stub')
+    handle = model.logits_store.put(np.zeros((256, 256), dtype=np.float32), (10, 20, 110, 120))
+
+    assert model.resolve_roi_window(200, 200, [], [], window=(-5, 0, 50, 300)) == (0, 0, 50, 200)
+    assert model.resolve_roi_window(4000, 4000, [(5, 5)], [], mask_input_handle=handle) == (10, 20, 110, 120)
+    assert model.resolve_roi_window(4000, 4000, [(5, 5)], []) is None
+    assert model.resolve_roi_window(4000, 4000, [(5, 5)], [], auto=True) == (0, 0, 512, 512)
+
+    with pytest.raises(InvalidPromptError):
+        model.resolve_roi_window(200, 200, [], [], window=(300, 300, 400, 400))
+
+
+def test_segment_image_in_window_maps_back_to_image():
+    model = SegmentationModel(backend='stub')
+    image = _image(1200, 900)
+    window = (600, 400, 856, 656)
+
+    labeled_image, segments = model.segment_image(image, 1200, 900, [(700, 500)], [1], roi_window=window)
+
+    assert labeled_image.shape == (900, 1200)
+    assert labeled_image[500, 700] != 0
+    assert not labeled_image[:400].any() and not labeled_image[:, :600].any()
+
+    # Only the window of the mask is encoded
+    mask = cv2.imdecode(np.frombuffer(segments[0]['mask'], np.uint8), cv2.IMREAD_GRAYSCALE)
+    assert mask.shape == (256, 256) and mask[100, 100] > 0
+    assert segments[0]['mask_window'] == window
+    assert segments[0]['mask_offset'] == (600, 400)
+    np.testing.assert_array_equal(mask > 0, segments[0]['mask_array'])
+
+    # Polygons traced from the encoded mask are still in image coordinates
+    from_png = SegmentationModel.segment_polygons({'mask': segments[0]['mask'], 'mask_window': window},
+                                                  PolygonOptions())
+    from_array = SegmentationModel.segment_polygons(segments[0], PolygonOptions())
+    assert len(from_png) == len(from_array)
+    assert all(np.array_equal(a, b) for a, b in zip(from_png, from_array))
+
+    # The logits remember their window, and the window's embedding is cached separately from the image's
+    assert model.logits_store.get_window(segments[0]['logits_handle']) == window
+    model.segment_image(image, 1200, 900, [(700, 500)], [1], roi_window=window)
+    assert model.backend.encode_calls == 1
+    model.segment_image(image, 1200, 900, [(700, 500)], [1])
+    assert model.backend.encode_calls == 2
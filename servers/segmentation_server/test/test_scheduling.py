@@ -0,0 +1,225 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from segmentation_grpc.tracing import Tracer, read_trace
+from segmentation_server.scheduling import (InferenceScheduler, RequestControl, Priority, FairQueue, SupersedeKeys,
+                                            RequestCancelled, RequestSuperseded, DeadlineExceeded, QueueFull,
+                                            PRIORITY_METADATA_KEY,
+                                            CLIENT_METADATA_KEY, client_from_metadata)
+
+
+def test_priority_from_metadata():
+    assert Priority.from_metadata([(PRIORITY_METADATA_KEY, 'bulk')], Priority.INTERACTIVE) == Priority.BULK
+    assert Priority.from_metadata([(PRIORITY_METADATA_KEY, 'Interactive')], Priority.BULK) == Priority.INTERACTIVE
+    assert Priority.from_metadata([(PRIORITY_METADATA_KEY, 'urgent')], Priority.BULK) == Priority.BULK
+    assert Priority.from_metadata(None, Priority.INTERACTIVE) == Priority.INTERACTIVE
+
+    # A request limited to bulk work cannot claim the interactive class, but may ask for less
+    assert Priority.from_metadata([(PRIORITY_METADATA_KEY, 'interactive')], Priority.BULK, Priority.BULK) == Priority.BULK
+    assert Priority.from_metadata([(PRIORITY_METADATA_KEY, 'prefetch')], Priority.BULK, Priority.BULK) == Priority.PREFETCH
+
+
+def test_client_from_metadata():
+    assert client_from_metadata([(CLIENT_METADATA_KEY, ' alice ')], 'ipv4:10.0.0.5:53412') == 'alice'
+    assert client_from_metadata(None, 'ipv4:10.0.0.5:53412') == 'ipv4:10.0.0.5'
+    assert client_from_metadata([], 'ipv6:[::1]:53412') == 'ipv6:[::1]'
+    assert client_from_metadata([], 'unix:/tmp/segmentation.sock') == 'unix:/tmp/segmentation.sock'
+
+
+def test_fair_queue_serves_clients_by_weight():
+    queue = FairQueue(lambda client: 2.0 if client == 'interactive' else 1.0)
+    for i in range(6):
+        queue.push('script', f's{i}')
+    for i in range(4):
+        queue.push('interactive', f'i{i}')
+
+    assert len(queue) == 10
+    assert queue.depth('script') == 6
+    assert [queue.pop() for _ in range(10)] == ['s0', 'i0', 'i1', 's1', 'i2', 'i3', 's2', 's3', 's4', 's5']
+    with pytest.raises(IndexError):
+        queue.pop()
+
+
+def test_request_control_check():
+    control = RequestControl()
+    control.check('encode')
+
+    control.cancel()
+    with pytest.raises(RequestCancelled):
+        control.check('encode')
+
+    with pytest.raises(DeadlineExceeded):
+        RequestControl(deadline=time.monotonic() - 1).check('encode')
+
+
+def test_newer_request_supersedes_older():
+    keys = SupersedeKeys()
+    first, second, other = RequestControl(), RequestControl(), RequestControl()
+    keys.register(('alice', 'object-1'), first)
+    keys.register(('bob', 'object-1'), other)
+    keys.register(('alice', 'object-1'), second)
+    keys.register(None, RequestControl())
+
+    with pytest.raises(RequestSuperseded):
+        first.check('inference')
+    second.check('inference')
+    other.check('inference')
+    assert keys.superseded == 1
+
+    # The older request finishing does not forget the newer one
+    keys.release(('alice', 'object-1'), first)
+    assert len(keys) == 2
+    keys.release(('alice', 'object-1'), second)
+    keys.release(('bob', 'object-1'), other)
+    assert len(keys) == 0
+
+
+def test_interactive_runs_before_queued_bulk():
+    async def run():
+        scheduler = InferenceScheduler()
+        release = threading.Event()
+        order = []
+
+        # Occupy the worker so the following jobs queue up
+        blocker = asyncio.ensure_future(scheduler.submit(release.wait, RequestControl(), Priority.BULK))
+        await asyncio.sleep(0.05)
+
+        prefetch = asyncio.ensure_future(scheduler.submit(lambda: order.append('prefetch'), RequestControl(), Priority.PREFETCH))
+        bulk = asyncio.ensure_future(scheduler.submit(lambda: order.append('bulk'), RequestControl(), Priority.BULK))
+        interactive = asyncio.ensure_future(scheduler.submit(lambda: order.append('interactive'), RequestControl(), Priority.INTERACTIVE))
+        await asyncio.sleep(0.05)
+        assert scheduler.queue_depth == 3
+
+        release.set()
+        await asyncio.gather(blocker, prefetch, bulk, interactive)
+        scheduler.shutdown()
+        return order
+
+    assert asyncio.run(run()) == ['interactive', 'bulk', 'prefetch']
+
+
+def test_clients_share_the_worker_fairly():
+    async def run():
+        scheduler = InferenceScheduler()
+        release = threading.Event()
+        order = []
+
+        blocker = asyncio.ensure_future(scheduler.submit(release.wait, RequestControl(client='script')))
+        await asyncio.sleep(0.05)
+
+        # A batch of one client queues ahead of another client's single request
+        jobs = [asyncio.ensure_future(scheduler.submit(lambda i=i: order.append(f'script{i}'), RequestControl(client='script'), Priority.BULK))
+                for i in range(3)]
+        jobs.append(asyncio.ensure_future(scheduler.submit(lambda: order.append('annotator'), RequestControl(client='annotator'), Priority.BULK)))
+        await asyncio.sleep(0.05)
+        assert scheduler.client_stats()['script'].queue_depth == 3
+
+        release.set()
+        await asyncio.gather(blocker, *jobs)
+        scheduler.shutdown()
+        return order, scheduler.client_stats()
+
+    order, stats = asyncio.run(run())
+    assert order == ['script0', 'annotator', 'script1', 'script2']
+    assert (stats['script'].started, stats['annotator'].started, stats['annotator'].queue_depth) == (4, 1, 0)
+    assert stats['annotator'].wait_seconds > 0
+
+
+def test_expired_and_cancelled_jobs_are_dropped():
+    async def run():
+        scheduler = InferenceScheduler()
+        release = threading.Event()
+        ran = []
+
+        blocker = asyncio.ensure_future(scheduler.submit(release.wait, RequestControl()))
+        await asyncio.sleep(0.05)
+
+        expiring = asyncio.ensure_future(scheduler.submit(lambda: ran.append('expired'),
+                                                          RequestControl(deadline=time.monotonic() + 0.01)))
+        abandoned = asyncio.ensure_future(scheduler.submit(lambda: ran.append('abandoned'), RequestControl()))
+        await asyncio.sleep(0.05)
+        abandoned.cancel()
+        await asyncio.sleep(0.01)
+
+        release.set()
+        await blocker
+        with pytest.raises(DeadlineExceeded):
+            await expiring
+        with pytest.raises(asyncio.CancelledError):
+            await abandoned
+
+        scheduler.shutdown()
+        return ran
+
+    assert asyncio.run(run()) == []
+
+
+def test_stats_count_completed_jobs():
+    async def run():
+        scheduler = InferenceScheduler(num_workers=2, name='postprocess')
+        await asyncio.gather(*(scheduler.submit(lambda: time.sleep(0.02), RequestControl()) for _ in range(4)))
+        with pytest.raises(ValueError):
+            await scheduler.submit(lambda: int('x'), RequestControl())
+        scheduler.shutdown()
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert (stats.name, stats.workers, stats.queue_depth, stats.running, stats.completed) == ('postprocess', 2, 0, 0, 5)
+    assert stats.busy_seconds >= 0.08
+    assert stats.wait_seconds >= 0
+
+
+def test_full_queue_rejects_jobs_of_its_client_and_priority_class():
+    async def run():
+        scheduler = InferenceScheduler(max_queue_depth=2)
+        release = threading.Event()
+
+        blocker = asyncio.ensure_future(scheduler.submit(release.wait, RequestControl(client='a')))
+        await asyncio.sleep(0.05)
+
+        queued = [asyncio.ensure_future(scheduler.submit(lambda: None, RequestControl(client='a'), Priority.BULK))
+                  for _ in range(2)]
+        await asyncio.sleep(0.01)
+        with pytest.raises(QueueFull) as rejected:
+            await scheduler.submit(lambda: None, RequestControl(client='a'), Priority.BULK)
+
+        # Other clients and priority classes have queues of their own, and work the server queues
+        # for itself is never rejected
+        other_client = asyncio.ensure_future(scheduler.submit(lambda: None, RequestControl(client='b'),
+                                                              Priority.BULK))
+        interactive = asyncio.ensure_future(scheduler.submit(lambda: None, RequestControl(client='a'),
+                                                             Priority.INTERACTIVE))
+        cleanup = scheduler.schedule(lambda: None, RequestControl(client='a'), Priority.BULK)
+        await asyncio.sleep(0.01)
+        stats = scheduler.stats()
+
+        release.set()
+        await asyncio.gather(blocker, other_client, interactive, *queued)
+        cleanup.result(timeout=1)
+        scheduler.shutdown()
+        return rejected.value, stats
+
+    error, stats = asyncio.run(run())
+    assert error.retry_after > 0
+    assert (stats.queue_depth, stats.max_queue_depth) == (5, 2)
+
+
+def test_traced_jobs_record_queue_and_stage_spans(tmp_path):
+    async def run():
+        tracer = Tracer(str(tmp_path / 'trace.json'), sample_rate=1.0)
+        scheduler = InferenceScheduler(name='preprocess', tracer=tracer)
+        trace = tracer.start_trace()
+        await scheduler.submit(lambda: time.sleep(0.01), RequestControl(trace=trace))
+        await scheduler.submit(lambda: None, RequestControl())
+        scheduler.shutdown()
+        tracer.close()
+        return trace
+
+    trace = asyncio.run(run())
+    spans = [event for event in read_trace(str(tmp_path / 'trace.json')) if event['ph'] == 'X']
+    assert [span['name'] for span in spans] == ['preprocess queue', 'preprocess']
+    assert all(span['args']['parent_id'] == trace.span_id for span in spans)
+    assert spans[1]['dur'] >= 10000
@@ -0,0 +1,256 @@
+import asyncio
+import socket
+import tempfile
+import threading
+
+import cv2
+import grpc
+import numpy as np
+import pytest
+
+from segmentation_grpc import (add_SegmentationServiceServicer_to_server, SegmentationServiceStub, Point, Box,
+                               SectionImage, StackPropagationRequest, EmbeddingRequest, SegmentationRequest,
+                               SegmentationStage, PrefetchRequest, PrefetchStatus)
+from segmentation_server.scheduling import RequestControl
+from segmentation_server.server import SegmentationServicer, remove_stale_socket
+
+
+def _section(section_number, width=96, height=64):
+    image_data = cv2.imencode('.png', np.full((height, width), 128, dtype=np.uint8))[1].tobytes()
+    return SectionImage(image_data=image_data, width=width, height=height, section_number=section_number)
+
+
+def _propagate(request: StackPropagationRequest, servicer: SegmentationServicer = None) -> grpc.aio.AioRpcError:
+    """Send a PropagateStack request to a stub backed server and return the error it fails with."""
+    async def run():
+        server = grpc.aio.server()
+        add_SegmentationServiceServicer_to_server(servicer or SegmentationServicer(backend='stub'), server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f'127.0.0.1:{port}') as channel:
+                with pytest.raises(grpc.aio.AioRpcError) as error:
+                    async for _ in SegmentationServiceStub(channel).PropagateStack(request):
+                        pass
+                return error.value
+        finally:
+            await server.stop(None)
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('request_fields', [
+    dict(),
+    dict(sections=[_section(1)], prompt_section_index=1, coordinates=[Point(x=10, y=10)], labels=[1]),
+    dict(sections=[_section(1), _section(2)], prompt_section_index=0),
+], ids=['no sections', 'bad prompt section', 'no prompts'])
+def test_propagate_stack_rejects_invalid_requests(request_fields):
+    error = _propagate(StackPropagationRequest(**request_fields))
+    assert error.code() == grpc.StatusCode.INVALID_ARGUMENT
+
+
+def test_propagate_stack_unsupported_by_backend():
+    error = _propagate(StackPropagationRequest(sections=[_section(1), _section(2)], prompt_section_index=0,
+                                               box=Box(x0=10, y0=10, x1=40, y1=40)))
+    assert error.code() == grpc.StatusCode.UNIMPLEMENTED
+
+
+def test_propagate_stack_cleans_up_after_scheduler_shutdown(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    servicer = SegmentationServicer(backend='stub')
+    servicer.scheduler.shutdown()
+
+    error = _propagate(StackPropagationRequest(sections=[_section(1)], prompt_section_index=0,
+                                               coordinates=[Point(x=10, y=10)], labels=[1]), servicer)
+    assert error.code() == grpc.StatusCode.INTERNAL
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_remove_stale_socket_refuses_other_files(tmp_path):
+    path = tmp_path / 'segmentation.sock'
+    path.write_text('not a socket')
+    with pytest.raises(ValueError):
+        remove_stale_socket(str(path))
+    assert path.exists()
+
+    path.unlink()
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.bind(str(path))
+    remove_stale_socket(str(path))
+    assert not path.exists()
+
+
+def test_get_image_embedding_of_evicted_image_is_not_found():
+    servicer = SegmentationServicer(backend='stub')
+    image_data = _section(1).image_data
+    servicer.model.prefetch_image(image_data, image_key='tile-7')
+
+    # Evict the embedding after the handler checked for it, before the image is prepared
+    prepare_image = servicer.model.prepare_image
+
+    def evict_and_prepare(*args, **kwargs):
+        for i in range(servicer.model.embedding_cache.max_entries):
+            servicer.model.embedding_cache.put(f'other-{i}', object())
+        return prepare_image(*args, **kwargs)
+
+    servicer.model.prepare_image = evict_and_prepare
+
+    async def run():
+        server = grpc.aio.server()
+        add_SegmentationServiceServicer_to_server(servicer, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f'127.0.0.1:{port}') as channel:
+                with pytest.raises(grpc.aio.AioRpcError) as error:
+                    await SegmentationServiceStub(channel).GetImageEmbedding(EmbeddingRequest(image_key='tile-7'))
+                return error.value
+        finally:
+            await server.stop(None)
+
+    assert asyncio.run(run()).code() == grpc.StatusCode.NOT_FOUND
+
+
+def test_segment_image_progressive_streams_stages_in_order():
+    section = _section(1)
+    request = SegmentationRequest(image_data=section.image_data, width=section.width, height=section.height,
+                                  coordinates=[Point(x=48, y=32)], labels=[1], multimask_output=True)
+
+    # Occupy the only post-processing worker, the preview must not wait for it
+    servicer = SegmentationServicer(backend='stub', postprocess_workers=1)
+    release = threading.Event()
+    blocker = servicer.postprocess.schedule(release.wait, RequestControl(client='other'))
+
+    async def run():
+        server = grpc.aio.server()
+        add_SegmentationServiceServicer_to_server(servicer, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f'127.0.0.1:{port}') as channel:
+                call = SegmentationServiceStub(channel).SegmentImageProgressive(request)
+                updates = [await asyncio.wait_for(call.read(), timeout=10)]
+                release.set()
+                while (update := await call.read()) is not grpc.aio.EOF:
+                    updates.append(update)
+                return updates
+        finally:
+            release.set()
+            await server.stop(None)
+
+    preview, refined, complete = asyncio.run(run())
+    blocker.result(timeout=1)
+    servicer.scheduler.shutdown()
+
+    assert [update.stage for update in (preview, refined, complete)] == [
+        SegmentationStage.STAGE_PREVIEW, SegmentationStage.STAGE_POLYGONS, SegmentationStage.STAGE_COMPLETE]
+    assert all((update.width, update.height) == (section.width, section.height)
+               for update in (preview, refined, complete))
+
+    [best] = preview.segments
+    assert best.index == 1 and best.score > 0
+    assert best.polygons and not best.mask
+
+    [best] = refined.segments
+    assert best.index == 1 and best.polygons and not best.mask
+
+    assert complete.labeled_image
+    assert [segment.index for segment in complete.segments] == [1, 2, 3]
+    assert all(segment.mask for segment in complete.segments)
+    assert not complete.segments[0].polygons
+    assert all(segment.polygons for segment in complete.segments[1:])
+
+
+def test_only_preprocessing_is_bounded():
+    servicer = SegmentationServicer(backend='stub', max_queue_depth=4)
+    assert [stage.max_queue_depth for stage in servicer.stage_stats()] == [4, 0, 0]
+
+
+def test_prefetch_image_decodes_on_the_preprocessing_pool():
+    servicer = SegmentationServicer(backend='stub')
+    threads = []
+    prepare_image = servicer.model.prepare_image
+
+    def record_thread(*args, **kwargs):
+        threads.append(threading.current_thread().name)
+        return prepare_image(*args, **kwargs)
+
+    servicer.model.prepare_image = record_thread
+    encoded = threading.Event()
+    encode_image = servicer.model.backend.encode_image
+
+    def encode_and_signal(*args, **kwargs):
+        try:
+            return encode_image(*args, **kwargs)
+        finally:
+            encoded.set()
+
+    servicer.model.backend.encode_image = encode_and_signal
+
+    async def run():
+        server = grpc.aio.server()
+        add_SegmentationServiceServicer_to_server(servicer, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f'127.0.0.1:{port}') as channel:
+                return await SegmentationServiceStub(channel).PrefetchImage(
+                    PrefetchRequest(image_data=_section(1).image_data, image_key='tile-7'))
+        finally:
+            await server.stop(None)
+
+    assert asyncio.run(run()).status == PrefetchStatus.PREFETCH_SCHEDULED
+    assert encoded.wait(timeout=10)
+    assert threads[0].startswith('preprocess')
+    assert all(not name.startswith('preprocess') for name in threads[1:])
+    servicer.scheduler.shutdown()
+    servicer.preprocess.shutdown()
+
+
+def test_superseded_segment_image_is_cancelled_and_releases_its_key():
+    section = _section(1)
+
+    def request():
+        return SegmentationRequest(image_data=section.image_data, width=section.width, height=section.height,
+                                   coordinates=[Point(x=48, y=32)], labels=[1], supersede_key='cell-7')
+
+    # Hold the model so the first request is still queued when the second arrives
+    servicer = SegmentationServicer(backend='stub')
+    release = threading.Event()
+    blocker = servicer.scheduler.schedule(release.wait, RequestControl(client='other'))
+
+    async def wait_for(condition):
+        for _ in range(500):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        raise TimeoutError("The server did not get there in time")
+
+    async def run():
+        server = grpc.aio.server()
+        add_SegmentationServiceServicer_to_server(servicer, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f'127.0.0.1:{port}') as channel:
+                stub = SegmentationServiceStub(channel)
+                first = asyncio.ensure_future(stub.SegmentImage(request()))
+                await wait_for(lambda: servicer.scheduler.queue_depth == 1)
+                second = asyncio.ensure_future(stub.SegmentImage(request()))
+                await wait_for(lambda: servicer.supersede_keys.superseded == 1)
+                release.set()
+
+                with pytest.raises(grpc.aio.AioRpcError) as superseded:
+                    await first
+                return superseded.value, await second
+        finally:
+            release.set()
+            await server.stop(None)
+
+    error, response = asyncio.run(run())
+    blocker.result(timeout=1)
+    servicer.scheduler.shutdown()
+
+    assert error.code() == grpc.StatusCode.CANCELLED
+    assert [segment.index for segment in response.segments] == [1]
+    assert len(servicer.supersede_keys) == 0